@@ -0,0 +1,364 @@
+# -*- coding: utf-8 -*-
+'''
+    saltcloud_buildbot.admission
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Admission control for salt-cloud VM creation.
+
+    All latent slaves share one controller which caps the number of VM
+    creates in flight, rate limits them per cloud provider with a token
+    bucket and admits the waiting creates by priority, so the important
+    builders get their VMs first. The creates in flight and waiting, and
+    the time waited to be admitted, are exported with the substantiation
+    metrics, see :mod:`saltcloud_buildbot.metrics`.
+
+    Per provider limits can be set in ``cloud.providers`` using the
+    ``buildbot_create_rate``, creates per second, and
+    ``buildbot_create_burst`` settings::
+
+        my-ec2:
+          provider: ec2
+          buildbot_create_rate: 0.5
+          buildbot_create_burst: 5
+
+    :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
+    :license: Apache 2.0, see LICENSE for more details.
+'''
+
+# Import python libs
+import heapq
+import logging
+import itertools
+
+# Import twisted libs
+from twisted.internet import defer, reactor
+
+# Import saltcloud_buildbot libs
+from saltcloud_buildbot import metrics, workers
+
+
+log = logging.getLogger(__name__)
+
+
+# Priorities used for creates nobody is waiting on
+BACKGROUND_PRIORITY = -100
+
+
+def provider_alias(config, profile_name):
+    '''
+    Return the provider alias used by the ``profile_name`` profile.
+    '''
+    profile = config['profiles'].get(profile_name, {})
+    provider = profile.get('provider', None) or 'default'
+    return provider.split(':', 1)[0]
+
+
+def provider_limits(config, alias):
+    '''
+    Return the ``(rate, burst)`` settings of the ``alias`` provider in
+    ``cloud.providers``, ``None`` for those not set.
+    '''
+    entries = config.get('providers', {}).get(alias, None)
+    if isinstance(entries, dict):
+        if 'buildbot_create_rate' not in entries and \
+                'buildbot_create_burst' not in entries:
+            # Newer salt-cloud, {alias: {driver: {...}}}
+            entries = entries.values()
+        else:
+            entries = [entries]
+    for entry in entries or []:
+        if not isinstance(entry, dict):
+            continue
+        rate = entry.get('buildbot_create_rate', None)
+        burst = entry.get('buildbot_create_burst', None)
+        if rate is not None or burst is not None:
+            return rate, burst
+    return None, None
+
+
+class TokenBucket(object):
+    '''
+    Allow ``rate`` operations per second with bursts of up to ``burst``.
+    A ``rate`` of ``None`` means no limit.
+    '''
+
+    def __init__(self, rate=None, burst=1, clock=None):
+        self.clock = clock or reactor
+        self.rate = rate
+        self.burst = max(burst or 1, 1)
+        self.tokens = float(self.burst)
+        self.updated = self.clock.seconds()
+
+    def configure(self, rate, burst):
+        self.rate = rate
+        self.burst = max(burst or 1, 1)
+        self.tokens = min(self.tokens, self.burst)
+
+    def _refill(self):
+        now = self.clock.seconds()
+        if self.rate:
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated) * self.rate
+            )
+        self.updated = now
+
+    def delay(self):
+        '''
+        Return how many seconds until a token is available, 0 if one is.
+        '''
+        if not self.rate:
+            return 0
+        self._refill()
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self):
+        if not self.rate:
+            return
+        self._refill()
+        self.tokens -= 1
+
+
+class _Request(object):
+    def __init__(self, provider, priority, enqueued, description):
+        self.provider = provider
+        self.priority = priority
+        self.enqueued = enqueued
+        self.description = description
+        self.deferred = defer.Deferred()
+
+
+class AdmissionController(object):
+    '''
+    Admit VM creates by priority, respecting the ``max_in_flight`` cap and
+    the per provider token buckets.
+
+    :param max_in_flight: the maximum number of creates running at once,
+                          ``None`` for no limit
+    :param default_rate: the creates per second allowed for providers
+                         without their own limits, ``None`` for no limit
+    :param default_burst: the burst size for providers without their own
+                          limits
+    '''
+
+    def __init__(self, max_in_flight=20, default_rate=None, default_burst=5,
+                 clock=None):
+        self.clock = clock or reactor
+        self.max_in_flight = max_in_flight
+        self.default_rate = default_rate
+        self.default_burst = default_burst
+        self.in_flight = 0
+        self._buckets = {}
+        # The providers without their own limits, following the defaults
+        self._defaulted = set()
+        self._queue = []
+        self._counter = itertools.count()
+        self._wakeup = None
+        # Wait time accounting, exposed by stats()
+        self._admitted = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+
+    def configure(self, max_in_flight=None, default_rate=None,
+                  default_burst=None):
+        '''
+        Update the settings, ``None`` values are left untouched. The
+        providers without their own limits follow the new defaults.
+        '''
+        if max_in_flight is not None:
+            self.max_in_flight = max_in_flight
+        if default_rate is not None:
+            self.default_rate = default_rate
+        if default_burst is not None:
+            self.default_burst = default_burst
+        for alias in self._defaulted:
+            self._buckets[alias].configure(
+                self.default_rate, self.default_burst
+            )
+        self._pump()
+
+    def configure_provider(self, alias, rate=None, burst=None):
+        '''
+        Set the ``alias`` provider's limits, it follows the default ones if
+        neither ``rate`` nor ``burst`` is set.
+        '''
+        if rate is None and burst is None:
+            rate, burst = self.default_rate, self.default_burst
+            self._defaulted.add(alias)
+        else:
+            self._defaulted.discard(alias)
+        bucket = self._buckets.get(alias, None)
+        if bucket is None:
+            self._buckets[alias] = TokenBucket(rate, burst, self.clock)
+        else:
+            bucket.configure(rate, burst)
+
+    def _bucket(self, alias):
+        if alias not in self._buckets:
+            self.configure_provider(alias)
+        return self._buckets[alias]
+
+    def acquire(self, provider, priority=0, description=None):
+        '''
+        Return a deferred firing once a create on ``provider`` is admitted.
+        Higher ``priority`` values are admitted first. :meth:`release` must
+        be called once the create finishes.
+        '''
+        request = _Request(
+            provider, priority, self.clock.seconds(), description
+        )
+        heapq.heappush(
+            self._queue, (-priority, next(self._counter), request)
+        )
+        self._pump()
+        if not request.deferred.called:
+            log.info(
+                'VM create {0} queued, {1} waiting, {2} in flight'.format(
+                    description or '', len(self._queue), self.in_flight
+                )
+            )
+        return request.deferred
+
+    def release(self):
+        self.in_flight -= 1
+        self._pump()
+
+    def _pump(self):
+        if self._wakeup is not None and self._wakeup.active():
+            self._wakeup.cancel()
+        self._wakeup = None
+
+        next_wakeup = None
+        skipped = []
+        admitted = []
+        while self._queue:
+            if self.max_in_flight is not None and \
+                    self.in_flight >= self.max_in_flight:
+                break
+            entry = heapq.heappop(self._queue)
+            request = entry[2]
+            bucket = self._bucket(request.provider)
+            delay = bucket.delay()
+            if delay > 0:
+                # This provider is rate limited, let other providers'
+                # requests through meanwhile
+                skipped.append(entry)
+                if next_wakeup is None or delay < next_wakeup:
+                    next_wakeup = delay
+                continue
+            bucket.consume()
+            self.in_flight += 1
+            waited = self.clock.seconds() - request.enqueued
+            self._admitted += 1
+            self._total_wait += waited
+            self._max_wait = max(self._max_wait, waited)
+            admitted.append((request, waited))
+
+        for entry in skipped:
+            heapq.heappush(self._queue, entry)
+
+        if next_wakeup is not None:
+            self._wakeup = self.clock.callLater(next_wakeup, self._pump)
+
+        self._export()
+
+        # Fire the admitted requests only once the queue is consistent again
+        for request, waited in admitted:
+            request.deferred.callback(waited)
+
+    def _export(self):
+        # Publish the in flight and queued creates as metrics gauges
+        registry = metrics.get_registry()
+        registry.set_gauge('admission_in_flight', self.in_flight)
+        queued = dict.fromkeys(self._buckets, 0)
+        for _, _, request in self._queue:
+            queued[request.provider] = queued.get(request.provider, 0) + 1
+        for provider, count in queued.items():
+            registry.set_gauge('admission_queued', count, provider=provider)
+
+    def stats(self):
+        '''
+        Return the queue depth, overall and per provider, the creates in
+        flight and the wait times of the admitted creates.
+        '''
+        per_provider = {}
+        for _, _, request in self._queue:
+            per_provider[request.provider] = (
+                per_provider.get(request.provider, 0) + 1
+            )
+        return {
+            'queued': len(self._queue),
+            'queued_per_provider': per_provider,
+            'in_flight': self.in_flight,
+            'max_in_flight': self.max_in_flight,
+            'admitted': self._admitted,
+            'average_wait': (
+                self._total_wait / self._admitted if self._admitted else 0.0
+            ),
+            'max_wait': self._max_wait
+        }
+
+
+_CONTROLLER = None
+
+
+def get_controller():
+    '''
+    Return the process wide admission controller.
+    '''
+    global _CONTROLLER
+    if _CONTROLLER is None:
+        _CONTROLLER = AdmissionController()
+    return _CONTROLLER
+
+
+def configure(max_in_flight=None, default_rate=None, default_burst=None):
+    '''
+    Update the process wide admission controller settings, ``None`` values
+    are left untouched.
+    '''
+    get_controller().configure(max_in_flight, default_rate, default_burst)
+
+
+def stats():
+    return get_controller().stats()
+
+
+@defer.inlineCallbacks
+def create_admitted(config, profile_name, vm_name, create, *args, **kwargs):
+    '''
+    Wait for the ``profile_name`` provider to admit the create of
+    ``vm_name`` and then call ``create(*args, **kwargs)`` in a thread.
+
+    The ``priority`` keyword argument sets the admission priority. With
+    ``in_thread=False``, ``create`` is called in the reactor thread and may
+    return a deferred.
+    '''
+    priority = kwargs.pop('priority', 0)
+    in_thread = kwargs.pop('in_thread', True)
+    controller = get_controller()
+    alias = provider_alias(config, profile_name)
+    # Follow changes to cloud.providers, back to the default limits if
+    # removed
+    controller.configure_provider(alias, *provider_limits(config, alias))
+
+    waited = yield controller.acquire(alias, priority, vm_name)
+    metrics.get_registry().observe(
+        metrics.ADMISSION_WAIT, waited, profile_name,
+        kwargs.get('slavename', None)
+    )
+    if waited:
+        log.info(
+            'VM create {0} on {1!r} admitted after waiting {2:.1f} '
+            'seconds'.format(vm_name, alias, waited)
+        )
+    try:
+        if in_thread:
+            ret = yield workers.defer_to_thread(create, *args, **kwargs)
+        else:
+            ret = yield defer.maybeDeferred(create, *args, **kwargs)
+        defer.returnValue(ret)
+    finally:
+        controller.release()
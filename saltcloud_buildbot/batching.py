@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+'''
+    saltcloud_buildbot.batching
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Coalesce the VM creates requested within a short window into a single
+    salt-cloud map run with parallel deploys, so that a burst of
+    substantiations pays for provider authentication, listing and deploy
+    set up once.
+
+    :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
+    :license: Apache 2.0, see LICENSE for more details.
+'''
+
+# Import python libs
+import logging
+
+# Import twisted libs
+from twisted.internet import defer, reactor
+
+# Import buildbot libs
+from buildbot.interfaces import LatentBuildSlaveFailedToSubstantiate
+
+# Import saltcloud_buildbot libs
+from saltcloud_buildbot import formatting, provision, workers
+
+
+log = logging.getLogger(__name__)
+
+
+class _Create(object):
+    def __init__(self, config, profile_name, vm_name, minion_conf,
+                 slavename, overrides):
+        self.config = config
+        self.profile_name = profile_name
+        self.vm_name = vm_name
+        self.minion_conf = minion_conf
+        self.slavename = slavename
+        self.overrides = overrides
+        self.deferred = defer.Deferred()
+
+
+def run_map(config, creates):
+    '''
+    Create all the VMs of ``creates`` in a single, parallel, salt-cloud map
+    run. Returns the salt-cloud return keyed by VM name.
+    '''
+    config = config.copy()
+    config['parallel'] = True
+    dmap = {'create': {}, 'destroy': {}}
+    for create in creates:
+        vm_ = provision.get_profile(config, create.profile_name).copy()
+        vm_.update(create.overrides or {})
+        vm_['name'] = create.vm_name
+        vm_['profile'] = create.profile_name
+        vm_['minion'] = create.minion_conf
+        dmap['create'][create.vm_name] = vm_
+
+    import saltcloud.cloud
+    mapper = saltcloud.cloud.Map(config)
+    ret = mapper.run_map(dmap)
+    formatter = formatting.get_formatter()
+    for vm_name in dmap['create']:
+        formatter.store(
+            vm_name, 'create', provision.find_vm_return(ret, vm_name)
+        )
+    log.info(
+        'salt-cloud started VM(s) %s. Details:\n%s',
+        ', '.join(sorted(dmap['create'])),
+        formatter.lazy(ret, 'pprint', config)
+    )
+    return ret
+
+
+class CreateBatcher(object):
+    '''
+    Collect VM creates for ``window`` seconds, or until ``max_size`` are
+    collected, and run them as a single salt-cloud map.
+
+    Creates are only batched with others using the same, shared,
+    salt-cloud configuration.
+    '''
+
+    def __init__(self, window=2, max_size=20, clock=None):
+        self.window = window
+        self.max_size = max_size
+        self.clock = clock or reactor
+        # Pending batches keyed by configuration identity
+        self._pending = {}
+        self._timers = {}
+
+    def submit(self, config, profile_name, vm_name, minion_conf,
+               slavename=None, overrides=None):
+        '''
+        Queue the create of ``vm_name``. Returns a deferred firing with its
+        salt-cloud return, shaped like ``Map.run_profile()``'s, once the
+        batch it's part of finishes.
+        '''
+        create = _Create(
+            config, profile_name, vm_name, minion_conf, slavename, overrides
+        )
+        key = id(config)
+        batch = self._pending.setdefault(key, [])
+        batch.append(create)
+        if len(batch) >= self.max_size:
+            self._flush(key)
+        elif key not in self._timers:
+            self._timers[key] = self.clock.callLater(
+                self.window, self._flush, key
+            )
+        return create.deferred
+
+    def _flush(self, key):
+        timer = self._timers.pop(key, None)
+        if timer is not None and timer.active():
+            timer.cancel()
+        creates = self._pending.pop(key, [])
+        if not creates:
+            return
+
+        log.info(
+            'Creating {0} VM(s) in a single salt-cloud map run: {1}'.format(
+                len(creates), ', '.join(c.vm_name for c in creates)
+            )
+        )
+        d = workers.defer_to_thread(run_map, creates[0].config, creates)
+        d.addCallbacks(
+            self._fan_out, self._fail_all,
+            callbackArgs=(creates,), errbackArgs=(creates,)
+        )
+
+    def _fan_out(self, ret, creates):
+        for create in creates:
+            node_ret = provision.find_vm_return(ret, create.vm_name)
+            vm_ret = {create.vm_name: node_ret} if node_ret else {}
+            try:
+                provision.check_create_return(
+                    vm_ret, create.vm_name, create.slavename
+                )
+            except LatentBuildSlaveFailedToSubstantiate:
+                create.deferred.errback()
+                continue
+            create.deferred.callback(vm_ret)
+
+    def _fail_all(self, failure, creates):
+        for create in creates:
+            msg = (
+                'salt-cloud failed to start VM {0} for slave {1}. '
+                'Details:\n{2}'.format(
+                    create.vm_name,
+                    create.slavename,
+                    failure.getErrorMessage()
+                )
+            )
+            log.error(msg)
+            create.deferred.errback(
+                LatentBuildSlaveFailedToSubstantiate(create.vm_name, msg)
+            )
+
+
+_BATCHER = None
+
+
+def get_batcher(window=None, max_size=None):
+    '''
+    Return the process wide create batcher, updating its settings with the
+    ones not ``None``.
+    '''
+    global _BATCHER
+    if _BATCHER is None:
+        _BATCHER = CreateBatcher()
+    if window is not None:
+        _BATCHER.window = window
+    if max_size is not None:
+        _BATCHER.max_size = max_size
+    return _BATCHER
@@ -0,0 +1,670 @@
+# -*- coding: utf-8 -*-
+'''
+    saltcloud_buildbot.benchmark
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Substantiation throughput and latency benchmark.
+
+    Drives many :class:`~saltcloud_buildbot.slave.SaltCloudLatentBuildSlave`
+    ``start_instance``/``stop_instance`` cycles against in-process
+    stand-ins for salt-cloud's ``Map`` and salt's ``LocalClient``, with
+    configurable latencies and failure rates, so the provisioning path can
+    be measured without a cloud provider or a salt master::
+
+        python -m saltcloud_buildbot.benchmark --slaves 50 \\
+            --create-latency 2 --highstate-latency 5 --failure-rate 0.02
+
+    The report includes the time-to-ready and destroy percentiles, the
+    thread pool occupancy and the peak memory usage.
+
+    With ``--import-time``, it instead measures, in fresh interpreters, how
+    long importing the slave takes and fails if that imports salt or
+    salt-cloud, which must only be imported once a slave substantiates::
+
+        python -m saltcloud_buildbot.benchmark --import-time \\
+            --max-import-time 0.5
+
+    :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
+    :license: Apache 2.0, see LICENSE for more details.
+'''
+
+# Import python libs
+import os
+import sys
+import json
+import time
+import random
+import logging
+import optparse
+import tempfile
+import itertools
+import threading
+import subprocess
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+# Import twisted libs
+from twisted.internet import defer, reactor, task
+
+# Import saltcloud_buildbot libs
+import saltcloud_buildbot.config
+import saltcloud_buildbot.provision
+import saltcloud_buildbot.workers
+import saltcloud_buildbot.admission
+from saltcloud_buildbot.history import percentile
+from saltcloud_buildbot.slave import SaltCloudLatentBuildSlave
+
+
+log = logging.getLogger(__name__)
+
+
+PROFILE_NAME = 'benchmark'
+
+# The packages the slave must not import until it substantiates
+HEAVY_PACKAGES = ('salt', 'saltcloud')
+
+IMPORT_TIME_SCRIPT = '''\
+import sys
+import json
+import time
+start = time.time()
+import {0}
+seconds = time.time() - start
+print(json.dumps({{
+    'seconds': seconds,
+    'heavy_modules': sorted(
+        name for name, module in sys.modules.items()
+        if module is not None and name.split('.')[0] in {1!r}
+    )
+}}))
+'''
+
+
+def _latency(mean, jitter):
+    '''
+    Return ``mean`` seconds, give or take ``jitter`` (a fraction of the
+    mean).
+    '''
+    if not mean:
+        return 0
+    return max(mean * (1 + jitter * (random.random() * 2 - 1)), 0)
+
+
+def _sleep(mean, jitter):
+    delay = _latency(mean, jitter)
+    if delay:
+        time.sleep(delay)
+
+
+class FakeCloud(object):
+    '''
+    A salt-cloud stand-in. Its :meth:`map` method replaces
+    ``saltcloud.cloud.Map``.
+    '''
+
+    def __init__(self, create_latency=1, destroy_latency=0.5,
+                 create_failure_rate=0, destroy_failure_rate=0, jitter=0.3):
+        self.create_latency = create_latency
+        self.destroy_latency = destroy_latency
+        self.create_failure_rate = create_failure_rate
+        self.destroy_failure_rate = destroy_failure_rate
+        self.jitter = jitter
+        # VM name to the time it was created
+        self.live = {}
+        self.lock = threading.Lock()
+
+    def map(self, opts):
+        return _FakeMap(self, opts)
+
+    def create(self, names):
+        _sleep(self.create_latency, self.jitter)
+        ret = {}
+        for name in names:
+            if random.random() < self.create_failure_rate:
+                ret[name] = {'Errors': 'Simulated create failure'}
+                continue
+            with self.lock:
+                self.live[name] = time.time()
+            ret[name] = {'id': name, 'state': 'running'}
+        return ret
+
+    def destroy(self, names):
+        _sleep(self.destroy_latency, self.jitter)
+        ret = {}
+        for name in names:
+            if random.random() < self.destroy_failure_rate:
+                ret[name] = {'Error': 'Simulated destroy failure'}
+                continue
+            with self.lock:
+                self.live.pop(name, None)
+            ret[name] = True
+        return ret
+
+    def created(self, name):
+        with self.lock:
+            return self.live.get(name, None)
+
+
+class _FakeMap(object):
+    def __init__(self, cloud, opts):
+        self.cloud = cloud
+        self.opts = opts
+
+    def run_profile(self, profile, names):
+        return self.cloud.create(names)
+
+    def run_map(self, dmap):
+        return self.cloud.create(list(dmap['create']))
+
+    def destroy(self, names):
+        return self.cloud.destroy(names)
+
+
+class FakeMaster(object):
+    '''
+    A salt master stand-in. Its :meth:`local_client` method replaces
+    ``saltcloud_buildbot.provision.get_local_client``.
+
+    :param boot_latency: the seconds a minion takes to answer after its VM
+                         is created
+    :param command_latency: the latency of each ``LocalClient`` call
+    :param highstate_latency: the seconds a state run takes
+    :param failure_rate: the fraction of state runs which fail
+    '''
+
+    def __init__(self, cloud, boot_latency=2, command_latency=0.05,
+                 highstate_latency=5, failure_rate=0, jitter=0.3):
+        self.cloud = cloud
+        self.boot_latency = boot_latency
+        self.command_latency = command_latency
+        self.highstate_latency = highstate_latency
+        self.failure_rate = failure_rate
+        self.jitter = jitter
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self._jids = itertools.count(1)
+        self._boot = {}
+
+    def local_client(self, master_config):
+        return _FakeLocalClient(self)
+
+    def responding(self, name):
+        created = self.cloud.created(name)
+        if created is None:
+            return False
+        with self.lock:
+            if name not in self._boot:
+                self._boot[name] = _latency(self.boot_latency, self.jitter)
+            return time.time() - created >= self._boot[name]
+
+    def publish(self, name, fun):
+        jid = '{0:020d}'.format(next(self._jids))
+        with self.lock:
+            self.jobs[jid] = {
+                'minion': name,
+                'fun': fun,
+                'finishes': time.time() + _latency(
+                    self.highstate_latency, self.jitter
+                ),
+                'result': random.random() >= self.failure_rate
+            }
+        return jid
+
+    def job(self, jid):
+        with self.lock:
+            return self.jobs.get(jid, None)
+
+
+class _FakeLocalClient(object):
+    def __init__(self, master):
+        self.master = master
+        # No pki_dir, the key acceptance is not probed
+        self.opts = {'sock_dir': tempfile.gettempdir(), 'pki_dir': None}
+
+    def cmd(self, tgt, fun, arg=(), timeout=None, expr_form='glob', **kwargs):
+        _sleep(self.master.command_latency, self.master.jitter)
+        ret = {}
+        for name in tgt:
+            if not self.master.responding(name):
+                continue
+            if fun == 'saltutil.running':
+                ret[name] = [
+                    {'jid': jid, 'fun': job['fun']}
+                    for jid, job in self.master.jobs.items()
+                    if job['minion'] == name and
+                    job['finishes'] > time.time()
+                ]
+            else:
+                ret[name] = True
+        return ret
+
+    def cmd_async(self, tgt, fun, arg=(), expr_form='glob', **kwargs):
+        _sleep(self.master.command_latency, self.master.jitter)
+        if not self.master.responding(tgt[0]):
+            return 0
+        return self.master.publish(tgt[0], fun)
+
+    def get_full_returns(self, jid, minions, timeout=None):
+        _sleep(self.master.command_latency, self.master.jitter)
+        job = self.master.job(jid)
+        if job is None or job['finishes'] > time.time():
+            return {}
+        return {
+            job['minion']: {
+                'ret': {
+                    'benchmark_|-benchmark_|-benchmark_|-run': {
+                        'name': 'benchmark',
+                        'result': job['result'],
+                        'comment': '',
+                        'changes': {}
+                    }
+                },
+                'retcode': 0 if job['result'] else 2
+            }
+        }
+
+
+class _FakeBotMaster(object):
+    def maybeStartBuildsForSlave(self, name):
+        pass
+
+
+def benchmark_config(log_file):
+    '''
+    Return the salt-cloud configuration used by the benchmark slaves.
+    '''
+    return {
+        'profiles': {
+            PROFILE_NAME: {
+                'provider': 'benchmark',
+                'profile': PROFILE_NAME,
+                'minion': {'master': '127.0.0.1'}
+            }
+        },
+        'providers': {'benchmark': {'provider': 'benchmark'}},
+        'minion': {},
+        'log_level': 'warning',
+        'log_level_logfile': 'warning',
+        'log_granular_levels': {},
+        'cli_salt_cloud_log_file': log_file,
+        'output': 'pprint',
+        'color': False
+    }
+
+
+def summarize(values):
+    return {
+        'count': len(values),
+        'p50': percentile(values, 0.50),
+        'p95': percentile(values, 0.95),
+        'p99': percentile(values, 0.99),
+        'max': max(values) if values else None
+    }
+
+
+def peak_memory():
+    '''
+    Return the process peak resident memory, in KiB.
+    '''
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # Reported in bytes
+        maxrss /= 1024
+    return maxrss
+
+
+class Benchmark(object):
+    '''
+    Run ``slaves`` concurrent substantiations, and then shut them all
+    down, against ``cloud`` and ``master``. ``slave_kwargs`` are passed to
+    every :class:`~saltcloud_buildbot.slave.SaltCloudLatentBuildSlave`.
+    '''
+
+    # Thread pool occupancy sampling interval, in seconds
+    sample_interval = 0.1
+
+    def __init__(self, cloud, master, slaves=10, slave_kwargs=None):
+        self.cloud = cloud
+        self.master = master
+        self.slaves = slaves
+        self.slave_kwargs = {
+            'saltcloud_highstate_completion': 'poll',
+            'saltcloud_probe_min_interval': 0.1,
+            'saltcloud_probe_max_interval': 1,
+            # Time the destroys too
+            'saltcloud_wait_for_destroy': True
+        }
+        self.slave_kwargs.update(slave_kwargs or {})
+        self.ready = []
+        self.destroyed = []
+        self.failures = []
+        self.samples = []
+
+    def _sample(self):
+        self.samples.append(saltcloud_buildbot.workers.stats())
+
+    def _patch(self, config):
+        # Imported here, measuring the import time doesn't need salt-cloud
+        import saltcloud.cloud
+        patches = [
+            (saltcloud.cloud, 'Map', self.cloud.map),
+            (saltcloud_buildbot.provision, 'get_local_client',
+             self.master.local_client),
+            (saltcloud_buildbot.config, 'load_cloud_config',
+             lambda *args, **kwargs: config)
+        ]
+        originals = []
+        for module, name, value in patches:
+            originals.append((module, name, getattr(module, name)))
+            setattr(module, name, value)
+        return originals
+
+    def _unpatch(self, originals):
+        for module, name, value in originals:
+            setattr(module, name, value)
+
+    @defer.inlineCallbacks
+    def _cycle(self, slave):
+        started = time.time()
+        try:
+            yield slave.start_instance(None)
+        except Exception as err:
+            self.failures.append((slave.slavename, 'start', str(err)))
+            # The slave tears down the failed VM, wait for it
+            yield slave.stop_instance().addErrback(lambda failure: None)
+            defer.returnValue(None)
+        self.ready.append(time.time() - started)
+
+        started = time.time()
+        try:
+            yield slave.stop_instance()
+        except Exception as err:
+            self.failures.append((slave.slavename, 'stop', str(err)))
+            defer.returnValue(None)
+        self.destroyed.append(time.time() - started)
+
+    @defer.inlineCallbacks
+    def run(self):
+        '''
+        Run the benchmark, returns a deferred firing with the report.
+        '''
+        log_file = tempfile.NamedTemporaryFile(
+            prefix='saltcloud-buildbot-benchmark-', suffix='.log'
+        )
+        originals = self._patch(benchmark_config(log_file.name))
+        sampler = task.LoopingCall(self._sample)
+        sampler.start(self.sample_interval)
+        started = time.time()
+        try:
+            slaves = []
+            for idx in range(self.slaves):
+                slave = SaltCloudLatentBuildSlave(
+                    'benchmark-{0}'.format(idx), 'benchmark', PROFILE_NAME,
+                    **self.slave_kwargs
+                )
+                slave.botmaster = _FakeBotMaster()
+                slaves.append(slave)
+            yield defer.DeferredList(map(self._cycle, slaves))
+        finally:
+            sampler.stop()
+            self._unpatch(originals)
+            log_file.close()
+        defer.returnValue(self.report(time.time() - started))
+
+    def report(self, duration):
+        busy = [sample['busy'] for sample in self.samples]
+        queued = [sample['queued'] for sample in self.samples]
+        return {
+            'slaves': self.slaves,
+            'duration': duration,
+            'time_to_ready': summarize(self.ready),
+            'time_to_destroy': summarize(self.destroyed),
+            'failures': len(self.failures),
+            'thread_pool': {
+                'size': saltcloud_buildbot.workers.stats()['size'],
+                'max_busy': max(busy) if busy else 0,
+                'mean_busy': float(sum(busy)) / len(busy) if busy else 0,
+                'max_queued': max(queued) if queued else 0
+            },
+            'admission': saltcloud_buildbot.admission.stats(),
+            'leaked_vms': sorted(self.cloud.live),
+            'peak_memory_kib': peak_memory()
+        }
+
+
+def import_time(module='saltcloud_buildbot.slave', runs=5):
+    '''
+    Import ``module`` in ``runs`` fresh interpreters, returning the import
+    time percentiles and the salt and salt-cloud modules it imported.
+    '''
+    script = IMPORT_TIME_SCRIPT.format(module, HEAVY_PACKAGES)
+    samples = []
+    heavy_modules = set()
+    for _ in range(runs):
+        process = subprocess.Popen(
+            [sys.executable, '-c', script],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            # Import from where this interpreter does, whatever the cwd
+            env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        )
+        out, err = process.communicate()
+        if process.returncode != 0:
+            raise RuntimeError(
+                'Failed to import {0}: {1}'.format(module, err.strip())
+            )
+        # The last line, the module might print on import
+        sample = json.loads(out.strip().splitlines()[-1])
+        samples.append(sample['seconds'])
+        heavy_modules.update(sample['heavy_modules'])
+    return {
+        'module': module,
+        'import_time': summarize(samples),
+        'heavy_modules': sorted(heavy_modules)
+    }
+
+
+def format_import_report(report):
+    stats = report['import_time']
+    lines = [
+        'Module:            {0}'.format(report['module']),
+        'Import time:       p50 {0[p50]:.3f}s  max {0[max]:.3f}s  '
+        '({0[count]} runs)'.format(stats)
+    ]
+    if report['heavy_modules']:
+        lines.append(
+            'Heavy imports:     {0}'.format(
+                ', '.join(report['heavy_modules'])
+            )
+        )
+    return '\n'.join(lines)
+
+
+def format_report(report):
+    lines = [
+        'Slaves:            {0}'.format(report['slaves']),
+        'Duration:          {0:.2f}s'.format(report['duration']),
+        'Failures:          {0}'.format(report['failures'])
+    ]
+    for key, title in (('time_to_ready', 'Time to ready:    '),
+                       ('time_to_destroy', 'Time to destroy:  ')):
+        stats = report[key]
+        if not stats['count']:
+            lines.append('{0} no samples'.format(title))
+            continue
+        lines.append(
+            '{0} p50 {1[p50]:.2f}s  p95 {1[p95]:.2f}s  p99 {1[p99]:.2f}s  '
+            'max {1[max]:.2f}s'.format(title, stats)
+        )
+    lines.append(
+        'Thread pool:       size {0[size]}  max busy {0[max_busy]}  '
+        'mean busy {0[mean_busy]:.1f}  max queued {0[max_queued]}'.format(
+            report['thread_pool']
+        )
+    )
+    lines.append(
+        'Admission:         max wait {0[max_wait]:.2f}s  average wait '
+        '{0[average_wait]:.2f}s'.format(report['admission'])
+    )
+    if report['leaked_vms']:
+        lines.append(
+            'Leaked VMs:        {0}'.format(', '.join(report['leaked_vms']))
+        )
+    if report['peak_memory_kib'] is not None:
+        lines.append(
+            'Peak memory:       {0:.1f} MiB'.format(
+                report['peak_memory_kib'] / 1024.0
+            )
+        )
+    return '\n'.join(lines)
+
+
+def parse_args(args=None):
+    parser = optparse.OptionParser(
+        usage='%prog [options]',
+        description='Benchmark the salt-cloud latent slave substantiation '
+                    'against simulated salt-cloud and salt master.'
+    )
+    parser.add_option('--slaves', type='int', default=10,
+                      help='Concurrent slaves. Default: %default')
+    parser.add_option('--create-latency', type='float', default=1,
+                      help='VM create seconds. Default: %default')
+    parser.add_option('--destroy-latency', type='float', default=0.5,
+                      help='VM destroy seconds. Default: %default')
+    parser.add_option('--boot-latency', type='float', default=2,
+                      help='Seconds until the minion answers after the VM '
+                           'is created. Default: %default')
+    parser.add_option('--command-latency', type='float', default=0.05,
+                      help='LocalClient call seconds. Default: %default')
+    parser.add_option('--highstate-latency', type='float', default=5,
+                      help='State run seconds. Default: %default')
+    parser.add_option('--jitter', type='float', default=0.3,
+                      help='Latency jitter, a fraction of the latencies. '
+                           'Default: %default')
+    parser.add_option('--create-failure-rate', type='float', default=0,
+                      help='Fraction of VM creates failing. '
+                           'Default: %default')
+    parser.add_option('--destroy-failure-rate', type='float', default=0,
+                      help='Fraction of VM destroys failing. '
+                           'Default: %default')
+    parser.add_option('--failure-rate', type='float', default=0,
+                      help='Fraction of state runs failing. '
+                           'Default: %default')
+    parser.add_option('--thread-pool-size', type='int', default=None,
+                      help='The worker thread pool size.')
+    parser.add_option('--max-in-flight-creates', type='int', default=None,
+                      help='The admission controller in flight creates cap.')
+    parser.add_option('--batch-window', type='float', default=0,
+                      help='Coalesce creates within this many seconds. '
+                           'Default: %default')
+    parser.add_option('--seed', type='int', default=None,
+                      help='Random seed, for repeatable runs.')
+    parser.add_option('--import-time', action='store_true', default=False,
+                      help='Measure the slave import time instead.')
+    parser.add_option('--import-runs', type='int', default=5,
+                      help='Fresh interpreters to import the slave in. '
+                           'Default: %default')
+    parser.add_option('--max-import-time', type='float', default=None,
+                      help='Fail if the median import time exceeds this '
+                           'many seconds.')
+    parser.add_option('--json', action='store_true', default=False,
+                      help='Output the report as JSON.')
+    parser.add_option('-v', '--verbose', action='store_true', default=False,
+                      help='Show the provisioning logging.')
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    options, _ = parse_args(args)
+    logging.basicConfig(
+        level=options.verbose and logging.INFO or logging.ERROR,
+        format='%(asctime)s %(name)s %(message)s'
+    )
+    if options.import_time:
+        return import_time_main(options)
+    if options.seed is not None:
+        random.seed(options.seed)
+
+    cloud = FakeCloud(
+        create_latency=options.create_latency,
+        destroy_latency=options.destroy_latency,
+        create_failure_rate=options.create_failure_rate,
+        destroy_failure_rate=options.destroy_failure_rate,
+        jitter=options.jitter
+    )
+    master = FakeMaster(
+        cloud,
+        boot_latency=options.boot_latency,
+        command_latency=options.command_latency,
+        highstate_latency=options.highstate_latency,
+        failure_rate=options.failure_rate,
+        jitter=options.jitter
+    )
+    benchmark = Benchmark(
+        cloud,
+        master,
+        slaves=options.slaves,
+        slave_kwargs={
+            'saltcloud_thread_pool_size': options.thread_pool_size,
+            'saltcloud_max_in_flight_creates': options.max_in_flight_creates,
+            'saltcloud_batch_window': options.batch_window
+        }
+    )
+
+    result = {}
+
+    @defer.inlineCallbacks
+    def run():
+        try:
+            result['report'] = yield benchmark.run()
+        finally:
+            reactor.stop()
+
+    reactor.callWhenRunning(run)
+    reactor.run()
+
+    report = result.get('report', None)
+    if report is None:
+        return 1
+    if options.json:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    else:
+        print(format_report(report))
+    return 0
+
+
+def import_time_main(options):
+    report = import_time(runs=options.import_runs)
+    if options.json:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    else:
+        print(format_import_report(report))
+    if report['heavy_modules']:
+        log.error(
+            'Importing {0} imports salt or salt-cloud: {1}'.format(
+                report['module'], ', '.join(report['heavy_modules'])
+            )
+        )
+        return 1
+    if options.max_import_time is not None and \
+            report['import_time']['p50'] > options.max_import_time:
+        log.error(
+            'Importing {0} takes {1:.3f}s, over {2:.3f}s'.format(
+                report['module'],
+                report['import_time']['p50'],
+                options.max_import_time
+            )
+        )
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
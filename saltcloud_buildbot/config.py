@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+'''
+    saltcloud_buildbot.config
+    ~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Process wide cache of the parsed salt-cloud configuration.
+
+    Every latent slave pointing at the same salt-cloud, master, providers and
+    profiles configuration files shares a single parsed configuration
+    dictionary. It's only parsed again when one of those files, or their
+    ``.d`` include directories, changes on disk.
+
+    :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
+    :license: Apache 2.0, see LICENSE for more details.
+'''
+
+# Import python libs
+import os
+import hashlib
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+
+# Some of salt-cloud's parsers cli defaults
+CLI_DEFAULTS = {
+    'map': None,
+    'deploy': True,
+    'parallel': False,
+    'keep_tmp': False
+}
+
+
+def _watched_files(path):
+    '''
+    Return the sorted list of files which make up the configuration at
+    ``path``, including the ``<path>.d/*.conf`` include files.
+    '''
+    paths = [path]
+    include_dir = '{0}.d'.format(path)
+    if os.path.isdir(include_dir):
+        paths.extend(
+            sorted(
+                os.path.join(include_dir, fname)
+                for fname in os.listdir(include_dir)
+                if fname.endswith('.conf')
+            )
+        )
+    return paths
+
+
+def _stat(paths):
+    '''
+    Return a tuple of ``(path, mtime, size)`` for each of ``paths``.
+    Missing files have an mtime and size of ``None``.
+    '''
+    stats = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+            stats.append((path, st.st_mtime, st.st_size))
+        except OSError:
+            stats.append((path, None, None))
+    return tuple(stats)
+
+
+def watched_stats(path):
+    '''
+    Return the :func:`_stat` of the files which make up the configuration
+    at ``path``, to tell when it changed on disk.
+    '''
+    return _stat(_watched_files(path))
+
+
+def _digest(paths):
+    '''
+    Return the SHA1 hex digest of the contents of ``paths``.
+    '''
+    digest = hashlib.sha1()
+    for path in paths:
+        digest.update(path)
+        try:
+            with open(path, 'rb') as rfh:
+                digest.update(rfh.read())
+        except (IOError, OSError):
+            digest.update('\0missing\0')
+    return digest.hexdigest()
+
+
+def parse_cloud_config(cloud_config, master_config, providers_config,
+                       vm_config):
+    '''
+    Parse the salt-cloud configuration, like the ``salt-cloud`` command
+    does.
+    '''
+    # Read/Parse salt-cloud configurations
+    import saltcloud.config
+    config = saltcloud.config.cloud_config(
+        # salt-cloud config
+        cloud_config,
+        # salt master configuration
+        master_config_path=master_config,
+        # providers configuration
+        providers_config_path=providers_config,
+        # profiles configuration
+        vm_config_path=vm_config
+    )
+
+    # Update with some parsers cli defaults
+    config.update(CLI_DEFAULTS)
+    return config
+
+
+class _CacheEntry(object):
+    def __init__(self, config, stats, digest):
+        self.config = config
+        self.stats = stats
+        self.digest = digest
+
+
+class CloudConfigCache(object):
+    '''
+    Cache of parsed salt-cloud configurations keyed by the four
+    configuration file paths.
+
+    The files are ``stat()``'ed on each lookup. When any of them changed its
+    modification time, or size, their contents are hashed and, only if the
+    hash differs from the cached one, the configuration is parsed again.
+
+    The returned configuration dictionary is shared and **must not** be
+    modified in place. Copy it before making changes.
+
+    :param loader: called with the four paths to parse the configuration,
+                   defaults to :func:`parse_cloud_config`
+    '''
+
+    def __init__(self, loader=None):
+        self.loader = loader or parse_cloud_config
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def get(self, cloud_config, master_config, providers_config,
+            vm_config):
+        key = (cloud_config, master_config, providers_config, vm_config)
+        paths = []
+        for path in key:
+            paths.extend(_watched_files(path))
+        stats = _stat(paths)
+
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry is not None and entry.stats == stats:
+                return entry.config
+
+            digest = _digest(paths)
+            if entry is not None and entry.digest == digest:
+                # Touched but not changed
+                entry.stats = stats
+                return entry.config
+
+            if entry is None:
+                log.debug(
+                    'Loading the salt-cloud configuration from {0}'.format(
+                        ', '.join(key)
+                    )
+                )
+            else:
+                log.info(
+                    'The salt-cloud configuration changed on disk. '
+                    'Reloading it from {0}'.format(', '.join(key))
+                )
+
+            config = self.loader(
+                cloud_config, master_config, providers_config, vm_config
+            )
+            self._entries[key] = _CacheEntry(config, stats, digest)
+            return config
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_CACHE = CloudConfigCache()
+
+
+def load_cloud_config(cloud_config, master_config, providers_config,
+                      vm_config):
+    '''
+    Return the, process wide, cached salt-cloud configuration for the passed
+    configuration file paths.
+    '''
+    return _CACHE.get(
+        cloud_config, master_config, providers_config, vm_config
+    )
@@ -0,0 +1,491 @@
+# -*- coding: utf-8 -*-
+'''
+    saltcloud_buildbot.events
+    ~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Wait for salt job returns on the master event bus instead of polling the
+    minion with ``saltutil.running``.
+
+    The event bus is read by one :class:`EventReader` per master, a single
+    subscription read from a single background thread, which dispatches the
+    job returns, and per state progress events, to the :class:`JobWatch`
+    waiting for them, on the reactor. Waiting for a job return doesn't hold
+    a thread.
+
+    :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
+    :license: Apache 2.0, see LICENSE for more details.
+'''
+
+# Import python libs
+import time
+import Queue
+import logging
+import threading
+
+# Import twisted libs
+from twisted.internet import defer, reactor
+from twisted.python import failure
+
+
+log = logging.getLogger(__name__)
+
+
+def get_master_event(opts):
+    '''
+    Return a connected salt master event bus subscriber for the master
+    ``opts``.
+    '''
+    import salt.utils.event
+    event = salt.utils.event.MasterEvent(opts['sock_dir'])
+    # Connect right away so no event fired after publishing a job is missed
+    event.connect_pub()
+    return event
+
+
+def job_return_tag(jid, minion=None):
+    '''
+    Return the event tag prefix under which the ``jid`` job returns are
+    fired.
+    '''
+    if minion is None:
+        return 'salt/job/{0}/ret'.format(jid)
+    return 'salt/job/{0}/ret/{1}'.format(jid, minion)
+
+
+def job_progress_tag(jid, minion):
+    '''
+    Return the event tag prefix under which the ``jid`` job per state
+    progress events of ``minion`` are fired, when the minion has
+    ``state_events`` enabled.
+    '''
+    return 'salt/job/{0}/prog/{1}'.format(jid, minion)
+
+
+def event_minion(tag, data):
+    '''
+    Return the minion a job return or progress event is about, or ``None``.
+    '''
+    if tag is not None and tag.startswith('salt/job/'):
+        # salt/job/<jid>/ret/<minion> and salt/job/<jid>/prog/<minion>/<n>
+        parts = tag.split('/')
+        if len(parts) >= 5 and parts[3] in ('ret', 'prog'):
+            return parts[4]
+    if isinstance(data, dict):
+        return data.get('id', None)
+    return None
+
+
+def _is_job_progress(tag, data, jid, minion):
+    if not isinstance(data, dict) or \
+            not isinstance(data.get('data', None), dict) or \
+            'ret' not in data['data']:
+        return False
+    if tag is not None:
+        return tag.startswith(job_progress_tag(jid, minion) + '/')
+    return 'len' in data['data'] and data.get('jid', None) == jid and \
+        data.get('id', minion) == minion
+
+
+def _is_job_return(tag, data, jid, minion):
+    if not isinstance(data, dict) or 'return' not in data:
+        return False
+    if tag is not None and tag != jid and \
+            not tag.startswith(job_return_tag(jid)):
+        # Neither the new style, nor the old style(just the jid), tag
+        return False
+    return data.get('jid', jid) == jid and data.get('id', minion) == minion
+
+
+def _next_event(event, wait):
+    '''
+    Return the next ``(tag, data)`` pair from ``event`` or ``(None, None)``.
+    '''
+    try:
+        ret = event.get_event(wait=wait, tag='', full=True)
+    except TypeError:
+        # Older salt, no ``full`` keyword argument
+        return None, event.get_event(wait=wait, tag='')
+    if not ret:
+        return None, None
+    if 'tag' in ret and 'data' in ret:
+        return ret['tag'], ret['data']
+    return None, ret
+
+
+class JobWatch(object):
+    '''
+    Wait for the return of a job of ``minion``. Watches are created, by
+    :meth:`EventReader.watch`, before the job is published, so that no event
+    is missed, and the job ID is set, with :meth:`set_jid`, once known.
+
+    If ``on_progress`` is passed, it's called with the ``{'ret': ...,
+    'len': ...}`` data of each per state progress event of the job. Any
+    exception it raises fails the watch.
+
+    The methods must be called from the reactor, except :meth:`poll`.
+    '''
+
+    # The events of the minion kept until the job ID is known
+    max_pending = 100
+
+    def __init__(self, reader, minion, on_progress=None, clock=None):
+        self.reader = reader
+        self.minion = minion
+        self.on_progress = on_progress
+        self.clock = clock or reactor
+        self.jid = None
+        self.data = None
+        self.failure = None
+        self._pending = []
+        self._waiters = []
+
+    def set_jid(self, jid):
+        self.jid = jid
+        pending, self._pending = self._pending, []
+        for tag, data in pending:
+            self.feed(tag, data)
+
+    def feed(self, tag, data):
+        '''
+        Handle an event of the minion.
+        '''
+        if self.data is not None or self.failure is not None:
+            return
+        if self.jid is None:
+            self._pending.append((tag, data))
+            del self._pending[:-self.max_pending]
+            return
+        if self.on_progress is not None and \
+                _is_job_progress(tag, data, self.jid, self.minion):
+            try:
+                self.on_progress(data['data'])
+            except Exception:
+                self.fail(failure.Failure())
+            return
+        if _is_job_return(tag, data, self.jid, self.minion):
+            log.debug(
+                'Got the {0} job return from {1} on the event bus'.format(
+                    self.jid, self.minion
+                )
+            )
+            self.data = data
+            self._fire()
+
+    def fail(self, reason):
+        if self.data is None and self.failure is None:
+            self.failure = reason
+            self._fire()
+
+    def poll(self):
+        '''
+        Return the return event data, ``None`` if it didn't show up yet.
+        Raises the watch's failure, if it failed.
+        '''
+        if self.failure is not None:
+            self.failure.raiseException()
+        return self.data
+
+    def wait(self, timeout):
+        '''
+        Return a deferred firing with the return event data, or with
+        ``None`` if it didn't show up within ``timeout`` seconds.
+        '''
+        if self.failure is not None:
+            return defer.fail(self.failure)
+        if self.data is not None:
+            return defer.succeed(self.data)
+        d = defer.Deferred()
+        timer = self.clock.callLater(max(timeout, 0), self._expire, d)
+        self._waiters.append((d, timer))
+        return d
+
+    def _expire(self, d):
+        self._waiters = [
+            waiter for waiter in self._waiters if waiter[0] is not d
+        ]
+        d.callback(None)
+
+    def _fire(self):
+        waiters, self._waiters = self._waiters, []
+        for d, timer in waiters:
+            if timer.active():
+                timer.cancel()
+            if self.failure is not None:
+                d.errback(self.failure)
+            else:
+                d.callback(self.data)
+
+    def close(self):
+        '''
+        Stop watching, the pending waits fire with ``None``.
+        '''
+        self.reader.unwatch(self)
+        waiters, self._waiters = self._waiters, []
+        for d, timer in waiters:
+            if timer.active():
+                timer.cancel()
+            d.callback(None)
+
+
+class EventReader(object):
+    '''
+    Read the master event bus, from a single subscription made with
+    ``factory``, called with ``opts``, in a background thread, and dispatch
+    the events to the :class:`JobWatch` of their minion.
+
+    The thread only runs while there are watches, and for ``linger``
+    seconds after the last one is closed. If the subscription fails, the
+    watches fail and the next watch subscribes again.
+    '''
+
+    # Block, at most, this many seconds at a time for events
+    event_wait = 1
+
+    def __init__(self, opts, factory=None, linger=60, clock=None):
+        self.opts = opts
+        self.factory = factory or get_master_event
+        self.linger = linger
+        self.clock = clock or reactor
+        # Minion to its watches, only used from the reactor
+        self._watches = {}
+        # The watched minions, read by the thread
+        self._minions = frozenset()
+        self._thread = None
+        self._stopping = None
+        self._subscribed = None
+        self._linger_call = None
+
+    def watch(self, minion, on_progress=None):
+        '''
+        Return a deferred firing with a new :class:`JobWatch` of ``minion``
+        once subscribed to the event bus.
+        '''
+        job_watch = JobWatch(self, minion, on_progress, clock=self.clock)
+        self._watches.setdefault(minion, []).append(job_watch)
+        self._minions = frozenset(self._watches)
+        if self._linger_call is not None and self._linger_call.active():
+            self._linger_call.cancel()
+        self._linger_call = None
+
+        d = defer.Deferred()
+
+        def failed(reason):
+            self.unwatch(job_watch)
+            return reason
+        d.addCallbacks(lambda _: job_watch, failed)
+        self._start().chainDeferred(d)
+        return d
+
+    def unwatch(self, job_watch):
+        watches = self._watches.get(job_watch.minion, [])
+        if job_watch in watches:
+            watches.remove(job_watch)
+        if not watches:
+            self._watches.pop(job_watch.minion, None)
+        self._minions = frozenset(self._watches)
+        if not self._watches and self._thread is not None and \
+                self._linger_call is None:
+            self._linger_call = self.clock.callLater(
+                self.linger, self._stop_idle
+            )
+
+    def _start(self):
+        # Returns a new deferred firing once subscribed
+        d = defer.Deferred()
+        if self._thread is None:
+            self._subscribed = []
+            self._stopping = threading.Event()
+            self._thread = threading.Thread(
+                target=self._run,
+                args=(self._stopping,),
+                name='saltcloud-buildbot-events'
+            )
+            self._thread.daemon = True
+            self._thread.start()
+        if self._subscribed is None:
+            # Already subscribed
+            d.callback(None)
+        else:
+            self._subscribed.append(d)
+        return d
+
+    def _stop_idle(self):
+        self._linger_call = None
+        if not self._watches:
+            self.stop()
+
+    def stop(self):
+        '''
+        Stop reading the event bus, the watches are left waiting.
+        '''
+        if self._linger_call is not None and self._linger_call.active():
+            self._linger_call.cancel()
+        self._linger_call = None
+        if self._thread is not None:
+            self._stopping.set()
+            self._thread = self._stopping = self._subscribed = None
+
+    def _run(self, stopping):
+        # Runs in the reader thread
+        try:
+            event = self.factory(self.opts)
+        except Exception:
+            reactor.callFromThread(self._lost, stopping, failure.Failure())
+            return
+        try:
+            reactor.callFromThread(self._connected, stopping)
+            while not stopping.is_set():
+                tag, data = _next_event(event, self.event_wait)
+                if data is None:
+                    continue
+                if event_minion(tag, data) in self._minions:
+                    reactor.callFromThread(
+                        self._dispatch, stopping, tag, data
+                    )
+        except Exception:
+            reactor.callFromThread(self._lost, stopping, failure.Failure())
+        finally:
+            if hasattr(event, 'destroy'):
+                event.destroy()
+
+    def _connected(self, stopping):
+        if stopping is not self._stopping:
+            return
+        subscribed, self._subscribed = self._subscribed, None
+        for d in subscribed:
+            d.callback(None)
+
+    def _dispatch(self, stopping, tag, data):
+        if stopping is not self._stopping:
+            return
+        minion = event_minion(tag, data)
+        for job_watch in list(self._watches.get(minion, ())):
+            job_watch.feed(tag, data)
+
+    def _lost(self, stopping, reason):
+        if stopping is not self._stopping:
+            return
+        log.warning(
+            'Lost the master event bus subscription: {0}'.format(
+                reason.getErrorMessage()
+            )
+        )
+        subscribed = self._subscribed or []
+        self._thread = self._stopping = self._subscribed = None
+        for d in subscribed:
+            d.errback(reason)
+        for watches in self._watches.values():
+            for job_watch in list(watches):
+                job_watch.fail(reason)
+
+
+# The process wide readers, keyed by the master socket directory and the
+# subscriber factory
+_READERS = {}
+
+
+def get_reader(opts, factory=None):
+    '''
+    Return the event reader of the master whose ``opts`` are passed.
+    '''
+    factory = factory or get_master_event
+    key = (opts.get('sock_dir', None), factory)
+    reader = _READERS.get(key, None)
+    if reader is None:
+        reader = _READERS[key] = EventReader(opts, factory)
+        reactor.addSystemEventTrigger('during', 'shutdown', reader.stop)
+    return reader
+
+
+def as_full_return(minion, data):
+    '''
+    Shape the return event ``data`` like
+    ``LocalClient.get_full_returns()`` does.
+    '''
+    ret = {'ret': data['return']}
+    if 'retcode' in data:
+        ret['retcode'] = data['retcode']
+    if 'out' in data:
+        ret['out'] = data['out']
+    return {minion: ret}
+
+
+class LocalEventBus(object):
+    '''
+    An in-process event publisher with the same subscriber interface as
+    salt's ``MasterEvent``.
+
+    Pass :meth:`subscribe` where a master event factory is expected and fire
+    events with :meth:`fire_event`.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = []
+
+    def subscribe(self, opts=None):
+        subscriber = _LocalSubscriber(self)
+        with self._lock:
+            self._subscribers.append(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            if subscriber in self._subscribers:
+                self._subscribers.remove(subscriber)
+
+    def fire_event(self, data, tag):
+        with self._lock:
+            subscribers = self._subscribers[:]
+        for subscriber in subscribers:
+            subscriber.queue.put({'tag': tag, 'data': data})
+        return True
+
+    def fire_job_return(self, jid, minion, ret, retcode=0):
+        '''
+        Fire a job return the same way the salt master does.
+        '''
+        return self.fire_event(
+            {'jid': jid, 'id': minion, 'return': ret, 'retcode': retcode},
+            job_return_tag(jid, minion)
+        )
+
+    def fire_state_progress(self, jid, minion, ret, length):
+        '''
+        Fire a per state progress event the same way a minion with
+        ``state_events`` enabled does.
+        '''
+        return self.fire_event(
+            {'jid': jid, 'id': minion, 'data': {'ret': ret, 'len': length}},
+            '{0}/{1}'.format(
+                job_progress_tag(jid, minion), ret.get('__run_num__', 0)
+            )
+        )
+
+
+class _LocalSubscriber(object):
+
+    def __init__(self, bus):
+        self.bus = bus
+        self.queue = Queue.Queue()
+
+    def connect_pub(self):
+        return True
+
+    def get_event(self, wait=5, tag='', full=False):
+        deadline = time.time() + wait
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None
+            try:
+                ret = self.queue.get(timeout=remaining)
+            except Queue.Empty:
+                return None
+            if not ret['tag'].startswith(tag):
+                continue
+            return ret if full else ret['data']
+
+    def destroy(self):
+        self.bus.unsubscribe(self)
@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+'''
+    saltcloud_buildbot.formatting
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Lazy, size capped, formatting of the salt-cloud and state run returns.
+
+    The returns are only formatted, with salt's outputters, once a log
+    handler actually emits the record, and the formatted text is capped to
+    ``max_size`` characters. In the ``summary`` mode, state runs are logged
+    as counts, failures and slowest states instead of the full output.
+    The full, raw, returns can be written as gzipped JSON artifacts, one
+    directory per VM, instead of to the master log.
+
+    :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
+    :license: Apache 2.0, see LICENSE for more details.
+'''
+
+# Import python libs
+import os
+import gzip
+import json
+import logging
+
+
+log = logging.getLogger(__name__)
+
+
+# The formatting modes
+FULL = 'full'
+SUMMARY = 'summary'
+
+
+def summarize_states(ret, slowest=5):
+    '''
+    Return a summary of the ``ret`` state run return, the states returns
+    keyed by state, as text.
+    '''
+    if not isinstance(ret, dict):
+        return repr(ret)
+    states = [
+        (key, step) for key, step in ret.items() if isinstance(step, dict)
+    ]
+    failed = [
+        (key, step) for key, step in states if step.get('result') is False
+    ]
+    changed = [step for _, step in states if step.get('changes')]
+    lines = [
+        '{0} state(s), {1} succeeded ({2} changed), {3} failed'.format(
+            len(states), len(states) - len(failed), len(changed), len(failed)
+        )
+    ]
+    for key, step in sorted(failed):
+        lines.append(
+            '  failed: {0}: {1}'.format(
+                step.get('__id__', step.get('name', key)),
+                step.get('comment', '')
+            )
+        )
+    timed = sorted(
+        (
+            (step['duration'], step.get('__id__', step.get('name', key)))
+            for key, step in states
+            if isinstance(step.get('duration'), (int, long, float))
+        ),
+        reverse=True
+    )
+    for duration, state_id in timed[:slowest]:
+        lines.append('  slowest: {0}: {1:.0f} ms'.format(state_id, duration))
+    return '\n'.join(lines)
+
+
+class LazyOutput(object):
+    '''
+    Format ``data`` with the ``out`` salt outputter, falling back to
+    ``pprint``, only when converted to a string. Pass it as a logging
+    argument, ``log.info('...%s', output)``, so that it's never formatted
+    if the record is dropped.
+    '''
+
+    def __init__(self, formatter, data, out, config, artifact=None,
+                 summary_data=None):
+        self.formatter = formatter
+        self.data = data
+        self.out = out
+        self.config = config
+        self.artifact = artifact
+        self.summary_data = summary_data
+        self._text = None
+
+    def _format(self):
+        if self.formatter.mode == SUMMARY and self.summary_data is not None:
+            return summarize_states(self.summary_data)
+        import salt.output
+        try:
+            return salt.output.out_format(self.data, self.out, self.config)
+        except Exception:
+            if self.out == 'pprint':
+                return repr(self.data)
+            return salt.output.out_format(self.data, 'pprint', self.config)
+
+    def __str__(self):
+        if self._text is None:
+            text = self._format()
+            max_size = self.formatter.max_size
+            if max_size and len(text) > max_size:
+                text = '{0}\n[{1} more characters truncated{2}]'.format(
+                    text[:max_size],
+                    len(text) - max_size,
+                    self.artifact and ', see {0}'.format(self.artifact) or ''
+                )
+            elif self.artifact:
+                text = '{0}\n[Full return in {1}]'.format(text, self.artifact)
+            self._text = text
+        return self._text
+
+    def __unicode__(self):
+        text = str(self)
+        if isinstance(text, unicode):
+            return text
+        return text.decode('utf-8', 'replace')
+
+
+class OutputFormatter(object):
+    '''
+    Lazily format the returns and store them as artifacts.
+
+    :param max_size: the maximum number of characters logged per return,
+                     ``0`` or ``None`` not to cap them
+    :param mode: ``full`` to log the state runs outputters output,
+                 ``summary`` to only log a summary of them
+    :param artifacts_dir: if set, the raw returns are written, gzipped, to
+                          ``<artifacts_dir>/<vm_name>/<name>.json.gz``
+    '''
+
+    def __init__(self, max_size=64 * 1024, mode=FULL, artifacts_dir=None):
+        self.max_size = max_size
+        self.mode = mode
+        self.artifacts_dir = artifacts_dir
+
+    def configure(self, max_size=None, mode=None, artifacts_dir=None):
+        '''
+        Update the settings, ``None`` values are left untouched.
+        '''
+        if max_size is not None:
+            self.max_size = max_size
+        if mode is not None:
+            if mode not in (FULL, SUMMARY):
+                raise ValueError(
+                    'Unknown output mode {0!r}, expected {1!r} or '
+                    '{2!r}'.format(mode, FULL, SUMMARY)
+                )
+            self.mode = mode
+        if artifacts_dir is not None:
+            self.artifacts_dir = artifacts_dir
+
+    def lazy(self, data, out, config, vm_name=None, name=None,
+             summary_data=None):
+        '''
+        Return a :class:`LazyOutput` of ``data``. If ``vm_name`` and
+        ``name`` are passed, ``data`` is first stored as an artifact, so
+        this blocks.
+        '''
+        artifact = None
+        if vm_name and name:
+            artifact = self.store(vm_name, name, data)
+        return LazyOutput(
+            self, data, out, config, artifact=artifact,
+            summary_data=summary_data
+        )
+
+    def store(self, vm_name, name, data):
+        '''
+        Atomically write ``data`` to the ``vm_name`` VM's ``name`` artifact,
+        returning its path, or ``None`` if artifacts are disabled or it
+        failed.
+        '''
+        if not self.artifacts_dir:
+            return None
+        dirname = os.path.join(self.artifacts_dir, vm_name)
+        path = os.path.join(dirname, '{0}.json.gz'.format(name))
+        tmp_path = '{0}.tmp'.format(path)
+        try:
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            fic = gzip.open(tmp_path, 'wb')
+            try:
+                json.dump(data, fic, default=repr)
+            finally:
+                fic.close()
+            os.rename(tmp_path, path)
+        except (IOError, OSError, TypeError, ValueError) as err:
+            log.error(
+                'Failed to write the {0} artifact of VM {1}: {2}'.format(
+                    name, vm_name, err
+                )
+            )
+            return None
+        return path
+
+
+_FORMATTER = None
+
+
+def get_formatter(**kwargs):
+    '''
+    Return the process wide output formatter, updating its settings with
+    the ``kwargs`` not ``None``.
+    '''
+    global _FORMATTER
+    if _FORMATTER is None:
+        _FORMATTER = OutputFormatter()
+    _FORMATTER.configure(**kwargs)
+    return _FORMATTER
+
+
+def lazy(data, out, config, vm_name=None, name=None, summary_data=None):
+    return get_formatter().lazy(
+        data, out, config, vm_name=vm_name, name=name,
+        summary_data=summary_data
+    )
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+'''
+    saltcloud_buildbot.hedging
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Hedged provisioning across equivalent salt-cloud profiles.
+
+    A slave can be given an ordered list of equivalent profiles, for example
+    the same image on different providers or regions. The VM is first
+    provisioned from the primary profile. If its minion doesn't respond
+    within a percentile of the time the profile usually takes, see
+    :mod:`~saltcloud_buildbot.history`, a second VM is started from the
+    next profile, and whichever VM becomes ready first is used. The losing
+    VM is cancelled and destroyed right away. If a VM fails, the next
+    profile is tried straight away.
+
+    :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
+    :license: Apache 2.0, see LICENSE for more details.
+'''
+
+# Import python libs
+import logging
+
+# Import twisted libs
+from twisted.internet import defer, reactor
+
+# Import saltcloud_buildbot libs
+from saltcloud_buildbot import history, metrics, readiness
+
+
+log = logging.getLogger(__name__)
+
+
+def hedge_delay(profile, fraction=0.95, default=60 * 5,
+                min_samples=history.DEFAULT_MIN_SAMPLES):
+    '''
+    Return the seconds to wait for the ``profile``'s minion to respond
+    before hedging, the ``fraction`` percentile of its history, or
+    ``default`` if there isn't enough history yet.
+    '''
+    delay = history.get_history().percentile(
+        profile, history.TIME_TO_RESPONDING, fraction, min_samples
+    )
+    if delay is None:
+        return default
+    return delay
+
+
+class Attempt(object):
+    '''
+    The provisioning of a VM from ``profile``. The ``vm_name``, and the
+    provisioning ``path`` if not a cold create, are set by whoever
+    provisions it.
+    '''
+
+    def __init__(self, profile, on_responding=None, clock=None):
+        self.profile = profile
+        self.vm_name = None
+        self.path = history.COLD
+        self.clock = clock or reactor
+        self.started = self.clock.seconds()
+        self.created = False
+        self.responding = False
+        self.cancelled = False
+        self.done = False
+        self.discarded = False
+        self._on_responding = on_responding
+
+    def is_cancelled(self):
+        return self.cancelled
+
+    def observer(self, state, seconds, failed=False):
+        '''
+        A :class:`~saltcloud_buildbot.readiness.ProvisioningMachine`
+        observer recording how long the minion took to respond.
+        '''
+        if failed or self.responding or \
+                state != readiness.MINION_RESPONDING:
+            return
+        self.responding = True
+        history.record(
+            self.profile,
+            history.TIME_TO_RESPONDING,
+            self.clock.seconds() - self.started,
+            path=self.path
+        )
+        if self._on_responding is not None:
+            self._on_responding(self)
+
+
+class Race(object):
+    '''
+    Provision from the ordered ``profiles``, hedging and failing over to
+    the next ones, until a VM is ready.
+
+    :param launch: called with an :class:`Attempt`, sets its ``vm_name``
+                   and returns a deferred firing once its VM is ready
+    :param discard: called with the failed and losing attempts, destroys
+                    their VM
+    :param delay: called with a profile, returns the seconds to wait for
+                  its minion to respond before hedging, ``None`` never
+                  to hedge, only to fail over
+    '''
+
+    def __init__(self, profiles, launch, discard, delay=None, clock=None):
+        self.profiles = list(profiles)
+        self.launch = launch
+        self.discard = discard
+        self.delay = delay
+        self.clock = clock or reactor
+
+        self.attempts = []
+        self.winner = None
+        self._remaining = list(self.profiles)
+        self._failures = []
+        self._timer = None
+        self._result = None
+
+    def run(self):
+        '''
+        Returns a deferred firing with the winning :class:`Attempt`, or
+        with the first failure if every profile failed.
+        '''
+        self._result = defer.Deferred()
+        self._launch_next()
+        return self._result
+
+    def _launch_next(self):
+        profile = self._remaining.pop(0)
+        attempt = Attempt(profile, self._responding, clock=self.clock)
+        self.attempts.append(attempt)
+        if len(self.attempts) > 1:
+            metrics.get_registry().increment(
+                'alternate_attempts', profile=profile
+            )
+        self._arm(attempt)
+        d = defer.maybeDeferred(self.launch, attempt)
+        d.addCallbacks(
+            self._succeeded,
+            self._failed,
+            callbackArgs=(attempt,),
+            errbackArgs=(attempt,)
+        )
+
+    def _arm(self, attempt):
+        self._disarm()
+        if self.delay is None or not self._remaining:
+            return
+        delay = self.delay(attempt.profile)
+        if delay is None:
+            return
+        self._timer = self.clock.callLater(delay, self._hedge, attempt)
+
+    def _disarm(self):
+        if self._timer is not None and self._timer.active():
+            self._timer.cancel()
+        self._timer = None
+
+    def _hedge(self, attempt):
+        self._timer = None
+        if self.winner is not None or attempt.done or attempt.responding:
+            return
+        log.info(
+            'VM {0} did not respond within {1:.0f} seconds, hedging with '
+            'the {2!r} profile'.format(
+                attempt.vm_name,
+                self.clock.seconds() - attempt.started,
+                self._remaining[0]
+            )
+        )
+        self._launch_next()
+
+    def _responding(self, attempt):
+        if attempt is self.attempts[-1]:
+            # No need to hedge
+            self._disarm()
+
+    def _succeeded(self, _, attempt):
+        attempt.done = True
+        if self.winner is not None or attempt.cancelled:
+            # Ready too late
+            self._discard(attempt)
+            return
+        self.winner = attempt
+        self._disarm()
+        for other in self.attempts:
+            if other.done:
+                continue
+            other.cancelled = True
+            if other.created:
+                # Otherwise, it's discarded once its create returns
+                self._discard(other)
+        if attempt is not self.attempts[0]:
+            metrics.get_registry().increment(
+                'alternate_wins', profile=attempt.profile
+            )
+        log.info(
+            'VM {0}, from the {1!r} profile, won the provisioning '
+            'race'.format(attempt.vm_name, attempt.profile)
+        )
+        self._result.callback(attempt)
+
+    def _failed(self, failure, attempt):
+        attempt.done = True
+        self._discard(attempt)
+        if self.winner is not None or failure.check(readiness.Cancelled):
+            return
+        self._failures.append(failure)
+        if self._remaining:
+            if attempt is self.attempts[-1]:
+                log.info(
+                    'VM {0}, from the {1!r} profile, failed, failing over '
+                    'to the {2!r} profile'.format(
+                        attempt.vm_name, attempt.profile, self._remaining[0]
+                    )
+                )
+                self._launch_next()
+            return
+        if [other for other in self.attempts if not other.done]:
+            return
+        self._disarm()
+        self._result.errback(self._failures[0])
+
+    def _discard(self, attempt):
+        if attempt.discarded or attempt.vm_name is None:
+            return
+        attempt.discarded = True
+        d = defer.maybeDeferred(self.discard, attempt)
+        d.addErrback(
+            lambda f: log.error(
+                'Failed to discard VM {0}: {1}'.format(
+                    attempt.vm_name, f.getErrorMessage()
+                )
+            )
+        )
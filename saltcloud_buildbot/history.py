@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+'''
+    saltcloud_buildbot.history
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Per profile provisioning latency history.
+
+    The most recent durations of each provisioning phase are kept, per
+    salt-cloud profile, so that decisions, like when to hedge a slow VM
+    create or how long to wait for a minion, can be based on how long the
+    profile usually takes rather than on fixed timeouts.
+
+    A cold VM create, a VM claimed from the warm pool, launched from a baked
+    image or reattached to after a restart, and a highstate or a single SLS
+    run, take very different times, so the durations are also keyed by the
+    provisioning path and by the function run.
+
+    The history can be kept in a local JSON file, written every
+    ``interval`` seconds and when the last slave stops, so that it
+    survives master restarts.
+
+    :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
+    :license: Apache 2.0, see LICENSE for more details.
+'''
+
+# Import python libs
+import os
+import json
+import math
+import logging
+import threading
+import collections
+
+# Import twisted libs
+from twisted.internet import task
+
+
+log = logging.getLogger(__name__)
+
+
+# The time from the start of provisioning until the minion responds
+TIME_TO_RESPONDING = 'time_to_responding'
+# The time from the substantiation request until the buildslave attaches
+SUBSTANTIATION = 'substantiation'
+
+# The provisioning paths
+COLD = 'cold'
+POOL = 'pool'
+IMAGE = 'image'
+REATTACH = 'reattach'
+
+# The history file format version, older files mixed the provisioning
+# paths and functions and are ignored
+VERSION = 2
+
+# Don't trust percentiles computed from fewer samples
+DEFAULT_MIN_SAMPLES = 10
+
+# The bounds, in seconds, of the deadlines derived from the history
+DEFAULT_FLOOR = 60
+DEFAULT_CEILING = 60 * 60 * 2
+
+
+def percentile(values, fraction):
+    '''
+    Return the ``fraction`` percentile, nearest rank, of ``values``.
+    '''
+    if not values:
+        return None
+    values = sorted(values)
+    rank = int(math.ceil(fraction * len(values))) - 1
+    return values[min(max(rank, 0), len(values) - 1)]
+
+
+class History(object):
+    '''
+    The last ``window`` durations of each ``(profile, phase, fun, path)``,
+    stored in the ``path`` JSON file if set. The ``fun`` is ``None`` for
+    the phases not depending on the function run.
+    '''
+
+    def __init__(self, path=None, window=200):
+        self.path = path
+        self.window = window
+        self._samples = {}
+        self._dirty = False
+        self._loop = None
+        self._users = 0
+        # Durations are also recorded from worker threads
+        self._lock = threading.Lock()
+
+    def configure(self, path=None, window=None):
+        '''
+        Update the settings, ``None`` values are left untouched. The
+        ``path`` file is loaded when set.
+        '''
+        if window is not None:
+            self.window = window
+        if path is not None and path != self.path:
+            self.path = path
+            self.load()
+
+    # Service like methods, driven by the slaves
+    def start(self, interval=60):
+        self._users += 1
+        if self._loop is None and self.path:
+            self._loop = task.LoopingCall(self.save)
+            self._loop.start(interval, now=False)
+
+    def stop(self):
+        self._users -= 1
+        if self._users > 0:
+            return
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+        self._loop = None
+        self.save()
+
+    def record(self, profile, phase, seconds, fun=None, path=COLD):
+        key = (profile, phase, fun, path)
+        with self._lock:
+            if key not in self._samples:
+                self._samples[key] = collections.deque(maxlen=self.window)
+            self._samples[key].append(seconds)
+            self._dirty = True
+
+    def samples(self, profile, phase, fun=None, path=COLD):
+        with self._lock:
+            return list(
+                self._samples.get((profile, phase, fun, path), ())
+            )
+
+    def percentile(self, profile, phase, fraction,
+                   min_samples=DEFAULT_MIN_SAMPLES, fun=None, path=COLD):
+        '''
+        Return the ``fraction`` percentile of the ``profile``'s ``phase``
+        durations, or ``None`` if fewer than ``min_samples`` are known.
+        '''
+        samples = self.samples(profile, phase, fun, path)
+        if len(samples) < max(min_samples, 1):
+            return None
+        return percentile(samples, fraction)
+
+    def deadline(self, profile, phase, fraction=0.99, factor=2,
+                 floor=DEFAULT_FLOOR, ceiling=DEFAULT_CEILING,
+                 min_samples=DEFAULT_MIN_SAMPLES, fun=None, path=COLD):
+        '''
+        Return the ``fraction`` percentile of the ``profile``'s ``phase``
+        durations times ``factor``, bounded by ``floor`` and ``ceiling``,
+        or ``None`` if fewer than ``min_samples`` are known.
+        '''
+        seconds = self.percentile(
+            profile, phase, fraction, min_samples, fun, path
+        )
+        if seconds is None:
+            return None
+        seconds *= factor
+        if floor is not None:
+            seconds = max(seconds, floor)
+        if ceiling is not None:
+            seconds = min(seconds, ceiling)
+        return seconds
+
+    def deadlines(self, profile, phases, **kwargs):
+        '''
+        Return a dictionary of the ``phases`` with enough history to their
+        :meth:`deadline`.
+        '''
+        deadlines = {}
+        for phase in phases:
+            seconds = self.deadline(profile, phase, **kwargs)
+            if seconds is not None:
+                deadlines[phase] = seconds
+        return deadlines
+
+    def state_observer(self, profile, fun, path=COLD):
+        '''
+        Return a :class:`~saltcloud_buildbot.readiness.ProvisioningMachine`
+        observer recording the time it took to reach each state while
+        running ``fun``.
+        '''
+        def observer(state, seconds, failed=False):
+            if not failed:
+                self.record(profile, state, seconds, fun, path)
+        return observer
+
+    def load(self):
+        '''
+        Load the ``path`` file, the durations already recorded are kept as
+        the most recent ones.
+        '''
+        if not self.path or not os.path.isfile(self.path):
+            return
+        try:
+            with open(self.path) as fic:
+                data = json.load(fic)
+        except (IOError, OSError, ValueError) as err:
+            log.error(
+                'Failed to load the latency history {0}: {1}'.format(
+                    self.path, err
+                )
+            )
+            return
+        if not isinstance(data, dict) or data.get('version') != VERSION:
+            log.info(
+                'Ignoring the latency history {0}, written by an older '
+                'release'.format(self.path)
+            )
+            return
+        with self._lock:
+            for entry in data.get('samples', []):
+                key = (
+                    entry['profile'], entry['phase'], entry['fun'],
+                    entry['path']
+                )
+                loaded = collections.deque(
+                    entry['durations'], maxlen=self.window
+                )
+                loaded.extend(self._samples.get(key, ()))
+                self._samples[key] = loaded
+
+    def save(self):
+        '''
+        Atomically write the durations to the ``path`` file, if any were
+        recorded since the last save.
+        '''
+        if not self.path:
+            return
+        with self._lock:
+            if not self._dirty:
+                return
+            samples = [
+                {
+                    'profile': profile,
+                    'phase': phase,
+                    'fun': fun,
+                    'path': path,
+                    'durations': list(durations)
+                }
+                for (profile, phase, fun, path), durations
+                in sorted(self._samples.items())
+            ]
+            self._dirty = False
+        tmp_path = '{0}.tmp'.format(self.path)
+        try:
+            dirname = os.path.dirname(self.path)
+            if dirname and not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            with open(tmp_path, 'w') as fic:
+                json.dump({'version': VERSION, 'samples': samples}, fic)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError) as err:
+            self._dirty = True
+            log.error(
+                'Failed to write the latency history {0}: {1}'.format(
+                    self.path, err
+                )
+            )
+
+
+_HISTORY = None
+
+
+def get_history(**kwargs):
+    '''
+    Return the process wide latency history, updating its settings with
+    the ``kwargs`` not ``None``.
+    '''
+    global _HISTORY
+    if _HISTORY is None:
+        _HISTORY = History()
+    _HISTORY.configure(**kwargs)
+    return _HISTORY
+
+
+def record(profile, phase, seconds, fun=None, path=COLD):
+    get_history().record(profile, phase, seconds, fun, path)
+
+
+def state_observer(profile, fun, path=COLD):
+    return get_history().state_observer(profile, fun, path)
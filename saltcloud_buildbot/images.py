@@ -0,0 +1,492 @@
+# -*- coding: utf-8 -*-
+'''
+    saltcloud_buildbot.images
+    ~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Golden image baking.
+
+    A fingerprint of the salt state and pillar trees, plus the salt-cloud
+    profile, is computed for each profile. The first time a fingerprint is
+    seen a VM is created and highstated from the plain profile and then
+    snapshotted into an image. Later VMs are launched from that image and
+    only get a, fast, state run rebinding them to their slave, the
+    verification state if one is set, a highstate otherwise.
+
+    Baked images are tracked in a local JSON index. Only the newest
+    ``max_images`` per profile are kept, the stale ones being deleted.
+
+    :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
+    :license: Apache 2.0, see LICENSE for more details.
+'''
+
+# Import python libs
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+
+# Import twisted libs
+from twisted.internet import defer
+
+# Import buildbot libs
+from buildbot.interfaces import LatentBuildSlaveFailedToSubstantiate
+
+# Import saltcloud_buildbot libs
+from saltcloud_buildbot import admission, naming, provision, teardown, workers
+import saltcloud_buildbot.config
+
+
+log = logging.getLogger(__name__)
+
+
+class TreeHasher(object):
+    '''
+    Hash directory trees, only reading again the files whose modification
+    time or size changed since the last time they were hashed.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._digests = {}
+
+    def _file_digest(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        key = (st.st_mtime, st.st_size)
+        with self._lock:
+            cached = self._digests.get(path, None)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        digest = hashlib.sha1()
+        with open(path, 'rb') as rfh:
+            for chunk in iter(lambda: rfh.read(65536), ''):
+                digest.update(chunk)
+        digest = digest.hexdigest()
+        with self._lock:
+            self._digests[path] = (key, digest)
+        return digest
+
+    def update(self, digest, root):
+        '''
+        Feed the relative path and contents digest of each file under
+        ``root`` into ``digest``.
+        '''
+        if os.path.isfile(root):
+            digest.update(self._file_digest(root) or '')
+            return
+        for dirpath, dirnames, filenames in os.walk(root):
+            # Walk in a stable order and skip VCS metadata
+            dirnames[:] = sorted(
+                dirname for dirname in dirnames
+                if dirname not in ('.git', '.hg', '.svn')
+            )
+            for filename in sorted(filenames):
+                path = os.path.join(dirpath, filename)
+                file_digest = self._file_digest(path)
+                if file_digest is None:
+                    continue
+                digest.update(os.path.relpath(path, root))
+                digest.update('\0')
+                digest.update(file_digest)
+
+
+_HASHER = TreeHasher()
+
+
+def fingerprint(master_opts, profile, saltenv='base', paths=None):
+    '''
+    Return the fingerprint of the state and pillar trees of ``saltenv`` and
+    of the salt-cloud ``profile``.
+
+    ``paths``, relative to the state and pillar roots, restrict the trees
+    hashed to the parts which apply to the profile.
+    '''
+    digest = hashlib.sha1()
+    digest.update(
+        json.dumps(profile, sort_keys=True, default=repr)
+    )
+    for roots_key in ('file_roots', 'pillar_roots'):
+        digest.update('\0{0}\0'.format(roots_key))
+        for root in master_opts.get(roots_key, {}).get(saltenv, []):
+            for path in (paths or ['']):
+                full_path = os.path.join(root, path)
+                if os.path.exists(full_path):
+                    digest.update(full_path)
+                    _HASHER.update(digest, full_path)
+    return digest.hexdigest()
+
+
+# The parsed master configurations, keyed by path, along with the stats of
+# the files they were parsed from
+_MASTER_OPTS = {}
+_MASTER_OPTS_LOCK = threading.Lock()
+
+
+def parse_master_config(master_config):
+    '''
+    Parse the salt master configuration file ``master_config``.
+    '''
+    import salt.config
+    return salt.config.master_config(master_config)
+
+
+def master_opts(master_config):
+    '''
+    Return the parsed ``master_config``, only parsing it again when it, or
+    its ``.d`` include files, changed on disk.
+    '''
+    stats = saltcloud_buildbot.config.watched_stats(master_config)
+    with _MASTER_OPTS_LOCK:
+        cached = _MASTER_OPTS.get(master_config, None)
+        if cached is None or cached[0] != stats:
+            if cached is not None:
+                log.info(
+                    'The salt master configuration changed on disk. '
+                    'Reloading it from {0}'.format(master_config)
+                )
+            cached = _MASTER_OPTS[master_config] = (
+                stats, parse_master_config(master_config)
+            )
+        return cached[1]
+
+
+def state_fingerprint(config, master_config, profile_name, saltenv='base',
+                      paths=None):
+    '''
+    Return the :func:`fingerprint` of the ``profile_name`` profile, reading
+    the state and pillar roots from the ``master_config`` file.
+    '''
+    return fingerprint(
+        master_opts(master_config),
+        provision.get_profile(config, profile_name),
+        saltenv=saltenv,
+        paths=paths
+    )
+
+
+class ImageIndex(object):
+    '''
+    A JSON file index of the baked images::
+
+        {profile_name: {fingerprint: {'image': ..., 'created': ...,
+                                      'last_used': ...}}}
+
+    Looking up an image only bumps its ``last_used`` time in memory, the
+    index is written at most every ``save_interval`` seconds by the
+    lookups, and always when images are added or evicted.
+    '''
+
+    def __init__(self, path, save_interval=300):
+        self.path = path
+        self.save_interval = save_interval
+        self._lock = threading.Lock()
+        self._data = None
+        self._dirty = False
+        self._saved = time.time()
+
+    def _load(self):
+        if self._data is not None:
+            return self._data
+        try:
+            with open(self.path) as rfh:
+                self._data = json.load(rfh)
+        except (IOError, OSError, ValueError):
+            self._data = {}
+        return self._data
+
+    def _save(self):
+        dirname = os.path.dirname(self.path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        tmp_path = '{0}.tmp'.format(self.path)
+        with open(tmp_path, 'w') as wfh:
+            json.dump(self._data, wfh, indent=2, sort_keys=True)
+        os.rename(tmp_path, self.path)
+        self._dirty = False
+        self._saved = time.time()
+
+    def get(self, profile_name, fingerprint):
+        with self._lock:
+            entry = self._load().get(profile_name, {}).get(fingerprint, None)
+            if entry is None:
+                return None
+            entry['last_used'] = time.time()
+            self._dirty = True
+            if time.time() - self._saved >= self.save_interval:
+                self._save()
+            return entry['image']
+
+    def add(self, profile_name, fingerprint, image):
+        with self._lock:
+            self._load().setdefault(profile_name, {})[fingerprint] = {
+                'image': image,
+                'created': time.time(),
+                'last_used': time.time()
+            }
+            self._save()
+
+    def evict(self, profile_name, keep, max_age=None):
+        '''
+        Remove all but the ``keep`` most recently used images of
+        ``profile_name``, and those not used in ``max_age`` seconds.
+        Returns the removed image IDs.
+        '''
+        with self._lock:
+            images = self._load().get(profile_name, {})
+            ordered = sorted(
+                images.items(),
+                key=lambda item: item[1]['last_used'],
+                reverse=True
+            )
+            evicted = []
+            for idx, (fprint, entry) in enumerate(ordered):
+                if idx >= keep or (
+                        max_age is not None and
+                        time.time() - entry['last_used'] > max_age):
+                    evicted.append(entry['image'])
+                    images.pop(fprint)
+            if evicted or self._dirty:
+                self._save()
+            return evicted
+
+    def flush(self):
+        '''
+        Write the pending ``last_used`` updates to the index.
+        '''
+        with self._lock:
+            if self._dirty:
+                self._save()
+
+
+def cloud_action(config, action, names, kwargs=None):
+    '''
+    Run the salt-cloud ``action`` against ``names``.
+    '''
+    import saltcloud.cloud
+    config = config.copy()
+    config['action'] = action
+    mapper = saltcloud.cloud.Map(config)
+    return mapper.do_action(names, kwargs or {})
+
+
+def snapshot_vm(config, profile_name, vm_name):
+    '''
+    Snapshot ``vm_name`` into an image using the provider's ``create_image``
+    salt-cloud action and return the new image ID.
+    '''
+    ret = cloud_action(
+        config, 'create_image', [vm_name],
+        {'name': '{0}-{1}'.format(vm_name, int(time.time()))}
+    )
+    node_ret = provision.find_vm_return(ret, vm_name)
+    if isinstance(node_ret, dict):
+        for key in ('image', 'ImageId', 'imageId', 'id'):
+            if node_ret.get(key, None):
+                return node_ret[key]
+    elif node_ret:
+        return node_ret
+    raise RuntimeError(
+        'Failed to snapshot {0}, unexpected return: {1}'.format(vm_name, ret)
+    )
+
+
+def delete_image(config, profile_name, image):
+    '''
+    Delete ``image`` using the provider's ``delete_image`` salt-cloud
+    function.
+    '''
+    import saltcloud.cloud
+    profile = provision.get_profile(config, profile_name)
+    mapper = saltcloud.cloud.Map(config)
+    return mapper.do_function(profile['provider'], 'delete_image', {
+        'image': image
+    })
+
+
+class ImageBaker(object):
+    '''
+    Bake, track and look up golden images.
+
+    :param index_path: where to keep the baked images index
+    :param max_images: how many images to keep per profile
+    :param max_age: delete images not used in this many seconds
+    :param paths: restrict the fingerprint to these state and pillar tree
+                  paths
+    :param saltenv: the salt environment to fingerprint
+    :param snapshot: called with ``(config, profile_name, vm_name)`` in a
+                     thread, must return the new image ID. Defaults to
+                     :func:`snapshot_vm`.
+    :param delete: called with ``(config, profile_name, image)`` in a
+                   thread to delete a stale image. Defaults to
+                   :func:`delete_image`.
+    '''
+
+    def __init__(self, index_path, max_images=2, max_age=None, paths=None,
+                 saltenv='base', snapshot=None, delete=None):
+        self.index = ImageIndex(index_path)
+        self.max_images = max_images
+        self.max_age = max_age
+        self.paths = paths
+        self.saltenv = saltenv
+        self.snapshot = snapshot or snapshot_vm
+        self.delete = delete or delete_image
+        self._baking = {}
+
+    def _fingerprint(self, config, master_config, profile_name):
+        return state_fingerprint(
+            config, master_config, profile_name,
+            saltenv=self.saltenv, paths=self.paths
+        )
+
+    @defer.inlineCallbacks
+    def lookup(self, config, master_config, profile_name):
+        '''
+        Return a deferred firing with ``(fingerprint, image)`` where
+        ``image`` is ``None`` if the current fingerprint was not baked yet.
+        '''
+        fprint = yield workers.defer_to_thread(
+            self._fingerprint, config, master_config, profile_name
+        )
+        image = yield workers.defer_to_thread(
+            self.index.get, profile_name, fprint
+        )
+        defer.returnValue((fprint, image))
+
+    def bake(self, config, master_config, profile_name, fprint,
+             minion_conf, state_options=None):
+        '''
+        Bake an image for ``fprint`` in the background, unless one is
+        already being baked. Returns a deferred firing with the image ID.
+        '''
+        key = (profile_name, fprint)
+        if key in self._baking:
+            return self._baking[key]
+
+        d = self._bake(
+            config, master_config, profile_name, fprint, minion_conf,
+            state_options or {}
+        )
+
+        def done(result):
+            self._baking.pop(key, None)
+            return result
+
+        def failed(failure):
+            log.error(
+                'Failed to bake an image for the {0!r} profile: {1}'.format(
+                    profile_name, failure.getErrorMessage()
+                )
+            )
+
+        d.addBoth(done)
+        d.addErrback(failed)
+        self._baking[key] = d
+        return d
+
+    @defer.inlineCallbacks
+    def _bake(self, config, master_config, profile_name, fprint,
+              minion_conf, state_options):
+        vm_name = naming.allocate(profile_name, naming.BAKE)
+        log.info(
+            'Baking an image for the {0!r} profile, fingerprint {1}, '
+            'using VM {2}'.format(profile_name, fprint, vm_name)
+        )
+        destroyer = teardown.get_destroyer()
+        destroyer.track(vm_name, lambda: config)
+        try:
+            yield admission.create_admitted(
+                config, profile_name, vm_name,
+                provision.create_vm,
+                config, profile_name, vm_name, minion_conf,
+                priority=admission.BACKGROUND_PRIORITY
+            )
+            yield provision.run_state(
+                config, master_config, vm_name, profile_name=profile_name,
+                **state_options
+            )
+            image = yield workers.defer_to_thread(
+                self.snapshot, config, profile_name, vm_name
+            )
+        finally:
+            d = destroyer.destroy(config, [vm_name])
+            d.addErrback(
+                lambda f: log.error(
+                    'Failed to destroy the bake VM {0}: {1}'.format(
+                        vm_name, f.getErrorMessage()
+                    )
+                )
+            )
+
+        yield workers.defer_to_thread(
+            self.index.add, profile_name, fprint, image
+        )
+        log.info(
+            'Baked image {0} for the {1!r} profile, fingerprint {2}'.format(
+                image, profile_name, fprint
+            )
+        )
+
+        evicted = yield workers.defer_to_thread(
+            self.index.evict, profile_name, self.max_images, self.max_age
+        )
+        for stale_image in evicted:
+            log.info(
+                'Deleting stale image {0} of the {1!r} profile'.format(
+                    stale_image, profile_name
+                )
+            )
+            d = workers.defer_to_thread(
+                self.delete, config, profile_name, stale_image
+            )
+            d.addErrback(
+                lambda f, stale_image=stale_image: log.error(
+                    'Failed to delete the stale image {0}: {1}'.format(
+                        stale_image, f.getErrorMessage()
+                    )
+                )
+            )
+        defer.returnValue(image)
+
+
+# The process wide bakers, keyed by index path
+_BAKERS = {}
+
+
+def get_baker(index_path, **kwargs):
+    '''
+    Return the image baker for ``index_path``, creating it if needed.
+    '''
+    baker = _BAKERS.get(index_path, None)
+    if baker is None:
+        baker = _BAKERS[index_path] = ImageBaker(index_path, **kwargs)
+    else:
+        for key, value in kwargs.items():
+            if value is not None:
+                setattr(baker, key, value)
+    return baker
+
+
+def launch_from_image(config, profile_name, vm_name, minion_conf, image,
+                      slavename=None, overrides=None):
+    '''
+    Create ``vm_name`` from the ``profile_name`` profile, updated with
+    ``overrides``, but booting the baked ``image``.
+    '''
+    overrides = dict(overrides or {}, image=image)
+    try:
+        return provision.create_vm(
+            config, profile_name, vm_name, minion_conf, slavename=slavename,
+            overrides=overrides
+        )
+    except LatentBuildSlaveFailedToSubstantiate:
+        log.error(
+            'Failed to launch {0} from the baked image {1}'.format(
+                vm_name, image
+            )
+        )
+        raise
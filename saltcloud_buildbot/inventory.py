@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+'''
+    saltcloud_buildbot.inventory
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    A persistent, SQLite backed, inventory of the slaves' VMs.
+
+    Each VM is recorded with the slave it belongs to, its salt-cloud
+    profile, the state tree fingerprint it was provisioned with and its
+    provisioning state. After a master restart, the slaves look up their
+    ready VMs and reattach to them, if they're still healthy, instead of
+    provisioning new ones.
+
+    :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
+    :license: Apache 2.0, see LICENSE for more details.
+'''
+
+# Import python libs
+import os
+import time
+import sqlite3
+import logging
+import threading
+
+
+log = logging.getLogger(__name__)
+
+
+# The VM provisioning states
+PROVISIONING = 'provisioning'
+READY = 'ready'
+DESTROYING = 'destroying'
+
+
+class Inventory(object):
+    '''
+    The VM inventory stored in the ``path`` SQLite database.
+
+    The methods block, call them from a thread.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connect(self):
+        if self._conn is not None:
+            return self._conn
+        dirname = os.path.dirname(self.path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS vms ('
+            'vm_name TEXT PRIMARY KEY, '
+            'slavename TEXT, '
+            'profile TEXT NOT NULL, '
+            'fingerprint TEXT, '
+            'state TEXT NOT NULL, '
+            'created REAL NOT NULL, '
+            'updated REAL NOT NULL)'
+        )
+        conn.execute(
+            'CREATE INDEX IF NOT EXISTS vms_slavename ON vms (slavename)'
+        )
+        conn.commit()
+        self._conn = conn
+        return conn
+
+    def record(self, vm_name, slavename, profile, fingerprint=None,
+               state=PROVISIONING):
+        '''
+        Record ``vm_name``, replacing any previous record of it.
+        '''
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                'INSERT OR REPLACE INTO vms (vm_name, slavename, profile, '
+                'fingerprint, state, created, updated) VALUES '
+                '(?, ?, ?, ?, ?, COALESCE((SELECT created FROM vms '
+                'WHERE vm_name = ?), ?), ?)',
+                (vm_name, slavename, profile, fingerprint, state, vm_name,
+                 now, now)
+            )
+            conn.commit()
+
+    def set_state(self, vm_name, state):
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                'UPDATE vms SET state = ?, updated = ? WHERE vm_name = ?',
+                (state, time.time(), vm_name)
+            )
+            conn.commit()
+
+    def remove(self, vm_name):
+        with self._lock:
+            conn = self._connect()
+            conn.execute('DELETE FROM vms WHERE vm_name = ?', (vm_name,))
+            conn.commit()
+
+    def get(self, vm_name):
+        with self._lock:
+            row = self._connect().execute(
+                'SELECT * FROM vms WHERE vm_name = ?', (vm_name,)
+            ).fetchone()
+        return row is not None and dict(row) or None
+
+    def for_slave(self, slavename):
+        '''
+        Return the records of ``slavename``'s VMs, the most recently
+        updated first.
+        '''
+        with self._lock:
+            rows = self._connect().execute(
+                'SELECT * FROM vms WHERE slavename = ? '
+                'ORDER BY updated DESC', (slavename,)
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def all(self):
+        with self._lock:
+            rows = self._connect().execute(
+                'SELECT * FROM vms ORDER BY updated DESC'
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+
+_INVENTORIES = {}
+
+
+def get_inventory(path):
+    '''
+    Return the inventory stored in ``path``, creating it if needed.
+    '''
+    inventory = _INVENTORIES.get(path, None)
+    if inventory is None:
+        inventory = _INVENTORIES[path] = Inventory(path)
+    return inventory
+
+
+def recorded():
+    '''
+    Return the names of the VMs recorded in every inventory in use. Blocks,
+    call it from a thread.
+    '''
+    names = set()
+    for inventory in _INVENTORIES.values():
+        names.update(record['vm_name'] for record in inventory.all())
+    return names
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+'''
+    saltcloud_buildbot.keys
+    ~~~~~~~~~~~~~~~~~~~~~~~
+
+    A pool of pre-generated minion keypairs.
+
+    salt-cloud generates a fresh RSA keypair for each VM it deploys, in the
+    provisioning thread, which makes the master's CPU spike when many slaves
+    substantiate at once. The key pool generates the keypairs ahead of
+    time, one at a time and only while no VM creates are in flight or
+    waiting to be admitted, so that substantiations just draw a ready one.
+    The drawn public key is pre-seeded into the master's accepted keys and
+    the keypair handed to salt-cloud with the profile.
+
+    The keypairs are only kept in memory and each one is handed out once,
+    a keypair is never reused, even if its VM failed to be created. The
+    seeded key of a VM which failed to be created is removed again.
+
+    :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
+    :license: Apache 2.0, see LICENSE for more details.
+'''
+
+# Import python libs
+import os
+import hashlib
+import logging
+import threading
+
+# Import twisted libs
+from twisted.internet import reactor, task
+
+# Import saltcloud_buildbot libs
+from saltcloud_buildbot import admission, metrics, workers
+
+
+log = logging.getLogger(__name__)
+
+
+def generate(keysize=2048):
+    '''
+    Generate a minion keypair, returning the ``(private, public)`` PEM
+    keys. Blocks, call it from a thread.
+    '''
+    try:
+        import saltcloud.utils
+        gen_keys = saltcloud.utils.gen_keys
+    except ImportError:
+        # salt-cloud merged into salt
+        import salt.utils.cloud
+        gen_keys = salt.utils.cloud.gen_keys
+    return gen_keys(keysize)
+
+
+def seed(pki_dir, minion_id, public_key):
+    '''
+    Atomically write ``public_key`` as the ``minion_id`` minion's accepted
+    key in the master's ``pki_dir``. Blocks, call it from a thread.
+    '''
+    dirname = os.path.join(pki_dir, 'minions')
+    path = os.path.join(dirname, minion_id)
+    tmp_path = '{0}.tmp'.format(path)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    with open(tmp_path, 'w') as fic:
+        fic.write(public_key)
+    os.rename(tmp_path, path)
+
+
+def unseed(pki_dir, minion_id, public_key):
+    '''
+    Remove the ``minion_id`` minion's accepted key from the master's
+    ``pki_dir`` if it is still the seeded ``public_key``, returning
+    ``True`` if removed. Blocks, call it from a thread.
+    '''
+    path = os.path.join(pki_dir, 'minions', minion_id)
+    try:
+        with open(path) as fic:
+            accepted = fic.read()
+    except (IOError, OSError):
+        return False
+    if _digest(accepted) != _digest(public_key):
+        # Replaced since, by salt-cloud or an operator
+        return False
+    os.remove(path)
+    return True
+
+
+def _digest(public_key):
+    return hashlib.sha1(public_key.strip()).hexdigest()
+
+
+class KeyPool(object):
+    '''
+    Keep up to ``size`` minion keypairs, of ``keysize`` bits, ready.
+
+    :param interval: the seconds between checks for a refill
+    :param generator: called with ``keysize`` in a thread, returns a
+                      ``(private, public)`` keypair
+    '''
+
+    def __init__(self, size=10, keysize=2048, interval=5, generator=None,
+                 clock=None):
+        self.size = size
+        self.keysize = keysize
+        self.interval = interval
+        self.generator = generator or generate
+        self.clock = clock or reactor
+
+        self._keys = []
+        # The digests of every public key handed out or pooled, so that
+        # no keypair is ever handed out twice
+        self._issued = set()
+        # Keys are drawn from worker threads too
+        self._lock = threading.Lock()
+        self._loop = None
+        self._generating = False
+        self._users = 0
+        self.generated = 0
+        self.drawn = 0
+        self.misses = 0
+
+    def configure(self, size=None, keysize=None):
+        '''
+        Update the settings, ``None`` values are left untouched. Changing
+        ``keysize`` drops the pooled keypairs.
+        '''
+        if size is not None:
+            self.size = size
+        if keysize is not None and keysize != self.keysize:
+            self.keysize = keysize
+            with self._lock:
+                self._keys = []
+
+    # Service like methods, driven by the slaves
+    def start(self):
+        self._users += 1
+        if self._loop is None:
+            self._loop = task.LoopingCall(self.refill)
+            self._loop.clock = self.clock
+            self._loop.start(self.interval, now=False)
+
+    def stop(self):
+        self._users -= 1
+        if self._users > 0:
+            return
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+        self._loop = None
+        with self._lock:
+            # Unused keypairs are not kept around
+            self._keys = []
+
+    def idle(self):
+        '''
+        Return ``True`` if no VM creates are in flight or waiting to be
+        admitted.
+        '''
+        stats = admission.stats()
+        return not stats['in_flight'] and not stats['queued']
+
+    def refill(self):
+        '''
+        Generate one keypair, in a thread, and go on until the pool is full
+        or VM creates start.
+        '''
+        if self._generating or len(self) >= self.size or not self.idle():
+            return
+        self._generating = True
+        keysize = self.keysize
+        d = workers.defer_to_thread(self.generator, keysize)
+        d.addCallback(self._add, keysize)
+
+        def added(_):
+            self._generating = False
+            if self._loop is not None:
+                # Keep going while idle
+                self.clock.callLater(0, self.refill)
+
+        def failed(failure):
+            self._generating = False
+            log.error(
+                'Failed to generate a minion keypair: {0}'.format(
+                    failure.getErrorMessage()
+                )
+            )
+        d.addCallbacks(added, failed)
+        return d
+
+    def _add(self, keys, keysize):
+        if keysize != self.keysize:
+            # Changed while generating
+            return
+        digest = _digest(keys[1])
+        with self._lock:
+            if digest in self._issued:
+                log.warning('Discarding an already issued minion keypair')
+                return
+            self._issued.add(digest)
+            self._keys.append(keys)
+        self.generated += 1
+
+    def draw(self):
+        '''
+        Return a ready ``(private, public)`` keypair, which is never handed
+        out again, or ``None`` if the pool is empty.
+        '''
+        with self._lock:
+            if not self._keys:
+                keys = None
+            else:
+                keys = self._keys.pop(0)
+        if keys is None:
+            self.misses += 1
+            metrics.get_registry().increment('minion_keys', result='miss')
+            return None
+        self.drawn += 1
+        metrics.get_registry().increment('minion_keys', result='hit')
+        return keys
+
+    def __len__(self):
+        with self._lock:
+            return len(self._keys)
+
+    def stats(self):
+        return {
+            'ready': len(self),
+            'size': self.size,
+            'keysize': self.keysize,
+            'generated': self.generated,
+            'drawn': self.drawn,
+            'misses': self.misses
+        }
+
+
+_POOL = None
+
+
+def get_pool(**kwargs):
+    '''
+    Return the process wide key pool, updating its settings with the
+    ``kwargs`` not ``None``.
+    '''
+    global _POOL
+    if _POOL is None:
+        _POOL = KeyPool()
+    _POOL.configure(**kwargs)
+    return _POOL
+
+
+def stats():
+    if _POOL is None:
+        return None
+    return _POOL.stats()
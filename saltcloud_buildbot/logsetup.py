@@ -0,0 +1,384 @@
+# -*- coding: utf-8 -*-
+'''
+    saltcloud_buildbot.logsetup
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    One time, process wide, salt logging setup.
+
+    The console and log file handlers are set up, from the salt-cloud
+    configuration, once per process, not once per slave, and reconfigured
+    in place if the logging settings change, salt only sets them up once.
+    They're then moved behind a queue: the provisioning threads only
+    enqueue their records, and a single listener thread formats and writes
+    them, so dozens of concurrent provisioning threads don't contend on the
+    handlers locks. The handlers installed by others are left alone.
+
+    :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
+    :license: Apache 2.0, see LICENSE for more details.
+'''
+
+# Import python libs
+import sys
+import Queue
+import atexit
+import logging
+import threading
+import logging.handlers
+
+
+log = logging.getLogger(__name__)
+
+
+class QueueHandler(logging.Handler):
+    '''
+    Enqueue the records for the :class:`QueueListener` to handle.
+
+    The records are enqueued as is, their message is only formatted by the
+    listener, so their arguments must not be changed once logged.
+    '''
+
+    def __init__(self, records):
+        logging.Handler.__init__(self)
+        self.records = records
+
+    def emit(self, record):
+        try:
+            self.records.put_nowait(record)
+        except Exception:
+            self.handleError(record)
+
+
+class QueueListener(object):
+    '''
+    Pass the queued records to ``handlers`` from a single background
+    thread, honouring the handlers levels.
+    '''
+
+    _sentinel = None
+
+    def __init__(self, records, handlers):
+        self.records = records
+        self.handlers = list(handlers)
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._monitor, name='saltcloud-buildbot-logging'
+        )
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _monitor(self):
+        while True:
+            record = self.records.get()
+            if record is self._sentinel:
+                break
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+    def stop(self):
+        '''
+        Handle the records still queued and stop the listener thread.
+        '''
+        if self._thread is None:
+            return
+        self.records.put_nowait(self._sentinel)
+        self._thread.join()
+        self._thread = None
+
+
+def logging_settings(config):
+    '''
+    Return the console and log file logging settings in the salt-cloud
+    ``config``, honouring salt-cloud's cli and inheritance rules.
+    '''
+    import salt.config
+
+    # Work on a copy since the configuration must not be changed
+    config = config.copy()
+
+    # First console logging
+    cli_log_fmt = 'cli_salt_cloud_log_fmt'
+    if cli_log_fmt in config and not config.get(cli_log_fmt):
+        # Remove it from config so it inherits from log_fmt_console
+        config.pop(cli_log_fmt)
+    logfmt = config.get(
+        cli_log_fmt, config.get(
+            'log_fmt_console',
+            config.get(
+                'log_fmt',
+                salt.config._DFLT_LOG_FMT_CONSOLE
+            )
+        )
+    )
+
+    cli_log_datefmt = 'cli_salt_cloud_log_datefmt'
+    if cli_log_datefmt in config and not config.get(cli_log_datefmt):
+        # Remove it from config so it inherits from log_datefmt_console
+        config.pop(cli_log_datefmt)
+
+    if config.get('log_datefmt_console', None) is None:
+        # Remove it from config so it inherits from log_datefmt
+        config.pop('log_datefmt_console', None)
+
+    datefmt = config.get(
+        cli_log_datefmt,
+        config.get(
+            'log_datefmt_console',
+            config.get(
+                'log_datefmt',
+                '%Y-%m-%d %H:%M:%S'
+            )
+        )
+    )
+
+    # Now the log file logging
+    if 'log_level_logfile' in config and not \
+            config.get('log_level_logfile'):
+        # Remove it from config so it inherits from log_level
+        config.pop('log_level_logfile')
+
+    loglevel = config.get(
+        'log_level_logfile',
+        # From the console setting
+        config['log_level']
+    )
+
+    cli_log_path = 'cli_salt_cloud_log_file'
+    if cli_log_path in config and not config.get(cli_log_path):
+        # Remove it from config so it inherits from log_file
+        config.pop(cli_log_path)
+
+    logfile = config.get(
+        # First from the config cli setting
+        cli_log_path,
+        config.get(
+            # From the config setting
+            'log_file',
+            # From the default setting
+            '/var/log/salt/cloud'
+        )
+    )
+
+    cli_log_file_fmt = 'cli_salt_cloud_log_file_fmt'
+    if cli_log_file_fmt in config and not config.get(cli_log_file_fmt):
+        # Remove it from config so it inherits from log_fmt_logfile
+        config.pop(cli_log_file_fmt)
+
+    if config.get('log_fmt_logfile', None) is None:
+        # Remove it from config so it inherits from log_fmt_console
+        config.pop('log_fmt_logfile', None)
+
+    log_file_fmt = config.get(
+        cli_log_file_fmt,
+        config.get(
+            'cli_salt_cloud_log_fmt',
+            config.get(
+                'log_fmt_logfile',
+                config.get(
+                    'log_fmt_console',
+                    config.get(
+                        'log_fmt',
+                        salt.config._DFLT_LOG_FMT_CONSOLE
+                    )
+                )
+            )
+        )
+    )
+
+    cli_log_file_datefmt = 'cli_salt_cloud_log_file_datefmt'
+    if cli_log_file_datefmt in config and not \
+            config.get(cli_log_file_datefmt):
+        # Remove it from config so it inherits from log_datefmt_logfile
+        config.pop(cli_log_file_datefmt)
+
+    if config.get('log_datefmt_logfile', None) is None:
+        # Remove it from config so it inherits from log_datefmt_console
+        config.pop('log_datefmt_logfile', None)
+
+    if config.get('log_datefmt_console', None) is None:
+        # Remove it from config so it inherits from log_datefmt
+        config.pop('log_datefmt_console', None)
+
+    log_file_datefmt = config.get(
+        cli_log_file_datefmt,
+        config.get(
+            'cli_salt_cloud_log_datefmt',
+            config.get(
+                'log_datefmt_logfile',
+                config.get(
+                    'log_datefmt_console',
+                    config.get(
+                        'log_datefmt',
+                        '%Y-%m-%d %H:%M:%S'
+                    )
+                )
+            )
+        )
+    )
+
+    return {
+        'console_level': config['log_level'],
+        'console_format': logfmt,
+        'console_datefmt': datefmt,
+        'logfile': logfile,
+        'logfile_level': loglevel,
+        'logfile_format': log_file_fmt,
+        'logfile_datefmt': log_file_datefmt,
+        'granular_levels': tuple(
+            sorted(config.get('log_granular_levels', {}).items())
+        )
+    }
+
+
+_LOCK = threading.Lock()
+_SETTINGS = None
+_LISTENER = None
+# The console and log file handlers set up by this module
+_HANDLERS = {}
+
+
+def setup_logging(config, queued=True):
+    '''
+    Set up the salt console and log file logging from the salt-cloud
+    ``config``, unless it's already set up with the same settings. If
+    ``queued`` is ``True``, the handlers are moved behind a queue.
+
+    Returns ``True`` if logging was set up.
+    '''
+    import salt.log
+
+    global _SETTINGS
+    settings = logging_settings(config)
+    settings['queued'] = queued
+    with _LOCK:
+        if settings == _SETTINGS:
+            return False
+        previous = _SETTINGS
+        _stop_listener()
+
+        if previous is None:
+            root = logging.getLogger()
+            existing = list(root.handlers)
+            salt.log.setup_console_logger(
+                settings['console_level'],
+                log_format=settings['console_format'],
+                date_format=settings['console_datefmt']
+            )
+            salt.log.setup_logfile_logger(
+                settings['logfile'],
+                settings['logfile_level'],
+                log_format=settings['logfile_format'],
+                date_format=settings['logfile_datefmt']
+            )
+            for handler in root.handlers:
+                if handler in existing:
+                    continue
+                if getattr(handler, 'stream', None) is sys.stderr and \
+                        not isinstance(handler, logging.FileHandler):
+                    _HANDLERS['console'] = handler
+                else:
+                    _HANDLERS['logfile'] = handler
+        else:
+            # salt only sets its handlers up once
+            _reconfigure(previous, settings)
+        # Now setup any granular logging levels
+        for name, level in settings['granular_levels']:
+            salt.log.set_logger_level(name, level)
+
+        if queued:
+            _start_listener()
+        _SETTINGS = settings
+    return True
+
+
+def _reconfigure(previous, settings):
+    # Apply the changed settings to the handlers set up by this module
+    import salt.log
+
+    root = logging.getLogger()
+    for kind in ('console', 'logfile'):
+        handler = _HANDLERS.get(kind, None)
+        if kind == 'logfile' and settings['logfile'] != previous['logfile']:
+            if '://' in settings['logfile']:
+                log.warning(
+                    'Logging to {0} requires restarting the master'.format(
+                        settings['logfile']
+                    )
+                )
+            else:
+                try:
+                    replacement = logging.handlers.WatchedFileHandler(
+                        settings['logfile'], mode='a', encoding='utf-8'
+                    )
+                except (IOError, OSError) as err:
+                    log.warning(
+                        'Failed to open the log file {0}: {1}'.format(
+                            settings['logfile'], err
+                        )
+                    )
+                else:
+                    if handler is not None:
+                        root.removeHandler(handler)
+                        handler.close()
+                    root.addHandler(replacement)
+                    handler = _HANDLERS[kind] = replacement
+        if handler is None:
+            continue
+        handler.setLevel(
+            salt.log.LOG_LEVELS.get(
+                (settings['{0}_level'.format(kind)] or 'warning').lower(),
+                logging.ERROR
+            )
+        )
+        handler.setFormatter(
+            logging.Formatter(
+                settings['{0}_format'.format(kind)],
+                datefmt=settings['{0}_datefmt'.format(kind)]
+            )
+        )
+
+
+def _start_listener():
+    global _LISTENER
+    root = logging.getLogger()
+    handlers = [
+        handler for handler in _HANDLERS.values()
+        if handler in root.handlers
+    ]
+    if not handlers:
+        return
+    records = Queue.Queue()
+    for handler in handlers:
+        root.removeHandler(handler)
+    root.addHandler(QueueHandler(records))
+    _LISTENER = QueueListener(records, handlers)
+    _LISTENER.start()
+
+
+def _stop_listener():
+    # Put the queued handlers back in place
+    global _LISTENER
+    if _LISTENER is None:
+        return
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        if isinstance(handler, QueueHandler):
+            root.removeHandler(handler)
+    _LISTENER.stop()
+    for handler in _LISTENER.handlers:
+        root.addHandler(handler)
+    _LISTENER = None
+
+
+def shutdown():
+    '''
+    Write out the queued records and stop the listener thread.
+    '''
+    with _LOCK:
+        _stop_listener()
+
+
+atexit.register(shutdown)
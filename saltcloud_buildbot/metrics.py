@@ -0,0 +1,421 @@
+# -*- coding: utf-8 -*-
+'''
+    saltcloud_buildbot.metrics
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Per phase substantiation timing metrics.
+
+    Each phase of a latent slave's life, from loading the salt-cloud
+    configuration to destroying its VM, is timed and recorded in a
+    histogram labelled by profile and slave, along with success and
+    failure counters. The metrics can be written to a Prometheus text file,
+    for the node exporter's textfile collector, or served over HTTP, as
+    JSON or in the Prometheus text format, by the buildbot master.
+
+    :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
+    :license: Apache 2.0, see LICENSE for more details.
+'''
+
+# Import python libs
+import os
+import json
+import time
+import logging
+import functools
+import threading
+
+# Import twisted libs
+from twisted.internet import defer, reactor, task
+from twisted.web import resource, server
+
+# Import saltcloud_buildbot libs
+from saltcloud_buildbot import readiness
+
+try:
+    from time import monotonic as _now
+except ImportError:
+    try:
+        from monotonic import monotonic as _now
+    except ImportError:
+        _now = time.time
+
+
+log = logging.getLogger(__name__)
+
+
+# The substantiation phases
+CONFIG_LOAD = 'config_load'
+ADMISSION_WAIT = 'admission_wait'
+CLOUD_CREATE = 'cloud_create'
+MINION_CONNECT = 'minion_connect'
+JOB_PUBLISH = 'job_publish'
+HIGHSTATE_RUN = 'highstate_run'
+# Checking and logging the fetched returns
+RETURN_CHECK = 'return_check'
+DESTROY = 'destroy'
+
+PHASES = (
+    CONFIG_LOAD,
+    ADMISSION_WAIT,
+    CLOUD_CREATE,
+    MINION_CONNECT,
+    JOB_PUBLISH,
+    HIGHSTATE_RUN,
+    RETURN_CHECK,
+    DESTROY
+)
+
+# The provisioning states which make up each phase
+STATE_PHASES = {
+    readiness.KEY_ACCEPTED: MINION_CONNECT,
+    readiness.MINION_RESPONDING: MINION_CONNECT,
+    readiness.JOB_PUBLISHED: JOB_PUBLISH,
+    readiness.JOB_RUNNING: HIGHSTATE_RUN,
+    readiness.RETURNED: HIGHSTATE_RUN
+}
+
+# The histogram buckets upper bounds, in seconds
+DEFAULT_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600)
+
+
+class Histogram(object):
+    '''
+    A cumulative histogram along with the success and failure counters of
+    a phase.
+    '''
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.success = 0
+        self.failure = 0
+
+    def observe(self, seconds, success=True):
+        for idx, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                self.counts[idx] += 1
+        self.count += 1
+        self.sum += seconds
+        if success:
+            self.success += 1
+        else:
+            self.failure += 1
+
+
+class Timer(object):
+    '''
+    Time a phase with a monotonic clock, see :meth:`Registry.timer`.
+    '''
+
+    def __init__(self, registry, phase, profile, slavename):
+        self.registry = registry
+        self.phase = phase
+        self.profile = profile
+        self.slavename = slavename
+        self.started = _now()
+
+    def stop(self, success=True):
+        elapsed = _now() - self.started
+        self.registry.observe(
+            self.phase, elapsed, self.profile, self.slavename, success
+        )
+        return elapsed
+
+    def track(self, d):
+        '''
+        Stop the timer once the ``d`` deferred fires, a failure counting as
+        a failed phase. Returns ``d``.
+        '''
+        def success(result):
+            self.stop()
+            return result
+
+        def failure(failure):
+            self.stop(success=False)
+            return failure
+        return d.addCallbacks(success, failure)
+
+
+class Registry(object):
+    '''
+    The phase histograms keyed by ``(phase, profile, slave)``, and a few
+    plain counters and gauges.
+    '''
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self._histograms = {}
+        self._counters = {}
+        self._gauges = {}
+        # Observations are also recorded from worker threads
+        self._lock = threading.Lock()
+
+    def observe(self, phase, seconds, profile=None, slavename=None,
+                success=True):
+        key = (phase, profile or '', slavename or '')
+        with self._lock:
+            if key not in self._histograms:
+                self._histograms[key] = Histogram(self.buckets)
+            self._histograms[key].observe(seconds, success)
+
+    def increment(self, name, amount=1, **labels):
+        '''
+        Increment the ``saltcloud_buildbot_<name>_total`` counter.
+        '''
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def set_gauge(self, name, value, **labels):
+        '''
+        Set the ``saltcloud_buildbot_<name>`` gauge to ``value``.
+        '''
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._gauges[key] = value
+
+    def timer(self, phase, profile=None, slavename=None):
+        '''
+        Start timing ``phase``, returning a :class:`Timer`.
+        '''
+        return Timer(self, phase, profile, slavename)
+
+    def state_observer(self, profile=None, slavename=None):
+        '''
+        Return a :class:`~saltcloud_buildbot.readiness.ProvisioningMachine`
+        observer recording the time spent in each phase.
+        '''
+        elapsed = {}
+
+        def observer(state, seconds, failed=False):
+            phase = STATE_PHASES.get(state, None)
+            if phase is None:
+                return
+            elapsed[phase] = elapsed.get(phase, 0) + seconds
+            if failed or state in (readiness.MINION_RESPONDING,
+                                   readiness.JOB_PUBLISHED,
+                                   readiness.RETURNED):
+                self.observe(
+                    phase, elapsed.pop(phase), profile, slavename,
+                    not failed
+                )
+        return observer
+
+    def as_dict(self):
+        '''
+        Return the metrics as a JSON serializable dictionary.
+        '''
+        metrics = []
+        with self._lock:
+            items = sorted(self._histograms.items())
+            for (phase, profile, slavename), histogram in items:
+                metrics.append({
+                    'phase': phase,
+                    'profile': profile,
+                    'slave': slavename,
+                    'count': histogram.count,
+                    'sum': histogram.sum,
+                    'success': histogram.success,
+                    'failure': histogram.failure,
+                    'buckets': dict(
+                        (str(bound), count) for bound, count in
+                        zip(histogram.buckets, histogram.counts)
+                    )
+                })
+            counters = [
+                {'name': name, 'labels': dict(labels), 'value': value}
+                for (name, labels), value in sorted(self._counters.items())
+            ]
+            gauges = [
+                {'name': name, 'labels': dict(labels), 'value': value}
+                for (name, labels), value in sorted(self._gauges.items())
+            ]
+        return {'phases': metrics, 'counters': counters, 'gauges': gauges}
+
+    def render(self):
+        '''
+        Return the metrics in the Prometheus text exposition format.
+        '''
+        lines = [
+            '# HELP saltcloud_buildbot_phase_seconds Time spent in each '
+            'substantiation phase.',
+            '# TYPE saltcloud_buildbot_phase_seconds histogram'
+        ]
+        totals = []
+        with self._lock:
+            items = sorted(self._histograms.items())
+            for (phase, profile, slavename), histogram in items:
+                labels = 'phase="{0}",profile="{1}",slave="{2}"'.format(
+                    _escape(phase), _escape(profile), _escape(slavename)
+                )
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    lines.append(
+                        'saltcloud_buildbot_phase_seconds_bucket'
+                        '{{{0},le="{1}"}} {2}'.format(labels, bound, count)
+                    )
+                lines.append(
+                    'saltcloud_buildbot_phase_seconds_bucket'
+                    '{{{0},le="+Inf"}} {1}'.format(labels, histogram.count)
+                )
+                lines.append(
+                    'saltcloud_buildbot_phase_seconds_sum{{{0}}} {1}'.format(
+                        labels, repr(histogram.sum)
+                    )
+                )
+                lines.append(
+                    'saltcloud_buildbot_phase_seconds_count{{{0}}} '
+                    '{1}'.format(labels, histogram.count)
+                )
+                for result in ('success', 'failure'):
+                    totals.append(
+                        'saltcloud_buildbot_phase_total{{{0},result="{1}"}} '
+                        '{2}'.format(
+                            labels, result, getattr(histogram, result)
+                        )
+                    )
+            counters = sorted(self._counters.items())
+            gauges = sorted(self._gauges.items())
+        lines.extend([
+            '# HELP saltcloud_buildbot_phase_total Substantiation phases '
+            'run, by result.',
+            '# TYPE saltcloud_buildbot_phase_total counter'
+        ])
+        lines.extend(totals)
+        typed = set()
+        for kind, template, values in (
+                ('counter', 'saltcloud_buildbot_{0}_total', counters),
+                ('gauge', 'saltcloud_buildbot_{0}', gauges)):
+            for (name, labels), value in values:
+                metric = template.format(name)
+                if metric not in typed:
+                    lines.append('# TYPE {0} {1}'.format(metric, kind))
+                    typed.add(metric)
+                lines.append(
+                    '{0}{{{1}}} {2}'.format(
+                        metric,
+                        ','.join(
+                            '{0}="{1}"'.format(key, _escape(str(val)))
+                            for key, val in labels
+                        ),
+                        value
+                    )
+                )
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n'
+    )
+
+
+_REGISTRY = None
+
+
+def get_registry():
+    '''
+    Return the process wide metrics registry.
+    '''
+    global _REGISTRY
+    if _REGISTRY is None:
+        _REGISTRY = Registry()
+    return _REGISTRY
+
+
+def timer(phase, profile=None, slavename=None):
+    return get_registry().timer(phase, profile, slavename)
+
+
+def state_observer(profile=None, slavename=None):
+    return get_registry().state_observer(profile, slavename)
+
+
+def timed(phase, profile=None, slavename=None):
+    '''
+    Return a decorator timing each call of the decorated function, which
+    may return a deferred.
+    '''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            phase_timer = timer(phase, profile, slavename)
+            try:
+                result = func(*args, **kwargs)
+            except Exception:
+                phase_timer.stop(success=False)
+                raise
+            if isinstance(result, defer.Deferred):
+                return phase_timer.track(result)
+            phase_timer.stop()
+            return result
+        return wrapper
+    return decorator
+
+
+def write_textfile(path, registry=None):
+    '''
+    Atomically write the metrics, in the Prometheus text format, to
+    ``path``.
+    '''
+    registry = registry or get_registry()
+    tmp_path = '{0}.tmp'.format(path)
+    try:
+        with open(tmp_path, 'w') as fic:
+            fic.write(registry.render())
+        os.rename(tmp_path, path)
+    except (IOError, OSError) as err:
+        log.error(
+            'Failed to write the metrics file {0}: {1}'.format(path, err)
+        )
+
+
+class MetricsResource(resource.Resource):
+    '''
+    Serve the metrics as JSON, or in the Prometheus text format if the
+    ``format=prometheus`` query argument is passed.
+    '''
+
+    isLeaf = True
+
+    def __init__(self, registry=None):
+        resource.Resource.__init__(self)
+        self.registry = registry or get_registry()
+
+    def render_GET(self, request):
+        if request.args.get('format', [None])[0] == 'prometheus':
+            request.setHeader('Content-Type', 'text/plain; version=0.0.4')
+            return self.registry.render()
+        request.setHeader('Content-Type', 'application/json')
+        return json.dumps(self.registry.as_dict())
+
+
+_EXPORTS = {}
+
+
+def export(path=None, port=None, interval=60, interface='127.0.0.1'):
+    '''
+    Export the process wide metrics, every ``interval`` seconds to the
+    ``path`` Prometheus text file, and over HTTP on ``port``, only
+    listening on ``interface``, the loopback one by default, since the
+    metrics are served unauthenticated. Each path and port is only exported
+    once.
+    '''
+    if path and path not in _EXPORTS:
+        loop = task.LoopingCall(write_textfile, path)
+        loop.start(interval, now=False)
+        reactor.addSystemEventTrigger(
+            'after', 'shutdown', write_textfile, path
+        )
+        _EXPORTS[path] = loop
+    if port and port not in _EXPORTS:
+        _EXPORTS[port] = reactor.listenTCP(
+            port, server.Site(MetricsResource()), interface=interface
+        )
+        log.info(
+            'Serving the substantiation metrics on {0}:{1}'.format(
+                interface, port
+            )
+        )
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+'''
+    saltcloud_buildbot.naming
+    ~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Collision free VM names.
+
+    Each substantiation, pool VM and image bake gets a fresh VM name, made
+    of its owner, its kind and a random 48 bits token, so names don't
+    collide across masters. The names in use are kept in a process wide
+    registry until their VM is destroyed, which also rules out collisions
+    within the master. Since a slave's next VM never reuses the previous
+    VM's name, it can be created while the previous one is still being
+    destroyed.
+
+    :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
+    :license: Apache 2.0, see LICENSE for more details.
+'''
+
+# Import python libs
+import random
+import logging
+import threading
+
+
+log = logging.getLogger(__name__)
+
+
+# The kinds of VMs
+RANDOM = 'rnd'
+BAKE = 'bake'
+
+# The names of the VMs created by saltcloud_buildbot, older releases used
+# decimal tokens
+PATTERN = r'-buildbot-(rnd|bake)[0-9a-f]+$'
+
+# Separates the prefix, the slave or profile owning the VM, from the rest
+# of the name
+SEPARATOR = '-buildbot-'
+
+
+def owner_prefix(vm_name):
+    '''
+    Return the prefix ``vm_name`` was allocated with, the name of the slave,
+    or profile, owning it.
+    '''
+    if SEPARATOR not in vm_name:
+        return None
+    return vm_name.rsplit(SEPARATOR, 1)[0]
+
+
+class NameAllocator(object):
+    '''
+    Issue unique VM names and track the ones in use.
+    '''
+
+    def __init__(self, bits=48):
+        self.bits = bits
+        # VM name to its owner
+        self._names = {}
+        # Names are also allocated from worker threads
+        self._lock = threading.Lock()
+        self._random = random.SystemRandom()
+
+    def allocate(self, prefix, kind=RANDOM, owner=None):
+        '''
+        Return a new VM name, ``<prefix>-buildbot-<kind><token>``, for
+        ``owner``, which defaults to ``prefix``.
+        '''
+        with self._lock:
+            while True:
+                vm_name = '{0}{1}{2}{3:0{4}x}'.format(
+                    prefix,
+                    SEPARATOR,
+                    kind,
+                    self._random.getrandbits(self.bits),
+                    self.bits // 4
+                )
+                if vm_name not in self._names:
+                    break
+            self._names[vm_name] = owner or prefix
+        return vm_name
+
+    def reserve(self, vm_name, owner=None):
+        '''
+        Register the ``vm_name`` VM, created by a previous master process,
+        as in use.
+        '''
+        with self._lock:
+            self._names[vm_name] = owner
+
+    def release(self, vm_name):
+        '''
+        Release ``vm_name`` once its VM is destroyed.
+        '''
+        with self._lock:
+            self._names.pop(vm_name, None)
+
+    def owner(self, vm_name):
+        with self._lock:
+            return self._names.get(vm_name, None)
+
+    def names(self, owner=None):
+        '''
+        Return the names in use, only ``owner``'s if passed.
+        '''
+        with self._lock:
+            return sorted(
+                vm_name for vm_name, vm_owner in self._names.items()
+                if owner is None or vm_owner == owner
+            )
+
+    def __contains__(self, vm_name):
+        with self._lock:
+            return vm_name in self._names
+
+    def __len__(self):
+        with self._lock:
+            return len(self._names)
+
+
+_ALLOCATOR = None
+
+
+def get_allocator():
+    '''
+    Return the process wide name allocator.
+    '''
+    global _ALLOCATOR
+    if _ALLOCATOR is None:
+        _ALLOCATOR = NameAllocator()
+    return _ALLOCATOR
+
+
+def allocate(prefix, kind=RANDOM, owner=None):
+    return get_allocator().allocate(prefix, kind, owner)
+
+
+def release(vm_name):
+    get_allocator().release(vm_name)
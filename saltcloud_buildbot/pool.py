@@ -0,0 +1,320 @@
+# -*- coding: utf-8 -*-
+'''
+    saltcloud_buildbot.pool
+    ~~~~~~~~~~~~~~~~~~~~~~~
+
+    A warm pool of idle, already highstated, salt-cloud VMs.
+
+    Pools are shared, per ``saltcloud_profile_name``, by every latent slave
+    running on the buildbot master. When a slave substantiates it claims a
+    ready VM from the pool, rebinds the ``buildbot`` grains to itself and the
+    pool is refilled in the background.
+
+    :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
+    :license: Apache 2.0, see LICENSE for more details.
+'''
+
+# Import python libs
+import time
+import logging
+
+# Import twisted libs
+from twisted.internet import defer, task
+
+# Import buildbot libs
+from buildbot.interfaces import LatentBuildSlaveFailedToSubstantiate
+
+# Import saltcloud_buildbot libs
+from saltcloud_buildbot import (
+    admission, history, naming, provision, teardown, workers
+)
+
+
+log = logging.getLogger(__name__)
+
+
+# The process wide pools, keyed by salt-cloud profile name
+_POOLS = {}
+
+
+def get_pool(profile_name, config_loader, master_config, **kwargs):
+    '''
+    Return the warm pool for ``profile_name``, creating it if needed.
+
+    ``config_loader`` is a callable returning the salt-cloud configuration
+    dictionary. The remaining keyword arguments are passed to
+    :class:`WarmPool` and update the settings of an already existing pool.
+    '''
+    pool = _POOLS.get(profile_name, None)
+    if pool is None:
+        pool = _POOLS[profile_name] = WarmPool(
+            profile_name, config_loader, master_config, **kwargs
+        )
+    else:
+        pool.configure(**kwargs)
+    return pool
+
+
+class PoolVM(object):
+    '''
+    An idle VM in the pool.
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        self.created = time.time()
+
+    @property
+    def age(self):
+        return time.time() - self.created
+
+
+class WarmPool(object):
+    '''
+    Keep ``size`` idle, highstated, VMs of a salt-cloud profile around.
+
+    :param size: the number of idle VMs to keep ready
+    :param max_age: idle VMs older than this, in seconds, are destroyed and
+                    replaced. ``None`` disables age based eviction.
+    :param check_interval: how often, in seconds, to look for VMs to evict
+    :param rebind_state: the SLS to run after rebinding the ``buildbot``
+                         grains of a claimed VM. ``None`` runs a
+                         ``state.highstate`` which, on an already highstated
+                         VM, only re-applies what changed.
+    :param state_options: the keyword arguments passed to
+                          :func:`~saltcloud_buildbot.provision.run_state`
+    :param minion_options: the keyword arguments passed to
+        :func:`~saltcloud_buildbot.provision.build_minion_config`
+    '''
+
+    def __init__(self, profile_name, config_loader, master_config, size=1,
+                 max_age=60 * 60 * 4, check_interval=60, rebind_state=None,
+                 state_options=None, minion_options=None):
+        self.profile_name = profile_name
+        self.config_loader = config_loader
+        self.master_config = master_config
+        self.size = size
+        self.max_age = max_age
+        self.check_interval = check_interval
+        self.rebind_state = rebind_state
+        self.state_options = state_options or {}
+        self.minion_options = minion_options or {}
+
+        self._ready = []
+        self._provisioning = 0
+        self._users = 0
+        self._evict_loop = None
+
+    def configure(self, size=None, max_age=None, check_interval=None,
+                  rebind_state=None, state_options=None,
+                  minion_options=None):
+        '''
+        Update the pool settings. The last configured slave wins.
+        '''
+        if size is not None:
+            self.size = size
+        if max_age is not None:
+            self.max_age = max_age
+        if check_interval is not None:
+            self.check_interval = check_interval
+        if rebind_state is not None:
+            self.rebind_state = rebind_state
+        if state_options is not None:
+            self.state_options = state_options
+        if minion_options is not None:
+            self.minion_options = minion_options
+
+    # Service like methods, driven by the slaves using this pool
+    def start(self):
+        self._users += 1
+        if self._evict_loop is None:
+            self._evict_loop = task.LoopingCall(self.evict)
+            self._evict_loop.start(self.check_interval, now=False)
+        self.refill()
+
+    def stop(self):
+        self._users -= 1
+        if self._users > 0:
+            return
+        if self._evict_loop is not None and self._evict_loop.running:
+            self._evict_loop.stop()
+        self._evict_loop = None
+        names = [vm.name for vm in self._ready]
+        self._ready = []
+        if names:
+            return self.__destroy(names)
+
+    @defer.inlineCallbacks
+    def claim(self, slavename, password):
+        '''
+        Claim a ready VM for ``slavename`` and rebind its ``buildbot`` grains.
+
+        Returns a deferred firing with the VM name or ``None`` if there's no
+        ready VM.
+        '''
+        while True:
+            if not self._ready:
+                vm = None
+            else:
+                # Hand out the youngest VM, the older ones will be evicted
+                # first
+                vm = self._ready.pop()
+            # Whatever happens next, the pool needs to be refilled
+            self.refill()
+
+            if vm is None:
+                log.info(
+                    'No ready VMs in the {0!r} pool'.format(self.profile_name)
+                )
+                defer.returnValue(None)
+
+            try:
+                yield self.__rebind(vm.name, slavename, password)
+            except Exception as err:
+                # Discard this VM, it's no longer in the pool, and try the
+                # next one
+                log.warning(
+                    'Failed to rebind VM {0} from the {1!r} pool to slave '
+                    '{2}, discarding it: {3}'.format(
+                        vm.name, self.profile_name, slavename, err
+                    )
+                )
+                self.__destroy([vm.name])
+                continue
+
+            log.info(
+                'Slave {0} claimed VM {1} from the {2!r} pool'.format(
+                    slavename, vm.name, self.profile_name
+                )
+            )
+            defer.returnValue(vm.name)
+
+    def refill(self):
+        '''
+        Start provisioning VMs until the pool has ``size`` ready, or being
+        provisioned, VMs.
+        '''
+        if self._users < 1:
+            return
+        missing = self.size - len(self._ready) - self._provisioning
+        for _ in range(missing):
+            d = self.__provision()
+            d.addErrback(
+                lambda f: log.error(
+                    'Failed to provision a VM for the {0!r} pool: {1}'.format(
+                        self.profile_name, f.getErrorMessage()
+                    )
+                )
+            )
+
+    def evict(self):
+        '''
+        Destroy the idle VMs older than ``max_age`` and any VMs above
+        ``size``.
+        '''
+        evicted = []
+        if self.max_age is not None:
+            for vm in self._ready[:]:
+                if vm.age > self.max_age:
+                    self._ready.remove(vm)
+                    evicted.append(vm.name)
+        # The oldest VMs are at the start of the list
+        while len(self._ready) > self.size:
+            evicted.append(self._ready.pop(0).name)
+        if evicted:
+            log.info(
+                'Evicting VM(s) {0} from the {1!r} pool'.format(
+                    ', '.join(evicted), self.profile_name
+                )
+            )
+            self.__destroy(evicted)
+        self.refill()
+
+    @defer.inlineCallbacks
+    def __provision(self):
+        self._provisioning += 1
+        try:
+            config = yield workers.defer_to_thread(self.config_loader)
+            minion_conf = yield workers.defer_to_thread(
+                provision.build_minion_config,
+                config, self.profile_name, None, None,
+                **self.minion_options
+            )
+            vm_name = naming.allocate(self.profile_name)
+            teardown.get_destroyer().track(vm_name, self.config_loader)
+            try:
+                yield admission.create_admitted(
+                    config, self.profile_name, vm_name,
+                    provision.create_vm,
+                    config, self.profile_name, vm_name, minion_conf,
+                    priority=admission.BACKGROUND_PRIORITY
+                )
+                yield provision.run_state(
+                    config, self.master_config, vm_name,
+                    profile_name=self.profile_name, **self.state_options
+                )
+            except Exception:
+                self.__destroy([vm_name])
+                raise
+        finally:
+            self._provisioning -= 1
+
+        if self._users < 1:
+            # Nobody's using the pool anymore
+            self.__destroy([vm_name])
+            defer.returnValue(None)
+
+        self._ready.append(PoolVM(vm_name))
+        log.info(
+            'VM {0} is ready in the {1!r} pool'.format(
+                vm_name, self.profile_name
+            )
+        )
+        defer.returnValue(vm_name)
+
+    @defer.inlineCallbacks
+    def __rebind(self, vm_name, slavename, password):
+        config = yield workers.defer_to_thread(self.config_loader)
+        client = yield workers.defer_to_thread(
+            provision.get_local_client, self.master_config
+        )
+        ret = yield workers.defer_to_thread(
+            client.cmd,
+            [vm_name],
+            'grains.setval',
+            ['buildbot', {'slavename': slavename, 'password': password}],
+            expr_form='list'
+        )
+        if not ret or not ret.get(vm_name, None):
+            msg = 'Failed to rebind the buildbot grains on {0}: {1}'.format(
+                vm_name, ret
+            )
+            log.error(msg)
+            raise LatentBuildSlaveFailedToSubstantiate(vm_name, msg)
+
+        if self.rebind_state is None:
+            yield provision.run_state(
+                config, self.master_config, vm_name, slavename,
+                profile_name=self.profile_name, history_path=history.POOL,
+                **self.state_options
+            )
+        else:
+            yield provision.run_state(
+                config, self.master_config, vm_name, slavename,
+                fun='state.sls', arg=[self.rebind_state],
+                profile_name=self.profile_name, history_path=history.POOL,
+                **self.state_options
+            )
+
+    def __destroy(self, names):
+        d = workers.defer_to_thread(self.config_loader)
+        d.addCallback(teardown.get_destroyer().destroy, names)
+        d.addErrback(
+            lambda f: log.error(
+                'Failed to destroy pool VM(s) {0}: {1}'.format(
+                    ', '.join(names), f.getErrorMessage()
+                )
+            )
+        )
+        return d
@@ -0,0 +1,397 @@
+# -*- coding: utf-8 -*-
+'''
+    saltcloud_buildbot.provision
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    The salt-cloud VM provisioning steps shared by the latent slave and the
+    warm VM pool.
+
+    Apart from :func:`run_state`, which returns a deferred, these functions
+    are blocking and are meant to run in a thread.
+
+    :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
+    :license: Apache 2.0, see LICENSE for more details.
+'''
+
+# Import python libs
+import copy
+import logging
+import threading
+
+# Import twisted libs
+from twisted.internet import defer
+
+# Import buildbot libs
+from buildbot.interfaces import LatentBuildSlaveFailedToSubstantiate
+
+# Import saltcloud_buildbot libs
+from saltcloud_buildbot import (
+    formatting, history, metrics, readiness, resolvers, workers
+)
+
+
+log = logging.getLogger(__name__)
+
+
+def get_profile(config, profile_name):
+    '''
+    Return the salt-cloud profile named ``profile_name`` or fail
+    substantiation.
+    '''
+    profile = config['profiles'].get(profile_name, None)
+    if profile is None:
+        msg = 'The profile {0!r} does not exist.'.format(profile_name)
+        log.error(msg)
+        raise LatentBuildSlaveFailedToSubstantiate(profile_name, msg)
+    return profile
+
+
+def build_minion_config(config, profile_name, slavename, password,
+                        master_resolvers=None, master_address_ttl=60 * 60,
+                        state_events=False):
+    '''
+    Return a copy of the profile's minion configuration with the ``buildbot``
+    grains set to ``slavename`` and ``password``, and with the per state
+    progress events enabled if ``state_events`` is ``True``.
+
+    If the minion configuration has no ``master`` set, it's discovered by
+    ``master_resolvers``, see
+    :func:`~saltcloud_buildbot.resolvers.resolve_master_address`.
+    '''
+    import saltcloud.config
+    profile = get_profile(config, profile_name)
+    minion_conf = copy.deepcopy(
+        saltcloud.config.get_config_value(
+            'minion', profile, config, default={}
+        )
+    )
+
+    # Setup the required slave grains to be used by the minion
+    if not minion_conf.get('master', None):
+        master = resolvers.resolve_master_address(
+            master_resolvers, master_address_ttl
+        )
+        if not master:
+            msg = 'Failed to get the public IP for the master.'
+            log.warning(msg)
+            raise LatentBuildSlaveFailedToSubstantiate(profile_name, msg)
+        minion_conf['master'] = master
+
+    # Set the buildbot slave name and password as a grain
+    if 'grains' not in minion_conf:
+        minion_conf['grains'] = {}
+
+    if 'buildbot' not in minion_conf['grains']:
+        minion_conf['grains']['buildbot'] = {}
+
+    minion_conf['grains']['buildbot']['slavename'] = slavename
+    minion_conf['grains']['buildbot']['password'] = password
+
+    if state_events:
+        minion_conf['state_events'] = True
+
+    # Remove settings that should be set at runtime
+    minion_conf.pop('conf_file', None)
+    return minion_conf
+
+
+def check_create_return(ret, vm_name, slavename=None):
+    '''
+    Fail substantiation if the salt-cloud create return for ``vm_name`` is
+    empty or has errors.
+    '''
+    if not ret or not ret.get(vm_name, None):
+        msg = 'Failed to start {0} for slave {1}'.format(
+            vm_name,
+            slavename
+        )
+        log.error(msg)
+        raise LatentBuildSlaveFailedToSubstantiate(vm_name, msg)
+
+    if 'Errors' in ret[vm_name]:
+        msg = (
+            'There were errors while trying to start salt-cloud VM '
+            '{0} for slave {1}: {2}'.format(
+                vm_name,
+                slavename,
+                ret[vm_name]['Errors']
+            )
+        )
+        log.error(msg)
+        raise LatentBuildSlaveFailedToSubstantiate(vm_name, msg)
+
+    if isinstance(ret[vm_name].get(vm_name, None), dict) and \
+            'Errors' in ret[vm_name][vm_name]:
+        msg = (
+            'There were errors while trying to start salt-cloud VM '
+            '{0} for slave {1}: {2}'.format(
+                vm_name,
+                slavename,
+                ret[vm_name][vm_name]['Errors']
+            )
+        )
+        log.error(msg)
+        raise LatentBuildSlaveFailedToSubstantiate(vm_name, msg)
+
+
+def deploys(config, profile_name):
+    '''
+    Return ``True`` if salt-cloud deploys a minion, with a fresh keypair,
+    on the VMs of the ``profile_name`` profile.
+    '''
+    import saltcloud.config
+    return bool(
+        saltcloud.config.get_config_value(
+            'deploy', get_profile(config, profile_name), config, default=True
+        )
+    )
+
+
+def create_vm(config, profile_name, vm_name, minion_conf, slavename=None,
+              overrides=None):
+    '''
+    Create the ``vm_name`` VM from the ``profile_name`` salt-cloud profile,
+    updated with ``overrides``, using ``minion_conf`` as its minion
+    configuration.
+    '''
+    config = config.copy()
+    config['profiles'] = config['profiles'].copy()
+    profile = get_profile(config, profile_name).copy()
+    profile.update(overrides or {})
+
+    # Update the virtual machines minion configuration
+    profile['minion'] = minion_conf
+    config['profiles'][profile_name] = profile
+
+    import saltcloud.cloud
+    mapper = saltcloud.cloud.Map(config)
+    try:
+        ret = mapper.run_profile(profile_name, [vm_name])
+        check_create_return(ret, vm_name, slavename)
+        # Only formatted if actually logged
+        log.info(
+            'salt-cloud started VM %s for slave %s. Details:\n%s',
+            vm_name,
+            slavename,
+            formatting.lazy(ret[vm_name], 'pprint', config, vm_name, 'create')
+        )
+        return ret
+    except LatentBuildSlaveFailedToSubstantiate:
+        raise
+    except Exception, err:
+        msg = (
+            'salt-cloud failed to start VM {0} for slave {1}. '
+            'Details:\n{2}'.format(
+                vm_name,
+                slavename,
+                err
+            )
+        )
+        log.error(msg, exc_info=True)
+        raise LatentBuildSlaveFailedToSubstantiate(vm_name, msg)
+
+
+def find_vm_return(ret, vm_name):
+    '''
+    Find the ``vm_name`` return in a, possibly provider nested, salt-cloud
+    return.
+    '''
+    if not isinstance(ret, dict):
+        return None
+    if vm_name in ret:
+        return ret[vm_name]
+    for value in ret.values():
+        found = find_vm_return(value, vm_name)
+        if found is not None:
+            return found
+    return None
+
+
+def get_local_client(master_config):
+    '''
+    Return a salt ``LocalClient`` instance for the ``master_config`` path.
+    '''
+    try:
+        import salt.client
+        return salt.client.LocalClient(c_path=master_config)
+    except Exception as err:
+        log.error(
+            'Failed to instantiate the salt local client: {0}\n'.format(
+                err
+            ),
+            exc_info=True
+        )
+        raise
+
+
+# LocalClient isn't thread safe, each thread gets its own
+_LOCAL_CLIENTS = threading.local()
+
+
+def get_shared_local_client(master_config):
+    '''
+    Return the calling thread's salt ``LocalClient`` for the
+    ``master_config`` path, so that the clients are reused, along with
+    their master connection, across calls made from the worker threads.
+    '''
+    clients = getattr(_LOCAL_CLIENTS, 'clients', None)
+    if clients is None:
+        clients = _LOCAL_CLIENTS.clients = {}
+    client = clients.get(master_config, None)
+    if client is None:
+        client = clients[master_config] = get_local_client(master_config)
+    return client
+
+
+@defer.inlineCallbacks
+def run_state(config, master_config, vm_name, slavename=None,
+              fun='state.highstate', arg=(), **kwargs):
+    '''
+    Run ``fun`` (``state.highstate`` by default) on the ``vm_name`` minion,
+    wait for it to finish and check that every state succeeded.
+
+    Returns a deferred firing with the job returns. The phase timings are
+    recorded in the metrics, and in the latency history, under the
+    ``history_path`` keyword argument provisioning path, cold by default, if
+    the ``profile_name`` keyword argument is passed, an ``observer`` keyword
+    argument is called along. The
+    remaining keyword arguments, like ``completion``, ``deadlines`` or
+    ``min_interval``, are passed to
+    :class:`~saltcloud_buildbot.readiness.ProvisioningMachine`.
+    '''
+    log.info('Running {0!r} on the minion'.format(fun))
+    profile_name = kwargs.pop('profile_name', None)
+    history_path = kwargs.pop('history_path', history.COLD)
+    observers = [metrics.state_observer(profile_name, slavename)]
+    if profile_name is not None:
+        observers.append(
+            history.state_observer(profile_name, fun, history_path)
+        )
+    if kwargs.get('observer', None) is not None:
+        observers.append(kwargs['observer'])
+
+    def observer(state, seconds, failed=False):
+        for func in observers:
+            func(state, seconds, failed)
+    kwargs['observer'] = observer
+    client = yield workers.defer_to_thread(get_local_client, master_config)
+
+    try:
+        machine = readiness.ProvisioningMachine(
+            client, vm_name, fun=fun, arg=arg, slavename=slavename, **kwargs
+        )
+        highstate = yield machine.run()
+        yield metrics.timer(
+            metrics.RETURN_CHECK, profile_name, slavename
+        ).track(
+            workers.defer_to_thread(
+                check_state_returns, config, vm_name, highstate, slavename,
+                fun
+            )
+        )
+        defer.returnValue(highstate)
+    except (LatentBuildSlaveFailedToSubstantiate, readiness.Cancelled):
+        raise
+    except Exception, err:
+        msg = (
+            'Failed to run {0!r} on the {1} minion({2}). '
+            'Details:\n{3}'.format(
+                fun,
+                slavename,
+                vm_name,
+                err
+            )
+        )
+        log.error(
+            msg,
+            # Show the traceback if the debug logging level is enabled
+            exc_info=log.isEnabledFor(logging.DEBUG)
+        )
+        raise LatentBuildSlaveFailedToSubstantiate(vm_name, msg)
+
+
+def check_state_returns(config, vm_name, highstate, slavename=None,
+                        fun='state.highstate'):
+    '''
+    Log the state run returns and fail substantiation if any of the states
+    failed.
+    '''
+    minion_ret = highstate and highstate.get(vm_name, None)
+    summary_data = None
+    if isinstance(minion_ret, dict) and \
+            isinstance(minion_ret.get('ret', None), dict):
+        summary_data = minion_ret['ret']
+    # Only formatted if actually logged, the raw return is stored as an
+    # artifact
+    log.info(
+        'Output of running %r on the %s minion(%s):\n%s',
+        fun,
+        slavename,
+        vm_name,
+        formatting.lazy(
+            minion_ret if minion_ret is not None else highstate,
+            'highstate' if minion_ret is not None else 'pprint',
+            config,
+            vm_name,
+            fun,
+            summary_data=summary_data
+        )
+    )
+
+    if not highstate or 'Error' in highstate:
+        msg = (
+            'Returned empty or error running {0} on '
+            '{1} for slave {2}: {3}'.format(
+                fun,
+                vm_name,
+                slavename,
+                highstate
+            )
+        )
+        log.error(msg)
+        raise LatentBuildSlaveFailedToSubstantiate(vm_name, msg)
+
+    if isinstance(highstate[vm_name]['ret'], list):
+        # We got a list back!?
+        msg = (
+            'Failed to run {0!r} on the {1} minion({2}).'
+            ' Highstate details:\n{3}'.format(
+                fun,
+                slavename,
+                vm_name,
+                highstate[vm_name]['ret']
+            )
+        )
+        log.error(msg)
+        raise LatentBuildSlaveFailedToSubstantiate(vm_name, msg)
+
+    for step in highstate[vm_name]['ret'].values():
+        if step['result'] is False:
+            try:
+                msg = 'The step {0[name]!r} failed!'.format(step)
+            except KeyError:
+                msg = (
+                    'There was failure in a step. '
+                    'Step details: {0}'.format(step)
+                )
+            log.error(msg)
+            raise LatentBuildSlaveFailedToSubstantiate(vm_name, msg)
+    log.info(
+        '{0} completed without any issues on {1}'.format(fun, vm_name)
+    )
+
+
+def destroy_vms(config, names):
+    '''
+    Destroy the salt-cloud VMs in ``names``.
+    '''
+    import saltcloud.cloud
+    mapper = saltcloud.cloud.Map(config)
+    ret = mapper.destroy(list(names))
+    log.info(
+        'salt-cloud destroyed VM(s) %s. Details:\n%s',
+        ', '.join(names),
+        formatting.lazy(ret, 'pprint', config)
+    )
+    return ret
@@ -0,0 +1,507 @@
+# -*- coding: utf-8 -*-
+'''
+    saltcloud_buildbot.readiness
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    The provisioning state machine which takes a freshly created salt-cloud
+    VM to a finished state run::
+
+        created -> key accepted -> minion responding -> job published
+                -> job running -> returned
+
+    Each transition is detected by a cheap probe, retried with exponential
+    backoff and jitter, and each phase has its own deadline. The machine is
+    driven by the reactor, only the blocking probes run in a thread. The job
+    return is waited for on the master's shared event bus reader, see
+    :mod:`saltcloud_buildbot.events`, without holding a thread.
+
+    :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
+    :license: Apache 2.0, see LICENSE for more details.
+'''
+
+# Import python libs
+import os
+import random
+import fnmatch
+import logging
+
+# Import twisted libs
+from twisted.internet import defer, reactor, task
+
+# Import buildbot libs
+from buildbot.interfaces import LatentBuildSlaveFailedToSubstantiate
+
+# Import saltcloud_buildbot libs
+from saltcloud_buildbot import events, workers
+
+
+log = logging.getLogger(__name__)
+
+
+# The provisioning states
+CREATED = 'created'
+KEY_ACCEPTED = 'key accepted'
+MINION_RESPONDING = 'minion responding'
+JOB_PUBLISHED = 'job published'
+JOB_RUNNING = 'job running'
+RETURNED = 'returned'
+
+STATES = (
+    CREATED,
+    KEY_ACCEPTED,
+    MINION_RESPONDING,
+    JOB_PUBLISHED,
+    JOB_RUNNING,
+    RETURNED
+)
+
+# The maximum time, in seconds, allowed to reach each state from the
+# previous one
+DEFAULT_DEADLINES = {
+    KEY_ACCEPTED: 60 * 5,
+    MINION_RESPONDING: 60 * 2,
+    JOB_PUBLISHED: 60 * 2,
+    JOB_RUNNING: 60 * 2,
+    RETURNED: 60 * 60
+}
+
+
+class Backoff(object):
+    '''
+    Exponential backoff delays, between ``initial`` and ``maximum``
+    seconds, with up to ``jitter`` (a fraction of the delay) random jitter
+    so that many slaves don't probe in lockstep.
+    '''
+
+    def __init__(self, initial=0.5, maximum=10, factor=2, jitter=0.5):
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.jitter = jitter
+        self.current = initial
+
+    def reset(self):
+        self.current = self.initial
+
+    def next(self):
+        delay = min(self.current, self.maximum)
+        self.current = min(self.current * self.factor, self.maximum)
+        return delay * (1 - self.jitter * random.random())
+
+
+# Returned by the probes when the next state has not been reached yet
+PENDING = object()
+
+
+class StateFailed(Exception):
+    '''
+    Raised, while streaming the state results, when a state run aborting
+    state fails.
+    '''
+
+    def __init__(self, state_id, ret):
+        Exception.__init__(self, state_id, ret)
+        self.state_id = state_id
+        self.ret = ret
+
+
+class Cancelled(Exception):
+    '''
+    Raised when the provisioning of a VM is cancelled, for example when a
+    hedged VM won the race against it.
+    '''
+
+
+class ProvisioningMachine(object):
+    '''
+    Drive the ``vm_name`` minion from :data:`CREATED` to :data:`RETURNED`
+    for the ``fun`` job.
+
+    :param client: a salt ``LocalClient``
+    :param completion: ``'event'`` to wait for the job return on the master
+                       event bus, ``'poll'`` to poll the minion with
+                       ``saltutil.running``
+    :param event_factory: called with the client options, returns an event
+                          bus subscriber, used by the master's shared
+                          :class:`~saltcloud_buildbot.events.EventReader`
+    :param event_fallback_interval: while waiting on the event bus, ask the
+                                    minion if the job is still running
+                                    after this many seconds without a return
+    :param deadlines: a dictionary of state to the maximum seconds allowed
+                      to reach it, updating :data:`DEFAULT_DEADLINES`
+    :param min_interval: the initial delay between probes
+    :param max_interval: the maximum delay between probes
+    :param stream_states: log each state result as the minion fires its
+                          progress event, requires ``completion='event'``
+                          and ``state_events: True`` on the minion
+    :param abort_states: while streaming, kill the job and fail as soon as
+                         a state whose ID, name or SLS matches one of these
+                         glob patterns fails. ``None`` aborts on any failed
+                         state, an empty list never aborts.
+    :param observer: called with ``(state, seconds, failed)`` on each
+                     transition, ``seconds`` being the time it took to reach
+                     ``state``, and with ``failed`` set to ``True`` if
+                     ``state`` could not be reached
+    :param cancelled: called before each probe, once it returns ``True``
+                      the machine stops, raising :class:`Cancelled`
+    '''
+
+    # Wait, at most, this many seconds at a time for the job return event,
+    # between the cancellation checks
+    event_wait = 5
+
+    def __init__(self, client, vm_name, fun='state.highstate', arg=(),
+                 slavename=None, completion='event', event_factory=None,
+                 event_fallback_interval=60, deadlines=None,
+                 min_interval=0.5, max_interval=10, stream_states=False,
+                 abort_states=None, observer=None, cancelled=None,
+                 clock=None):
+        self.client = client
+        self.vm_name = vm_name
+        self.fun = fun
+        self.arg = arg
+        self.slavename = slavename
+        self.completion = completion
+        self.event_factory = event_factory or events.get_master_event
+        self.event_fallback_interval = event_fallback_interval
+        self.deadlines = DEFAULT_DEADLINES.copy()
+        if deadlines:
+            self.deadlines.update(deadlines)
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.stream_states = stream_states
+        if abort_states is None:
+            abort_states = ['*']
+        self.abort_states = abort_states
+        self.observer = observer
+        self.cancelled = cancelled
+        self.clock = clock or reactor
+
+        self.state = CREATED
+        self.jid = None
+        self.watch = None
+        self.watch_lost = False
+        self.returns = None
+        self.progress = 0
+        self._answered = False
+        self._last_running_check = None
+
+    @defer.inlineCallbacks
+    def run(self):
+        '''
+        Run the state machine. Returns a deferred firing with the job
+        returns, shaped like ``LocalClient.get_full_returns()``.
+        '''
+        try:
+            yield self._advance(KEY_ACCEPTED, self.probe_key_accepted)
+            yield self._advance(
+                MINION_RESPONDING, self.probe_minion_responding
+            )
+            if self.completion == 'event':
+                # Watch before publishing so the return can't be missed
+                reader = events.get_reader(
+                    self.client.opts, self.event_factory
+                )
+                try:
+                    self.watch = yield reader.watch(
+                        self.vm_name,
+                        on_progress=self.stream_states and
+                        self._on_progress or None
+                    )
+                except Exception as err:
+                    log.warning(
+                        'Failed to subscribe to the master event bus, '
+                        'falling back to polling the minion: {0}'.format(err),
+                        exc_info=log.isEnabledFor(logging.DEBUG)
+                    )
+            yield self._advance(JOB_PUBLISHED, self.probe_job_published)
+            if self.watch is not None:
+                self.watch.set_jid(self.jid)
+            yield self._advance(JOB_RUNNING, self.probe_job_running)
+            if self.returns is None:
+                if self.watch is not None:
+                    # Waiting on the event bus is the delay between probes
+                    backoff = Backoff(0, 0)
+                else:
+                    backoff = None
+                yield self._advance(
+                    RETURNED, self.probe_job_returned, backoff,
+                    in_thread=False
+                )
+            elif self.state != RETURNED:
+                self._transition(RETURNED, 0)
+            defer.returnValue(self.returns)
+        except StateFailed as err:
+            yield self.kill_job()
+            msg = (
+                'The state {0!r} failed on {1} for slave {2}, aborted '
+                '{3!r}: {4}'.format(
+                    err.state_id,
+                    self.vm_name,
+                    self.slavename,
+                    self.fun,
+                    err.ret.get('comment', '')
+                )
+            )
+            log.error(msg)
+            raise LatentBuildSlaveFailedToSubstantiate(self.vm_name, msg)
+        finally:
+            if self.watch is not None:
+                self.watch.close()
+
+    def kill_job(self):
+        '''
+        Kill the running job on the minion. Returns a deferred which never
+        fails.
+        '''
+        log.info('Killing job {0} on {1}'.format(self.jid, self.vm_name))
+        d = workers.defer_to_thread(
+            self.client.cmd,
+            [self.vm_name],
+            'saltutil.kill_job',
+            [self.jid],
+            timeout=5,
+            expr_form='list'
+        )
+        d.addErrback(
+            lambda f: log.warning(
+                'Failed to kill job {0} on {1}: {2}'.format(
+                    self.jid, self.vm_name, f.getErrorMessage()
+                )
+            )
+        )
+        return d
+
+    def _transition(self, state, elapsed):
+        log.info(
+            '{0} reached {1!r} after {2:.1f} seconds'.format(
+                self.vm_name, state, elapsed
+            )
+        )
+        self.state = state
+        if self.observer is not None:
+            self.observer(state, elapsed, False)
+
+    def _failed(self, state, elapsed):
+        if self.observer is not None:
+            self.observer(state, elapsed, True)
+
+    @defer.inlineCallbacks
+    def _advance(self, state, probe, backoff=None, in_thread=True):
+        '''
+        Probe until ``state`` is reached or its deadline expires. Unless
+        ``in_thread`` is ``False``, the probe blocks and is run in a thread,
+        otherwise it returns a deferred.
+        '''
+        import salt.exceptions
+        if backoff is None:
+            backoff = Backoff(self.min_interval, self.max_interval)
+        started = self.clock.seconds()
+        deadline = started + self.deadlines[state]
+        attempt = 0
+        while True:
+            if self.cancelled is not None and self.cancelled():
+                log.info(
+                    'Provisioning of {0} cancelled while waiting for '
+                    '{1!r}'.format(self.vm_name, state)
+                )
+                raise Cancelled(self.vm_name)
+            attempt += 1
+            try:
+                if in_thread:
+                    result = yield workers.defer_to_thread(probe)
+                else:
+                    result = yield probe()
+            except salt.exceptions.SaltReqTimeoutError:
+                log.debug(
+                    'Probing {0} for {1!r} timed out'.format(
+                        self.vm_name, state
+                    )
+                )
+                result = PENDING
+            except Exception:
+                self._failed(state, self.clock.seconds() - started)
+                raise
+
+            now = self.clock.seconds()
+            if result is not PENDING:
+                self._transition(state, now - started)
+                defer.returnValue(result)
+
+            if now >= deadline:
+                msg = (
+                    '{0} for slave {1} did not reach {2!r} while running '
+                    '{3!r} within {4} seconds, after {5} probes'.format(
+                        self.vm_name,
+                        self.slavename,
+                        state,
+                        self.fun,
+                        self.deadlines[state],
+                        attempt
+                    )
+                )
+                log.error(msg)
+                self._failed(state, now - started)
+                raise LatentBuildSlaveFailedToSubstantiate(self.vm_name, msg)
+
+            delay = min(backoff.next(), deadline - now)
+            if delay > 0:
+                yield task.deferLater(self.clock, delay, lambda: None)
+
+    # Probes, these run in a thread, except probe_job_returned
+    def probe_key_accepted(self):
+        # The accepted key may have been pre-seeded before the VM even
+        # existed, only a minion answering proves it authenticated with it
+        pki_dir = self.client.opts.get('pki_dir', None)
+        if pki_dir and not os.path.isfile(
+                os.path.join(pki_dir, 'minions', self.vm_name)):
+            return PENDING
+        if self._ping():
+            self._answered = True
+            return True
+        return PENDING
+
+    def probe_minion_responding(self):
+        if self._answered:
+            # Already answered on its accepted key
+            return True
+        if self._ping():
+            return True
+        return PENDING
+
+    def _ping(self):
+        ret = self.client.cmd(
+            [self.vm_name], 'test.ping', timeout=5, expr_form='list'
+        )
+        return bool(ret) and ret.get(self.vm_name, False) is True
+
+    def probe_job_published(self):
+        jid = self.client.cmd_async(
+            [self.vm_name], self.fun, arg=self.arg, expr_form='list'
+        )
+        if not jid:
+            return PENDING
+        log.info('Published job information: {0}'.format(jid))
+        self.jid = jid
+        return jid
+
+    def _check_event(self):
+        # Non blocking, returns True if the job return was fired on the
+        # event bus. Raises StateFailed if a state aborting the job failed.
+        if self.watch is None or self.watch_lost:
+            return False
+        try:
+            data = self.watch.poll()
+        except StateFailed:
+            raise
+        except Exception as err:
+            self._lost_watch(err)
+            return False
+        return self._got_return(data)
+
+    def _got_return(self, data):
+        if data is None:
+            return False
+        self.returns = events.as_full_return(self.vm_name, data)
+        return True
+
+    def _lost_watch(self, err):
+        log.warning(
+            'Lost the master event bus while waiting for the {0} job on '
+            '{1}, falling back to polling the minion: {2}'.format(
+                self.jid, self.vm_name, err
+            )
+        )
+        self.watch_lost = True
+
+    def _on_progress(self, data):
+        ret = data['ret']
+        self.progress += 1
+        state_id = ret.get('__id__', ret.get('name', '?'))
+        log.info(
+            '{0} [{1}/{2}] {3}: {4} {5}'.format(
+                self.vm_name,
+                self.progress,
+                data.get('len', '?'),
+                state_id,
+                {True: 'succeeded', False: 'failed'}.get(
+                    ret.get('result', None), 'changes pending'
+                ),
+                ret.get('comment', '')
+            )
+        )
+        if ret.get('result', None) is not False:
+            return
+        candidates = [
+            str(ret.get(key)) for key in ('__id__', 'name', '__sls__')
+            if ret.get(key, None) is not None
+        ]
+        for pattern in self.abort_states:
+            for candidate in candidates:
+                if fnmatch.fnmatch(candidate, pattern):
+                    raise StateFailed(state_id, ret)
+
+    def _job_running(self):
+        '''
+        Return ``True`` if the minion lists the job as running, ``False`` if
+        it doesn't and ``None`` if the minion did not answer.
+        '''
+        running = self.client.cmd(
+            [self.vm_name], 'saltutil.running', timeout=5, expr_form='list'
+        )
+        self._last_running_check = self.clock.seconds()
+        if not running or self.vm_name not in running:
+            return None
+        return bool([job for job in running[self.vm_name] or []
+                     if job and job.get('jid', None) == self.jid])
+
+    def _fetch_returns(self, timeout=5):
+        returns = self.client.get_full_returns(
+            self.jid, [self.vm_name], timeout=timeout
+        )
+        if returns and self.vm_name in returns:
+            self.returns = returns
+            return True
+        return False
+
+    def probe_job_running(self):
+        if self._check_event():
+            return True
+        running = self._job_running()
+        if running:
+            return True
+        if running is False and self._fetch_returns(timeout=1):
+            # The job has already finished
+            return True
+        return PENDING
+
+    @defer.inlineCallbacks
+    def probe_job_returned(self):
+        # Runs on the reactor, only asking the minion, in a thread, if the
+        # job is still running every event_fallback_interval seconds
+        # without a return event
+        if self.watch is not None and not self.watch_lost:
+            since = self.clock.seconds() - self._last_running_check
+            wait = min(self.event_wait, self.event_fallback_interval - since)
+            try:
+                data = yield self.watch.wait(max(wait, 0))
+            except StateFailed:
+                raise
+            except Exception as err:
+                self._lost_watch(err)
+                data = None
+            if self._got_return(data):
+                defer.returnValue(True)
+            since = self.clock.seconds() - self._last_running_check
+            if since < self.event_fallback_interval and \
+                    not self.watch_lost:
+                defer.returnValue(PENDING)
+        result = yield workers.defer_to_thread(self._poll_job_returned)
+        defer.returnValue(result)
+
+    def _poll_job_returned(self):
+        running = self._job_running()
+        if running is False and self._fetch_returns():
+            return True
+        return PENDING
@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+'''
+    saltcloud_buildbot.reaper
+    ~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Periodically destroy leaked buildbot VMs.
+
+    Every ``interval`` seconds, all the instances of every provider are
+    listed with a single, bulk, salt-cloud query. Only the buildbot VMs
+    allocated for this master's slaves, or for the profiles of their warm
+    pools and baked images, are considered, the other masters' VMs are left
+    alone. Those not owned anymore, that is, neither tracked by the
+    :mod:`~saltcloud_buildbot.teardown` destroyer nor recorded in a
+    :mod:`~saltcloud_buildbot.inventory`, are destroyed in batches once
+    they've been seen unowned for ``grace`` seconds. Owned VMs seen for
+    longer than ``max_age`` seconds are destroyed too.
+
+    :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
+    :license: Apache 2.0, see LICENSE for more details.
+'''
+
+# Import python libs
+import re
+import logging
+
+# Import twisted libs
+from twisted.internet import defer, reactor, task
+
+# Import saltcloud_buildbot libs
+from saltcloud_buildbot import inventory, metrics, naming, teardown, workers
+
+
+log = logging.getLogger(__name__)
+
+
+# The names of the VMs created by saltcloud_buildbot
+DEFAULT_PATTERN = naming.PATTERN
+
+
+def list_nodes(config):
+    '''
+    Return the salt-cloud listing of every provider's instances, in a
+    single bulk query.
+    '''
+    import saltcloud.cloud
+    mapper = saltcloud.cloud.Map(config)
+    return mapper.map_providers()
+
+
+def matching_nodes(ret, pattern):
+    '''
+    Return a dictionary of the node names in the ``list_nodes`` return
+    matching ``pattern`` to their provider alias.
+    '''
+    regex = re.compile(pattern)
+    nodes = {}
+    for alias, entries in ret.items():
+        stack = [entries]
+        while stack:
+            entry = stack.pop()
+            if not isinstance(entry, dict):
+                continue
+            for name, value in entry.items():
+                if isinstance(name, basestring) and regex.search(name):
+                    nodes[name] = alias
+                elif isinstance(value, dict):
+                    # Newer salt-cloud nests the nodes under the driver
+                    stack.append(value)
+    return nodes
+
+
+class Reaper(object):
+    '''
+    Find and destroy leaked VMs.
+
+    :param config_loader: returns the salt-cloud configuration, called in
+                          a thread
+    :param interval: the seconds between runs
+    :param grace: the seconds an unowned VM must be seen for before it's
+                  destroyed, so that VMs being created are left alone
+    :param max_age: destroy owned VMs seen for longer than this many
+                    seconds, ``None`` to never destroy owned VMs
+    :param pattern: the regular expression buildbot VM names match
+    '''
+
+    def __init__(self, config_loader, interval=60 * 10, grace=60 * 30,
+                 max_age=None, pattern=DEFAULT_PATTERN, clock=None):
+        self.config_loader = config_loader
+        self.interval = interval
+        self.grace = grace
+        self.max_age = max_age
+        self.pattern = pattern
+        self.clock = clock or reactor
+
+        # VM name to the time it was first seen
+        self._seen = {}
+        # The VM name prefixes, see saltcloud_buildbot.naming, of this
+        # master's slaves and profiles to their users
+        self._prefixes = {}
+        self._loop = None
+        self._running = None
+        self._users = 0
+        # Reclaimed quota accounting
+        self.reclaimed = 0
+        self.reclaimed_per_provider = {}
+        self.runs = 0
+        self.last_run = None
+
+    def configure(self, interval=None, grace=None, max_age=None,
+                  pattern=None):
+        '''
+        Update the settings, ``None`` values are left untouched.
+        '''
+        if interval is not None:
+            self.interval = interval
+        if grace is not None:
+            self.grace = grace
+        if max_age is not None:
+            self.max_age = max_age
+        if pattern is not None:
+            self.pattern = pattern
+
+    # Service like methods, driven by the slaves
+    def start(self, prefixes=()):
+        '''
+        Start reaping, the VMs allocated with ``prefixes`` included.
+        '''
+        self._users += 1
+        for prefix in prefixes:
+            self._prefixes[prefix] = self._prefixes.get(prefix, 0) + 1
+        if self._loop is None:
+            self._loop = task.LoopingCall(self.run)
+            self._loop.clock = self.clock
+            self._loop.start(self.interval, now=False)
+
+    def stop(self, prefixes=()):
+        for prefix in prefixes:
+            self._prefixes[prefix] = self._prefixes.get(prefix, 1) - 1
+            if self._prefixes[prefix] <= 0:
+                self._prefixes.pop(prefix)
+        self._users -= 1
+        if self._users > 0:
+            return
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+        self._loop = None
+
+    def run(self):
+        '''
+        Run once, unless already running. Returns a deferred which never
+        fails.
+        '''
+        if self._running is not None:
+            return self._running
+
+        def done(result):
+            self._running = None
+            return result
+
+        d = self._reap()
+        d.addErrback(
+            lambda f: log.error(
+                'Failed to reap the leaked VMs: {0}'.format(
+                    f.getErrorMessage()
+                )
+            )
+        )
+        if not d.called:
+            self._running = d
+            d.addBoth(done)
+        return d
+
+    def owned(self):
+        '''
+        Return the names of the VMs this master process is using.
+        '''
+        destroyer = teardown.get_destroyer()
+        return set(destroyer.live) | set(destroyer._destroying) | \
+            set(naming.get_allocator().names())
+
+    def select(self, nodes, owned):
+        '''
+        Return the names of the ``nodes``, as returned by
+        :func:`matching_nodes`, to destroy.
+        '''
+        now = self.clock.seconds()
+        nodes = [
+            name for name in nodes
+            if naming.owner_prefix(name) in self._prefixes
+        ]
+        for name in list(self._seen):
+            if name not in nodes:
+                # Gone, or not ours anymore
+                self._seen.pop(name)
+
+        reap = []
+        for name in sorted(nodes):
+            first_seen = self._seen.setdefault(name, now)
+            age = now - first_seen
+            if name not in owned:
+                if age >= self.grace:
+                    reap.append(name)
+            elif self.max_age is not None and age >= self.max_age:
+                log.warning(
+                    'VM {0} has been running for over {1} seconds'.format(
+                        name, self.max_age
+                    )
+                )
+                reap.append(name)
+        return reap
+
+    @defer.inlineCallbacks
+    def _reap(self):
+        config = yield workers.defer_to_thread(self.config_loader)
+        ret = yield workers.defer_to_thread(list_nodes, config)
+        nodes = matching_nodes(ret, self.pattern)
+        # The VMs left running by a previous master process, to be
+        # reattached to, are owned too
+        recorded = yield workers.defer_to_thread(inventory.recorded)
+        reap = self.select(nodes, self.owned() | recorded)
+        self.runs += 1
+        self.last_run = self.clock.seconds()
+        if not reap:
+            log.debug(
+                'No leaked VMs among the {0} buildbot VM(s) found'.format(
+                    len(nodes)
+                )
+            )
+            defer.returnValue([])
+
+        log.warning(
+            'Destroying {0} leaked VM(s): {1}'.format(
+                len(reap), ', '.join(reap)
+            )
+        )
+        destroyer = teardown.get_destroyer()
+        results = yield defer.DeferredList(
+            [destroyer.destroy(config, [name]) for name in reap],
+            consumeErrors=True
+        )
+        reclaimed = []
+        for name, (success, _) in zip(reap, results):
+            if not success:
+                continue
+            reclaimed.append(name)
+            self._seen.pop(name, None)
+            provider = nodes[name]
+            self.reclaimed_per_provider[provider] = (
+                self.reclaimed_per_provider.get(provider, 0) + 1
+            )
+            metrics.get_registry().increment(
+                'reaped_vms', provider=provider
+            )
+        self.reclaimed += len(reclaimed)
+        log.warning(
+            'Reclaimed {0} leaked VM(s), {1} in total: {2}'.format(
+                len(reclaimed), self.reclaimed, ', '.join(reclaimed)
+            )
+        )
+        defer.returnValue(reclaimed)
+
+    def stats(self):
+        return {
+            'runs': self.runs,
+            'last_run': self.last_run,
+            'watched': len(self._seen),
+            'reclaimed': self.reclaimed,
+            'reclaimed_per_provider': dict(self.reclaimed_per_provider)
+        }
+
+
+_REAPER = None
+
+
+def get_reaper(config_loader, **kwargs):
+    '''
+    Return the process wide reaper, updating its settings with the
+    ``kwargs`` not ``None``. The first caller's ``config_loader`` is used.
+    '''
+    global _REAPER
+    if _REAPER is None:
+        _REAPER = Reaper(config_loader)
+    _REAPER.configure(**kwargs)
+    return _REAPER
+
+
+def stats():
+    if _REAPER is None:
+        return None
+    return _REAPER.stats()
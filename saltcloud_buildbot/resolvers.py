@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+'''
+    saltcloud_buildbot.resolvers
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Discover the address the salt-cloud VMs should use to reach the salt
+    master when the profile's minion configuration has no ``master`` set.
+
+    Resolvers are tried in order until one returns an address. The result is
+    cached, process wide, for ``ttl`` seconds and concurrent lookups for the
+    same resolver chain wait for the one in progress instead of repeating it.
+    A chain which found nothing isn't tried again for ``failed_ttl`` seconds,
+    so that a burst of substantiations during an outage doesn't wait on it
+    once per slave.
+
+    :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
+    :license: Apache 2.0, see LICENSE for more details.
+'''
+
+# Import python libs
+import time
+import socket
+import urllib2
+import logging
+import threading
+
+
+log = logging.getLogger(__name__)
+
+
+def is_private_address(address):
+    '''
+    Return ``True`` if ``address`` is a loopback, link local or RFC 1918
+    IPv4 address.
+    '''
+    try:
+        octets = [int(octet) for octet in address.split('.')]
+    except ValueError:
+        return False
+    if len(octets) != 4:
+        return False
+    return (
+        octets[0] in (10, 127) or
+        (octets[0] == 172 and 16 <= octets[1] <= 31) or
+        (octets[0] == 192 and octets[1] == 168) or
+        (octets[0] == 169 and octets[1] == 254)
+    )
+
+
+class StaticResolver(object):
+    '''
+    Always resolve to ``address``.
+    '''
+
+    def __init__(self, address):
+        self.address = address
+
+    def __repr__(self):
+        return 'StaticResolver({0!r})'.format(self.address)
+
+    def resolve(self):
+        return self.address
+
+
+class InterfaceResolver(object):
+    '''
+    Resolve to the address of the local interface holding the default route,
+    found by connecting, without sending anything, an UDP socket to
+    ``probe_host``.
+
+    With ``public_only``, private addresses are not returned since the VMs,
+    most likely, won't be able to reach them.
+    '''
+
+    def __init__(self, probe_host='8.8.8.8', public_only=True):
+        self.probe_host = probe_host
+        self.public_only = public_only
+
+    def __repr__(self):
+        return 'InterfaceResolver({0!r}, public_only={1})'.format(
+            self.probe_host, self.public_only
+        )
+
+    def resolve(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.connect((self.probe_host, 80))
+            address = sock.getsockname()[0]
+        finally:
+            sock.close()
+        if self.public_only and is_private_address(address):
+            log.debug(
+                'Ignoring the private local address {0}'.format(address)
+            )
+            return None
+        return address
+
+
+class HTTPEchoResolver(object):
+    '''
+    Resolve to the address reported back by an HTTP echo service, like
+    ``http://v4.ident.me/``, giving up after ``timeout`` seconds.
+    '''
+
+    def __init__(self, url='http://v4.ident.me/', timeout=5):
+        self.url = url
+        self.timeout = timeout
+
+    def __repr__(self):
+        return 'HTTPEchoResolver({0!r})'.format(self.url)
+
+    def resolve(self):
+        request = urllib2.urlopen(self.url, timeout=self.timeout)
+        try:
+            return request.read().strip() or None
+        finally:
+            request.close()
+
+
+DEFAULT_RESOLVERS = (InterfaceResolver(), HTTPEchoResolver())
+
+
+class _CacheEntry(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.address = None
+        self.expires = 0
+        # Nothing was found, don't try again before then
+        self.failed_until = 0
+
+
+class ResolverCache(object):
+    '''
+    Process wide cache of resolved master addresses keyed by resolver chain.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def resolve(self, resolvers, ttl, failed_ttl=30):
+        key = tuple(repr(resolver) for resolver in resolvers)
+        with self._lock:
+            entry = self._entries.setdefault(key, _CacheEntry())
+
+        # Only one lookup per chain at a time, the others wait for it
+        with entry.lock:
+            now = time.time()
+            if entry.address is not None and entry.expires > now:
+                return entry.address
+            if entry.failed_until > now:
+                return None
+
+            for resolver in resolvers:
+                try:
+                    address = resolver.resolve()
+                except Exception as err:
+                    log.warning(
+                        'Failed to resolve the master address using '
+                        '{0!r}: {1}'.format(resolver, err),
+                        # Show the traceback if the debug logging level is
+                        # enabled
+                        exc_info=log.isEnabledFor(logging.DEBUG)
+                    )
+                    continue
+                if address:
+                    log.info(
+                        'Found the master address, {0}, using {1!r}'.format(
+                            address, resolver
+                        )
+                    )
+                    entry.address = address
+                    entry.expires = time.time() + ttl
+                    entry.failed_until = 0
+                    return address
+            entry.failed_until = time.time() + failed_ttl
+            return None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_CACHE = ResolverCache()
+
+
+def resolve_master_address(resolvers=None, ttl=60 * 60, failed_ttl=30):
+    '''
+    Return the master address found by the first of ``resolvers``, which
+    default to :data:`DEFAULT_RESOLVERS`, that finds one, or ``None``.
+    '''
+    return _CACHE.resolve(resolvers or DEFAULT_RESOLVERS, ttl, failed_ttl)
@@ -11,34 +11,47 @@
 '''
 
 # Import python libs
-import time
-import random
 import logging
 
-# Import salt & salt-cloud libs
-import salt.log
-import salt.client
-import salt.config
-import salt.output
-import salt.exceptions
-import saltcloud.cloud
-import saltcloud.config
-
-# Setup the salt temporary logging
-salt.log.setup_temp_logger()
-
 # Import twisted libs
-from twisted.internet import reactor, threads
+from twisted.internet import defer, reactor
+from twisted.python import failure
 
 # Import buildbot libs
 from buildbot.buildslave import AbstractLatentBuildSlave
 from buildbot.interfaces import LatentBuildSlaveFailedToSubstantiate
 
+# Import saltcloud_buildbot libs
+import saltcloud_buildbot.pool
+import saltcloud_buildbot.batching
+import saltcloud_buildbot.admission
+import saltcloud_buildbot.images
+import saltcloud_buildbot.inventory
+import saltcloud_buildbot.keys
+import saltcloud_buildbot.config
+import saltcloud_buildbot.formatting
+import saltcloud_buildbot.hedging
+import saltcloud_buildbot.history
+import saltcloud_buildbot.logsetup
+import saltcloud_buildbot.provision
+import saltcloud_buildbot.readiness
+import saltcloud_buildbot.workers
+import saltcloud_buildbot.metrics
+import saltcloud_buildbot.naming
+import saltcloud_buildbot.resolvers
+import saltcloud_buildbot.reaper
+import saltcloud_buildbot.teardown
+
 
 log = logging.getLogger(__name__)
 
 
-reactor.suggestThreadPoolSize(30)
+def _peer_host(bot):
+    # The host a buildslave connected from, None if unknown
+    try:
+        return bot.broker.transport.getPeer().host
+    except AttributeError:
+        return None
 
 
 class SaltCloudLatentBuildSlave(AbstractLatentBuildSlave):
@@ -62,7 +75,65 @@ class SaltCloudLatentBuildSlave(AbstractLatentBuildSlave):
         saltcloud_config='/etc/salt/cloud',
         saltcloud_vm_config='/etc/salt/cloud.profiles',
         saltcloud_master_config='/etc/salt/master',
-        saltcloud_providers_config='/etc/salt/cloud.providers'
+        saltcloud_providers_config='/etc/salt/cloud.providers',
+        saltcloud_pool_size=0,
+        saltcloud_pool_max_age=60 * 60 * 4,
+        saltcloud_pool_check_interval=60,
+        saltcloud_pool_rebind_state=None,
+        saltcloud_highstate_completion='event',
+        saltcloud_event_fallback_interval=60,
+        saltcloud_phase_deadlines=None,
+        saltcloud_probe_min_interval=0.5,
+        saltcloud_probe_max_interval=10,
+        saltcloud_master_address=None,
+        saltcloud_master_resolvers=None,
+        saltcloud_master_address_ttl=60 * 60,
+        saltcloud_bake=False,
+        saltcloud_bake_index='/var/cache/salt/cloud/buildbot-images.json',
+        saltcloud_bake_verify_state=None,
+        saltcloud_bake_max_images=2,
+        saltcloud_bake_max_age=None,
+        saltcloud_bake_paths=None,
+        saltcloud_thread_pool_size=None,
+        saltcloud_priority=0,
+        saltcloud_max_in_flight_creates=None,
+        saltcloud_create_rate=None,
+        saltcloud_create_burst=None,
+        saltcloud_batch_window=0,
+        saltcloud_batch_max_size=20,
+        saltcloud_destroy_window=None,
+        saltcloud_destroy_max_parallel=None,
+        saltcloud_destroy_deadline=None,
+        saltcloud_shutdown_deadline=None,
+        saltcloud_destroy_report=None,
+        saltcloud_metrics_file=None,
+        saltcloud_metrics_port=None,
+        saltcloud_metrics_interval=60,
+        saltcloud_metrics_interface='127.0.0.1',
+        saltcloud_stream_states=False,
+        saltcloud_abort_states=None,
+        saltcloud_inventory=None,
+        saltcloud_reaper_interval=0,
+        saltcloud_reaper_grace=None,
+        saltcloud_reaper_max_age=None,
+        saltcloud_reaper_pattern=None,
+        saltcloud_wait_for_destroy=False,
+        saltcloud_output_max_size=None,
+        saltcloud_output_mode=None,
+        saltcloud_artifacts_dir=None,
+        saltcloud_queued_logging=True,
+        saltcloud_alternate_profiles=None,
+        saltcloud_hedge=False,
+        saltcloud_hedge_percentile=0.95,
+        saltcloud_hedge_delay=60 * 5,
+        saltcloud_history=None,
+        saltcloud_adaptive_timeouts=False,
+        saltcloud_timeout_percentile=0.99,
+        saltcloud_timeout_factor=2,
+        saltcloud_timeout_floor=None,
+        saltcloud_timeout_ceiling=None,
+        saltcloud_key_pool_size=0,
+        saltcloud_key_size=2048
     ):
 
         if single_build:
@@ -83,9 +154,71 @@ class SaltCloudLatentBuildSlave(AbstractLatentBuildSlave):
         )
 
         self._saltcloud_config = None
-        self.saltcloud_vm_name = '{0}-buildbot-rnd{1:04d}'.format(
-            self.slavename, random.randrange(0, 10001, 2)
+        # Whether the salt logging handlers are fed from a queue, by a
+        # single thread, see saltcloud_buildbot.logsetup
+        self.saltcloud_queued_logging = saltcloud_queued_logging
+
+        # The blocking salt and salt-cloud calls run in a dedicated thread
+        # pool shared by all slaves, the biggest size requested wins
+        saltcloud_buildbot.workers.configure(saltcloud_thread_pool_size)
+
+        # VM creates are admitted by the process wide admission controller,
+        # see saltcloud_buildbot.admission. The rate and burst apply to the
+        # providers without limits in cloud.providers
+        self.saltcloud_priority = saltcloud_priority
+        saltcloud_buildbot.admission.configure(
+            max_in_flight=saltcloud_max_in_flight_creates,
+            default_rate=saltcloud_create_rate,
+            default_burst=saltcloud_create_burst
+        )
+
+        # Coalesce the VM creates requested within saltcloud_batch_window
+        # seconds into a single parallel salt-cloud map run, 0 disables it
+        self._saltcloud_batcher = None
+        if saltcloud_batch_window:
+            self._saltcloud_batcher = saltcloud_buildbot.batching.get_batcher(
+                window=saltcloud_batch_window,
+                max_size=saltcloud_batch_max_size
+            )
+
+        # VM destroys are coalesced and the live VMs destroyed on master
+        # shutdown by the process wide destroyer, see
+        # saltcloud_buildbot.teardown
+        self._saltcloud_destroyer = saltcloud_buildbot.teardown.get_destroyer(
+            window=saltcloud_destroy_window,
+            max_parallel=saltcloud_destroy_max_parallel,
+            deadline=saltcloud_destroy_deadline,
+            shutdown_deadline=saltcloud_shutdown_deadline,
+            report_path=saltcloud_destroy_report
         )
+
+        # Where to export the substantiation phase metrics, a Prometheus
+        # text file and/or an HTTP port, served on the loopback interface
+        # unless told otherwise, see saltcloud_buildbot.metrics
+        self.saltcloud_metrics_file = saltcloud_metrics_file
+        self.saltcloud_metrics_port = saltcloud_metrics_port
+        self.saltcloud_metrics_interval = saltcloud_metrics_interval
+        self.saltcloud_metrics_interface = saltcloud_metrics_interface
+
+        # How the salt-cloud and state run returns are logged, and where
+        # the full returns are stored, see saltcloud_buildbot.formatting
+        saltcloud_buildbot.formatting.get_formatter(
+            max_size=saltcloud_output_max_size,
+            mode=saltcloud_output_mode,
+            artifacts_dir=saltcloud_artifacts_dir
+        )
+
+        # A fresh VM name is allocated for each substantiation, see
+        # saltcloud_buildbot.naming. Unless saltcloud_wait_for_destroy is
+        # set, the slave does not wait for its VM to be destroyed before
+        # substantiating again. The buildslaves of the previous VMs, told
+        # apart by the host they connected from, are refused until those
+        # VMs are gone, they would otherwise be accepted as the new VM's.
+        self.saltcloud_vm_name = None
+        self.saltcloud_wait_for_destroy = saltcloud_wait_for_destroy
+        self._saltcloud_retiring = set()
+        # VM name to the host its buildslave connected from
+        self._saltcloud_vm_hosts = {}
         self.saltcloud_config = saltcloud_config or '/etc/salt/cloud'
         self.saltcloud_vm_config = (
             saltcloud_vm_config or '/etc/salt/cloud.profiles'
@@ -98,313 +231,524 @@ class SaltCloudLatentBuildSlave(AbstractLatentBuildSlave):
         )
         self.saltcloud_profile_name = saltcloud_profile_name
 
-    def __load_saltcloud_config(self):
-        if self._saltcloud_config is not None:
-            return self._saltcloud_config
-
-        # We want some early console debugging
-        salt.log.setup_console_logger('debug')
+        # Equivalent profiles, in order, to fail over to when provisioning
+        # from saltcloud_profile_name fails and, with saltcloud_hedge, to
+        # race against it when its minion doesn't respond within the
+        # saltcloud_hedge_percentile of the profile's history, or
+        # saltcloud_hedge_delay seconds until enough history is known, see
+        # saltcloud_buildbot.hedging
+        self.saltcloud_alternate_profiles = list(
+            saltcloud_alternate_profiles or ()
+        )
+        self.saltcloud_hedge = saltcloud_hedge
+        self.saltcloud_hedge_percentile = saltcloud_hedge_percentile
+        self.saltcloud_hedge_delay = saltcloud_hedge_delay
+        # The profile the current VM was provisioned from, and how, see
+        # the saltcloud_buildbot.history provisioning paths
+        self.saltcloud_vm_profile = None
+        self._saltcloud_vm_path = None
+
+        # The per profile phase durations are kept in the process wide
+        # latency history, stored in the saltcloud_history JSON file if set,
+        # see saltcloud_buildbot.history. With saltcloud_adaptive_timeouts,
+        # the provisioning phase deadlines, and missing_timeout, are derived
+        # from it, the saltcloud_timeout_percentile of the profile's
+        # durations times saltcloud_timeout_factor, bounded by
+        # saltcloud_timeout_floor and saltcloud_timeout_ceiling. The
+        # saltcloud_phase_deadlines set explicitly still win.
+        self.saltcloud_history = saltcloud_history
+        self.saltcloud_adaptive_timeouts = saltcloud_adaptive_timeouts
+        self.saltcloud_timeout_percentile = saltcloud_timeout_percentile
+        self.saltcloud_timeout_factor = saltcloud_timeout_factor
+        self.saltcloud_timeout_floor = saltcloud_timeout_floor
+        self.saltcloud_timeout_ceiling = saltcloud_timeout_ceiling
+        # The missing_timeout used until the profile has enough history
+        self.saltcloud_missing_timeout = self.missing_timeout
+        self._saltcloud_history = None
+
+        # Minion keypairs pre-generated in the background, see
+        # saltcloud_buildbot.keys, a pool size of 0 disables it
+        self.saltcloud_key_pool_size = saltcloud_key_pool_size
+        self.saltcloud_key_size = saltcloud_key_size
+        self._saltcloud_keys = None
+
+        # Warm VM pool settings, a pool size of 0 disables it
+        self.saltcloud_pool_size = saltcloud_pool_size
+        self.saltcloud_pool_max_age = saltcloud_pool_max_age
+        self.saltcloud_pool_check_interval = saltcloud_pool_check_interval
+        self.saltcloud_pool_rebind_state = saltcloud_pool_rebind_state
+        self._saltcloud_pool = None
+
+        # How to find out the highstate has finished, 'event' waits for the
+        # job return on the master event bus, 'poll' polls the minion
+        self.saltcloud_highstate_completion = saltcloud_highstate_completion
+        self.saltcloud_event_fallback_interval = (
+            saltcloud_event_fallback_interval
+        )
 
-        # Read/Parse salt-cloud configurations
-        config = saltcloud.config.cloud_config(
-            # salt-cloud config
-            self.saltcloud_config,
-            # salt master configuration
-            master_config_path=self.saltcloud_master_config,
-            # providers configuration
-            providers_config_path=self.saltcloud_providers_config,
-            # profiles configuration
-            vm_config_path=self.saltcloud_vm_config
-        )
-
-        # Update with some parsers cli defaults
-        config.update({
-            'map': None,
-            'deploy': True,
-            'parallel': False,
-            'keep_tmp': False
-        })
-
-        # Now configure logging respecting the configuration
-        # First console logging
-        cli_log_fmt = 'cli_salt_cloud_log_fmt'
-        if cli_log_fmt in config and not config.get(cli_log_fmt):
-            # Remove it from config so it inherits from log_fmt_console
-            config.pop(cli_log_fmt)
-        logfmt = config.get(
-            cli_log_fmt, config.get(
-                'log_fmt_console',
-                config.get(
-                    'log_fmt',
-                    salt.config._DFLT_LOG_FMT_CONSOLE
+        # Provisioning state machine settings, the deadlines are a mapping
+        # of state to the maximum seconds allowed to reach it, see
+        # saltcloud_buildbot.readiness
+        self.saltcloud_phase_deadlines = saltcloud_phase_deadlines or {}
+        self.saltcloud_probe_min_interval = saltcloud_probe_min_interval
+        self.saltcloud_probe_max_interval = saltcloud_probe_max_interval
+
+        # Stream the state results as the minion runs them, aborting the
+        # state run on the first failure of the saltcloud_abort_states
+        # patterns (any state if None). Requires the event completion.
+        self.saltcloud_stream_states = saltcloud_stream_states
+        self.saltcloud_abort_states = saltcloud_abort_states
+
+        # How to find the master address when the profile's minion
+        # configuration does not set it, see saltcloud_buildbot.resolvers
+        if saltcloud_master_address and not saltcloud_master_resolvers:
+            saltcloud_master_resolvers = [
+                saltcloud_buildbot.resolvers.StaticResolver(
+                    saltcloud_master_address
                 )
+            ]
+        self.saltcloud_master_resolvers = saltcloud_master_resolvers
+        self.saltcloud_master_address_ttl = saltcloud_master_address_ttl
+
+        # Golden image baking, see saltcloud_buildbot.images
+        self.saltcloud_bake = saltcloud_bake
+        self.saltcloud_bake_verify_state = saltcloud_bake_verify_state
+        self.saltcloud_bake_paths = saltcloud_bake_paths
+        self._saltcloud_baker = None
+        if saltcloud_bake:
+            self._saltcloud_baker = saltcloud_buildbot.images.get_baker(
+                saltcloud_bake_index,
+                max_images=saltcloud_bake_max_images,
+                max_age=saltcloud_bake_max_age,
+                paths=saltcloud_bake_paths
             )
-        )
-
-        cli_log_datefmt = 'cli_salt_cloud_log_datefmt'
-        if cli_log_datefmt in config and not config.get(cli_log_datefmt):
-            # Remove it from config so it inherits from log_datefmt_console
-            config.pop(cli_log_datefmt)
 
-        if config.get('log_datefmt_console', None) is None:
-            # Remove it from config so it inherits from log_datefmt
-            config.pop('log_datefmt_console', None)
-
-        datefmt = config.get(
-            cli_log_datefmt,
-            config.get(
-                'log_datefmt_console',
-                config.get(
-                    'log_datefmt',
-                    '%Y-%m-%d %H:%M:%S'
-                )
+        # The persistent VM inventory, see saltcloud_buildbot.inventory. With
+        # it, ready VMs are left running on master shutdown and reattached
+        # to on startup.
+        self._saltcloud_inventory = None
+        if saltcloud_inventory:
+            self._saltcloud_inventory = (
+                saltcloud_buildbot.inventory.get_inventory(saltcloud_inventory)
             )
-        )
+        self._saltcloud_reattach = None
+        self._saltcloud_reattach_expiry = None
+        # Set while the slave is being stopped, on master shutdown or
+        # reconfiguration, when its ready VM is left running
+        self._saltcloud_stopping = False
+
+        # The leaked VMs reaper, see saltcloud_buildbot.reaper, an interval
+        # of 0 disables it
+        self.saltcloud_reaper_interval = saltcloud_reaper_interval
+        self.saltcloud_reaper_grace = saltcloud_reaper_grace
+        self.saltcloud_reaper_max_age = saltcloud_reaper_max_age
+        self.saltcloud_reaper_pattern = saltcloud_reaper_pattern
+        self._saltcloud_reaper = None
 
-        salt.log.setup_console_logger(
-            config['log_level'], log_format=logfmt, date_format=datefmt
+    def __load_saltcloud_config(self):
+        # The parsed configuration is shared by every slave using the same
+        # configuration files and only parsed again when those change.
+        config = saltcloud_buildbot.config.load_cloud_config(
+            self.saltcloud_config,
+            self.saltcloud_master_config,
+            self.saltcloud_providers_config,
+            self.saltcloud_vm_config
         )
+        if config is not self._saltcloud_config:
+            # Logging is only set up once per process, and again if its
+            # settings change
+            saltcloud_buildbot.logsetup.setup_logging(
+                config, queued=self.saltcloud_queued_logging
+            )
+            self._saltcloud_config = config
+        return self._saltcloud_config
 
-        # Now the log file logging
-        if 'log_level_logfile' in config and not \
-                config.get('log_level_logfile'):
-            # Remove it from config so it inherits from log_level
-            config.pop('log_level_logfile')
+    def __state_options(self, profile_name=None, fun='state.highstate',
+                        path=saltcloud_buildbot.history.COLD):
+        # The options passed to saltcloud_buildbot.provision.run_state
+        return {
+            'completion': self.saltcloud_highstate_completion,
+            'event_fallback_interval': self.saltcloud_event_fallback_interval,
+            'deadlines': self.__deadlines(profile_name, fun, path),
+            'min_interval': self.saltcloud_probe_min_interval,
+            'max_interval': self.saltcloud_probe_max_interval,
+            'stream_states': self.saltcloud_stream_states,
+            'abort_states': self.saltcloud_abort_states
+        }
+
+    def __timeout_options(self):
+        # The options passed to saltcloud_buildbot.history.History.deadline
+        options = {
+            'fraction': self.saltcloud_timeout_percentile,
+            'factor': self.saltcloud_timeout_factor
+        }
+        if self.saltcloud_timeout_floor is not None:
+            options['floor'] = self.saltcloud_timeout_floor
+        if self.saltcloud_timeout_ceiling is not None:
+            options['ceiling'] = self.saltcloud_timeout_ceiling
+        return options
+
+    def __deadlines(self, profile_name=None, fun='state.highstate',
+                    path=saltcloud_buildbot.history.COLD):
+        # The provisioning state deadlines for the profile_name profile,
+        # running fun
+        deadlines = {}
+        if self.saltcloud_adaptive_timeouts:
+            deadlines = saltcloud_buildbot.history.get_history().deadlines(
+                profile_name or self.saltcloud_profile_name,
+                saltcloud_buildbot.readiness.STATES[1:],
+                fun=fun,
+                path=path,
+                **self.__timeout_options()
+            )
+        deadlines.update(self.saltcloud_phase_deadlines)
+        return deadlines
+
+    def __minion_options(self):
+        # The options passed to
+        # saltcloud_buildbot.provision.build_minion_config
+        return {
+            'master_resolvers': self.saltcloud_master_resolvers,
+            'master_address_ttl': self.saltcloud_master_address_ttl,
+            'state_events': self.saltcloud_stream_states
+        }
 
-        loglevel = config.get(
-            'log_level_logfile',
-            # From the console setting
-            config['log_level']
+    # AbstractLatentBuildSlave methods
+    def startService(self):
+        self._saltcloud_stopping = False
+        AbstractLatentBuildSlave.startService(self)
+        self._saltcloud_history = saltcloud_buildbot.history.get_history(
+            path=self.saltcloud_history
+        )
+        self._saltcloud_history.start()
+        saltcloud_buildbot.metrics.export(
+            path=self.saltcloud_metrics_file,
+            port=self.saltcloud_metrics_port,
+            interval=self.saltcloud_metrics_interval,
+            interface=self.saltcloud_metrics_interface
         )
+        if self.saltcloud_pool_size:
+            self._saltcloud_pool = saltcloud_buildbot.pool.get_pool(
+                self.saltcloud_profile_name,
+                self.__load_saltcloud_config,
+                self.saltcloud_master_config,
+                size=self.saltcloud_pool_size,
+                max_age=self.saltcloud_pool_max_age,
+                check_interval=self.saltcloud_pool_check_interval,
+                rebind_state=self.saltcloud_pool_rebind_state,
+                state_options=self.__state_options(),
+                minion_options=self.__minion_options()
+            )
+            self._saltcloud_pool.start()
+        if self.saltcloud_reaper_interval:
+            self._saltcloud_reaper = saltcloud_buildbot.reaper.get_reaper(
+                self.__load_saltcloud_config,
+                interval=self.saltcloud_reaper_interval,
+                grace=self.saltcloud_reaper_grace,
+                max_age=self.saltcloud_reaper_max_age,
+                pattern=self.saltcloud_reaper_pattern
+            )
+            self._saltcloud_reaper.start(self.__vm_name_prefixes())
+        if self.saltcloud_key_pool_size:
+            self._saltcloud_keys = saltcloud_buildbot.keys.get_pool(
+                size=self.saltcloud_key_pool_size,
+                keysize=self.saltcloud_key_size
+            )
+            self._saltcloud_keys.start()
+        if self._saltcloud_inventory is not None:
+            d = self.__load_inventory()
+            d.addErrback(
+                lambda f: log.error(
+                    'Failed to load the VM inventory for slave {0}: '
+                    '{1}'.format(self.slavename, f.getErrorMessage())
+                )
+            )
 
-        cli_log_path = 'cli_salt_cloud_log_file'
-        if cli_log_path in config and not config.get(cli_log_path):
-            # Remove it from config so it inherits from log_level_logfile
-            config.pop(cli_log_path)
+    def stopService(self):
+        self._saltcloud_stopping = True
+        if self._saltcloud_history is not None:
+            self._saltcloud_history.stop()
+            self._saltcloud_history = None
+        if self._saltcloud_pool is not None:
+            self._saltcloud_pool.stop()
+            self._saltcloud_pool = None
+        if self._saltcloud_reaper is not None:
+            self._saltcloud_reaper.stop(self.__vm_name_prefixes())
+            self._saltcloud_reaper = None
+        if self._saltcloud_keys is not None:
+            self._saltcloud_keys.stop()
+            self._saltcloud_keys = None
+        if self._saltcloud_baker is not None:
+            # Write the pending last used times of the baked images
+            self._saltcloud_baker.index.flush()
+        if self._saltcloud_reattach_expiry is not None and \
+                self._saltcloud_reattach_expiry.active():
+            self._saltcloud_reattach_expiry.cancel()
+        self._saltcloud_reattach_expiry = None
+        return AbstractLatentBuildSlave.stopService(self)
+
+    @defer.inlineCallbacks
+    def __load_inventory(self):
+        # Find a VM, left running by a previous master process, to reattach
+        # to, destroying any other VMs of this slave
+        records = yield saltcloud_buildbot.workers.defer_to_thread(
+            self._saltcloud_inventory.for_slave, self.slavename
+        )
+        for record in records:
+            vm_name = record['vm_name']
+            if vm_name in self._saltcloud_destroyer.live:
+                # Still in use in this master process
+                continue
+            if self._saltcloud_reattach is None and \
+                    self.build_wait_timeout != 0 and \
+                    record['state'] == saltcloud_buildbot.inventory.READY and \
+                    record['profile'] in self.__profiles():
+                log.info(
+                    'Slave {0} will try to reattach to VM {1}'.format(
+                        self.slavename, vm_name
+                    )
+                )
+                self._saltcloud_reattach = record
+                saltcloud_buildbot.naming.get_allocator().reserve(
+                    vm_name, self.slavename
+                )
+                self._saltcloud_destroyer.track(
+                    vm_name, self.__load_saltcloud_config, self.slavename,
+                    keep_on_shutdown=True
+                )
+                if self.build_wait_timeout > 0:
+                    # Don't keep it around if nobody needs it
+                    self._saltcloud_reattach_expiry = reactor.callLater(
+                        self.build_wait_timeout, self.__discard_reattach
+                    )
+                continue
+            self.__destroy_stale(vm_name)
 
-        if 'log_level_logfile' in config and not \
-                config.get('log_level_logfile'):
-            # Remove it from config so it inherits from log_file
-            config.pop('log_level_logfile')
+    def __discard_reattach(self):
+        self._saltcloud_reattach_expiry = None
+        record, self._saltcloud_reattach = self._saltcloud_reattach, None
+        if record is not None:
+            self.__destroy_stale(record['vm_name'])
 
-        logfile = config.get(
-            # First from the config cli setting
-            cli_log_path,
-            config.get(
-                # From the config setting
-                'log_level_logfile'
-                # From the default setting
-                '/var/log/salt/cloud'
+    def __destroy_stale(self, vm_name):
+        # Destroy, in the background, a VM we won't use
+        log.info(
+            'Destroying stale VM {0} of slave {1}'.format(
+                vm_name, self.slavename
             )
         )
-
-        cli_log_file_fmt = 'cli_salt_cloud_log_file_fmt'
-        if cli_log_file_fmt in config and not config.get(cli_log_file_fmt):
-            # Remove it from config so it inherits from log_fmt_logfile
-            config.pop(cli_log_file_fmt)
-
-        if config.get('log_fmt_logfile', None) is None:
-            # Remove it from config so it inherits from log_fmt_console
-            config.pop('log_fmt_logfile', None)
-
-        log_file_fmt = config.get(
-            cli_log_file_fmt,
-            config.get(
-                'cli_salt_cloud_log_fmt',
-                config.get(
-                    'log_fmt_logfile',
-                    config.get(
-                        'log_fmt_console',
-                        config.get(
-                            'log_fmt',
-                            salt.config._DFLT_LOG_FMT_CONSOLE
-                        )
-                    )
-                )
+        d = saltcloud_buildbot.workers.defer_to_thread(
+            self.__load_saltcloud_config
+        )
+        d.addCallback(
+            self._saltcloud_destroyer.destroy, [vm_name], self.slavename
+        )
+        d.addCallback(
+            lambda _: saltcloud_buildbot.workers.defer_to_thread(
+                self._saltcloud_inventory.remove, vm_name
             )
         )
-
-        cli_log_file_datefmt = 'cli_salt_cloud_log_file_datefmt'
-        if cli_log_file_datefmt in config and not \
-                config.get(cli_log_file_datefmt):
-            # Remove it from config so it inherits from log_datefmt_logfile
-            config.pop(cli_log_file_datefmt)
-
-        if config.get('log_datefmt_logfile', None) is None:
-            # Remove it from config so it inherits from log_datefmt_console
-            config.pop('log_datefmt_logfile', None)
-
-        if config.get('log_datefmt_console', None) is None:
-            # Remove it from config so it inherits from log_datefmt
-            config.pop('log_datefmt_console', None)
-
-        log_file_datefmt = config.get(
-            cli_log_file_datefmt,
-            config.get(
-                'cli_salt_cloud_log_datefmt',
-                config.get(
-                    'log_datefmt_logfile',
-                    config.get(
-                        'log_datefmt_console',
-                        config.get(
-                            'log_datefmt',
-                            '%Y-%m-%d %H:%M:%S'
-                        )
-                    )
+        d.addErrback(
+            lambda f: log.error(
+                'Failed to destroy stale VM {0}: {1}'.format(
+                    vm_name, f.getErrorMessage()
                 )
             )
         )
-
-        salt.log.setup_logfile_logger(
-            logfile,
-            loglevel,
-            log_format=log_file_fmt,
-            date_format=log_file_datefmt
+        return d
+
+    @defer.inlineCallbacks
+    def __reattach(self):
+        # Reattach to the VM found in the inventory, if it's healthy.
+        # Returns True if reattached.
+        if self._saltcloud_reattach_expiry is not None and \
+                self._saltcloud_reattach_expiry.active():
+            self._saltcloud_reattach_expiry.cancel()
+        self._saltcloud_reattach_expiry = None
+        record, self._saltcloud_reattach = self._saltcloud_reattach, None
+
+        config = yield saltcloud_buildbot.workers.defer_to_thread(
+            self.__load_saltcloud_config
         )
+        healthy = yield saltcloud_buildbot.workers.defer_to_thread(
+            self.__check_reattachable, config, record
+        )
+        if not healthy:
+            self.__destroy_stale(record['vm_name'])
+            defer.returnValue(False)
 
-        # Now setup any granular logging levels
-        for name, level in config['log_granular_levels'].items():
-            salt.log.set_logger_level(name, level)
-
-        self._saltcloud_config = config
-        return self._saltcloud_config
-
-    # AbstractLatentBuildSlave methods
-    def start_instance(self, build):
-        # responsible for starting instance that will try to connect with this
-        # master. Should return deferred with either True (instance started)
-        # or False (instance not started, so don't run a build here). Problems
-        # should use an errback.
-        return threads.deferToThread(self.__start_instance)
-
-    def __start_instance(self):
-        config = self.__load_saltcloud_config().copy()
-
-        profile = config['profiles'].get(self.saltcloud_profile_name, None)
-        if profile is None:
-            msg = 'The profile {0!r} does not exist.'.format(
-                self.saltcloud_profile_name
+        log.info(
+            'Slave {0} reattached to VM {1}'.format(
+                self.slavename, record['vm_name']
             )
-            log.error(msg)
-            reactor.callLater(0, self.stop_instance)
-            raise LatentBuildSlaveFailedToSubstantiate(
-                self.saltcloud_profile_name, msg
+        )
+        self.saltcloud_vm_name = str(record['vm_name'])
+        self.saltcloud_vm_profile = str(record['profile'])
+        self._saltcloud_vm_path = saltcloud_buildbot.history.REATTACH
+        defer.returnValue(True)
+
+    def __check_reattachable(self, config, record):
+        # Runs in a thread
+        vm_name = record['vm_name']
+        if record['fingerprint'] and \
+                record['fingerprint'] != self.__fingerprint(
+                    config, record['profile']
+                ):
+            log.info(
+                'The state tree changed since VM {0} was provisioned, not '
+                'reattaching to it'.format(vm_name)
             )
+            return False
 
-        minion_conf = saltcloud.config.get_config_value(
-            'minion', profile, config, default={}
+        client = saltcloud_buildbot.provision.get_local_client(
+            self.saltcloud_master_config
         )
-
-        # Setup the required slave grains to be used by the minion
-        if not minion_conf.get('master', None):
-            import urllib2
-            attempts = 5
-            while attempts > 0:
-                try:
-                    request = urllib2.urlopen('http://v4.ident.me/')
-                    public_ip = request.read()
-                    minion_conf['master'] = public_ip
-                    log.info(
-                        'Found local public IP address, {0},  to be '
-                        'used as the master address'.format(public_ip)
-                    )
-                    break
-                except urllib2.HTTPError:
-                    log.warn(
-                        'Failed to get the public IP for the master. '
-                        'Remaining attempts: {0}'.format(
-                            attempts
-                        ),
-                        # Show the traceback if the debug logging level is
-                        # enabled
-                        exc_info=log.isEnabledFor(logging.DEBUG)
-                    )
-            else:
-                msg = 'Failed to get the public IP for the master.'
-                log.warning(msg)
-                reactor.callLater(0, self.stop_instance)
-                raise LatentBuildSlaveFailedToSubstantiate(
-                    self.saltcloud_profile_name, msg
-                )
-
-        # Set the buildbot slave name and password as a grain
-        if 'grains' not in minion_conf:
-            minion_conf['grains'] = {}
-
-        if 'buildbot' not in minion_conf['grains']:
-            minion_conf['grains']['buildbot'] = {}
-
-        minion_conf['grains']['buildbot']['slavename'] = self.slavename
-        minion_conf['grains']['buildbot']['password'] = self.password
-
-        # Remove settings that should be set at runtime
-        minion_conf.pop('conf_file', None)
-
-        # Update the virtual machines minion configuration
-        config['profiles'][self.saltcloud_vm_name]['minion'] = minion_conf
-
-        mapper = saltcloud.cloud.Map(config)
         try:
-            ret = mapper.run_profile(
-                self.saltcloud_profile_name, [self.saltcloud_vm_name]
+            ret = client.cmd(
+                [vm_name], 'test.ping', timeout=5, expr_form='list'
             )
-            if not ret:
-                msg = 'Failed to start {0} for slave {1}'.format(
-                    self.saltcloud_vm_name,
-                    self.slavename
-                )
-                log.error(msg)
-                reactor.callLater(0, self.stop_instance)
-                raise LatentBuildSlaveFailedToSubstantiate(
-                    self.saltcloud_vm_name, msg
-                )
-
-            if 'Errors' in ret[self.saltcloud_vm_name]:
-                msg = (
-                    'There were errors while trying to start salt-cloud VM '
-                    '{0} for slave {1}: {2}'.format(
-                        self.saltcloud_vm_name,
-                        self.slavename,
-                        ret[self.saltcloud_vm_name]['Errors']
+            if not ret or ret.get(vm_name, None) is not True:
+                log.info(
+                    'VM {0} did not answer, not reattaching to it'.format(
+                        vm_name
                     )
                 )
-                log.error(msg)
-                reactor.callLater(0, self.stop_instance)
-                raise LatentBuildSlaveFailedToSubstantiate(
-                    self.saltcloud_vm_name, msg
+                return False
+            # The slave password might have changed
+            ret = client.cmd(
+                [vm_name],
+                'grains.setval',
+                ['buildbot', {
+                    'slavename': self.slavename,
+                    'password': self.password
+                }],
+                expr_form='list'
+            )
+        except Exception as err:
+            log.info(
+                'Failed to check VM {0}, not reattaching to it: {1}'.format(
+                    vm_name, err
                 )
+            )
+            return False
+        return bool(ret and ret.get(vm_name, None))
 
-            try:
-                if 'Errors' in ret[self.saltcloud_vm_name][self.saltcloud_vm_name]:
-                    msg = (
-                        'There were errors while trying to start salt-cloud VM '
-                        '{0} for slave {1}: {2}'.format(
-                            self.saltcloud_vm_name,
-                            self.slavename,
-                            ret[self.saltcloud_vm_name][self.saltcloud_vm_name]['Errors']
-                        )
-                    )
-                log.error(msg)
-                reactor.callLater(0, self.stop_instance)
-                raise LatentBuildSlaveFailedToSubstantiate(
-                    self.saltcloud_vm_name, msg
+    def __fingerprint(self, config, profile_name):
+        # The state tree fingerprint recorded in the inventory, runs in a
+        # thread
+        try:
+            return saltcloud_buildbot.images.state_fingerprint(
+                config,
+                self.saltcloud_master_config,
+                profile_name,
+                paths=self.saltcloud_bake_paths
+            )
+        except Exception as err:
+            log.warning(
+                'Failed to fingerprint the state tree: {0}'.format(err)
+            )
+            return None
+
+    def __record_vm(self, config, vm_name, profile_name, state):
+        # Record the VM in the inventory, if enabled
+        if self._saltcloud_inventory is None:
+            return defer.succeed(None)
+
+        def record():
+            self._saltcloud_inventory.record(
+                vm_name,
+                self.slavename,
+                profile_name,
+                self.__fingerprint(config, profile_name),
+                state
+            )
+        d = saltcloud_buildbot.workers.defer_to_thread(record)
+        d.addErrback(
+            lambda f: log.error(
+                'Failed to record VM {0} in the inventory: {1}'.format(
+                    vm_name, f.getErrorMessage()
                 )
-            except KeyError:
-                pass
-
-            log.info(
-                'salt-cloud started VM {0} for slave {1}. '
-                'Details:\n{2}'.format(
-                    self.saltcloud_vm_name,
-                    self.slavename,
-                    salt.output.out_format(
-                        ret[self.saltcloud_vm_name], 'pprint', config
-                    )
+            )
+        )
+        return d
+
+    def substantiate(self, sb, build):
+        if self.substantiated or self.substantiation_deferred is not None:
+            return AbstractLatentBuildSlave.substantiate(self, sb, build)
+
+        # A new substantiation, missing_timeout covers all of it
+        if self.saltcloud_adaptive_timeouts:
+            self.missing_timeout = self.__missing_timeout()
+        started = reactor.seconds()
+
+        def record(result):
+            # The pool claims, images and reattaches would skew the cold
+            # creates' substantiation deadline
+            if result and self.saltcloud_vm_profile is not None and \
+                    self._saltcloud_vm_path == \
+                    saltcloud_buildbot.history.COLD:
+                saltcloud_buildbot.history.record(
+                    self.saltcloud_vm_profile,
+                    saltcloud_buildbot.history.SUBSTANTIATION,
+                    reactor.seconds() - started
                 )
+            return result
+        d = AbstractLatentBuildSlave.substantiate(self, sb, build)
+        d.addCallback(record)
+        return d
+
+    def __missing_timeout(self):
+        # The substantiation deadline of the primary profile, or the
+        # configured missing_timeout until it has enough history
+        missing_timeout = saltcloud_buildbot.history.get_history().deadline(
+            self.saltcloud_profile_name,
+            saltcloud_buildbot.history.SUBSTANTIATION,
+            **self.__timeout_options()
+        )
+        if missing_timeout is None:
+            return self.saltcloud_missing_timeout
+        log.info(
+            'Slave {0} will wait up to {1:.0f} seconds to substantiate'.format(
+                self.slavename, missing_timeout
             )
-        except Exception, err:
+        )
+        return missing_timeout
+
+    def start_instance(self, build):
+        # responsible for starting instance that will try to connect with this
+        # master. Should return deferred with either True (instance started)
+        # or False (instance not started, so don't run a build here). Problems
+        # should use an errback.
+        return self.__start_instance(self.__priority(build))
+
+    def __priority(self, build):
+        # The VM create admission priority, the build's saltcloud_priority
+        # property, if set, overrides the slave's
+        priority = self.saltcloud_priority
+        if build is not None and hasattr(build, 'getProperty'):
+            priority = build.getProperty('saltcloud_priority', priority)
+        return priority
+
+    @defer.inlineCallbacks
+    def __start_instance(self, priority):
+        self._saltcloud_vm_path = None
+        try:
+            if self._saltcloud_reattach is not None:
+                reattached = yield self.__reattach()
+                if reattached:
+                    yield self.__ready()
+                    defer.returnValue(
+                        [self.saltcloud_vm_name, self.slavename]
+                    )
+            yield self.__provision(priority)
+            yield self.__ready()
+            defer.returnValue([self.saltcloud_vm_name, self.slavename])
+        except LatentBuildSlaveFailedToSubstantiate:
+            reactor.callLater(0, self.stop_instance)
+            raise
+        except Exception as err:
             msg = (
-                'salt-cloud failed to start VM {0} for slave {1}. '
+                'Failed to substantiate VM {0} for slave {1}. '
                 'Details:\n{2}'.format(
                     self.saltcloud_vm_name,
                     self.slavename,
@@ -417,290 +761,486 @@ class SaltCloudLatentBuildSlave(AbstractLatentBuildSlave):
                 self.saltcloud_vm_name, msg
             )
 
-        # Let the minion connect back
-        time.sleep(2)
+    @defer.inlineCallbacks
+    def __ready(self):
+        # The VM is ready, with the inventory enabled it survives master
+        # restarts, unless it's only used for a single build
+        config = yield saltcloud_buildbot.workers.defer_to_thread(
+            self.__load_saltcloud_config
+        )
+        self._saltcloud_destroyer.track(
+            self.saltcloud_vm_name, self.__load_saltcloud_config,
+            self.slavename,
+            keep_on_shutdown=self._saltcloud_inventory is not None and
+            self.build_wait_timeout != 0
+        )
+        yield self.__record_vm(
+            config,
+            self.saltcloud_vm_name,
+            self.saltcloud_vm_profile,
+            saltcloud_buildbot.inventory.READY
+        )
 
-        try:
-            log.info('Running \'state.highstate\' on the minion')
-            client = salt.client.LocalClient(c_path=self.saltcloud_master_config)
-        except Exception as err:
-            log.error(
-                'Failed to instantiate the salt local client: {0}\n'.format(
-                    err
-                ),
-                exc_info=True
+    @defer.inlineCallbacks
+    def __provision(self, priority):
+        if self._saltcloud_pool is not None:
+            vm_name = yield self._saltcloud_pool.claim(
+                self.slavename, self.password
             )
+            if vm_name is not None:
+                self.saltcloud_vm_name = vm_name
+                self.saltcloud_vm_profile = self.saltcloud_profile_name
+                self._saltcloud_vm_path = saltcloud_buildbot.history.POOL
+                defer.returnValue(None)
+
+        # No ready VMs, provision one ourselves
+        if self.saltcloud_alternate_profiles:
+            yield self.__provision_race(priority)
+            defer.returnValue(None)
+
+        self.saltcloud_vm_name = saltcloud_buildbot.naming.allocate(
+            self.slavename
+        )
+        self.saltcloud_vm_profile = self.saltcloud_profile_name
+        attempt = saltcloud_buildbot.hedging.Attempt(
+            self.saltcloud_vm_profile
+        )
+        attempt.vm_name = self.saltcloud_vm_name
+        yield self.__provision_vm(attempt, priority)
+        self._saltcloud_vm_path = attempt.path
+
+    def __profiles(self):
+        return [self.saltcloud_profile_name] + \
+            self.saltcloud_alternate_profiles
+
+    def __vm_name_prefixes(self):
+        # The prefixes of the names of the VMs this slave creates, directly,
+        # through its warm pool or when baking images, see
+        # saltcloud_buildbot.naming
+        prefixes = set([self.slavename])
+        if self.saltcloud_pool_size:
+            prefixes.add(self.saltcloud_profile_name)
+        if self._saltcloud_baker is not None:
+            prefixes.update(self.__profiles())
+        return sorted(prefixes)
+
+    @defer.inlineCallbacks
+    def __provision_race(self, priority):
+        # Provision from the primary profile, failing over, or hedging, to
+        # the alternate profiles. The failed and losing VMs are destroyed
+        # by the race, not by stop_instance.
+        self.saltcloud_vm_name = self.saltcloud_vm_profile = None
+
+        def launch(attempt):
+            attempt.vm_name = saltcloud_buildbot.naming.allocate(
+                self.slavename
+            )
+            return self.__provision_vm(attempt, priority)
 
-        try:
-            attempts = 11
-            while True:
-                log.error(
-                    'Publishing \'state.highstate\' job to {0}. '
-                    'Attempts remaining {1}'.format(
-                        self.saltcloud_vm_name,
-                        attempts - 1
-                    )
-                )
-                try:
-                    job = client.cmd_async(
-                        [self.saltcloud_vm_name],
-                        'state.highstate',
-                        expr_form='list',
-                    )
-                    if not job:
-                        attempts -= 1
-                        if attempts < 1:
-                            msg = (
-                                'Failed to publish \'state.highstate\' job to '
-                                '{0}. Returned empty response.'.format(
-                                    self.saltcloud_vm_name
-                                )
-                            )
-                            log.error(msg)
-                            reactor.callLater(0, self.stop_instance)
-                            raise LatentBuildSlaveFailedToSubstantiate(
-                                self.saltcloud_vm_name, msg
-                            )
-                        continue
-                    break
-                except salt.exceptions.SaltReqTimeoutError:
-                    attempts -= 1
-                    if attempts < 1:
-                        msg = (
-                            'Failed to publish \'state.highstate\' job to '
-                            '{0} for slave {1}, timed out.'.format(
-                                self.saltcloud_vm_name,
-                                self.slavename
-                            )
-                        )
-                        log.error(msg)
-                        reactor.callLater(0, self.stop_instance)
-                        raise LatentBuildSlaveFailedToSubstantiate(
-                            self.saltcloud_vm_name, msg
-                        )
-                    continue
-
-            log.info('Published job information: {0}'.format(job))
-
-            # Let the job start
-            time.sleep(1)
-
-            attempts = 11
-            job_running = False
-            while True:
-                time.sleep(5)
-                log.info(
-                    'Checking if \'state.highstate\' is running on '
-                    '{0}. Attempts remaining {1}'.format(
-                        self.saltcloud_vm_name,
-                        attempts - 1
-                    )
-                )
-                try:
-                    running = client.cmd(
-                        [self.saltcloud_vm_name],
-                        'saltutil.running',
-                        expr_form='list'
-                    )
-                    log.info('Running on the minion: {0}'.format(running))
-                except salt.exceptions.SaltReqTimeoutError:
-                    attempts -= 1
-                    if attempts < 1:
-                        msg = (
-                            'Failed to check if state.highstate is running '
-                            'on {0} for slave {1}, timed out'.format(
-                                self.saltcloud_vm_name, self.slavename
-                            )
-                        )
-                        log.error(msg)
-                        reactor.callLater(0, self.stop_instance)
-                        raise LatentBuildSlaveFailedToSubstantiate(
-                            self.saltcloud_vm_name, msg
-                        )
-                    continue
-
-                if not running or (running and not job_running and not
-                                   running.get(self.saltcloud_vm_name, [])):
-                    attempts -= 1
-                    if attempts < 1:
-                        msg = (
-                            'state.highstate is apparently not running '
-                            'on {0} for slave {1}, empty response'.format(
-                                self.saltcloud_vm_name,
-                                self.slavename
-                            )
-                        )
-                        log.error(msg)
-                        raise LatentBuildSlaveFailedToSubstantiate(
-                            self.saltcloud_vm_name, msg
-                        )
-                    continue
-
-                if job_running is False:
-                    job_running = True
-
-                # Reset failed attempts
-                if attempts < 11:
-                    log.info('Reseting failed attempts')
-                    attempts = 11
-
-                log.info(
-                    'Job is still running on {0}: {1}'.format(
-                        self.saltcloud_vm_name, running
-                    )
-                )
-                if not [job_details for job_details in
-                        running.get(self.saltcloud_vm_name, [])
-                        if job_details and job_details['jid'] == job]:
-                    # Job is no longer running
-                    log.info(
-                        '\'state.highstate\' has completed on {0}'.format(
-                            self.saltcloud_vm_name
-                        )
-                    )
-                    break
-
+        def discard(attempt):
             log.info(
-                'state.highstate has apparently completed in {0}'.format(
-                    self.saltcloud_vm_name
-                )
+                'Destroying VM {0} of slave {1}, from the {2!r} '
+                'profile'.format(attempt.vm_name, self.slavename,
+                                 attempt.profile)
+            )
+            d = saltcloud_buildbot.workers.defer_to_thread(
+                self.__load_saltcloud_config
             )
+            d.addCallback(
+                self.__destroy_vm, attempt.vm_name, attempt.profile
+            )
+            return d
 
-            # Let the minion settle
-            time.sleep(2)
-            log.info(
-                'Getting \'state.highstate\' job information from {0}'.format(
-                    self.saltcloud_vm_name
-                )
+        def delay(profile_name):
+            return saltcloud_buildbot.hedging.hedge_delay(
+                profile_name,
+                self.saltcloud_hedge_percentile,
+                self.saltcloud_hedge_delay
             )
 
-            highstate = client.get_full_returns(
-                job, [self.saltcloud_vm_name], timeout=5
+        race = saltcloud_buildbot.hedging.Race(
+            self.__profiles(),
+            launch,
+            discard,
+            delay=self.saltcloud_hedge and delay or None
+        )
+        attempt = yield race.run()
+        self.saltcloud_vm_name = attempt.vm_name
+        self.saltcloud_vm_profile = attempt.profile
+        self._saltcloud_vm_path = attempt.path
+
+    @defer.inlineCallbacks
+    def __provision_vm(self, attempt, priority):
+        # Provision the attempt's VM from its profile
+        profile_name = attempt.profile
+        config = yield self.__timer(
+            saltcloud_buildbot.metrics.CONFIG_LOAD, profile_name
+        ).track(
+            saltcloud_buildbot.workers.defer_to_thread(
+                self.__load_saltcloud_config
             )
-            try:
-                log.info(
-                    'Output of running \'state.highstate\' on the {0} '
-                    'minion({1}):\n{2}'.format(
-                        self.slavename,
-                        self.saltcloud_vm_name,
-                        salt.output.out_format(
-                            highstate[self.saltcloud_vm_name],
-                            'highstate',
-                            config
-                        )
-                    )
-                )
-            except Exception:
-                log.info(
-                    'Output of running \'state.highstate\' on the {0} '
-                    'minion({1}):\n{2}'.format(
-                        self.slavename,
-                        self.saltcloud_vm_name,
-                        salt.output.out_format(
-                            highstate, 'pprint', config
-                        )
-                    )
-                )
+        )
+        if self._saltcloud_baker is not None:
+            launched = yield self.__start_from_image(
+                config, attempt, priority
+            )
+            if launched:
+                defer.returnValue(None)
+
+        minion_conf = yield saltcloud_buildbot.workers.defer_to_thread(
+            saltcloud_buildbot.provision.build_minion_config,
+            config,
+            profile_name,
+            self.slavename,
+            self.password,
+            **self.__minion_options()
+        )
+        yield self.__create_vm(config, attempt, minion_conf, priority)
+        yield saltcloud_buildbot.provision.run_state(
+            config,
+            self.saltcloud_master_config,
+            attempt.vm_name,
+            slavename=self.slavename,
+            profile_name=profile_name,
+            observer=attempt.observer,
+            cancelled=attempt.is_cancelled,
+            **self.__state_options(profile_name)
+        )
 
-            if not highstate or 'Error' in highstate:
-                msg = (
-                    'Returned empty or error running state.highstate on '
-                    '{0} for slave {1}: {2}'.format(
-                        self.saltcloud_vm_name,
-                        self.slavename,
-                        highstate
-                    )
-                )
-                log.error(msg)
-                reactor.callLater(0, self.stop_instance)
-                raise LatentBuildSlaveFailedToSubstantiate(
-                    self.saltcloud_vm_name, msg
-                )
+    def __timer(self, phase, profile_name=None):
+        return saltcloud_buildbot.metrics.timer(
+            phase, profile_name or self.saltcloud_profile_name, self.slavename
+        )
 
-            if isinstance(highstate[self.saltcloud_vm_name]['ret'], list):
-                # We got a list back!?
-                msg = (
-                    'Failed to run \'state.highstate\' on the {0} minion({1}).'
-                    ' Highstate details:\n{2}'.format(
-                        self.slavename,
-                        self.saltcloud_vm_name,
-                        highstate[self.saltcloud_vm_name]['ret']
-                    ),
-                )
-                log.error(msg)
-                reactor.callLater(0, self.stop_instance)
-                raise LatentBuildSlaveFailedToSubstantiate(
-                    self.saltcloud_vm_name, msg
+    @defer.inlineCallbacks
+    def __create_vm(self, config, attempt, minion_conf, priority,
+                    image=None):
+        # Create the attempt's VM once admitted, as part of a batch if
+        # batching is enabled, booting the baked image if one is passed. The
+        # VM is tracked as live, and recorded in the inventory, right away
+        # so that it does not leak if the master shuts down mid-create
+        self._saltcloud_destroyer.track(
+            attempt.vm_name, self.__load_saltcloud_config, self.slavename
+        )
+        yield self.__record_vm(
+            config,
+            attempt.vm_name,
+            attempt.profile,
+            saltcloud_buildbot.inventory.PROVISIONING
+        )
+        keys = yield self.__draw_keys(
+            config, attempt.vm_name, attempt.profile, minion_conf
+        )
+        try:
+            ret = yield self.__admit_create(
+                config, attempt.vm_name, attempt.profile, minion_conf,
+                priority, image, keys
+            )
+        except Exception:
+            failed = failure.Failure()
+            if keys is not None:
+                yield self.__unseed_keys(
+                    config, minion_conf.get('id', attempt.vm_name), keys
                 )
+            failed.raiseException()
+        attempt.created = True
+        if attempt.cancelled:
+            raise saltcloud_buildbot.readiness.Cancelled(attempt.vm_name)
+        defer.returnValue(ret)
+
+    def __draw_keys(self, config, vm_name, profile_name, minion_conf):
+        # Draw a pre-generated minion keypair, if salt-cloud deploys one,
+        # and pre-seed its public key in the master's accepted keys. Fires
+        # with None if there's none ready, salt-cloud then generates it.
+        if self._saltcloud_keys is None or not \
+                saltcloud_buildbot.provision.deploys(config, profile_name):
+            return defer.succeed(None)
+        keys = self._saltcloud_keys.draw()
+        if keys is None:
+            log.info(
+                'No minion keypair ready for VM {0}, salt-cloud will '
+                'generate it'.format(vm_name)
+            )
+            return defer.succeed(None)
+        if not config.get('pki_dir', None):
+            # salt-cloud accepts it
+            return defer.succeed(keys)
+        d = saltcloud_buildbot.workers.defer_to_thread(
+            saltcloud_buildbot.keys.seed,
+            config['pki_dir'],
+            minion_conf.get('id', vm_name),
+            keys[1]
+        )
+        d.addErrback(
+            lambda f: log.warning(
+                'Failed to pre-seed the minion key of VM {0}, leaving it to '
+                'salt-cloud: {1}'.format(vm_name, f.getErrorMessage())
+            )
+        )
+        d.addCallback(lambda _: keys)
+        return d
+
+    def __unseed_keys(self, config, minion_id, keys):
+        # Remove the pre-seeded public key of a VM which failed to be
+        # created, so that it doesn't linger in the master's accepted keys
+        if not config.get('pki_dir', None):
+            return defer.succeed(None)
+        d = saltcloud_buildbot.workers.defer_to_thread(
+            saltcloud_buildbot.keys.unseed,
+            config['pki_dir'],
+            minion_id,
+            keys[1]
+        )
+        d.addErrback(
+            lambda f: log.warning(
+                'Failed to remove the pre-seeded minion key of {0}: '
+                '{1}'.format(minion_id, f.getErrorMessage())
+            )
+        )
+        return d
+
+    def __admit_create(self, config, vm_name, profile_name, minion_conf,
+                       priority, image, keys=None):
+        # Only time the create itself, not the wait to be admitted
+        timed = saltcloud_buildbot.metrics.timed(
+            saltcloud_buildbot.metrics.CLOUD_CREATE,
+            profile_name,
+            self.slavename
+        )
+        overrides = {}
+        if keys is not None:
+            overrides['priv_key'], overrides['pub_key'] = keys
+        if self._saltcloud_batcher is not None:
+            if image is not None:
+                overrides['image'] = image
+            return saltcloud_buildbot.admission.create_admitted(
+                config,
+                profile_name,
+                vm_name,
+                timed(self._saltcloud_batcher.submit),
+                config,
+                profile_name,
+                vm_name,
+                minion_conf,
+                slavename=self.slavename,
+                overrides=overrides or None,
+                priority=priority,
+                in_thread=False
+            )
+        if image is not None:
+            return saltcloud_buildbot.admission.create_admitted(
+                config,
+                profile_name,
+                vm_name,
+                timed(saltcloud_buildbot.images.launch_from_image),
+                config,
+                profile_name,
+                vm_name,
+                minion_conf,
+                image,
+                slavename=self.slavename,
+                overrides=overrides or None,
+                priority=priority
+            )
+        return saltcloud_buildbot.admission.create_admitted(
+            config,
+            profile_name,
+            vm_name,
+            timed(saltcloud_buildbot.provision.create_vm),
+            config,
+            profile_name,
+            vm_name,
+            minion_conf,
+            slavename=self.slavename,
+            overrides=overrides or None,
+            priority=priority
+        )
 
-            for step in highstate[self.saltcloud_vm_name]['ret'].values():
-                if step['result'] is False:
-                    try:
-                        msg = 'The step {0[name]!r} failed!'.format(step)
-                    except KeyError:
-                        msg = (
-                            'There was failure in a step. '
-                            'Step details: {0}'.format(step)
-                        )
-                    log.error(msg)
-                    reactor.callLater(0, self.stop_instance)
-                    raise LatentBuildSlaveFailedToSubstantiate(
-                        self.saltcloud_vm_name, msg
-                    )
+    @defer.inlineCallbacks
+    def __start_from_image(self, config, attempt, priority):
+        # Launch the attempt's VM from the image baked for the current state
+        # tree fingerprint. If there's none, start baking it in the
+        # background and let the caller provision the VM the usual way.
+        profile_name = attempt.profile
+        fprint, image = yield self._saltcloud_baker.lookup(
+            config, self.saltcloud_master_config, profile_name
+        )
+        if image is None:
             log.info(
-                'state.highstate completed without any issues on {0}'.format(
-                    self.saltcloud_vm_name
+                'No baked image for the {0!r} profile, fingerprint {1}'.format(
+                    profile_name, fprint
                 )
             )
-            return [self.saltcloud_vm_name, self.slavename]
-        except Exception, err:
-            msg = (
-                'Failed to run \'state.highstate\' on the {0} minion({1}). '
-                'Details:\n{2}'.format(
-                    self.slavename,
-                    self.saltcloud_vm_name,
-                    err
-                )
+            bake_conf = yield saltcloud_buildbot.workers.defer_to_thread(
+                saltcloud_buildbot.provision.build_minion_config,
+                config,
+                profile_name,
+                None,
+                None,
+                **self.__minion_options()
             )
-            log.error(
-                msg,
-                # Show the traceback if the debug logging level is enabled
-                exc_info=log.isEnabledFor(logging.DEBUG)
+            self._saltcloud_baker.bake(
+                config,
+                self.saltcloud_master_config,
+                profile_name,
+                fprint,
+                bake_conf,
+                self.__state_options(profile_name)
             )
-            reactor.callLater(0, self.stop_instance)
-            raise LatentBuildSlaveFailedToSubstantiate(
-                self.saltcloud_vm_name, msg
+            defer.returnValue(False)
+
+        minion_conf = yield saltcloud_buildbot.workers.defer_to_thread(
+            saltcloud_buildbot.provision.build_minion_config,
+            config,
+            profile_name,
+            self.slavename,
+            self.password,
+            **self.__minion_options()
+        )
+        attempt.path = saltcloud_buildbot.history.IMAGE
+        yield self.__create_vm(
+            config, attempt, minion_conf, priority, image=image
+        )
+        # The image was baked with empty buildbot grains, re-apply the
+        # states reading them. Without a verification state, a highstate
+        # only re-applies what changed.
+        if self.saltcloud_bake_verify_state:
+            fun, arg = 'state.sls', [self.saltcloud_bake_verify_state]
+        else:
+            fun, arg = 'state.highstate', ()
+        yield saltcloud_buildbot.provision.run_state(
+            config,
+            self.saltcloud_master_config,
+            attempt.vm_name,
+            slavename=self.slavename,
+            fun=fun,
+            arg=arg,
+            profile_name=profile_name,
+            history_path=saltcloud_buildbot.history.IMAGE,
+            observer=attempt.observer,
+            cancelled=attempt.is_cancelled,
+            **self.__state_options(
+                profile_name, fun, saltcloud_buildbot.history.IMAGE
+            )
+        )
+        defer.returnValue(True)
+
+    def attached(self, bot):
+        host = _peer_host(bot)
+        if self.__from_retiring_vm(host):
+            # The buildslave of a VM being destroyed reconnecting, the new
+            # VM's buildslave connects from another host
+            msg = (
+                'Slave {0} received a connection from {1}, which may be one '
+                'of its previous VM(s), {2}, being destroyed. '
+                'Disconnecting.'.format(
+                    self.slavename, host,
+                    ', '.join(sorted(self._saltcloud_retiring))
+                )
             )
+            log.info(msg)
+            self._disconnect(bot)
+            return defer.fail(RuntimeError(msg))
+        vm_name = self.saltcloud_vm_name
+        d = AbstractLatentBuildSlave.attached(self, bot)
+
+        def connected(result):
+            if host is not None and vm_name is not None:
+                self._saltcloud_vm_hosts[vm_name] = host
+            return result
+        d.addCallback(connected)
+        return d
+
+    def __from_retiring_vm(self, host):
+        # True unless the connection is known not to come from a VM being
+        # destroyed. A VM whose buildslave never connected, or sharing the
+        # host, NAT'ed for example, can't be told apart
+        for vm_name in self._saltcloud_retiring:
+            retiring_host = self._saltcloud_vm_hosts.get(vm_name, None)
+            if host is None or retiring_host is None or \
+                    retiring_host == host:
+                return True
+        return False
 
     def stop_instance(self, fast=False):
         # responsible for shutting down instance.
+        if self.__keep_vm(fast):
+            # Reattached to by the next master process, or by this slave's
+            # replacement once reconfigured
+            log.info(
+                'Leaving VM {0} of slave {1} running, to be reattached '
+                'to'.format(self.saltcloud_vm_name, self.slavename)
+            )
+            self._saltcloud_destroyer.forget(self.saltcloud_vm_name)
+            return defer.succeed(True)
         log.info(
             'Shutting down VM {0} for slave {1}'.format(
                 self.saltcloud_vm_name,
                 self.slavename
             )
         )
-        return threads.deferToThread(self.__stop_instance)
+        return self.__stop_instance()
+
+    def __keep_vm(self, fast):
+        # The ready VMs kept on shutdown, see __ready, are left running,
+        # and their inventory record ready, when the master shuts down or
+        # the slave is reconfigured
+        return (
+            (fast or self._saltcloud_stopping) and
+            self.saltcloud_vm_name in self._saltcloud_destroyer.kept
+        )
 
+    @defer.inlineCallbacks
     def __stop_instance(self):
-        config = self.__load_saltcloud_config()
-        mapper = saltcloud.cloud.Map(config)
+        # The slave may be substantiated again, with a new VM, while this
+        # one is still being destroyed
+        vm_name = self.saltcloud_vm_name
+        profile_name = self.saltcloud_vm_profile
         try:
-            ret = mapper.destroy([self.saltcloud_vm_name])
-            log.info(
-                'salt-cloud stopped VM {0} for slave {1}. '
-                'Details:\n{2}'.format(
-                    self.saltcloud_vm_name,
-                    self.slavename,
-                    salt.output.out_format(ret, 'pprint', config)
+            if vm_name is None:
+                # No VM was ever provisioned
+                defer.returnValue(True)
+            config = yield saltcloud_buildbot.workers.defer_to_thread(
+                self.__load_saltcloud_config
+            )
+            if self._saltcloud_inventory is not None:
+                yield saltcloud_buildbot.workers.defer_to_thread(
+                    self._saltcloud_inventory.set_state,
+                    vm_name,
+                    saltcloud_buildbot.inventory.DESTROYING
                 )
+            # Not to be left running anymore
+            self._saltcloud_destroyer.track(
+                vm_name, self.__load_saltcloud_config, self.slavename
             )
-            return True
+            d = self.__destroy_vm(config, vm_name, profile_name)
+            if self.saltcloud_wait_for_destroy:
+                try:
+                    yield d
+                finally:
+                    self._saltcloud_vm_hosts.pop(vm_name, None)
+            else:
+                self._saltcloud_retiring.add(vm_name)
+
+                def retired(result):
+                    self._saltcloud_retiring.discard(vm_name)
+                    self._saltcloud_vm_hosts.pop(vm_name, None)
+                    return result
+                d.addBoth(retired)
+                d.addErrback(
+                    lambda failure: log.error(
+                        'salt-cloud failed to stop VM {0} for slave {1}. '
+                        'Details:\n{2}'.format(
+                            vm_name, self.slavename, failure.getErrorMessage()
+                        )
+                    )
+                )
+            defer.returnValue(True)
         except Exception, err:
             msg = (
                 'salt-cloud failed to stop VM {0} for slave {1}. '
                 'Details:\n{2}'.format(
-                    self.saltcloud_vm_name,
+                    vm_name,
                     self.slavename,
                     err
                 )
@@ -711,3 +1251,23 @@ class SaltCloudLatentBuildSlave(AbstractLatentBuildSlave):
             reactor.callLater(
                 5, self.botmaster.maybeStartBuildsForSlave, self.name
             )
+
+    @defer.inlineCallbacks
+    def __destroy_vm(self, config, vm_name, profile_name=None):
+        yield self.__timer(
+            saltcloud_buildbot.metrics.DESTROY, profile_name
+        ).track(
+            self._saltcloud_destroyer.destroy(
+                config, [vm_name], self.slavename
+            )
+        )
+        if self._saltcloud_inventory is not None:
+            yield saltcloud_buildbot.workers.defer_to_thread(
+                self._saltcloud_inventory.remove, vm_name
+            )
+        log.info(
+            'salt-cloud stopped VM {0} for slave {1}.'.format(
+                vm_name,
+                self.slavename
+            )
+        )
@@ -10,20 +10,198 @@
     :license: Apache 2.0, see LICENSE for more details.
 '''
 
+import json
+import logging
+
+from twisted.internet import defer
+
+from buildbot.process.buildstep import BuildStep, LogLineObserver, LogObserver
 from buildbot.steps.shell import ShellCommand
 from buildbot.status.results import SUCCESS, FAILURE, WARNINGS
 
+from saltcloud_buildbot import events, provision, workers
+
+
+log = logging.getLogger(__name__)
+
+
+class StateStreamParser(object):
+    '''
+    Incrementally parse ``salt-call --out=json`` state run output, calling
+    ``on_state(state_key, ret)`` as soon as each state's return is
+    complete, without holding on to the whole output.
+    '''
+
+    def __init__(self, on_state):
+        self.on_state = on_state
+        # The open containers, '{' or '['
+        self._stack = []
+        self._in_string = False
+        self._escape = False
+        # The text of the state return being read
+        self._buf = []
+        self._reading = False
+
+    def feed(self, data):
+        for char in data:
+            if self._reading:
+                self._buf.append(char)
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == '\\':
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+                continue
+            if not self._stack and char != '{':
+                # Not JSON yet, like warnings printed before the output
+                continue
+            if char == '"':
+                self._in_string = True
+                if self._stack == ['{', '{'] and not self._reading:
+                    # A state key in {"local": {"<state key>": {...}}}
+                    self._reading = True
+                    self._buf = [char]
+            elif char in '{[':
+                self._stack.append(char)
+            elif char in '}]':
+                if self._stack:
+                    self._stack.pop()
+                if self._reading and char == '}' and \
+                        self._stack == ['{', '{']:
+                    self._state_done()
+
+    def _state_done(self):
+        text = ''.join(self._buf)
+        self._buf = []
+        self._reading = False
+        try:
+            state = json.loads('{' + text + '}')
+        except ValueError:
+            return
+        for key, ret in state.items():
+            if isinstance(ret, dict):
+                self.on_state(key, ret)
+
+
+def state_duration(ret):
+    '''
+    Return the duration, in milliseconds, of a state return, ``None`` if
+    unknown. Some salt versions report it as a ``'<n> ms'`` string.
+    '''
+    duration = ret.get('duration', None)
+    if isinstance(duration, basestring):
+        duration = duration.split()[0] if duration.split() else None
+    try:
+        return float(duration)
+    except (TypeError, ValueError):
+        return None
+
+
+def state_summary(key, ret, index=0):
+    '''
+    Return the summary of the ``key`` state's return published by the
+    steps.
+    '''
+    return {
+        'key': key,
+        'id': ret.get('__id__', ret.get('name', key)),
+        'sls': ret.get('__sls__', None),
+        'result': ret.get('result', None),
+        'comment': ret.get('comment', ''),
+        'changes': bool(ret.get('changes', None)),
+        'duration': state_duration(ret),
+        'run_num': ret.get('__run_num__', index)
+    }
+
+
+def format_state(state):
+    return '{0:<7} {1:>10} {2}{3}: {4}'.format(
+        {True: 'OK', False: 'FAILED'}.get(state['result'], 'UNKNOWN'),
+        state['duration'] is not None and
+        '{0:.0f} ms'.format(state['duration']) or '-',
+        state['id'],
+        state['changes'] and ' (changed)' or '',
+        state['comment']
+    )
+
+
+def format_states(states, slowest=10):
+    '''
+    Return the state summaries as a log, followed by the slowest states.
+    '''
+    lines = [format_state(state) for state in states]
+    timed = sorted(
+        (state for state in states if state['duration'] is not None),
+        key=lambda state: state['duration'],
+        reverse=True
+    )
+    if timed:
+        lines.extend(['', 'Slowest states:'])
+        for state in timed[:slowest]:
+            lines.append(
+                '{0:>10.0f} ms {1}'.format(state['duration'], state['id'])
+            )
+    return '\n'.join(lines) + '\n'
+
+
+class StateResultsObserver(LogObserver):
+    '''
+    Feed the step's stdout to a :class:`StateStreamParser` as it arrives.
+    '''
+
+    def __init__(self, step):
+        self.step = step
+        self.parser = StateStreamParser(step.addStateResult)
+
+    def outReceived(self, data):
+        self.parser.feed(data)
+
+
+class SlsListsObserver(LogLineObserver):
+    '''
+    Record the SLS files :data:`STATES_DRIVER` skipped, and those only
+    including other SLS files.
+    '''
+
+    def __init__(self, step):
+        LogLineObserver.__init__(self)
+        self.step = step
+
+    def outLineReceived(self, line):
+        for prefix, names in ((SKIPPED_PREFIX, self.step.skipped),
+                              (INCLUDES_PREFIX, self.step.includes)):
+            if line.startswith(prefix):
+                names.extend(
+                    name.strip() for name in
+                    line[len(prefix):].split(',') if name.strip()
+                )
+
 
 class SaltCallCommand(ShellCommand):
+    '''
+    Run ``salt-call``. With ``json_results=True``, the state run is made
+    with the JSON outputter, and each state's result, changes and duration
+    are parsed as the output arrives. They're published in the
+    ``salt_states`` and ``salt_failed_states`` build properties, and in a
+    ``states`` log.
+    '''
 
-    logfiles = {'minion.log': '/var/log/salt/minion'}
+    # Only the lines logged while the step runs
+    logfiles = {
+        'minion.log': {'filename': '/var/log/salt/minion', 'follow': True}
+    }
 
     def __init__(self, salt_call_args, **kwargs):
         command = []
         sudo_required = kwargs.pop('sudo_required', False)
+        json_results = kwargs.pop('json_results', False)
         if sudo_required:
             command.append('sudo')
         command.append('salt-call')
+        if json_results:
+            command.append('--out=json')
         if salt_call_args:
             if isinstance(salt_call_args, basestring):
                 salt_call_args = salt_call_args.split()
@@ -31,6 +209,57 @@ class SaltCallCommand(ShellCommand):
         kwargs['command'] = command
         kwargs['decodeRC'] = {0: SUCCESS, 1: FAILURE, 2: WARNINGS}
         ShellCommand.__init__(self, **kwargs)
+        self._setup_results(json_results)
+
+    def _setup_results(self, json_results):
+        self.json_results = json_results
+        self.states = []
+        if json_results:
+            self.addLogObserver('stdio', StateResultsObserver(self))
+
+    def addStateResult(self, key, ret):
+        '''
+        Record a state's return, as parsed from the output.
+        '''
+        self.states.append(state_summary(key, ret, len(self.states)))
+        if len(self.states) % 10 == 1 and self.step_status is not None:
+            # Let the progress show while the output is coming in
+            self.step_status.setText(self.describe(False))
+
+    def failedStates(self):
+        return [state for state in self.states if state['result'] is False]
+
+    def describe(self, done=False):
+        description = ShellCommand.describe(self, done)
+        if not self.states:
+            return description
+        description = list(description)
+        description.append('{0} states'.format(len(self.states)))
+        changed = len([state for state in self.states if state['changes']])
+        if changed:
+            description.append('{0} changed'.format(changed))
+        failed = len(self.failedStates())
+        if failed:
+            description.append('{0} failed'.format(failed))
+        return description
+
+    def createSummary(self, log):
+        if not self.json_results:
+            return
+        states = sorted(self.states, key=lambda state: state['run_num'])
+        self.setProperty('salt_states', states, 'SaltCallCommand')
+        self.setProperty(
+            'salt_failed_states',
+            [state['id'] for state in self.failedStates()],
+            'SaltCallCommand'
+        )
+        if states:
+            self.addCompleteLog('states', format_states(states))
+
+    def evaluateCommand(self, cmd):
+        if self.json_results and self.failedStates():
+            return FAILURE
+        return ShellCommand.evaluateCommand(self, cmd)
 
 
 class SaltTemplateCommand(SaltCallCommand):
@@ -39,10 +268,13 @@ class SaltTemplateCommand(SaltCallCommand):
         if isinstance(salt_call_args, basestring):
             salt_call_args = salt_call_args.split()
         sudo_required = kwargs.pop('sudo_required', False)
+        json_results = kwargs.pop('json_results', False)
         command = []
         if sudo_required:
             command.append('sudo')
         command.append('salt-call')
+        if json_results:
+            command.append('--out=json')
         if salt_call_args:
             if isinstance(salt_call_args, basestring):
                 salt_call_args = salt_call_args.split()
@@ -51,3 +283,471 @@ class SaltTemplateCommand(SaltCallCommand):
         kwargs['command'] = command
         kwargs['decodeRC'] = {0: SUCCESS, 1: FAILURE, 2: WARNINGS}
         ShellCommand.__init__(self, **kwargs)
+        self._setup_results(json_results)
+
+
+SKIPPED_PREFIX = 'Skipping unchanged SLS: '
+INCLUDES_PREFIX = 'Include only SLS: '
+
+# Run on the slave by SaltTemplatesCommand, as
+#   python -c STATES_DRIVER <fingerprints path> <skip 0|1> <a,b,c> <salt-call>
+# With skipping enabled, the SLS files are rendered with state.show_sls and
+# those whose rendered content matches the fingerprint of their last
+# successful run are skipped. The others are applied with a single state.sls
+# call, its JSON output passed through as it arrives. The SLS files with no
+# states of their own, only includes, are listed once the run is over. Which
+# of the included states are theirs isn't known, so they're fingerprinted
+# with the whole rendered content.
+STATES_DRIVER = r'''
+import os, sys, json, hashlib, subprocess
+path, skip, names = sys.argv[1], sys.argv[2] == '1', sys.argv[3].split(',')
+salt_call = sys.argv[4:] + ['--out=json']
+out = getattr(sys.stdout, 'buffer', sys.stdout)
+
+def load(data):
+    try:
+        ret = json.loads(data.decode('utf-8'))['local']
+    except (ValueError, KeyError, TypeError):
+        return None
+    if isinstance(ret, dict):
+        return ret
+
+def by_sls(ret):
+    grouped = {}
+    for key, data in ret.items():
+        if isinstance(data, dict):
+            grouped.setdefault(data.get('__sls__'), {})[key] = data
+    return grouped
+
+stored, fingerprints, skipped = {}, {}, []
+if skip:
+    try:
+        with open(path) as fic:
+            stored = json.load(fic)
+    except (IOError, OSError, ValueError):
+        pass
+    proc = subprocess.Popen(
+        salt_call + ['state.show_sls', ','.join(names)],
+        stdout=subprocess.PIPE
+    )
+    high = load(proc.communicate()[0]) or {}
+    for name, states in by_sls(high).items():
+        fingerprints[name] = hashlib.sha1(
+            json.dumps(states, sort_keys=True).encode('utf-8')
+        ).hexdigest()
+    if high:
+        for name in names:
+            if name not in fingerprints:
+                fingerprints[name] = hashlib.sha1(
+                    json.dumps(high, sort_keys=True).encode('utf-8')
+                ).hexdigest()
+    skipped = [
+        name for name in names
+        if name in fingerprints and stored.get(name) == fingerprints[name]
+    ]
+    if skipped:
+        out.write(('%s%s\n' % (SKIPPED_PREFIX, ', '.join(skipped))).encode())
+        out.flush()
+apply = [name for name in names if name not in skipped]
+if not apply:
+    sys.exit(0)
+
+proc = subprocess.Popen(
+    salt_call + ['state.sls', ','.join(apply)], stdout=subprocess.PIPE
+)
+chunks = []
+while True:
+    chunk = os.read(proc.stdout.fileno(), 4096)
+    if not chunk:
+        break
+    chunks.append(chunk)
+    out.write(chunk)
+    out.flush()
+retcode = proc.wait()
+ret = load(b''.join(chunks))
+if ret is None:
+    sys.exit(retcode or 1)
+grouped = by_sls(ret)
+failed = set(
+    name for name, states in grouped.items()
+    if any(data.get('result') is False for data in states.values())
+)
+# Salt fails the whole run on a missing SLS
+includes = [name for name in apply if name not in grouped]
+if includes:
+    out.write(('%s%s\n' % (INCLUDES_PREFIX, ', '.join(includes))).encode())
+    out.flush()
+if skip:
+    for name in apply:
+        if name in includes:
+            succeeded = not failed and retcode == 0
+        else:
+            succeeded = name not in failed
+        if name in fingerprints and succeeded:
+            stored[name] = fingerprints[name]
+        else:
+            stored.pop(name, None)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path + '.tmp', 'w') as fic:
+        json.dump(stored, fic)
+    os.rename(path + '.tmp', path)
+sys.exit(failed and 1 or retcode)
+'''.replace('SKIPPED_PREFIX', repr(SKIPPED_PREFIX)).replace(
+    'INCLUDES_PREFIX', repr(INCLUDES_PREFIX)
+)
+
+
+class SaltTemplatesCommand(SaltCallCommand):
+    '''
+    Apply several SLS files with a single ``state.sls a,b,c`` call, still
+    reporting the results per SLS, in the ``salt_sls_results`` build
+    property and an ``sls`` log.
+
+    With ``skip_unchanged=True``, the fingerprint of each SLS's rendered
+    content is kept, in the ``fingerprints`` file on the slave, after each
+    successful run, and the SLS files which didn't change since are
+    skipped. Only the rendered SLS is fingerprinted, not the files it
+    references. An SLS only including others is reported as ``include``,
+    and only skipped when nothing at all changed.
+    '''
+
+    def __init__(self, state_names, salt_call_args=None, **kwargs):
+        if isinstance(state_names, basestring):
+            state_names = state_names.split(',')
+        names = []
+        for state_name in state_names:
+            state_name = state_name.strip()
+            if state_name.endswith('.sls'):
+                state_name = state_name[:-4]
+            if state_name:
+                names.append(state_name)
+        if isinstance(salt_call_args, basestring):
+            salt_call_args = salt_call_args.split()
+        sudo_required = kwargs.pop('sudo_required', False)
+        skip_unchanged = kwargs.pop('skip_unchanged', False)
+        fingerprints = kwargs.pop(
+            'fingerprints', '/var/cache/salt/buildbot/fingerprints.json'
+        )
+        python = kwargs.pop('python', 'python')
+        command = []
+        if sudo_required:
+            command.append('sudo')
+        command.extend([
+            python, '-c', STATES_DRIVER,
+            fingerprints, skip_unchanged and '1' or '0', ','.join(names),
+            'salt-call'
+        ])
+        if salt_call_args:
+            command.extend(salt_call_args)
+        kwargs['command'] = command
+        kwargs['decodeRC'] = {0: SUCCESS, 1: FAILURE, 2: WARNINGS}
+        ShellCommand.__init__(self, **kwargs)
+        self.state_names = names
+        self.skipped = []
+        self.includes = []
+        self._setup_results(True)
+        self.addLogObserver('stdio', SlsListsObserver(self))
+
+    def slsResults(self):
+        '''
+        Return the results keyed by SLS.
+        '''
+        results = {}
+        for name in self.state_names:
+            if name in self.skipped:
+                results[name] = {'result': 'skipped'}
+            elif name in self.includes:
+                results[name] = {'result': 'include'}
+            else:
+                results[name] = {
+                    # No state return for it at all
+                    'result': 'missing',
+                    'states': 0,
+                    'failed': 0,
+                    'changed': 0,
+                    'duration': 0.0
+                }
+        for state in self.states:
+            result = results.setdefault(state['sls'], {
+                'result': 'missing',
+                'states': 0,
+                'failed': 0,
+                'changed': 0,
+                'duration': 0.0
+            })
+            result['states'] += 1
+            result['failed'] += state['result'] is False and 1 or 0
+            result['changed'] += state['changes'] and 1 or 0
+            result['duration'] += state['duration'] or 0
+            result['result'] = result['failed'] and 'failure' or 'success'
+        return results
+
+    def describe(self, done=False):
+        description = SaltCallCommand.describe(self, done)
+        if self.skipped:
+            description = list(description)
+            description.append('{0} skipped'.format(len(self.skipped)))
+        return description
+
+    def createSummary(self, log):
+        SaltCallCommand.createSummary(self, log)
+        results = self.slsResults()
+        self.setProperty('salt_sls_results', results, 'SaltTemplatesCommand')
+        lines = []
+        for name in self.state_names:
+            result = results[name]
+            if result['result'] == 'skipped':
+                lines.append('{0:<8} {1}: unchanged'.format('SKIPPED', name))
+                continue
+            if result['result'] == 'include':
+                lines.append(
+                    '{0:<8} {1}: only includes'.format('INCLUDE', name)
+                )
+                continue
+            lines.append(
+                '{0:<8} {1}: {2} states, {3} changed, {4} failed, '
+                '{5:.0f} ms'.format(
+                    result['result'].upper(),
+                    name,
+                    result['states'],
+                    result['changed'],
+                    result['failed'],
+                    result['duration']
+                )
+            )
+        self.addCompleteLog('sls', '\n'.join(lines) + '\n')
+
+    def evaluateCommand(self, cmd):
+        results = self.slsResults()
+        if any(result['result'] in ('failure', 'missing')
+               for result in results.values()):
+            return FAILURE
+        return SaltCallCommand.evaluateCommand(self, cmd)
+
+
+class SaltMasterCommand(BuildStep):
+    '''
+    Run ``fun``, ``state.highstate`` by default, on the build slave's
+    minion from the master, through a shared ``LocalClient``, instead of
+    spawning ``salt-call`` on the slave.
+
+    The minion is the slave's current VM or, for other slaves, the one
+    whose ``buildbot:slavename`` grain matches the slave name. With
+    ``state_events`` enabled on the minion, each state's result is written
+    to the step log as it completes. State runs publish the same
+    properties and ``states`` log as :class:`SaltCallCommand`. Once the
+    build is stopped, or ``timeout`` seconds pass without a return, the
+    step stops waiting and the job is killed with ``saltutil.kill_job``.
+    '''
+
+    name = 'salt'
+    description = ['running', 'salt']
+    descriptionDone = ['salt']
+
+    def __init__(self, fun='state.highstate', arg=(), kwarg=None,
+                 master_config='/etc/salt/master', timeout=60 * 60,
+                 **kwargs):
+        BuildStep.__init__(self, **kwargs)
+        self.fun = fun
+        self.arg = list(arg)
+        self.kwarg = kwarg
+        self.master_config = master_config
+        self.timeout = timeout
+        self.states = []
+        self.stdio = None
+        self._minion = None
+        self._jid = None
+        self._watch = None
+        self._interrupted = False
+
+    def describe(self, done=False):
+        description = list(done and self.descriptionDone or self.description)
+        if self.fun not in ('state.highstate', 'state.sls'):
+            description.append(self.fun)
+        if self.states:
+            description.append('{0} states'.format(len(self.states)))
+            failed = len([
+                state for state in self.states if state['result'] is False
+            ])
+            if failed:
+                description.append('{0} failed'.format(failed))
+        return description
+
+    def start(self):
+        self.step_status.setText(self.describe(False))
+        self.stdio = self.addLog('stdio')
+        d = self._run()
+        d.addCallback(self._done)
+        d.addErrback(self.failed)
+
+    def interrupt(self, reason):
+        BuildStep.interrupt(self, reason)
+        if self._interrupted:
+            return
+        self._interrupted = True
+        if self.stdio is not None:
+            self.stdio.addHeader('Interrupted: {0}\n'.format(reason))
+        if self._watch is not None:
+            # Stop waiting for the return
+            self._watch.close()
+        if self._jid is not None:
+            self._kill()
+
+    def _kill(self):
+        d = workers.defer_to_thread(
+            self._kill_job, self._minion, self._jid
+        )
+        d.addErrback(
+            lambda failure: log.error(
+                'Failed to kill job {0} on minion {1}: {2}'.format(
+                    self._jid, self._minion, failure.getErrorMessage()
+                )
+            )
+        )
+        return d
+
+    def _done(self, result):
+        description = self.describe(True)
+        if self._interrupted:
+            description.append('interrupted')
+        elif result != SUCCESS:
+            description.append('failed')
+        self.step_status.setText(description)
+        self.finished(result)
+
+    def _client(self):
+        # Runs in a thread, LocalClient isn't thread safe
+        return provision.get_shared_local_client(self.master_config)
+
+    @defer.inlineCallbacks
+    def _run(self):
+        opts = yield workers.defer_to_thread(lambda: self._client().opts)
+        minion = yield workers.defer_to_thread(self._find_minion)
+        if minion is None:
+            self.stdio.addStderr(
+                'No minion found for slave {0}\n'.format(self._slavename())
+            )
+            defer.returnValue(FAILURE)
+
+        self.stdio.addHeader(
+            'Running {0!r} on minion {1} from the master\n'.format(
+                self.fun, minion
+            )
+        )
+        # Watch before publishing so that no event is missed, waiting for
+        # the return on the master's shared event bus reader doesn't hold
+        # a thread
+        watch = yield events.get_reader(opts).watch(
+            minion, on_progress=self._progress
+        )
+        self._minion = minion
+        self._watch = watch
+        try:
+            if self._interrupted:
+                defer.returnValue(FAILURE)
+            jid = yield workers.defer_to_thread(self._publish, minion)
+            self._jid = jid
+            if self._interrupted:
+                # Interrupted while publishing
+                yield self._kill()
+                defer.returnValue(FAILURE)
+            watch.set_jid(jid)
+            data = yield watch.wait(self.timeout)
+        finally:
+            watch.close()
+            self._watch = None
+        if self._interrupted:
+            defer.returnValue(FAILURE)
+        if data is None:
+            self.stdio.addStderr(
+                'No return from {0} within {1} seconds, killing job '
+                '{2}\n'.format(minion, self.timeout, self._jid)
+            )
+            yield self._kill()
+            defer.returnValue(FAILURE)
+        defer.returnValue(self._results(minion, data))
+
+    def _slavename(self):
+        return self.getProperty('slavename', None) or getattr(
+            getattr(self, 'buildslave', None), 'slavename', None
+        )
+
+    def _find_minion(self):
+        # Runs in a thread
+        vm_name = getattr(
+            getattr(self, 'buildslave', None), 'saltcloud_vm_name', None
+        )
+        if vm_name:
+            return vm_name
+        ret = self._client().cmd(
+            'buildbot:slavename:{0}'.format(self._slavename()),
+            'test.ping',
+            timeout=10,
+            expr_form='grain'
+        )
+        minions = sorted(minion for minion, ping in ret.items() if ping)
+        return minions and minions[0] or None
+
+    def _publish(self, minion):
+        # Runs in a thread
+        jid = self._client().cmd_async(
+            [minion], self.fun, self.arg, expr_form='list', kwarg=self.kwarg
+        )
+        if not jid:
+            raise RuntimeError(
+                'Failed to publish {0!r} to {1}'.format(self.fun, minion)
+            )
+        return jid
+
+    def _kill_job(self, minion, jid):
+        # Runs in a thread
+        return self._client().cmd(
+            [minion], 'saltutil.kill_job', [jid], timeout=10,
+            expr_form='list'
+        )
+
+    def _progress(self, data):
+        ret = data.get('ret', {})
+        if not isinstance(ret, dict):
+            return
+        state = state_summary(ret.get('__id__', ''), ret, len(self.states))
+        self.stdio.addStdout(
+            '[{0}/{1}] {2}\n'.format(
+                state['run_num'] + 1, data.get('len', '?'),
+                format_state(state)
+            )
+        )
+
+    def _results(self, minion, data):
+        ret = data.get('return', None)
+        self.stdio.addStdout(
+            json.dumps(ret, indent=2, sort_keys=True, default=repr) + '\n'
+        )
+        if data.get('retcode', 0):
+            result = FAILURE
+        else:
+            result = SUCCESS
+        if self.fun.startswith('state.'):
+            if not isinstance(ret, dict):
+                # A list of rendering errors
+                return FAILURE
+            self.states = sorted(
+                (
+                    state_summary(key, state_ret, idx)
+                    for idx, (key, state_ret) in enumerate(ret.items())
+                    if isinstance(state_ret, dict)
+                ),
+                key=lambda state: state['run_num']
+            )
+            failed = [
+                state['id'] for state in self.states
+                if state['result'] is False
+            ]
+            self.setProperty('salt_states', self.states, 'SaltMasterCommand')
+            self.setProperty('salt_failed_states', failed, 'SaltMasterCommand')
+            if self.states:
+                self.addCompleteLog('states', format_states(self.states))
+            if failed:
+                result = FAILURE
+        return result
@@ -0,0 +1,355 @@
+# -*- coding: utf-8 -*-
+'''
+    saltcloud_buildbot.teardown
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Batched, bounded-parallel, VM destruction.
+
+    The destroys requested within a short window are coalesced into a single
+    salt-cloud ``destroy`` call, and only a few of those calls run at once.
+    The live VMs are tracked so that, on master shutdown, all of them are
+    destroyed concurrently within a global deadline. The VMs which failed
+    to die are logged and, optionally, written to a JSON report.
+
+    :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
+    :license: Apache 2.0, see LICENSE for more details.
+'''
+
+# Import python libs
+import os
+import json
+import time
+import logging
+
+# Import twisted libs
+from twisted.internet import defer, reactor
+
+# Import saltcloud_buildbot libs
+from saltcloud_buildbot import naming, provision, workers
+
+
+log = logging.getLogger(__name__)
+
+
+class DestroyFailed(Exception):
+    '''
+    Raised when salt-cloud failed to destroy, or did not destroy in time,
+    a VM.
+    '''
+
+
+def failed_destroy(ret, vm_name):
+    '''
+    Return the reason salt-cloud failed to destroy ``vm_name`` according to
+    its ``destroy`` return, ``None`` if it didn't fail.
+    '''
+    node_ret = provision.find_vm_return(ret, vm_name)
+    if node_ret is False:
+        return 'salt-cloud returned False'
+    if isinstance(node_ret, dict) and 'Error' in node_ret:
+        return str(node_ret['Error'])
+    # A missing return means salt-cloud did not find the VM, it's gone
+    return None
+
+
+class Destroyer(object):
+    '''
+    Coalesce VM destroys and track the live VMs.
+
+    :param window: the seconds to wait for more destroys to batch together
+    :param max_size: the maximum number of VMs destroyed in a single call
+    :param max_parallel: the maximum number of destroy calls running at once
+    :param deadline: the seconds a destroy call is waited for before its VMs
+                     are reported as failed to die
+    :param shutdown_deadline: the seconds the master shutdown is delayed,
+                              at most, while destroying the live VMs
+    :param report_path: if set, the VMs which failed to die are written to
+                        this JSON file
+    '''
+
+    def __init__(self, window=1, max_size=20, max_parallel=4, deadline=300,
+                 shutdown_deadline=120, report_path=None, clock=None):
+        self.window = window
+        self.max_size = max_size
+        self.max_parallel = max_parallel
+        self.deadline = deadline
+        self.shutdown_deadline = shutdown_deadline
+        self.report_path = report_path
+        self.clock = clock or reactor
+
+        # Live VMs, name to (config_loader, slavename)
+        self.live = {}
+        # Live VMs left running on master shutdown
+        self.kept = set()
+        # VMs which failed to die, name to details
+        self.failed = {}
+        # The deferreds waiting on each destroy requested and not finished
+        self._destroying = {}
+        # Pending batches keyed by configuration identity
+        self._pending = {}
+        self._timers = {}
+        self._semaphore = defer.DeferredSemaphore(max_parallel)
+
+    def configure(self, window=None, max_size=None, max_parallel=None,
+                  deadline=None, shutdown_deadline=None, report_path=None):
+        '''
+        Update the settings, ``None`` values are left untouched.
+        '''
+        if window is not None:
+            self.window = window
+        if max_size is not None:
+            self.max_size = max_size
+        if max_parallel is not None and max_parallel != self.max_parallel:
+            self.max_parallel = max_parallel
+            self._semaphore = defer.DeferredSemaphore(max_parallel)
+        if deadline is not None:
+            self.deadline = deadline
+        if shutdown_deadline is not None:
+            self.shutdown_deadline = shutdown_deadline
+        if report_path is not None:
+            self.report_path = report_path
+
+    def track(self, vm_name, config_loader, slavename=None,
+              keep_on_shutdown=False):
+        '''
+        Track ``vm_name`` as live, so it's destroyed on master shutdown,
+        unless ``keep_on_shutdown`` is ``True``. ``config_loader`` returns
+        the salt-cloud configuration to destroy it with.
+        '''
+        self.live[vm_name] = (config_loader, slavename)
+        if keep_on_shutdown:
+            self.kept.add(vm_name)
+        else:
+            self.kept.discard(vm_name)
+
+    def forget(self, vm_name):
+        '''
+        Stop tracking ``vm_name``, which is left running.
+        '''
+        self.live.pop(vm_name, None)
+        self.kept.discard(vm_name)
+
+    def destroy(self, config, names, slavename=None):
+        '''
+        Destroy the VMs in ``names``. Returns a deferred firing with the
+        names once all of them are destroyed, or failing with
+        :class:`DestroyFailed` if any of them failed to die.
+        '''
+        deferreds = []
+        for vm_name in names:
+            # Wait on it before submitting, the destroy may finish right away
+            d = defer.Deferred()
+            deferreds.append(d)
+            if vm_name in self._destroying:
+                # Being destroyed already
+                self._destroying[vm_name].append(d)
+                continue
+            self._destroying[vm_name] = [d]
+            self._submit(config, vm_name, slavename)
+
+        d = defer.DeferredList(deferreds, consumeErrors=True)
+
+        def check(results):
+            errors = [
+                result.getErrorMessage()
+                for success, result in results if not success
+            ]
+            if errors:
+                raise DestroyFailed('\n'.join(errors))
+            return list(names)
+        return d.addCallback(check)
+
+    def _submit(self, config, vm_name, slavename):
+        key = id(config)
+        batch = self._pending.setdefault(key, (config, []))[1]
+        batch.append((vm_name, slavename))
+        if len(batch) >= self.max_size or not self.window:
+            self._flush(key)
+        elif key not in self._timers:
+            self._timers[key] = self.clock.callLater(
+                self.window, self._flush, key
+            )
+
+    def _flush(self, key):
+        timer = self._timers.pop(key, None)
+        if timer is not None and timer.active():
+            timer.cancel()
+        config, batch = self._pending.pop(key, (None, []))
+        if not batch:
+            return
+
+        names = [vm_name for vm_name, _ in batch]
+        log.info(
+            'Destroying {0} VM(s) in a single salt-cloud call: {1}'.format(
+                len(names), ', '.join(names)
+            )
+        )
+        d = self._semaphore.run(
+            workers.defer_to_thread, provision.destroy_vms, config, names
+        )
+        d = self._with_deadline(d, self.deadline)
+        d.addCallbacks(
+            self._fan_out, self._fail_all,
+            callbackArgs=(batch,), errbackArgs=(batch,)
+        )
+
+    def _with_deadline(self, d, seconds):
+        # The destroy thread can't be interrupted, stop waiting for it
+        result = defer.Deferred()
+
+        def expired():
+            result.errback(
+                DestroyFailed('not destroyed within {0} seconds'.format(
+                    seconds
+                ))
+            )
+        timer = self.clock.callLater(seconds, expired)
+
+        def done(ret):
+            if timer.active():
+                timer.cancel()
+                result.callback(ret)
+            # Otherwise, the deadline already expired
+        d.addBoth(done)
+        return result
+
+    def _fan_out(self, ret, batch):
+        for vm_name, slavename in batch:
+            reason = failed_destroy(ret, vm_name)
+            if reason is None:
+                self.live.pop(vm_name, None)
+                self.kept.discard(vm_name)
+                self.failed.pop(vm_name, None)
+                # The name may be handed out again
+                naming.release(vm_name)
+                self._finished(vm_name, vm_name)
+            else:
+                self._failed(vm_name, slavename, reason)
+        self.write_report()
+
+    def _fail_all(self, failure, batch):
+        for vm_name, slavename in batch:
+            self._failed(vm_name, slavename, failure.getErrorMessage())
+        self.write_report()
+
+    def _failed(self, vm_name, slavename, reason):
+        if slavename is None and vm_name in self.live:
+            slavename = self.live[vm_name][1]
+        msg = 'salt-cloud failed to destroy VM {0} for slave {1}: {2}'.format(
+            vm_name, slavename, reason
+        )
+        log.error(msg)
+        self.failed[vm_name] = {
+            'slavename': slavename,
+            'reason': reason,
+            'time': time.time()
+        }
+        self._finished(vm_name, DestroyFailed(msg))
+
+    def _finished(self, vm_name, result):
+        for d in self._destroying.pop(vm_name, []):
+            if isinstance(result, Exception):
+                d.errback(result)
+            else:
+                d.callback(result)
+
+    def write_report(self):
+        '''
+        Write the VMs which failed to die to ``report_path``.
+        '''
+        if not self.report_path:
+            return
+        try:
+            tmp_path = '{0}.tmp'.format(self.report_path)
+            with open(tmp_path, 'w') as fic:
+                json.dump(self.failed, fic, indent=2, sort_keys=True)
+            os.rename(tmp_path, self.report_path)
+        except (IOError, OSError) as err:
+            log.error(
+                'Failed to write the destroy report {0}: {1}'.format(
+                    self.report_path, err
+                )
+            )
+
+    @defer.inlineCallbacks
+    def shutdown(self):
+        '''
+        Destroy every live VM concurrently, waiting at most
+        ``shutdown_deadline`` seconds.
+        '''
+        if self.kept:
+            log.info(
+                'Leaving VM(s) {0} running, to be reattached to'.format(
+                    ', '.join(sorted(self.kept))
+                )
+            )
+        live = dict(
+            (vm_name, entry) for vm_name, entry in self.live.items()
+            if vm_name not in self.kept
+        )
+        if not live and not self._destroying:
+            return
+        log.info(
+            'Destroying {0} live VM(s) before shutting down: {1}'.format(
+                len(live), ', '.join(sorted(live))
+            )
+        )
+        # Flush everything right away, as concurrently as possible
+        self.window = 0
+        self.deadline = min(self.deadline, self.shutdown_deadline)
+        self._semaphore = defer.DeferredSemaphore(
+            max(self.max_parallel, len(live))
+        )
+        for key in self._pending.keys():
+            self._flush(key)
+
+        deferreds = []
+        for vm_name, (config_loader, slavename) in live.items():
+            d = workers.defer_to_thread(config_loader)
+            d.addCallback(self.destroy, [vm_name], slavename)
+            deferreds.append(d)
+        for vm_name, waiters in self._destroying.items():
+            if vm_name not in live:
+                d = defer.Deferred()
+                waiters.append(d)
+                deferreds.append(d)
+
+        yield self._with_deadline(
+            defer.DeferredList(deferreds, consumeErrors=True),
+            self.shutdown_deadline
+        ).addErrback(lambda failure: None)
+
+        for vm_name, (_, slavename) in self.live.items():
+            if vm_name not in self.failed and vm_name not in self.kept:
+                self.failed[vm_name] = {
+                    'slavename': slavename,
+                    'reason': 'not destroyed before shutting down',
+                    'time': time.time()
+                }
+        if self.failed:
+            log.error(
+                'VM(s) which failed to die and need to be destroyed '
+                'manually: {0}'.format(', '.join(sorted(self.failed)))
+            )
+        self.write_report()
+
+
+_DESTROYER = None
+
+
+def get_destroyer(**kwargs):
+    '''
+    Return the process wide destroyer, updating its settings with the
+    ``kwargs`` not ``None``.
+
+    The first call registers the master shutdown hook.
+    '''
+    global _DESTROYER
+    if _DESTROYER is None:
+        _DESTROYER = Destroyer()
+        reactor.addSystemEventTrigger(
+            'before', 'shutdown', _DESTROYER.shutdown
+        )
+    _DESTROYER.configure(**kwargs)
+    return _DESTROYER
@@ -6,6 +6,10 @@
     This is the same, although adapted, version.py as seen in salt's source
     code.
 
+    The git version is only discovered at build or install time, by
+    ``setup.py``, which writes it to ``saltcloud_buildbot/_version.py``.
+    Importing this module never spawns a ``git`` process.
+
     :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
     :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
     :license: Apache 2.0, see LICENSE for more details.
@@ -24,20 +28,12 @@ GIT_DESCRIBE_REGEX = (
 )
 
 
-def __get_version(version, version_info):
+def git_version(version=__version__, version_info=__version_info__):
     '''
-    If we can get a version provided at installation time or from Git, use
-    that instead, otherwise we carry on.
+    Return the version information from ``git describe``, if this is a git
+    checkout, otherwise ``version`` and ``version_info``. Only meant to be
+    called at build or install time.
     '''
-    try:
-        # Try to import the version information provided at install time
-        from salt._version import __version__, __version_info__
-        return __version__, __version_info__
-    except ImportError:
-        pass
-
-    # This might be a 'python setup.py develop' installation type. Let's
-    # discover the version information at runtime.
     import os
     import re
     import warnings
@@ -115,10 +111,11 @@ def __get_version(version, version_info):
     return version, version_info
 
 
-# Get additional version information if available
-__version__, __version_info__ = __get_version(__version__, __version_info__)
-# This function has executed once, we're done with it. Delete it!
-del __get_version
+try:
+    # Use the version information provided at build or install time
+    from saltcloud_buildbot._version import __version__, __version_info__
+except ImportError:
+    pass
 
 
 if __name__ == '__main__':
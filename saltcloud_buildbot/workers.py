@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+'''
+    saltcloud_buildbot.workers
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    A dedicated thread pool for the blocking salt and salt-cloud calls.
+
+    The provisioning pipeline is driven by deferreds on the reactor, only
+    the blocking calls, like ``Map.run_profile`` or ``LocalClient.cmd``, are
+    offloaded to this pool. Keeping them off the reactor's shared thread
+    pool means that many concurrent substantiations don't starve the other
+    buildbot thread users, like the database.
+
+    :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
+    :license: Apache 2.0, see LICENSE for more details.
+'''
+
+# Import python libs
+import logging
+
+# Import twisted libs
+from twisted.internet import reactor, threads
+from twisted.python import threadpool
+
+
+log = logging.getLogger(__name__)
+
+
+DEFAULT_SIZE = 30
+
+_POOL = None
+_SIZE = DEFAULT_SIZE
+
+
+def configure(size):
+    '''
+    Set the maximum number of threads of the pool. The biggest size
+    requested wins.
+    '''
+    global _SIZE
+    if size is None or size <= _SIZE:
+        return
+    _SIZE = size
+    if _POOL is not None:
+        _POOL.adjustPoolsize(maxthreads=size)
+
+
+def get_pool():
+    '''
+    Return the, started, process wide pool.
+    '''
+    global _POOL
+    if _POOL is None:
+        _POOL = threadpool.ThreadPool(0, _SIZE, name='saltcloud-buildbot')
+        _POOL.start()
+        reactor.addSystemEventTrigger('during', 'shutdown', _stop)
+    return _POOL
+
+
+def _stop():
+    global _POOL
+    if _POOL is not None:
+        _POOL.stop()
+        _POOL = None
+
+
+def defer_to_thread(func, *args, **kwargs):
+    '''
+    Run ``func`` in the pool and return a deferred with its result.
+    '''
+    return threads.deferToThreadPool(
+        reactor, get_pool(), func, *args, **kwargs
+    )
+
+
+def stats():
+    '''
+    Return the pool size and how many threads are busy or idle, and how
+    many calls are queued waiting for a thread.
+    '''
+    pool = _POOL
+    if pool is None:
+        return {'size': _SIZE, 'busy': 0, 'idle': 0, 'queued': 0}
+    if hasattr(pool, '_team'):
+        # Twisted >= 15.5
+        stats = pool._team.statistics()
+        return {
+            'size': pool.max,
+            'busy': stats.busyWorkerCount,
+            'idle': stats.idleWorkerCount,
+            'queued': stats.backloggedWorkCount
+        }
+    return {
+        'size': pool.max,
+        'busy': len(pool.working),
+        'idle': len(pool.waiters),
+        'queued': pool.q.qsize()
+    }
@@ -14,12 +14,27 @@
 
 import os
 from setuptools import setup
+from setuptools.command.build_py import build_py
+from setuptools.command.develop import develop
+from setuptools.command.sdist import sdist
 
 import saltcloud_buildbot as package
+from saltcloud_buildbot.version import git_version
+
+SETUP_DIRNAME = os.path.dirname(__file__)
+# Discover the git version once, at build time, never at import time
+VERSION, VERSION_INFO = git_version()
+VERSION_TEMPLATE = '''\
+# -*- coding: utf-8 -*-
+# This file was generated by setup.py, do not edit it.
+
+__version__ = {0!r}
+__version_info__ = {1!r}
+'''
 
 
 REQUIREMENTS = ['Distribute']
-REQUIREMENTS_FILE = os.path.join(os.path.dirname(__file__), 'requirements.txt')
+REQUIREMENTS_FILE = os.path.join(SETUP_DIRNAME, 'requirements.txt')
 if os.path.isfile(REQUIREMENTS_FILE):
     with open(REQUIREMENTS_FILE) as orf:
         REQUIREMENTS.extend(
@@ -27,8 +42,44 @@ if os.path.isfile(REQUIREMENTS_FILE):
         )
 
 
+def write_version(base_dir):
+    '''
+    Write the version information to ``base_dir``'s
+    ``saltcloud_buildbot/_version.py``.
+    '''
+    path = os.path.join(base_dir, 'saltcloud_buildbot', '_version.py')
+    if not os.path.isdir(os.path.dirname(path)):
+        return
+    if os.path.exists(path):
+        # Might be hard linked to the source tree's copy
+        os.remove(path)
+    with open(path, 'w') as ofh:
+        ofh.write(VERSION_TEMPLATE.format(VERSION, VERSION_INFO))
+
+
+class BuildPy(build_py):
+    def run(self):
+        build_py.run(self)
+        if not self.dry_run:
+            write_version(self.build_lib)
+
+
+class Develop(develop):
+    def run(self):
+        if not self.dry_run:
+            write_version(SETUP_DIRNAME or os.curdir)
+        develop.run(self)
+
+
+class SDist(sdist):
+    def make_release_tree(self, base_dir, files):
+        sdist.make_release_tree(self, base_dir, files)
+        if not self.dry_run:
+            write_version(base_dir)
+
+
 setup(name=package.__package_name__,
-      version=package.__version__,
+      version=VERSION,
       author=package.__author__,
       author_email=package.__email__,
       url=package.__url__,
@@ -39,6 +90,11 @@ setup(name=package.__package_name__,
       keywords='Salt Cloud Latent Slave for Buildbot',
       packages=['saltcloud_buildbot'],
       install_requires=REQUIREMENTS,
+      cmdclass={
+          'build_py': BuildPy,
+          'develop': Develop,
+          'sdist': SDist,
+      },
       classifiers=[
           'Development Status :: 3 - Alpha',
           'Environment :: Web Environment',
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+'''
+    tests
+    ~~~~~
+
+    saltcloud_buildbot's unit tests, run them with ``trial tests``.
+
+    :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
+    :license: Apache 2.0, see LICENSE for more details.
+'''
+
+# Import twisted libs
+from twisted.internet import defer
+
+
+try:
+    import salt.exceptions  # pylint: disable=unused-import
+    HAS_SALT = True
+except ImportError:
+    HAS_SALT = False
+
+try:
+    import saltcloud.cloud  # pylint: disable=unused-import
+    HAS_SALTCLOUD = True
+except ImportError:
+    HAS_SALTCLOUD = False
+
+# The skip reason of the tests needing salt
+SKIP_SALT = not HAS_SALT and 'salt is not installed' or None
+# The skip reason of the tests needing salt-cloud
+SKIP_SALTCLOUD = not HAS_SALTCLOUD and 'salt-cloud is not installed' or None
+
+
+def run_inline(func, *args, **kwargs):
+    '''
+    A drop in replacement of
+    :func:`~saltcloud_buildbot.workers.defer_to_thread` running ``func``
+    right away, in the calling thread.
+    '''
+    return defer.maybeDeferred(func, *args, **kwargs)
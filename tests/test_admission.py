@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+'''
+    tests.test_admission
+    ~~~~~~~~~~~~~~~~~~~~
+
+    :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
+    :license: Apache 2.0, see LICENSE for more details.
+'''
+
+# Import twisted libs
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+# Import saltcloud_buildbot libs
+from saltcloud_buildbot import admission, metrics
+from tests import run_inline
+
+
+class ProviderTestCase(unittest.TestCase):
+
+    def test_provider_alias(self):
+        config = {'profiles': {
+            'linux': {'provider': 'my-ec2:ec2'},
+            'windows': {'provider': 'my-azure'},
+            'bare': {}
+        }}
+        self.assertEqual(admission.provider_alias(config, 'linux'), 'my-ec2')
+        self.assertEqual(
+            admission.provider_alias(config, 'windows'), 'my-azure'
+        )
+        self.assertEqual(admission.provider_alias(config, 'bare'), 'default')
+
+    def test_provider_limits(self):
+        config = {'providers': {
+            'old': {'provider': 'ec2', 'buildbot_create_rate': 0.5},
+            'new': {'ec2': {'buildbot_create_burst': 3}},
+            'none': {'ec2': {}}
+        }}
+        self.assertEqual(
+            admission.provider_limits(config, 'old'), (0.5, None)
+        )
+        self.assertEqual(admission.provider_limits(config, 'new'), (None, 3))
+        self.assertEqual(
+            admission.provider_limits(config, 'none'), (None, None)
+        )
+        self.assertEqual(
+            admission.provider_limits(config, 'missing'), (None, None)
+        )
+
+
+class TokenBucketTestCase(unittest.TestCase):
+
+    def test_rate_and_burst(self):
+        clock = task.Clock()
+        bucket = admission.TokenBucket(rate=0.5, burst=2, clock=clock)
+        for _ in range(2):
+            self.assertEqual(bucket.delay(), 0)
+            bucket.consume()
+        self.assertEqual(bucket.delay(), 2)
+        clock.advance(1)
+        self.assertEqual(bucket.delay(), 1)
+        clock.advance(10)
+        # Never more than the burst
+        bucket.consume()
+        bucket.consume()
+        self.assertEqual(bucket.delay(), 2)
+
+    def test_no_limit(self):
+        bucket = admission.TokenBucket(clock=task.Clock())
+        for _ in range(10):
+            bucket.consume()
+        self.assertEqual(bucket.delay(), 0)
+
+
+class AdmissionControllerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.controller = admission.AdmissionController(
+            max_in_flight=2, clock=self.clock
+        )
+        self.admitted = []
+
+    def acquire(self, provider, priority=0, name=None):
+        d = self.controller.acquire(provider, priority, name)
+        d.addCallback(lambda waited: self.admitted.append(name))
+        return d
+
+    def test_max_in_flight(self):
+        for idx in range(3):
+            self.acquire('ec2', name=idx)
+        self.assertEqual(self.admitted, [0, 1])
+        self.assertEqual(self.controller.stats()['queued'], 1)
+        self.controller.release()
+        self.assertEqual(self.admitted, [0, 1, 2])
+        self.assertEqual(self.controller.stats()['in_flight'], 2)
+
+    def test_priority_order(self):
+        self.acquire('ec2', name='first')
+        self.acquire('ec2', name='second')
+        self.acquire('ec2', priority=0, name='low')
+        self.acquire('ec2', priority=10, name='high')
+        self.acquire('ec2', priority=admission.BACKGROUND_PRIORITY,
+                     name='background')
+        self.acquire('ec2', priority=0, name='low2')
+        for _ in range(4):
+            self.controller.release()
+        self.assertEqual(
+            self.admitted,
+            ['first', 'second', 'high', 'low', 'low2', 'background']
+        )
+
+    def test_rate_limited_providers_let_others_through(self):
+        self.controller.max_in_flight = None
+        self.controller.configure_provider('ec2', rate=1, burst=1)
+        self.acquire('ec2', name='ec2-1')
+        self.acquire('ec2', priority=10, name='ec2-2')
+        self.acquire('azure', name='azure-1')
+        self.assertEqual(self.admitted, ['ec2-1', 'azure-1'])
+        stats = self.controller.stats()
+        self.assertEqual(stats['queued_per_provider'], {'ec2': 1})
+        self.clock.advance(1)
+        self.assertEqual(self.admitted, ['ec2-1', 'azure-1', 'ec2-2'])
+        stats = self.controller.stats()
+        self.assertEqual(stats['admitted'], 3)
+        self.assertEqual(stats['max_wait'], 1)
+
+    def test_default_limits_follow_the_configuration(self):
+        self.controller.max_in_flight = None
+        self.controller.configure_provider('ec2', rate=1, burst=1)
+        self.acquire('azure', name='azure-1')
+        self.acquire('azure', name='azure-2')
+        self.assertEqual(self.admitted, ['azure-1', 'azure-2'])
+        self.controller.configure(default_rate=0.5, default_burst=1)
+        self.assertEqual(self.controller._buckets['azure'].rate, 0.5)
+        # Providers with their own limits keep them
+        self.assertEqual(self.controller._buckets['ec2'].rate, 1)
+        self.acquire('azure', name='azure-3')
+        self.acquire('azure', name='azure-4')
+        self.assertEqual(self.admitted, ['azure-1', 'azure-2', 'azure-3'])
+        self.clock.advance(2)
+        self.assertEqual(self.admitted[-1], 'azure-4')
+        # Back to the defaults once its own limits are removed
+        self.controller.configure_provider('ec2')
+        self.controller.configure(default_rate=2)
+        self.assertEqual(self.controller._buckets['ec2'].rate, 2)
+
+
+
+class CreateAdmittedTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = metrics.Registry()
+        self.patch(metrics, '_REGISTRY', self.registry)
+        self.controller = admission.AdmissionController(max_in_flight=1)
+        self.patch(admission, '_CONTROLLER', self.controller)
+        self.patch(admission.workers, 'defer_to_thread', run_inline)
+        self.config = {
+            'profiles': {'linux': {'provider': 'my-ec2:ec2'}},
+            'providers': {'my-ec2': {'ec2': {'buildbot_create_rate': 2}}}
+        }
+
+    @defer.inlineCallbacks
+    def test_create_and_release(self):
+        ret = yield admission.create_admitted(
+            self.config, 'linux', 'vm1', lambda name: {name: True}, 'vm1'
+        )
+        self.assertEqual(ret, {'vm1': True})
+        self.assertEqual(self.controller.in_flight, 0)
+        # The provider limits were picked up
+        self.assertEqual(self.controller._buckets['my-ec2'].rate, 2)
+
+    @defer.inlineCallbacks
+    def test_failed_creates_are_released(self):
+        def create():
+            raise RuntimeError('no capacity')
+        yield self.assertFailure(
+            admission.create_admitted(self.config, 'linux', 'vm1', create),
+            RuntimeError
+        )
+        self.assertEqual(self.controller.in_flight, 0)
+
+    @defer.inlineCallbacks
+    def test_not_in_thread(self):
+        ret = yield admission.create_admitted(
+            self.config, 'linux', 'vm1', defer.succeed, 'done',
+            in_thread=False
+        )
+        self.assertEqual(ret, 'done')
+
+    @defer.inlineCallbacks
+    def test_metrics(self):
+        # Not rate limited
+        self.config['providers'] = {}
+        created = defer.Deferred()
+        first = admission.create_admitted(
+            self.config, 'linux', 'vm1', lambda slavename: created,
+            in_thread=False, slavename='slave01'
+        )
+        second = admission.create_admitted(
+            self.config, 'linux', 'vm2', lambda slavename: slavename,
+            in_thread=False, slavename='slave02'
+        )
+        gauges = dict(
+            ((gauge['name'], gauge['labels'].get('provider')),
+             gauge['value'])
+            for gauge in self.registry.as_dict()['gauges']
+        )
+        self.assertEqual(
+            gauges,
+            {('admission_in_flight', None): 1,
+             ('admission_queued', 'my-ec2'): 1}
+        )
+        created.callback('vm1')
+        yield defer.gatherResults([first, second])
+        self.assertIn(
+            'saltcloud_buildbot_admission_queued{provider="my-ec2"} 0',
+            self.registry.render()
+        )
+        self.assertEqual(
+            sorted(
+                key for key in self.registry._histograms
+                if key[0] == metrics.ADMISSION_WAIT
+            ),
+            [(metrics.ADMISSION_WAIT, 'linux', 'slave01'),
+             (metrics.ADMISSION_WAIT, 'linux', 'slave02')]
+        )
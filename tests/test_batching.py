@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+'''
+    tests.test_batching
+    ~~~~~~~~~~~~~~~~~~~
+
+    :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
+    :license: Apache 2.0, see LICENSE for more details.
+'''
+
+# Import twisted libs
+from twisted.internet import task
+from twisted.trial import unittest
+
+# Import buildbot libs
+from buildbot.interfaces import LatentBuildSlaveFailedToSubstantiate
+
+# Import saltcloud_buildbot libs
+from saltcloud_buildbot import batching
+from tests import run_inline
+
+
+class CreateBatcherTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.batcher = batching.CreateBatcher(
+            window=2, max_size=3, clock=self.clock
+        )
+        self.batches = []
+        self.errors = {}
+        self.patch(batching.workers, 'defer_to_thread', run_inline)
+        self.patch(batching, 'run_map', self._run_map)
+
+    def _run_map(self, config, creates):
+        self.batches.append([create.vm_name for create in creates])
+        # Provider nested, like salt-cloud returns them
+        return {'my-ec2': {'ec2': dict(
+            (create.vm_name, self.errors.get(create.vm_name, {'id': 1}))
+            for create in creates
+        )}}
+
+    def submit(self, vm_name, config):
+        return self.batcher.submit(
+            config, 'linux', vm_name, {}, slavename='slave01'
+        )
+
+    def test_window(self):
+        config = {}
+        first = self.submit('vm1', config)
+        self.clock.advance(1)
+        second = self.submit('vm2', config)
+        self.assertEqual(self.batches, [])
+        self.clock.advance(1)
+        self.assertEqual(self.batches, [['vm1', 'vm2']])
+        self.assertEqual(self.successResultOf(first), {'vm1': {'id': 1}})
+        self.assertEqual(self.successResultOf(second), {'vm2': {'id': 1}})
+
+    def test_max_size(self):
+        config = {}
+        for idx in range(4):
+            self.submit('vm{0}'.format(idx), config)
+        self.assertEqual(self.batches, [['vm0', 'vm1', 'vm2']])
+        self.clock.advance(2)
+        self.assertEqual(self.batches[-1], ['vm3'])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_batched_per_config(self):
+        self.submit('vm1', {})
+        self.submit('vm2', {})
+        self.clock.advance(2)
+        self.assertEqual(sorted(self.batches), [['vm1'], ['vm2']])
+
+    def test_failed_creates(self):
+        self.errors['vm2'] = {'Errors': 'quota exceeded'}
+        config = {}
+        first = self.submit('vm1', config)
+        second = self.submit('vm2', config)
+        self.clock.advance(2)
+        self.successResultOf(first)
+        self.failureResultOf(second, LatentBuildSlaveFailedToSubstantiate)
+
+    def test_failed_map_run(self):
+        def broken(config, creates):
+            raise IOError('provider down')
+        self.patch(batching, 'run_map', broken)
+        config = {}
+        creates = [self.submit('vm1', config), self.submit('vm2', config)]
+        self.clock.advance(2)
+        for d in creates:
+            failure = self.failureResultOf(
+                d, LatentBuildSlaveFailedToSubstantiate
+            )
+            self.assertIn('provider down', failure.getErrorMessage())
+
+    def test_get_batcher(self):
+        self.patch(batching, '_BATCHER', None)
+        batcher = batching.get_batcher(window=5)
+        self.assertIdentical(batching.get_batcher(max_size=7), batcher)
+        self.assertEqual((batcher.window, batcher.max_size), (5, 7))
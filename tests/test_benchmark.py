@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+'''
+    tests.test_benchmark
+    ~~~~~~~~~~~~~~~~~~~~
+
+    :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
+    :license: Apache 2.0, see LICENSE for more details.
+'''
+
+# Import twisted libs
+from twisted.internet import defer, reactor, task
+from twisted.trial import unittest
+
+# Import saltcloud_buildbot libs
+from saltcloud_buildbot import benchmark, logsetup
+from tests import SKIP_SALTCLOUD
+
+
+class ImportTimeTestCase(unittest.TestCase):
+
+    def test_slave_import_does_not_import_salt(self):
+        report = benchmark.import_time(runs=1)
+        self.assertEqual(report['module'], 'saltcloud_buildbot.slave')
+        self.assertEqual(report['heavy_modules'], [])
+        self.assertEqual(report['import_time']['count'], 1)
+
+    def test_import_failure(self):
+        self.assertRaises(
+            RuntimeError, benchmark.import_time, 'saltcloud_buildbot.nope', 1
+        )
+
+
+class BenchmarkTestCase(unittest.TestCase):
+
+    skip = SKIP_SALTCLOUD
+
+    def setUp(self):
+        self.addCleanup(logsetup.shutdown)
+        self.addCleanup(self.cancel_build_starts)
+        self.cloud = benchmark.FakeCloud(
+            create_latency=0.01, destroy_latency=0.01, jitter=0
+        )
+        self.master = benchmark.FakeMaster(
+            self.cloud, boot_latency=0.01, command_latency=0.01,
+            highstate_latency=0.01, jitter=0
+        )
+
+    def cancel_build_starts(self):
+        # The slaves ask the botmaster to start builds 5 seconds after
+        # they're stopped, and stop on their own once failed to start
+        return task.deferLater(reactor, 0.2, self._cancel_build_starts)
+
+    def _cancel_build_starts(self):
+        for call in reactor.getDelayedCalls():
+            if getattr(call.func, '__name__', None) == \
+                    'maybeStartBuildsForSlave':
+                call.cancel()
+
+    @defer.inlineCallbacks
+    def test_report(self):
+        report = yield benchmark.Benchmark(
+            self.cloud, self.master, slaves=3
+        ).run()
+        self.assertEqual(
+            sorted(report),
+            ['admission', 'duration', 'failures', 'leaked_vms',
+             'peak_memory_kib', 'slaves', 'thread_pool', 'time_to_destroy',
+             'time_to_ready']
+        )
+        self.assertEqual(report['slaves'], 3)
+        self.assertEqual(report['failures'], 0)
+        self.assertEqual(report['time_to_ready']['count'], 3)
+        self.assertEqual(report['time_to_destroy']['count'], 3)
+        self.assertEqual(report['leaked_vms'], [])
+        # And it can be formatted
+        self.assertIn('Time to ready', benchmark.format_report(report))
+
+    @defer.inlineCallbacks
+    def test_failures_are_counted(self):
+        self.cloud.create_failure_rate = 1
+        report = yield benchmark.Benchmark(
+            self.cloud, self.master, slaves=2
+        ).run()
+        self.assertEqual(report['failures'], 2)
+        self.assertEqual(report['time_to_ready']['count'], 0)
+        self.assertEqual(report['leaked_vms'], [])
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+'''
+    tests.test_config
+    ~~~~~~~~~~~~~~~~~
+
+    :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
+    :license: Apache 2.0, see LICENSE for more details.
+'''
+
+# Import python libs
+import os
+
+# Import twisted libs
+from twisted.trial import unittest
+
+# Import saltcloud_buildbot libs
+from saltcloud_buildbot import config
+
+
+class CloudConfigCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.root = self.mktemp()
+        os.makedirs(self.root)
+        self.paths = []
+        for name in ('cloud', 'master', 'cloud.providers', 'cloud.profiles'):
+            path = os.path.join(self.root, name)
+            self.write(path, '{0}: 1\n'.format(name))
+            self.paths.append(path)
+        self.loads = []
+        self.cache = config.CloudConfigCache(self.load)
+
+    def load(self, *paths):
+        self.loads.append(paths)
+        return {'loads': len(self.loads)}
+
+    def write(self, path, contents, mtime=None):
+        with open(path, 'w') as wfh:
+            wfh.write(contents)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+
+    def get(self):
+        return self.cache.get(*self.paths)
+
+    def test_shared_until_changed(self):
+        first = self.get()
+        self.assertIdentical(self.get(), first)
+        self.assertEqual(self.loads, [tuple(self.paths)])
+
+    def test_reloaded_when_changed(self):
+        first = self.get()
+        stat = os.stat(self.paths[3])
+        self.write(self.paths[3], 'changed: 2\n', stat.st_mtime + 10)
+        second = self.get()
+        self.assertNotIdentical(second, first)
+        self.assertEqual(second, {'loads': 2})
+
+    def test_touched_but_not_changed(self):
+        first = self.get()
+        stat = os.stat(self.paths[0])
+        os.utime(self.paths[0], (stat.st_atime, stat.st_mtime + 10))
+        self.assertIdentical(self.get(), first)
+        self.assertEqual(len(self.loads), 1)
+
+    def test_include_files_are_watched(self):
+        first = self.get()
+        include_dir = '{0}.d'.format(self.paths[2])
+        os.makedirs(include_dir)
+        self.write(os.path.join(include_dir, 'ignored.txt'), 'ignored')
+        self.assertIdentical(self.get(), first)
+        self.write(os.path.join(include_dir, 'ec2.conf'), 'ec2: {}\n')
+        self.assertEqual(self.get(), {'loads': 2})
+
+    def test_missing_files(self):
+        os.remove(self.paths[1])
+        first = self.get()
+        self.assertIdentical(self.get(), first)
+        self.write(self.paths[1], 'master: 1\n')
+        self.assertEqual(self.get(), {'loads': 2})
+
+    def test_keyed_by_paths(self):
+        first = self.get()
+        other = self.cache.get(self.paths[0], self.paths[1], self.paths[2],
+                               self.paths[2])
+        self.assertNotIdentical(other, first)
+        self.cache.clear()
+        self.assertEqual(self.get(), {'loads': 3})
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+'''
+    tests.test_events
+    ~~~~~~~~~~~~~~~~~
+
+    :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
+    :license: Apache 2.0, see LICENSE for more details.
+'''
+
+# Import twisted libs
+from twisted.internet import defer, reactor, task
+from twisted.trial import unittest
+
+# Import saltcloud_buildbot libs
+from saltcloud_buildbot import events
+
+
+def wait_until(predicate, timeout=5):
+    '''
+    Return a deferred firing once ``predicate()`` is true.
+    '''
+    started = reactor.seconds()
+
+    def check():
+        if predicate():
+            return None
+        if reactor.seconds() - started > timeout:
+            raise AssertionError('Timed out waiting')
+        return task.deferLater(reactor, 0.01, check)
+    return check()
+
+
+class CountingBus(events.LocalEventBus):
+
+    def __init__(self):
+        events.LocalEventBus.__init__(self)
+        self.subscriptions = 0
+
+    def subscribe(self, opts=None):
+        self.subscriptions += 1
+        return events.LocalEventBus.subscribe(self, opts)
+
+
+class HelpersTestCase(unittest.TestCase):
+
+    def test_event_minion(self):
+        self.assertEqual(
+            events.event_minion('salt/job/123/ret/minion1', {}), 'minion1'
+        )
+        self.assertEqual(
+            events.event_minion('salt/job/123/prog/minion1/4', {}),
+            'minion1'
+        )
+        # Old style, jid tagged, returns
+        self.assertEqual(
+            events.event_minion('123', {'id': 'minion1'}), 'minion1'
+        )
+        self.assertEqual(events.event_minion('salt/auth', {}), None)
+
+    def test_as_full_return(self):
+        self.assertEqual(
+            events.as_full_return(
+                'minion1', {'return': {'a': 1}, 'retcode': 2, 'jid': '1'}
+            ),
+            {'minion1': {'ret': {'a': 1}, 'retcode': 2}}
+        )
+
+
+class EventReaderTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.bus = CountingBus()
+        self.reader = events.EventReader(
+            {'sock_dir': '/tmp'}, self.bus.subscribe, linger=0
+        )
+        self.reader.event_wait = 0.05
+        self.addCleanup(self.reader.stop)
+
+    @defer.inlineCallbacks
+    def test_job_return(self):
+        watch = yield self.reader.watch('minion1')
+        watch.set_jid('1')
+        waiting = watch.wait(5)
+        self.bus.fire_job_return('1', 'minion1', {'state': {}})
+        data = yield waiting
+        self.assertEqual(data['return'], {'state': {}})
+        self.assertEqual(watch.poll(), data)
+        watch.close()
+
+    @defer.inlineCallbacks
+    def test_returns_before_the_jid_is_known(self):
+        watch = yield self.reader.watch('minion1')
+        # A previous job, and the job's return, before it's published
+        self.bus.fire_job_return('0', 'minion1', True)
+        self.bus.fire_job_return('1', 'minion1', {'state': {}})
+        yield wait_until(lambda: len(watch._pending) == 2)
+        watch.set_jid('1')
+        self.assertEqual(watch.poll()['return'], {'state': {}})
+        watch.close()
+
+    @defer.inlineCallbacks
+    def test_other_jobs_and_minions_are_ignored(self):
+        watch = yield self.reader.watch('minion1')
+        watch.set_jid('1')
+        self.bus.fire_job_return('1', 'minion2', {})
+        self.bus.fire_job_return('2', 'minion1', {})
+        data = yield watch.wait(0.2)
+        self.assertIdentical(data, None)
+        watch.close()
+
+    @defer.inlineCallbacks
+    def test_progress(self):
+        progress = []
+        watch = yield self.reader.watch('minion1', progress.append)
+        watch.set_jid('1')
+        for idx in range(3):
+            self.bus.fire_state_progress(
+                '1', 'minion1', {'__run_num__': idx, 'result': True}, 3
+            )
+        self.bus.fire_job_return('1', 'minion1', {})
+        yield watch.wait(5)
+        self.assertEqual(
+            [data['ret']['__run_num__'] for data in progress], [0, 1, 2]
+        )
+        self.assertEqual(progress[0]['len'], 3)
+        watch.close()
+
+    @defer.inlineCallbacks
+    def test_progress_failure_fails_the_watch(self):
+        def on_progress(data):
+            raise RuntimeError('state failed')
+        watch = yield self.reader.watch('minion1', on_progress)
+        watch.set_jid('1')
+        waiting = watch.wait(5)
+        self.bus.fire_state_progress('1', 'minion1', {'result': False}, 1)
+        yield self.assertFailure(waiting, RuntimeError)
+        self.assertRaises(RuntimeError, watch.poll)
+        watch.close()
+
+    @defer.inlineCallbacks
+    def test_close_fires_the_waits(self):
+        watch = yield self.reader.watch('minion1')
+        waiting = watch.wait(60)
+        watch.close()
+        data = yield waiting
+        self.assertIdentical(data, None)
+
+    @defer.inlineCallbacks
+    def test_one_subscription_for_all_the_watches(self):
+        watches = yield defer.gatherResults([
+            self.reader.watch('minion{0}'.format(idx)) for idx in range(5)
+        ])
+        for idx, watch in enumerate(watches):
+            watch.set_jid(str(idx))
+        for idx in range(5):
+            self.bus.fire_job_return(str(idx), 'minion{0}'.format(idx), idx)
+        returns = yield defer.gatherResults(
+            [watch.wait(5) for watch in watches]
+        )
+        self.assertEqual([data['return'] for data in returns], range(5))
+        self.assertEqual(self.bus.subscriptions, 1)
+        for watch in watches:
+            watch.close()
+
+    @defer.inlineCallbacks
+    def test_stops_once_idle(self):
+        watch = yield self.reader.watch('minion1')
+        watch.close()
+        yield wait_until(lambda: self.reader._thread is None)
+        yield wait_until(lambda: not self.bus._subscribers)
+        # And subscribes again when needed
+        watch = yield self.reader.watch('minion1')
+        self.assertEqual(self.bus.subscriptions, 2)
+        watch.close()
+
+    @defer.inlineCallbacks
+    def test_subscription_failure(self):
+        def broken(opts):
+            raise IOError('no master')
+        reader = events.EventReader({'sock_dir': '/tmp'}, broken)
+        yield self.assertFailure(reader.watch('minion1'), IOError)
+        self.assertEqual(reader._watches, {})
+
+    def test_get_reader_per_master(self):
+        self.patch(events, '_READERS', {})
+        reader = events.get_reader({'sock_dir': '/a'}, self.bus.subscribe)
+        self.assertIdentical(
+            events.get_reader({'sock_dir': '/a'}, self.bus.subscribe), reader
+        )
+        self.assertNotIdentical(
+            events.get_reader({'sock_dir': '/b'}, self.bus.subscribe), reader
+        )
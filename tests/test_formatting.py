@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+'''
+    tests.test_formatting
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
+    :license: Apache 2.0, see LICENSE for more details.
+'''
+
+# Import python libs
+import os
+import gzip
+import json
+
+# Import twisted libs
+from twisted.trial import unittest
+
+# Import saltcloud_buildbot libs
+from saltcloud_buildbot import formatting
+from tests import SKIP_SALT
+
+
+STATES = {
+    'pkg_|-git_|-git_|-installed': {
+        '__id__': 'git', 'result': True, 'changes': {'git': {}},
+        'duration': 1200.0, 'comment': ''
+    },
+    'file_|-conf_|-/etc/conf_|-managed': {
+        '__id__': 'conf', 'result': False, 'changes': {},
+        'duration': 30.0, 'comment': 'Source file not found'
+    },
+    'service_|-bot_|-bot_|-running': {
+        '__id__': 'bot', 'result': True, 'changes': {}, 'duration': 400.0
+    }
+}
+
+
+class SummarizeStatesTestCase(unittest.TestCase):
+
+    def test_summary(self):
+        self.assertEqual(
+            formatting.summarize_states(STATES, slowest=2).splitlines(),
+            ['3 state(s), 2 succeeded (1 changed), 1 failed',
+             '  failed: conf: Source file not found',
+             '  slowest: git: 1200 ms',
+             '  slowest: bot: 400 ms']
+        )
+
+    def test_not_a_state_return(self):
+        self.assertEqual(
+            formatting.summarize_states(['error']), "['error']"
+        )
+
+
+class LazyOutputTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.formatter = formatting.OutputFormatter(
+            max_size=20, mode=formatting.SUMMARY
+        )
+
+    def test_formatted_once_when_converted(self):
+        output = self.formatter.lazy(
+            {'vm1': STATES}, 'highstate', {}, summary_data=STATES
+        )
+        self.assertIdentical(output._text, None)
+        text = str(output)
+        self.assertTrue(text.startswith('3 state(s), 2 succe'))
+        self.assertIn('more characters truncated]', text)
+        self.assertIdentical(str(output), text)
+        self.assertEqual(unicode(output), text.decode('utf-8'))
+
+    def test_uncapped(self):
+        self.formatter.configure(max_size=0)
+        output = self.formatter.lazy(
+            {'vm1': STATES}, 'highstate', {}, summary_data=STATES
+        )
+        self.assertEqual(str(output), formatting.summarize_states(STATES))
+
+    def test_full_mode(self):
+        self.formatter.configure(max_size=0, mode=formatting.FULL)
+        output = self.formatter.lazy({'vm1': {'id': 'vm1'}}, 'pprint', {})
+        self.assertIn('vm1', str(output))
+    test_full_mode.skip = SKIP_SALT
+
+    def test_unknown_mode(self):
+        self.assertRaises(ValueError, self.formatter.configure, mode='raw')
+
+
+class ArtifactsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.artifacts_dir = self.mktemp()
+        self.formatter = formatting.OutputFormatter(
+            max_size=20, mode=formatting.SUMMARY,
+            artifacts_dir=self.artifacts_dir
+        )
+
+    def test_stored(self):
+        output = self.formatter.lazy(
+            STATES, 'highstate', {}, vm_name='vm1', name='highstate',
+            summary_data=STATES
+        )
+        path = os.path.join(self.artifacts_dir, 'vm1', 'highstate.json.gz')
+        self.assertEqual(output.artifact, path)
+        self.assertIn(path, str(output))
+        fic = gzip.open(path)
+        try:
+            self.assertEqual(json.load(fic), STATES)
+        finally:
+            fic.close()
+
+    def test_disabled(self):
+        self.formatter.artifacts_dir = None
+        self.assertIdentical(
+            self.formatter.store('vm1', 'highstate', STATES), None
+        )
+
+    def test_failure_is_logged(self):
+        # A file where the VM's directory should be
+        os.makedirs(self.artifacts_dir)
+        open(os.path.join(self.artifacts_dir, 'vm1'), 'w').close()
+        self.assertIdentical(
+            self.formatter.store('vm1', 'highstate', STATES), None
+        )
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+'''
+    tests.test_hedging
+    ~~~~~~~~~~~~~~~~~~
+
+    :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
+    :license: Apache 2.0, see LICENSE for more details.
+'''
+
+# Import twisted libs
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+# Import saltcloud_buildbot libs
+from saltcloud_buildbot import hedging, history, readiness
+
+
+class RaceTestCase(unittest.TestCase):
+    '''
+    Race the ``primary``, ``secondary`` and ``tertiary`` profiles, the test
+    firing each attempt's deferred.
+    '''
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(history, '_HISTORY', history.History())
+        self.launched = {}
+        self.discarded = []
+        self.race = hedging.Race(
+            ['primary', 'secondary', 'tertiary'], self.launch, self.discard,
+            delay=lambda profile: 60, clock=self.clock
+        )
+
+    def launch(self, attempt):
+        attempt.vm_name = '{0}-vm'.format(attempt.profile)
+        attempt.created = True
+        d = self.launched[attempt.profile] = defer.Deferred()
+        return d
+
+    def discard(self, attempt):
+        self.discarded.append(attempt.vm_name)
+
+    def test_primary_wins(self):
+        d = self.race.run()
+        self.launched['primary'].callback(None)
+        winner = self.successResultOf(d)
+        self.assertEqual(winner.profile, 'primary')
+        self.assertEqual(self.discarded, [])
+        # Nothing hedged once won
+        self.clock.advance(120)
+        self.assertEqual(sorted(self.launched), ['primary'])
+
+    def test_hedged_when_slow(self):
+        d = self.race.run()
+        self.clock.advance(59)
+        self.assertEqual(sorted(self.launched), ['primary'])
+        self.clock.advance(1)
+        self.assertEqual(sorted(self.launched), ['primary', 'secondary'])
+        self.launched['secondary'].callback(None)
+        self.assertEqual(self.successResultOf(d).profile, 'secondary')
+        # The losing VM is cancelled and destroyed
+        primary = self.race.attempts[0]
+        self.assertTrue(primary.cancelled)
+        self.assertEqual(self.discarded, ['primary-vm'])
+        # Not discarded twice once its provisioning gives up
+        self.launched['primary'].errback(readiness.Cancelled('primary-vm'))
+        self.assertEqual(self.discarded, ['primary-vm'])
+
+    def test_not_hedged_once_responding(self):
+        self.race.run()
+        attempt = self.race.attempts[0]
+        self.clock.advance(10)
+        attempt.observer(readiness.MINION_RESPONDING, 10)
+        self.clock.advance(120)
+        self.assertEqual(sorted(self.launched), ['primary'])
+        self.assertEqual(
+            history.get_history().samples(
+                'primary', history.TIME_TO_RESPONDING
+            ),
+            [10]
+        )
+
+    def test_failover(self):
+        d = self.race.run()
+        self.launched['primary'].errback(RuntimeError('quota exceeded'))
+        self.assertEqual(sorted(self.launched), ['primary', 'secondary'])
+        self.assertEqual(self.discarded, ['primary-vm'])
+        self.launched['secondary'].callback(None)
+        self.assertEqual(self.successResultOf(d).profile, 'secondary')
+
+    def test_every_profile_failed(self):
+        d = self.race.run()
+        self.launched['primary'].errback(RuntimeError('quota exceeded'))
+        self.launched['secondary'].errback(RuntimeError('no capacity'))
+        self.assertNoResult(d)
+        self.launched['tertiary'].errback(RuntimeError('bad image'))
+        failure = self.failureResultOf(d, RuntimeError)
+        self.assertEqual(str(failure.value), 'quota exceeded')
+        self.assertEqual(
+            self.discarded, ['primary-vm', 'secondary-vm', 'tertiary-vm']
+        )
+
+    def test_no_delay_never_hedges(self):
+        self.race.delay = lambda profile: None
+        self.race.run()
+        self.clock.advance(3600)
+        self.assertEqual(sorted(self.launched), ['primary'])
+
+
+class HedgeDelayTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.patch(history, '_HISTORY', history.History())
+
+    def test_default_without_history(self):
+        self.assertEqual(hedging.hedge_delay('linux', default=300), 300)
+
+    def test_percentile_of_the_history(self):
+        for seconds in range(1, 11):
+            history.record('linux', history.TIME_TO_RESPONDING, seconds)
+        self.assertEqual(hedging.hedge_delay('linux'), 10)
+        self.assertEqual(
+            hedging.hedge_delay('linux', min_samples=20, default=300), 300
+        )
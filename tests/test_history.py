@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+'''
+    tests.test_history
+    ~~~~~~~~~~~~~~~~~~
+
+    :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
+    :license: Apache 2.0, see LICENSE for more details.
+'''
+
+# Import python libs
+import os
+import json
+
+# Import twisted libs
+from twisted.trial import unittest
+
+# Import saltcloud_buildbot libs
+from saltcloud_buildbot import history, readiness
+
+
+class PercentileTestCase(unittest.TestCase):
+
+    def test_nearest_rank(self):
+        values = range(20, 0, -1)
+        self.assertEqual(history.percentile(values, 0.5), 10)
+        self.assertEqual(history.percentile(values, 0.95), 19)
+        self.assertEqual(history.percentile(values, 0.99), 20)
+        self.assertEqual(history.percentile(values, 0), 1)
+        self.assertEqual(history.percentile([7], 0.5), 7)
+        self.assertIdentical(history.percentile([], 0.5), None)
+
+
+class HistoryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.history = history.History(window=20)
+
+    def record(self, phase, durations, **kwargs):
+        for seconds in durations:
+            self.history.record('linux', phase, seconds, **kwargs)
+
+    def test_keyed_by_fun_and_path(self):
+        self.record(readiness.RETURNED, [600], fun='state.highstate')
+        self.record(
+            readiness.RETURNED, [30], fun='state.sls', path=history.POOL
+        )
+        self.record(
+            readiness.RETURNED, [90], fun='state.highstate',
+            path=history.IMAGE
+        )
+        self.assertEqual(
+            self.history.samples(
+                'linux', readiness.RETURNED, 'state.highstate'
+            ),
+            [600]
+        )
+        self.assertEqual(
+            self.history.samples(
+                'linux', readiness.RETURNED, 'state.sls', history.POOL
+            ),
+            [30]
+        )
+        self.assertEqual(
+            self.history.samples(
+                'linux', readiness.RETURNED, 'state.highstate',
+                history.IMAGE
+            ),
+            [90]
+        )
+        self.assertEqual(
+            self.history.samples('linux', readiness.RETURNED, 'state.sls'),
+            []
+        )
+
+    def test_window(self):
+        self.record(history.SUBSTANTIATION, range(30))
+        self.assertEqual(
+            self.history.samples('linux', history.SUBSTANTIATION),
+            range(10, 30)
+        )
+
+    def test_deadline(self):
+        self.assertIdentical(
+            self.history.deadline('linux', history.SUBSTANTIATION), None
+        )
+        self.record(history.SUBSTANTIATION, [100] * 10)
+        self.assertEqual(
+            self.history.deadline('linux', history.SUBSTANTIATION), 200
+        )
+        self.assertEqual(
+            self.history.deadline(
+                'linux', history.SUBSTANTIATION, floor=300
+            ),
+            300
+        )
+        self.assertEqual(
+            self.history.deadline(
+                'linux', history.SUBSTANTIATION, ceiling=150
+            ),
+            150
+        )
+        self.assertIdentical(
+            self.history.deadline(
+                'linux', history.SUBSTANTIATION, path=history.POOL
+            ),
+            None
+        )
+
+    def test_deadlines(self):
+        self.record(
+            readiness.MINION_RESPONDING, [40] * 10, fun='state.highstate'
+        )
+        self.assertEqual(
+            self.history.deadlines(
+                'linux', readiness.STATES[1:], fun='state.highstate',
+                floor=None
+            ),
+            {readiness.MINION_RESPONDING: 80}
+        )
+
+    def test_state_observer(self):
+        observer = self.history.state_observer(
+            'linux', 'state.sls', history.POOL
+        )
+        observer(readiness.MINION_RESPONDING, 5)
+        observer(readiness.RETURNED, 50, failed=True)
+        self.assertEqual(
+            self.history.samples(
+                'linux', readiness.MINION_RESPONDING, 'state.sls',
+                history.POOL
+            ),
+            [5]
+        )
+        self.assertEqual(
+            self.history.samples(
+                'linux', readiness.RETURNED, 'state.sls', history.POOL
+            ),
+            []
+        )
+
+
+class PersistenceTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.path = os.path.join(self.mktemp(), 'history.json')
+
+    def test_saved_and_loaded(self):
+        saved = history.History(self.path)
+        saved.record('linux', history.SUBSTANTIATION, 100)
+        saved.record(
+            'linux', readiness.RETURNED, 60, 'state.sls', history.IMAGE
+        )
+        saved.save()
+
+        loaded = history.History()
+        loaded.record('linux', history.SUBSTANTIATION, 120)
+        loaded.configure(path=self.path)
+        # The loaded durations are older than the recorded ones
+        self.assertEqual(
+            loaded.samples('linux', history.SUBSTANTIATION), [100, 120]
+        )
+        self.assertEqual(
+            loaded.samples(
+                'linux', readiness.RETURNED, 'state.sls', history.IMAGE
+            ),
+            [60]
+        )
+
+    def test_older_files_are_ignored(self):
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path, 'w') as wfh:
+            json.dump(
+                {'samples': {'linux': {history.SUBSTANTIATION: [100]}}}, wfh
+            )
+        loaded = history.History(self.path)
+        loaded.load()
+        self.assertEqual(loaded.samples('linux', history.SUBSTANTIATION), [])
+
+    def test_only_saved_when_changed(self):
+        saved = history.History(self.path)
+        saved.save()
+        self.assertFalse(os.path.exists(self.path))
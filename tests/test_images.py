@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+'''
+    tests.test_images
+    ~~~~~~~~~~~~~~~~~
+
+    :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
+    :license: Apache 2.0, see LICENSE for more details.
+'''
+
+# Import python libs
+import os
+import time
+
+# Import twisted libs
+from twisted.trial import unittest
+
+# Import saltcloud_buildbot libs
+from saltcloud_buildbot import images
+
+
+class FingerprintTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.root = self.mktemp()
+        for path in ('states/top.sls', 'states/web/init.sls',
+                     'pillar/top.sls'):
+            self.write(path, path)
+        self.opts = {
+            'file_roots': {'base': [os.path.join(self.root, 'states')]},
+            'pillar_roots': {'base': [os.path.join(self.root, 'pillar')]}
+        }
+
+    def write(self, path, contents):
+        path = os.path.join(self.root, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as wfh:
+            wfh.write(contents)
+        # Make sure the modification is seen
+        os.utime(path, (time.time() + 10, time.time() + 10))
+
+    def fingerprint(self, profile=None, **kwargs):
+        return images.fingerprint(
+            self.opts, profile or {'image': 'ami-0'}, **kwargs
+        )
+
+    def test_stable(self):
+        self.assertEqual(self.fingerprint(), self.fingerprint())
+
+    def test_tree_changes(self):
+        before = self.fingerprint()
+        self.write('states/web/init.sls', 'changed')
+        self.assertNotEqual(self.fingerprint(), before)
+        before = self.fingerprint()
+        self.write('pillar/web.sls', 'new')
+        self.assertNotEqual(self.fingerprint(), before)
+
+    def test_vcs_metadata_is_ignored(self):
+        before = self.fingerprint()
+        self.write('states/.git/HEAD', 'ref')
+        self.assertEqual(self.fingerprint(), before)
+
+    def test_profile_changes(self):
+        self.assertNotEqual(
+            self.fingerprint({'image': 'ami-1'}), self.fingerprint()
+        )
+
+    def test_paths(self):
+        before = self.fingerprint(paths=['top.sls'])
+        self.write('states/web/init.sls', 'changed')
+        self.assertEqual(self.fingerprint(paths=['top.sls']), before)
+        self.write('states/top.sls', 'changed')
+        self.assertNotEqual(self.fingerprint(paths=['top.sls']), before)
+
+
+class ImageIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.path = os.path.join(self.mktemp(), 'images.json')
+        self.index = images.ImageIndex(self.path)
+
+    def test_add_and_get(self):
+        self.assertIdentical(self.index.get('linux', 'fp1'), None)
+        self.index.add('linux', 'fp1', 'ami-1')
+        self.assertEqual(self.index.get('linux', 'fp1'), 'ami-1')
+        self.assertIdentical(self.index.get('windows', 'fp1'), None)
+        # Persisted
+        self.assertEqual(
+            images.ImageIndex(self.path).get('linux', 'fp1'), 'ami-1'
+        )
+
+    def test_evict(self):
+        for idx in range(3):
+            self.index.add('linux', 'fp{0}'.format(idx),
+                           'ami-{0}'.format(idx))
+        self.index._data['linux']['fp0']['last_used'] -= 60
+        self.index._data['linux']['fp1']['last_used'] -= 30
+        self.assertEqual(self.index.evict('linux', 2), ['ami-0'])
+        self.assertEqual(self.index.evict('linux', 2, max_age=10), ['ami-1'])
+        self.assertEqual(self.index.get('linux', 'fp2'), 'ami-2')
+
+    def test_lookups_are_batched(self):
+        self.index.add('linux', 'fp1', 'ami-1')
+        with open(self.path) as rfh:
+            saved = rfh.read()
+        self.index.get('linux', 'fp1')
+        with open(self.path) as rfh:
+            self.assertEqual(rfh.read(), saved)
+        # Once the save interval elapsed the lookup writes the index
+        self.index._saved -= self.index.save_interval
+        self.index.get('linux', 'fp1')
+        with open(self.path) as rfh:
+            self.assertNotEqual(rfh.read(), saved)
+
+    def test_flush(self):
+        self.index.add('linux', 'fp1', 'ami-1')
+        self.index.get('linux', 'fp1')
+        last_used = self.index._data['linux']['fp1']['last_used']
+        self.index.flush()
+        self.assertEqual(
+            images.ImageIndex(self.path)._load()['linux']['fp1'][
+                'last_used'
+            ],
+            last_used
+        )
+
+    def test_evict_saves_the_lookups(self):
+        self.index.add('linux', 'fp1', 'ami-1')
+        self.index.get('linux', 'fp1')
+        self.assertEqual(self.index.evict('linux', 2), [])
+        self.assertFalse(self.index._dirty)
+
+
+class MasterOptsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.path = self.mktemp()
+        with open(self.path, 'w') as wfh:
+            wfh.write('file_roots: {}')
+        self.loads = []
+        self.patch(images, '_MASTER_OPTS', {})
+        self.patch(images, 'parse_master_config', self.load)
+
+    def load(self, path):
+        self.loads.append(path)
+        with open(path) as rfh:
+            return {'contents': rfh.read()}
+
+    def test_cached(self):
+        self.assertEqual(
+            images.master_opts(self.path), {'contents': 'file_roots: {}'}
+        )
+        images.master_opts(self.path)
+        self.assertEqual(self.loads, [self.path])
+
+    def test_reloaded_when_changed(self):
+        images.master_opts(self.path)
+        with open(self.path, 'w') as wfh:
+            wfh.write('file_roots: {base: [/srv/salt]}')
+        self.assertEqual(
+            images.master_opts(self.path)['contents'],
+            'file_roots: {base: [/srv/salt]}'
+        )
+        self.assertEqual(self.loads, [self.path, self.path])
+
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+'''
+    tests.test_inventory
+    ~~~~~~~~~~~~~~~~~~~~
+
+    :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
+    :license: Apache 2.0, see LICENSE for more details.
+'''
+
+# Import python libs
+import os
+
+# Import twisted libs
+from twisted.trial import unittest
+
+# Import saltcloud_buildbot libs
+from saltcloud_buildbot import inventory
+
+
+class InventoryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.path = os.path.join(self.mktemp(), 'vms.sqlite')
+        self.inventory = inventory.Inventory(self.path)
+
+    def test_record(self):
+        self.inventory.record('vm1', 'slave01', 'linux', 'fp1')
+        record = self.inventory.get('vm1')
+        self.assertEqual(
+            (record['slavename'], record['profile'], record['fingerprint'],
+             record['state']),
+            ('slave01', 'linux', 'fp1', inventory.PROVISIONING)
+        )
+        created = record['created']
+        # Recording again keeps the creation time
+        self.inventory.record('vm1', 'slave01', 'linux', 'fp1',
+                              inventory.READY)
+        record = self.inventory.get('vm1')
+        self.assertEqual(record['state'], inventory.READY)
+        self.assertEqual(record['created'], created)
+
+    def test_set_state_and_remove(self):
+        self.inventory.record('vm1', 'slave01', 'linux')
+        self.inventory.set_state('vm1', inventory.DESTROYING)
+        self.assertEqual(
+            self.inventory.get('vm1')['state'], inventory.DESTROYING
+        )
+        self.inventory.remove('vm1')
+        self.assertIdentical(self.inventory.get('vm1'), None)
+
+    def test_persisted(self):
+        self.inventory.record('vm1', 'slave01', 'linux')
+        self.assertEqual(
+            inventory.Inventory(self.path).get('vm1')['slavename'],
+            'slave01'
+        )
+
+    def test_for_slave_and_all(self):
+        self.inventory.record('vm1', 'slave01', 'linux')
+        self.inventory.record('vm2', 'slave02', 'linux')
+        self.inventory.record('vm3', 'slave01', 'linux')
+        self.assertEqual(
+            [record['vm_name'] for record in
+             self.inventory.for_slave('slave01')],
+            ['vm3', 'vm1']
+        )
+        self.assertEqual(
+            sorted(record['vm_name'] for record in self.inventory.all()),
+            ['vm1', 'vm2', 'vm3']
+        )
+
+    def test_get_inventory(self):
+        self.patch(inventory, '_INVENTORIES', {})
+        self.assertIdentical(
+            inventory.get_inventory(self.path),
+            inventory.get_inventory(self.path)
+        )
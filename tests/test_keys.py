@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+'''
+    tests.test_keys
+    ~~~~~~~~~~~~~~~
+
+    :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
+    :license: Apache 2.0, see LICENSE for more details.
+'''
+
+# Import python libs
+import os
+import itertools
+
+# Import twisted libs
+from twisted.internet import task
+from twisted.trial import unittest
+
+# Import saltcloud_buildbot libs
+from saltcloud_buildbot import keys, workers
+from tests import run_inline
+
+
+class SeedTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.pki_dir = self.mktemp()
+        self.path = os.path.join(self.pki_dir, 'minions', 'vm1')
+
+    def test_seed(self):
+        keys.seed(self.pki_dir, 'vm1', 'PUBLIC')
+        with open(self.path) as fic:
+            self.assertEqual(fic.read(), 'PUBLIC')
+        self.assertEqual(
+            os.listdir(os.path.dirname(self.path)), ['vm1']
+        )
+
+    def test_unseed(self):
+        keys.seed(self.pki_dir, 'vm1', 'PUBLIC')
+        self.assertTrue(keys.unseed(self.pki_dir, 'vm1', 'PUBLIC\n'))
+        self.assertFalse(os.path.exists(self.path))
+        # Already gone
+        self.assertFalse(keys.unseed(self.pki_dir, 'vm1', 'PUBLIC'))
+
+    def test_replaced_key_is_kept(self):
+        keys.seed(self.pki_dir, 'vm1', 'OTHER')
+        self.assertFalse(keys.unseed(self.pki_dir, 'vm1', 'PUBLIC'))
+        self.assertTrue(os.path.exists(self.path))
+
+
+class KeyPoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.patch(workers, 'defer_to_thread', run_inline)
+        self.busy = False
+        self.counter = itertools.count()
+        self.clock = task.Clock()
+        self.pool = keys.KeyPool(
+            size=3, keysize=1024, interval=5, generator=self.generate,
+            clock=self.clock
+        )
+        self.patch(self.pool, 'idle', lambda: not self.busy)
+        self.addCleanup(self.stop)
+
+    def stop(self):
+        while self.pool._users > 0:
+            self.pool.stop()
+
+    def generate(self, keysize):
+        number = next(self.counter)
+        return (
+            'PRIVATE{0}-{1}'.format(keysize, number),
+            'PUBLIC{0}-{1}'.format(keysize, number)
+        )
+
+    def test_filled_while_idle(self):
+        self.pool.start()
+        self.assertEqual(len(self.pool), 0)
+        self.clock.advance(5)
+        self.assertEqual(len(self.pool), 3)
+        self.assertEqual(self.pool.generated, 3)
+        # Full, nothing more is generated
+        self.clock.advance(5)
+        self.assertEqual(self.pool.generated, 3)
+
+    def test_not_filled_while_creating(self):
+        self.busy = True
+        self.pool.start()
+        self.clock.advance(15)
+        self.assertEqual(len(self.pool), 0)
+        # Stops as soon as creates start again
+        generate = self.pool.generator
+
+        def creating(keysize):
+            self.busy = True
+            return generate(keysize)
+        self.pool.generator = creating
+        self.busy = False
+        self.clock.advance(5)
+        self.assertEqual(len(self.pool), 1)
+
+    def test_draw(self):
+        self.pool.refill()
+        self.assertEqual(
+            self.pool.draw(), ('PRIVATE1024-0', 'PUBLIC1024-0')
+        )
+        self.assertIdentical(self.pool.draw(), None)
+        self.assertEqual(
+            (self.pool.drawn, self.pool.misses), (1, 1)
+        )
+
+    def test_never_handed_out_twice(self):
+        self.pool.generator = lambda keysize: ('PRIVATE', 'PUBLIC')
+        self.pool.refill()
+        self.pool.refill()
+        self.assertEqual(len(self.pool), 1)
+        self.pool.draw()
+        self.pool.refill()
+        self.assertEqual(len(self.pool), 0)
+
+    def test_keysize_change_drops_the_keys(self):
+        self.pool.refill()
+        self.pool.configure(size=5, keysize=2048)
+        self.assertEqual(len(self.pool), 0)
+        self.assertEqual(self.pool.size, 5)
+        self.pool.refill()
+        self.assertEqual(self.pool.draw()[1], 'PUBLIC2048-1')
+
+    def test_generation_failure(self):
+        def broken(keysize):
+            raise RuntimeError('no entropy')
+        self.pool.generator = broken
+        self.pool.refill()
+        self.assertEqual(len(self.pool), 0)
+        self.assertFalse(self.pool._generating)
+
+    def test_ref_counted(self):
+        self.pool.start()
+        self.pool.start()
+        self.pool.refill()
+        self.pool.stop()
+        self.assertEqual(len(self.pool), 1)
+        self.pool.stop()
+        self.assertEqual(len(self.pool), 0)
+        self.assertIdentical(self.pool._loop, None)
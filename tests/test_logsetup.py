@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+'''
+    tests.test_logsetup
+    ~~~~~~~~~~~~~~~~~~~
+
+    :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
+    :license: Apache 2.0, see LICENSE for more details.
+'''
+
+# Import python libs
+import os
+import sys
+import logging
+import threading
+
+# Import twisted libs
+from twisted.trial import unittest
+
+# Import saltcloud_buildbot libs
+from saltcloud_buildbot import logsetup
+from tests import SKIP_SALT
+
+
+class RecordingHandler(logging.Handler):
+
+    def __init__(self, level=logging.NOTSET):
+        logging.Handler.__init__(self, level)
+        self.records = []
+        self.threads = set()
+
+    def emit(self, record):
+        self.records.append(record.getMessage())
+        self.threads.add(threading.current_thread().name)
+
+
+class QueueListenerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.root = logging.getLogger()
+        self.handler = RecordingHandler()
+        self.root.addHandler(self.handler)
+        self.addCleanup(self.root.removeHandler, self.handler)
+        self.patch(logsetup, '_LISTENER', None)
+        self.patch(logsetup, '_HANDLERS', {'logfile': self.handler})
+        self.addCleanup(logsetup.shutdown)
+        self.patch(self.root, 'level', logging.DEBUG)
+
+    def test_records_are_written_by_the_listener(self):
+        logsetup._start_listener()
+        self.assertNotIn(self.handler, self.root.handlers)
+        logging.getLogger('saltcloud').info('Created VM %s', 'vm1')
+        logsetup.shutdown()
+        # The handler is put back in place once stopped
+        self.assertIn(self.handler, self.root.handlers)
+        self.assertEqual(self.handler.records, ['Created VM vm1'])
+        self.assertEqual(
+            self.handler.threads, set(['saltcloud-buildbot-logging'])
+        )
+
+    def test_others_handlers_are_left_alone(self):
+        other = RecordingHandler()
+        self.root.addHandler(other)
+        self.addCleanup(self.root.removeHandler, other)
+        logsetup._start_listener()
+        self.assertIn(other, self.root.handlers)
+        logging.getLogger('buildbot').info('Build started')
+        logsetup.shutdown()
+        self.assertEqual(other.threads, set([threading.current_thread().name]))
+        self.assertEqual(self.handler.records, ['Build started'])
+
+    def test_handlers_levels_are_honoured(self):
+        self.handler.setLevel(logging.WARNING)
+        logsetup._start_listener()
+        log = logging.getLogger('saltcloud')
+        log.info('Ignored')
+        log.warning('Written')
+        logsetup.shutdown()
+        self.assertEqual(self.handler.records, ['Written'])
+
+
+class SetupLoggingTestCase(unittest.TestCase):
+
+    skip = SKIP_SALT
+
+    def setUp(self):
+        import salt.log
+        self.calls = []
+        self.root = logging.getLogger()
+        self.patch(
+            salt.log, 'setup_console_logger', self.recorder(
+                'setup_console_logger', logging.StreamHandler(sys.stderr)
+            )
+        )
+        self.patch(
+            salt.log, 'setup_logfile_logger', self.recorder(
+                'setup_logfile_logger', logging.StreamHandler(self)
+            )
+        )
+        self.patch(
+            salt.log, 'set_logger_level', self.recorder('set_logger_level')
+        )
+        self.patch(logsetup, '_SETTINGS', None)
+        self.patch(logsetup, '_LISTENER', None)
+        self.patch(logsetup, '_HANDLERS', {})
+        self.addCleanup(logsetup.shutdown)
+        self.addCleanup(self.remove_handlers)
+        self.logfile = self.mktemp()
+        self.config = {
+            'log_level': 'info',
+            'log_file': self.logfile,
+            'log_level_logfile': None,
+            'log_granular_levels': {'salt.cloud': 'debug'}
+        }
+
+    def recorder(self, name, handler=None):
+        def record(*args, **kwargs):
+            self.calls.append((name, args))
+            if handler is not None:
+                handler.setLevel(salt_level(args[-1]))
+                self.root.addHandler(handler)
+        return record
+
+    def remove_handlers(self):
+        for handler in logsetup._HANDLERS.values():
+            self.root.removeHandler(handler)
+            handler.close()
+
+    def write(self, text):
+        # The log file handler stream
+        pass
+
+    def flush(self):
+        pass
+
+    def test_settings_inheritance(self):
+        settings = logsetup.logging_settings(self.config)
+        self.assertEqual(settings['logfile_level'], 'info')
+        self.assertEqual(settings['logfile'], self.logfile)
+        self.assertEqual(
+            settings['granular_levels'], (('salt.cloud', 'debug'),)
+        )
+        # Not changed
+        self.assertIn('log_level_logfile', self.config)
+
+    def test_set_up_once(self):
+        self.assertTrue(logsetup.setup_logging(self.config, queued=False))
+        calls = list(self.calls)
+        self.assertEqual(
+            [name for name, _ in calls],
+            ['setup_console_logger', 'setup_logfile_logger',
+             'set_logger_level']
+        )
+        self.assertEqual(
+            sorted(logsetup._HANDLERS), ['console', 'logfile']
+        )
+        self.assertFalse(
+            logsetup.setup_logging(dict(self.config), queued=False)
+        )
+        self.assertEqual(self.calls, calls)
+
+    def test_reconfigured_when_changed(self):
+        logsetup.setup_logging(self.config, queued=False)
+        console = logsetup._HANDLERS['console']
+        self.assertEqual(console.level, logging.INFO)
+        self.calls = []
+        self.config['log_level'] = 'debug'
+        self.config['log_fmt_console'] = '%(message)s'
+        self.assertTrue(logsetup.setup_logging(self.config, queued=False))
+        # salt's handlers are only set up once, they're changed in place
+        self.assertEqual(
+            [name for name, _ in self.calls], ['set_logger_level']
+        )
+        self.assertIdentical(logsetup._HANDLERS['console'], console)
+        self.assertEqual(console.level, logging.DEBUG)
+        self.assertEqual(console.formatter._fmt, '%(message)s')
+        self.assertEqual(logsetup._HANDLERS['logfile'].level, logging.DEBUG)
+
+    def test_log_file_changed(self):
+        logsetup.setup_logging(self.config, queued=False)
+        previous = logsetup._HANDLERS['logfile']
+        self.config['log_file'] = self.mktemp()
+        logsetup.setup_logging(self.config, queued=False)
+        logfile = logsetup._HANDLERS['logfile']
+        self.assertNotIdentical(logfile, previous)
+        self.assertNotIn(previous, self.root.handlers)
+        self.assertIn(logfile, self.root.handlers)
+        self.assertEqual(
+            logfile.baseFilename, os.path.abspath(self.config['log_file'])
+        )
+
+
+def salt_level(name):
+    import salt.log
+    return salt.log.LOG_LEVELS[name]
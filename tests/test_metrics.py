@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+'''
+    tests.test_metrics
+    ~~~~~~~~~~~~~~~~~~
+
+    :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
+    :license: Apache 2.0, see LICENSE for more details.
+'''
+
+# Import python libs
+import json
+
+# Import twisted libs
+from twisted.internet import defer
+from twisted.trial import unittest
+from twisted.web.test.requesthelper import DummyRequest
+
+# Import saltcloud_buildbot libs
+from saltcloud_buildbot import metrics, readiness
+
+
+class HistogramTestCase(unittest.TestCase):
+
+    def test_observe(self):
+        histogram = metrics.Histogram((1, 10))
+        histogram.observe(0.5)
+        histogram.observe(5, success=False)
+        histogram.observe(50)
+        self.assertEqual(histogram.counts, [1, 2])
+        self.assertEqual(histogram.count, 3)
+        self.assertEqual(histogram.sum, 55.5)
+        self.assertEqual((histogram.success, histogram.failure), (2, 1))
+
+
+class RegistryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = metrics.Registry(buckets=(1, 10))
+
+    def phases(self):
+        return dict(
+            ((metric['phase'], metric['profile'], metric['slave']), metric)
+            for metric in self.registry.as_dict()['phases']
+        )
+
+    def test_labels(self):
+        self.registry.observe(metrics.CLOUD_CREATE, 2, 'linux', 'slave01')
+        self.registry.observe(metrics.CLOUD_CREATE, 3, 'linux', 'slave02')
+        self.registry.observe(metrics.DESTROY, 1)
+        phases = self.phases()
+        self.assertEqual(len(phases), 3)
+        self.assertEqual(
+            phases[(metrics.CLOUD_CREATE, 'linux', 'slave01')]['sum'], 2
+        )
+        self.assertIn((metrics.DESTROY, '', ''), phases)
+
+    def test_state_observer(self):
+        observer = self.registry.state_observer('linux', 'slave01')
+        observer(readiness.KEY_ACCEPTED, 1)
+        observer(readiness.MINION_RESPONDING, 2)
+        observer(readiness.JOB_PUBLISHED, 0.5)
+        observer(readiness.JOB_RUNNING, 1)
+        observer(readiness.RETURNED, 30, True)
+        phases = self.phases()
+        connect = phases[(metrics.MINION_CONNECT, 'linux', 'slave01')]
+        self.assertEqual((connect['count'], connect['sum']), (1, 3))
+        run = phases[(metrics.HIGHSTATE_RUN, 'linux', 'slave01')]
+        self.assertEqual((run['sum'], run['failure']), (31, 1))
+
+    def test_render(self):
+        self.registry.observe(metrics.CLOUD_CREATE, 2, 'lin"ux', 'slave01')
+        self.registry.increment('reaped', profile='linux')
+        text = self.registry.render()
+        labels = 'phase="cloud_create",profile="lin\\"ux",slave="slave01"'
+        self.assertIn(
+            'saltcloud_buildbot_phase_seconds_bucket{{{0},le="1"}} 0'.format(
+                labels
+            ),
+            text
+        )
+        self.assertIn(
+            'saltcloud_buildbot_phase_seconds_bucket{{{0},le="+Inf"}} '
+            '1'.format(labels),
+            text
+        )
+        self.assertIn(
+            'saltcloud_buildbot_phase_total{{{0},result="success"}} '
+            '1'.format(labels),
+            text
+        )
+        self.assertIn(
+            'saltcloud_buildbot_reaped_total{profile="linux"} 1', text
+        )
+
+    def test_gauges(self):
+        self.registry.set_gauge('admission_in_flight', 3)
+        self.registry.set_gauge('admission_queued', 2, provider='ec2')
+        self.registry.set_gauge('admission_queued', 0, provider='ec2')
+        text = self.registry.render()
+        self.assertIn(
+            '# TYPE saltcloud_buildbot_admission_queued gauge', text
+        )
+        self.assertIn(
+            'saltcloud_buildbot_admission_queued{provider="ec2"} 0', text
+        )
+        self.assertIn('saltcloud_buildbot_admission_in_flight{} 3', text)
+        self.assertEqual(len(self.registry.as_dict()['gauges']), 2)
+
+    def test_resource(self):
+        self.registry.observe(metrics.DESTROY, 1)
+        resource = metrics.MetricsResource(self.registry)
+        data = json.loads(resource.render_GET(DummyRequest([''])))
+        self.assertEqual(data['phases'][0]['phase'], metrics.DESTROY)
+        request = DummyRequest([''])
+        request.args['format'] = ['prometheus']
+        self.assertIn(
+            'saltcloud_buildbot_phase_seconds', resource.render_GET(request)
+        )
+
+    def test_write_textfile(self):
+        path = self.mktemp()
+        self.registry.observe(metrics.DESTROY, 1)
+        metrics.write_textfile(path, self.registry)
+        with open(path) as rfh:
+            self.assertEqual(rfh.read(), self.registry.render())
+
+
+class TimedTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = metrics.Registry()
+        self.patch(metrics, '_REGISTRY', self.registry)
+
+    def histogram(self):
+        return self.registry._histograms[
+            (metrics.CLOUD_CREATE, 'linux', 'slave01')
+        ]
+
+    def test_timed(self):
+        timed = metrics.timed(metrics.CLOUD_CREATE, 'linux', 'slave01')
+        self.assertEqual(timed(lambda: 'created')(), 'created')
+
+        def broken():
+            raise RuntimeError('broken')
+        self.assertRaises(RuntimeError, timed(broken))
+        self.assertEqual(
+            (self.histogram().success, self.histogram().failure), (1, 1)
+        )
+
+    def test_timed_deferred(self):
+        timed = metrics.timed(metrics.CLOUD_CREATE, 'linux', 'slave01')
+        d = defer.Deferred()
+        timed(lambda: d)()
+        self.assertEqual(self.registry._histograms, {})
+        d.errback(RuntimeError('broken'))
+        self.failureResultOf(d, RuntimeError)
+        self.assertEqual(self.histogram().failure, 1)
+
+
+class ExportTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.listening = []
+        self.patch(metrics, '_EXPORTS', {})
+        self.patch(
+            metrics.reactor, 'listenTCP',
+            lambda port, factory, interface='': self.listening.append(
+                (port, interface)
+            )
+        )
+
+    def test_loopback_by_default(self):
+        metrics.export(port=8010)
+        metrics.export(port=8010)
+        metrics.export(port=8011, interface='0.0.0.0')
+        self.assertEqual(
+            self.listening, [(8010, '127.0.0.1'), (8011, '0.0.0.0')]
+        )
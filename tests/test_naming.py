@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+'''
+    tests.test_naming
+    ~~~~~~~~~~~~~~~~~
+
+    :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
+    :license: Apache 2.0, see LICENSE for more details.
+'''
+
+# Import python libs
+import re
+
+# Import twisted libs
+from twisted.trial import unittest
+
+# Import saltcloud_buildbot libs
+from saltcloud_buildbot import naming
+
+
+class NameAllocatorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.allocator = naming.NameAllocator()
+
+    def test_allocate(self):
+        vm_name = self.allocator.allocate('slave01')
+        self.assertTrue(re.search(naming.PATTERN, vm_name))
+        self.assertTrue(vm_name.startswith('slave01-buildbot-rnd'))
+        self.assertEqual(self.allocator.owner(vm_name), 'slave01')
+        baked = self.allocator.allocate('linux', naming.BAKE, 'slave01')
+        self.assertTrue(baked.startswith('linux-buildbot-bake'))
+        self.assertEqual(
+            self.allocator.names('slave01'), sorted([vm_name, baked])
+        )
+
+    def test_release_and_reserve(self):
+        vm_name = self.allocator.allocate('slave01')
+        self.allocator.release(vm_name)
+        self.assertNotIn(vm_name, self.allocator)
+        self.allocator.reserve(vm_name, 'slave01')
+        self.assertIn(vm_name, self.allocator)
+        self.assertEqual(len(self.allocator), 1)
+
+    def test_owner_prefix(self):
+        vm_name = self.allocator.allocate('linux-buildbot-ubuntu')
+        self.assertEqual(
+            naming.owner_prefix(vm_name), 'linux-buildbot-ubuntu'
+        )
+        self.assertIdentical(naming.owner_prefix('web01'), None)
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+'''
+    tests.test_pool
+    ~~~~~~~~~~~~~~~
+
+    :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
+    :license: Apache 2.0, see LICENSE for more details.
+'''
+
+# Import twisted libs
+from twisted.internet import defer
+from twisted.trial import unittest
+
+# Import buildbot libs
+from buildbot.interfaces import LatentBuildSlaveFailedToSubstantiate
+
+# Import saltcloud_buildbot libs
+from saltcloud_buildbot import pool
+
+
+class FakeDestroyer(object):
+
+    def __init__(self):
+        self.tracked = []
+        self.destroyed = []
+
+    def track(self, vm_name, config_loader, slavename=None,
+              keep_on_shutdown=False):
+        self.tracked.append(vm_name)
+
+    def destroy(self, config, names, slavename=None):
+        self.destroyed.extend(names)
+        return defer.succeed(None)
+
+
+class FakeClient(object):
+
+    def __init__(self, answers=True):
+        self.answers = answers
+        self.calls = []
+
+    def cmd(self, tgt, fun, arg=(), timeout=None, expr_form='glob'):
+        self.calls.append((tgt, fun, arg))
+        return dict((name, self.answers) for name in tgt)
+
+
+class WarmPoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.destroyer = FakeDestroyer()
+        self.client = FakeClient()
+        self.created = []
+        self.states = []
+        # Run the blocking calls inline
+        self.patch(pool.workers, 'defer_to_thread', defer.maybeDeferred)
+        self.patch(pool.teardown, 'get_destroyer', lambda: self.destroyer)
+        self.patch(
+            pool.provision, 'build_minion_config',
+            lambda *args, **kwargs: {'master': 'salt'}
+        )
+        self.patch(
+            pool.provision, 'get_local_client', lambda path: self.client
+        )
+        self.patch(pool.admission, 'create_admitted', self._create)
+        self.patch(pool.provision, 'run_state', self._run_state)
+        self.pool = pool.WarmPool(
+            'linux', lambda: {'profiles': {}}, '/etc/salt/master', size=2,
+            check_interval=3600
+        )
+
+    def tearDown(self):
+        if self.pool._evict_loop is not None:
+            self.pool._evict_loop.stop()
+
+    def _create(self, config, profile_name, vm_name, create, *args,
+                **kwargs):
+        self.created.append(vm_name)
+        return defer.succeed({vm_name: {}})
+
+    def _run_state(self, config, master_config, vm_name, slavename=None,
+                   fun='state.highstate', arg=(), **kwargs):
+        self.states.append((vm_name, slavename, fun, list(arg)))
+        return defer.succeed({vm_name: {'ret': {}}})
+
+    def test_start_fills_the_pool(self):
+        self.pool.start()
+        self.assertEqual(len(self.created), 2)
+        self.assertEqual(
+            [vm.name for vm in self.pool._ready], self.created
+        )
+        self.assertEqual(self.destroyer.tracked, self.created)
+        for vm_name in self.created:
+            self.assertTrue(vm_name.startswith('linux-buildbot-rnd'))
+
+    @defer.inlineCallbacks
+    def test_claim_rebinds_the_youngest_vm(self):
+        self.pool.rebind_state = 'buildbot.rebind'
+        self.pool.start()
+        youngest = self.pool._ready[-1].name
+        vm_name = yield self.pool.claim('slave01', 'secret')
+        self.assertEqual(vm_name, youngest)
+        self.assertIn(
+            ([vm_name], 'grains.setval',
+             ['buildbot', {'slavename': 'slave01', 'password': 'secret'}]),
+            self.client.calls
+        )
+        self.assertEqual(
+            self.states[-1],
+            (vm_name, 'slave01', 'state.sls', ['buildbot.rebind'])
+        )
+        # And it's replaced right away
+        self.assertEqual(len(self.created), 3)
+        self.assertEqual(len(self.pool._ready), 2)
+
+    @defer.inlineCallbacks
+    def test_claim_empty_pool(self):
+        vm_name = yield self.pool.claim('slave01', 'secret')
+        self.assertIdentical(vm_name, None)
+
+    @defer.inlineCallbacks
+    def test_claim_discards_vms_failing_to_rebind(self):
+        self.pool.start()
+        broken = self.pool._ready[-1].name
+
+        def rebind(config, master_config, vm_name, *args, **kwargs):
+            if vm_name == broken:
+                return defer.fail(
+                    LatentBuildSlaveFailedToSubstantiate(vm_name, 'failed')
+                )
+            return defer.succeed({vm_name: {'ret': {}}})
+        self.patch(pool.provision, 'run_state', rebind)
+        vm_name = yield self.pool.claim('slave01', 'secret')
+        self.assertNotEqual(vm_name, None)
+        self.assertNotEqual(vm_name, broken)
+        self.assertEqual(self.destroyer.destroyed, [broken])
+
+    @defer.inlineCallbacks
+    def test_claim_discards_vms_on_any_rebind_error(self):
+        self.pool.start()
+        broken = self.pool._ready[-1].name
+
+        def cmd(tgt, fun, arg=(), timeout=None, expr_form='glob'):
+            if tgt == [broken]:
+                raise RuntimeError('Salt request timed out')
+            return dict((name, True) for name in tgt)
+        self.patch(self.client, 'cmd', cmd)
+        vm_name = yield self.pool.claim('slave01', 'secret')
+        self.assertNotIn(vm_name, (None, broken))
+        self.assertEqual(self.destroyer.destroyed, [broken])
+
+    def test_evict_old_and_extra_vms(self):
+        self.pool.start()
+        oldest = self.pool._ready[0]
+        oldest.created -= 60 * 60 * 5
+        self.pool.evict()
+        self.assertEqual(self.destroyer.destroyed, [oldest.name])
+        # Replaced
+        self.assertEqual(len(self.pool._ready), 2)
+
+        self.pool.configure(size=1)
+        self.pool.evict()
+        self.assertEqual(len(self.pool._ready), 1)
+        self.assertEqual(len(self.destroyer.destroyed), 2)
+
+    def test_stop_destroys_the_idle_vms(self):
+        self.pool.start()
+        ready = [vm.name for vm in self.pool._ready]
+        self.pool.stop()
+        self.assertEqual(self.destroyer.destroyed, ready)
+        self.assertEqual(self.pool._ready, [])
+
+    def test_get_pool_is_shared_per_profile(self):
+        self.patch(pool, '_POOLS', {})
+        first = pool.get_pool('linux', None, '/etc/salt/master', size=1)
+        second = pool.get_pool('linux', None, '/etc/salt/master', size=3)
+        self.assertIdentical(first, second)
+        self.assertEqual(first.size, 3)
+        self.assertNotIdentical(
+            first, pool.get_pool('windows', None, '/etc/salt/master')
+        )
@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-
+'''
+    tests.test_readiness
+    ~~~~~~~~~~~~~~~~~~~~
+
+    :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
+    :license: Apache 2.0, see LICENSE for more details.
+'''
+
+# Import python libs
+import os
+
+# Import twisted libs
+from twisted.internet import defer
+from twisted.trial import unittest
+
+# Import buildbot libs
+from buildbot.interfaces import LatentBuildSlaveFailedToSubstantiate
+
+# Import saltcloud_buildbot libs
+from saltcloud_buildbot import events, readiness
+from tests import SKIP_SALT, run_inline
+
+
+class FakeClient(object):
+    '''
+    A ``LocalClient`` whose minion answers ``test.ping`` after ``pings``
+    pings, and runs the job for ``running`` ``saltutil.running`` calls.
+    '''
+
+    def __init__(self, opts=None, pings=0, running=1, returns=True,
+                 on_publish=None, jid='1'):
+        self.opts = opts or {}
+        self.jid = jid
+        self.pings = pings
+        self.running = running
+        self.returns = returns
+        self.on_publish = on_publish
+        self.calls = []
+
+    def cmd(self, tgt, fun, arg=(), timeout=None, expr_form='glob'):
+        self.calls.append(fun)
+        if fun == 'test.ping':
+            if self.pings > 0:
+                self.pings -= 1
+                return {}
+            return dict((name, True) for name in tgt)
+        if fun == 'saltutil.running':
+            jobs = []
+            if self.running > 0:
+                self.running -= 1
+                jobs.append({'jid': self.jid})
+            return dict((name, jobs) for name in tgt)
+        return dict((name, True) for name in tgt)
+
+    def cmd_async(self, tgt, fun, arg=(), expr_form='glob'):
+        self.calls.append(fun)
+        if self.on_publish is not None:
+            self.on_publish(self.jid, tgt[0])
+        return self.jid
+
+    def get_full_returns(self, jid, minions, timeout=None):
+        self.calls.append('get_full_returns')
+        if not self.returns:
+            return {}
+        return dict((name, {'ret': {}, 'retcode': 0}) for name in minions)
+
+
+class BackoffTestCase(unittest.TestCase):
+
+    def test_grows_to_the_maximum(self):
+        backoff = readiness.Backoff(1, 8, jitter=0)
+        self.assertEqual(
+            [backoff.next() for _ in range(6)], [1, 2, 4, 8, 8, 8]
+        )
+        backoff.reset()
+        self.assertEqual(backoff.next(), 1)
+
+    def test_jitter(self):
+        backoff = readiness.Backoff(10, 10, jitter=0.5)
+        for _ in range(50):
+            delay = backoff.next()
+            self.assertTrue(5 <= delay <= 10, delay)
+
+
+class ProvisioningMachineTestCase(unittest.TestCase):
+
+    skip = SKIP_SALT
+
+    def setUp(self):
+        self.patch(readiness.workers, 'defer_to_thread', run_inline)
+        self.transitions = []
+
+    def observer(self, state, seconds, failed):
+        self.transitions.append((state, failed))
+
+    def machine(self, client, **kwargs):
+        kwargs.setdefault('completion', 'poll')
+        kwargs.setdefault('min_interval', 0.001)
+        kwargs.setdefault('max_interval', 0.01)
+        return readiness.ProvisioningMachine(
+            client, 'vm1', slavename='slave01', observer=self.observer,
+            **kwargs
+        )
+
+    @defer.inlineCallbacks
+    def test_polls_to_the_return(self):
+        client = FakeClient(pings=2, running=2)
+        returns = yield self.machine(client).run()
+        self.assertEqual(returns, {'vm1': {'ret': {}, 'retcode': 0}})
+        self.assertEqual(
+            self.transitions,
+            [(state, False) for state in readiness.STATES[1:]]
+        )
+        self.assertEqual(client.calls.count('test.ping'), 3)
+        self.assertEqual(client.calls.count('state.highstate'), 1)
+
+    @defer.inlineCallbacks
+    def test_job_finished_before_the_first_running_check(self):
+        client = FakeClient(running=0)
+        machine = self.machine(client)
+        yield machine.run()
+        self.assertEqual(machine.state, readiness.RETURNED)
+        self.assertEqual(client.calls.count('get_full_returns'), 1)
+
+    @defer.inlineCallbacks
+    def test_key_accepted(self):
+        pki_dir = self.mktemp()
+        os.makedirs(os.path.join(pki_dir, 'minions'))
+        machine = self.machine(
+            FakeClient({'pki_dir': pki_dir}),
+            deadlines={readiness.KEY_ACCEPTED: 0.05}
+        )
+        yield self.assertFailure(
+            machine.run(), LatentBuildSlaveFailedToSubstantiate
+        )
+        self.assertEqual(
+            self.transitions, [(readiness.KEY_ACCEPTED, True)]
+        )
+
+        del self.transitions[:]
+        open(os.path.join(pki_dir, 'minions', 'vm1'), 'w').close()
+        client = FakeClient({'pki_dir': pki_dir})
+        yield self.machine(client).run()
+        self.assertEqual(
+            self.transitions[0], (readiness.KEY_ACCEPTED, False)
+        )
+        # Answering on its accepted key is enough to be responding
+        self.assertEqual(client.calls.count('test.ping'), 1)
+
+    @defer.inlineCallbacks
+    def test_seeded_key_is_not_enough(self):
+        # A pre-seeded key is accepted before the minion ever uses it
+        pki_dir = self.mktemp()
+        os.makedirs(os.path.join(pki_dir, 'minions'))
+        open(os.path.join(pki_dir, 'minions', 'vm1'), 'w').close()
+        machine = self.machine(
+            FakeClient({'pki_dir': pki_dir}, pings=1000),
+            deadlines={readiness.KEY_ACCEPTED: 0.05}
+        )
+        yield self.assertFailure(
+            machine.run(), LatentBuildSlaveFailedToSubstantiate
+        )
+        self.assertEqual(machine.state, readiness.CREATED)
+        self.assertEqual(
+            self.transitions, [(readiness.KEY_ACCEPTED, True)]
+        )
+
+    @defer.inlineCallbacks
+    def test_phase_deadline(self):
+        client = FakeClient(pings=1000)
+        machine = self.machine(
+            client, deadlines={readiness.KEY_ACCEPTED: 0.05}
+        )
+        yield self.assertFailure(
+            machine.run(), LatentBuildSlaveFailedToSubstantiate
+        )
+        self.assertEqual(machine.state, readiness.CREATED)
+        self.assertEqual(
+            self.transitions[-1], (readiness.KEY_ACCEPTED, True)
+        )
+        self.assertNotIn('state.highstate', client.calls)
+
+    @defer.inlineCallbacks
+    def test_probe_errors_fail_the_machine(self):
+        client = FakeClient()
+
+        def broken(*args, **kwargs):
+            raise RuntimeError('broken')
+        client.cmd_async = broken
+        yield self.assertFailure(self.machine(client).run(), RuntimeError)
+        self.assertEqual(
+            self.transitions[-1], (readiness.JOB_PUBLISHED, True)
+        )
+
+
+class EventCompletionTestCase(unittest.TestCase):
+
+    skip = SKIP_SALT
+
+    def setUp(self):
+        self.patch(readiness.workers, 'defer_to_thread', run_inline)
+        self.patch(events, '_READERS', {})
+        self.bus = events.LocalEventBus()
+        self.addCleanup(self._stop_readers)
+
+    def _stop_readers(self):
+        for reader in events._READERS.values():
+            reader.stop()
+
+    def machine(self, client, **kwargs):
+        return readiness.ProvisioningMachine(
+            client, 'vm1', completion='event',
+            event_factory=self.bus.subscribe, min_interval=0.001,
+            max_interval=0.01, **kwargs
+        )
+
+    @defer.inlineCallbacks
+    def test_return_event(self):
+        def publish(jid, minion):
+            self.bus.fire_job_return(jid, minion, {'state': {}})
+        client = FakeClient({'sock_dir': '/tmp'}, on_publish=publish,
+                            running=1000)
+        machine = self.machine(client)
+        returns = yield machine.run()
+        self.assertEqual(
+            returns, {'vm1': {'ret': {'state': {}}, 'retcode': 0}}
+        )
+        self.assertNotIn('get_full_returns', client.calls)
+        # Done with the watch
+        self.assertEqual(events._READERS.values()[0]._watches, {})
+
+    @defer.inlineCallbacks
+    def test_falls_back_to_polling(self):
+        # No return event, the minion is asked if the job is still running
+        client = FakeClient({'sock_dir': '/tmp'}, running=2)
+        machine = self.machine(client, event_fallback_interval=0.05)
+        returns = yield machine.run()
+        self.assertEqual(returns, {'vm1': {'ret': {}, 'retcode': 0}})
+        self.assertEqual(client.calls.count('saltutil.running'), 3)
+
+    @defer.inlineCallbacks
+    def test_subscription_failure_falls_back_to_polling(self):
+        def broken(opts):
+            raise IOError('no master')
+        client = FakeClient({'sock_dir': '/tmp'})
+        machine = readiness.ProvisioningMachine(
+            client, 'vm1', completion='event', event_factory=broken,
+            min_interval=0.001, max_interval=0.01
+        )
+        returns = yield machine.run()
+        self.assertEqual(returns, {'vm1': {'ret': {}, 'retcode': 0}})
+        self.assertIdentical(machine.watch, None)
+
+    @defer.inlineCallbacks
+    def test_failed_state_aborts_the_job(self):
+        def publish(jid, minion):
+            self.bus.fire_state_progress(
+                jid, minion, {'__id__': 'ok', 'result': True}, 2
+            )
+            self.bus.fire_state_progress(
+                jid, minion,
+                {'__id__': 'pkgs', '__run_num__': 1, 'result': False,
+                 'comment': 'broken'},
+                2
+            )
+        client = FakeClient({'sock_dir': '/tmp'}, on_publish=publish,
+                            running=1000)
+        machine = self.machine(
+            client, stream_states=True, abort_states=['pkg*']
+        )
+        yield self.assertFailure(
+            machine.run(), LatentBuildSlaveFailedToSubstantiate
+        )
+        self.assertEqual(machine.progress, 2)
+        self.assertIn('saltutil.kill_job', client.calls)
+
+
+class StateStreamingTestCase(unittest.TestCase):
+
+    skip = SKIP_SALT
+
+    def setUp(self):
+        self.patch(readiness.workers, 'defer_to_thread', run_inline)
+        self.patch(events, '_READERS', {})
+        self.bus = events.LocalEventBus()
+        self.addCleanup(
+            lambda: [reader.stop() for reader in events._READERS.values()]
+        )
+        self.jids = iter(range(100))
+
+    def publish(self, jid, minion):
+        states = [
+            {'__id__': 'base', '__sls__': 'core', 'result': True},
+            {'__id__': 'nginx', '__sls__': 'web', 'name': 'nginx-full',
+             'result': False, 'comment': 'broken'},
+            {'__id__': 'site', '__sls__': 'web', 'result': None}
+        ]
+        for idx, ret in enumerate(states):
+            ret['__run_num__'] = idx
+            self.bus.fire_state_progress(jid, minion, ret, len(states))
+        self.bus.fire_job_return(jid, minion, {})
+
+    @defer.inlineCallbacks
+    def stream(self, abort_states):
+        client = FakeClient(
+            {'sock_dir': '/tmp'}, on_publish=self.publish, running=1000,
+            jid=str(next(self.jids))
+        )
+        machine = readiness.ProvisioningMachine(
+            client, 'vm1', completion='event',
+            event_factory=self.bus.subscribe, min_interval=0.001,
+            max_interval=0.01, stream_states=True, abort_states=abort_states
+        )
+        try:
+            yield machine.run()
+        except LatentBuildSlaveFailedToSubstantiate:
+            defer.returnValue(('aborted', machine.progress))
+        defer.returnValue(('returned', machine.progress))
+
+    @defer.inlineCallbacks
+    def test_abort_on_any_failure(self):
+        result = yield self.stream(None)
+        self.assertEqual(result, ('aborted', 2))
+
+    @defer.inlineCallbacks
+    def test_never_abort(self):
+        result = yield self.stream([])
+        self.assertEqual(result, ('returned', 3))
+
+    @defer.inlineCallbacks
+    def test_abort_patterns(self):
+        # Matched by ID, name or SLS
+        for pattern in ('ngin?', 'nginx-*', 'web'):
+            result = yield self.stream([pattern])
+            self.assertEqual(result, ('aborted', 2), pattern)
+        result = yield self.stream(['db*', 'core'])
+        self.assertEqual(result, ('returned', 3))
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+'''
+    tests.test_reaper
+    ~~~~~~~~~~~~~~~~~
+
+    :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
+    :license: Apache 2.0, see LICENSE for more details.
+'''
+
+# Import python libs
+import os
+
+# Import twisted libs
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+# Import saltcloud_buildbot libs
+from saltcloud_buildbot import inventory, reaper
+from tests import run_inline
+
+
+class FakeDestroyer(object):
+
+    def __init__(self):
+        self.live = {}
+        self._destroying = {}
+        self.destroyed = []
+
+    def destroy(self, config, names, slavename=None):
+        self.destroyed.extend(names)
+        return defer.succeed(None)
+
+
+class MatchingNodesTestCase(unittest.TestCase):
+
+    def test_flat_and_nested_listings(self):
+        ret = {
+            'ec2': {
+                'slave01-buildbot-rnd0a1b': {'state': 'running'},
+                'web01': {'state': 'running'}
+            },
+            'linode': {
+                'linode': {
+                    'linux-buildbot-bake99ff': {'state': 'running'}
+                }
+            }
+        }
+        self.assertEqual(
+            reaper.matching_nodes(ret, reaper.DEFAULT_PATTERN),
+            {'slave01-buildbot-rnd0a1b': 'ec2',
+             'linux-buildbot-bake99ff': 'linode'}
+        )
+
+
+class ReaperTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.destroyer = FakeDestroyer()
+        self.nodes = {}
+        self.patch(reaper.workers, 'defer_to_thread', run_inline)
+        self.patch(reaper.teardown, 'get_destroyer', lambda: self.destroyer)
+        self.patch(reaper, 'list_nodes', lambda config: self.nodes)
+        self.patch(inventory, '_INVENTORIES', {})
+        self.reaper = reaper.Reaper(
+            lambda: {}, interval=60, grace=120, clock=self.clock
+        )
+        self.reaper.start(['slave01', 'linux'])
+        self.addCleanup(self.reaper.stop, ['slave01', 'linux'])
+
+    def list(self, *names):
+        self.nodes = {'ec2': dict((name, {}) for name in names)}
+
+    def test_unowned_vms_are_reaped_after_the_grace_period(self):
+        self.list('slave01-buildbot-rnd01', 'linux-buildbot-bake02')
+        self.clock.advance(60)
+        self.assertEqual(self.destroyer.destroyed, [])
+        self.clock.advance(120)
+        self.assertEqual(
+            self.destroyer.destroyed,
+            ['linux-buildbot-bake02', 'slave01-buildbot-rnd01']
+        )
+        self.assertEqual(self.reaper.reclaimed_per_provider, {'ec2': 2})
+
+    def test_other_masters_vms_are_left_alone(self):
+        self.list('slave02-buildbot-rnd01', 'windows-buildbot-rnd02')
+        self.clock.advance(600)
+        self.assertEqual(self.destroyer.destroyed, [])
+        self.assertEqual(self.reaper._seen, {})
+
+    def test_owned_vms_are_left_alone(self):
+        self.destroyer.live['slave01-buildbot-rnd01'] = (None, 'slave01')
+        self.destroyer._destroying['slave01-buildbot-rnd02'] = []
+        self.list('slave01-buildbot-rnd01', 'slave01-buildbot-rnd02')
+        self.clock.advance(600)
+        self.assertEqual(self.destroyer.destroyed, [])
+
+    def test_inventory_recorded_vms_are_left_alone(self):
+        path = self.mktemp()
+        os.makedirs(path)
+        recorded = inventory.get_inventory(os.path.join(path, 'vms.db'))
+        recorded.record(
+            'slave01-buildbot-rnd01', 'slave01', 'linux',
+            state=inventory.READY
+        )
+        self.list('slave01-buildbot-rnd01')
+        self.clock.advance(600)
+        self.assertEqual(self.destroyer.destroyed, [])
+
+    def test_owned_vms_past_max_age_are_reaped(self):
+        self.reaper.configure(max_age=300)
+        self.destroyer.live['slave01-buildbot-rnd01'] = (None, 'slave01')
+        self.list('slave01-buildbot-rnd01')
+        self.clock.advance(240)
+        self.assertEqual(self.destroyer.destroyed, [])
+        self.clock.advance(360)
+        self.assertEqual(
+            self.destroyer.destroyed, ['slave01-buildbot-rnd01']
+        )
+
+    def test_allocated_names_are_left_alone(self):
+        allocator = reaper.naming.NameAllocator()
+        self.patch(reaper.naming, '_ALLOCATOR', allocator)
+        vm_name = allocator.allocate('slave01')
+        self.list(vm_name)
+        self.clock.advance(600)
+        self.assertEqual(self.destroyer.destroyed, [])
+
+    def test_stopped_slaves_vms_are_left_alone(self):
+        self.reaper.start(['slave02'])
+        self.reaper.stop(['slave02'])
+        self.list('slave02-buildbot-rnd01')
+        self.clock.advance(600)
+        self.assertEqual(self.destroyer.destroyed, [])
+
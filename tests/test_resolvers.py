@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+'''
+    tests.test_resolvers
+    ~~~~~~~~~~~~~~~~~~~~
+
+    :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
+    :license: Apache 2.0, see LICENSE for more details.
+'''
+
+# Import python libs
+import time
+import threading
+
+# Import twisted libs
+from twisted.trial import unittest
+
+# Import saltcloud_buildbot libs
+from saltcloud_buildbot import resolvers
+
+
+class FakeResolver(object):
+
+    def __init__(self, address, name='fake', delay=0):
+        self.address = address
+        self.name = name
+        self.delay = delay
+        self.calls = 0
+
+    def __repr__(self):
+        return 'FakeResolver({0!r})'.format(self.name)
+
+    def resolve(self):
+        self.calls += 1
+        if self.delay:
+            time.sleep(self.delay)
+        if isinstance(self.address, Exception):
+            raise self.address
+        return self.address
+
+
+class IsPrivateAddressTestCase(unittest.TestCase):
+
+    def test_private(self):
+        for address in ('10.1.2.3', '127.0.0.1', '172.16.0.1',
+                        '172.31.255.255', '192.168.1.1', '169.254.169.254'):
+            self.assertTrue(resolvers.is_private_address(address), address)
+
+    def test_public(self):
+        for address in ('8.8.8.8', '172.32.0.1', '192.169.0.1', 'foo',
+                        '1.2.3', '::1'):
+            self.assertFalse(resolvers.is_private_address(address), address)
+
+
+class ResolverCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = resolvers.ResolverCache()
+
+    def test_first_address_wins(self):
+        broken = FakeResolver(IOError('unreachable'), 'broken')
+        empty = FakeResolver(None, 'empty')
+        found = FakeResolver('1.2.3.4', 'found')
+        unused = FakeResolver('5.6.7.8', 'unused')
+        self.assertEqual(
+            self.cache.resolve([broken, empty, found, unused], 60),
+            '1.2.3.4'
+        )
+        self.assertEqual(unused.calls, 0)
+
+    def test_nothing_found(self):
+        resolver = FakeResolver(None)
+        self.assertIdentical(self.cache.resolve([resolver], 60), None)
+        # Failures are cached, for failed_ttl seconds
+        self.cache.resolve([resolver], 60)
+        self.assertEqual(resolver.calls, 1)
+        for entry in self.cache._entries.values():
+            entry.failed_until = time.time() - 1
+        self.cache.resolve([resolver], 60)
+        self.assertEqual(resolver.calls, 2)
+
+    def test_failing_chain_is_tried_once_per_burst(self):
+        broken = FakeResolver(IOError('unreachable'), 'broken', delay=0.1)
+        timeout = FakeResolver(IOError('timed out'), 'timeout')
+        results = []
+        threads = [
+            threading.Thread(
+                target=lambda: results.append(
+                    self.cache.resolve([broken, timeout], 60)
+                )
+            ) for _ in range(5)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [None] * 5)
+        self.assertEqual((broken.calls, timeout.calls), (1, 1))
+
+    def test_found_after_failing(self):
+        resolver = FakeResolver(None)
+        self.cache.resolve([resolver], 60, failed_ttl=0)
+        resolver.address = '1.2.3.4'
+        self.assertEqual(self.cache.resolve([resolver], 60), '1.2.3.4')
+
+    def test_cached_until_expired(self):
+        resolver = FakeResolver('1.2.3.4')
+        self.cache.resolve([resolver], 60)
+        self.cache.resolve([resolver], 60)
+        self.assertEqual(resolver.calls, 1)
+        for entry in self.cache._entries.values():
+            entry.expires = time.time() - 1
+        self.cache.resolve([resolver], 60)
+        self.assertEqual(resolver.calls, 2)
+        self.cache.clear()
+        self.cache.resolve([resolver], 60)
+        self.assertEqual(resolver.calls, 3)
+
+    def test_keyed_by_chain(self):
+        first = FakeResolver('1.2.3.4', 'first')
+        second = FakeResolver('5.6.7.8', 'second')
+        self.assertEqual(self.cache.resolve([first], 60), '1.2.3.4')
+        self.assertEqual(self.cache.resolve([second], 60), '5.6.7.8')
+
+    def test_concurrent_lookups_are_shared(self):
+        resolver = FakeResolver('1.2.3.4', delay=0.1)
+        results = []
+        threads = [
+            threading.Thread(
+                target=lambda: results.append(
+                    self.cache.resolve([resolver], 60)
+                )
+            ) for _ in range(5)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, ['1.2.3.4'] * 5)
+        self.assertEqual(resolver.calls, 1)
+
+    def test_static_resolver(self):
+        self.assertEqual(
+            resolvers.resolve_master_address(
+                [resolvers.StaticResolver('salt.example.com')], ttl=0
+            ),
+            'salt.example.com'
+        )
@@ -0,0 +1,458 @@
+# -*- coding: utf-8 -*-
+'''
+    tests.test_slave
+    ~~~~~~~~~~~~~~~~
+
+    :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
+    :license: Apache 2.0, see LICENSE for more details.
+'''
+
+# Import python libs
+import os
+
+# Import twisted libs
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+# Import buildbot libs
+from buildbot.interfaces import LatentBuildSlaveFailedToSubstantiate
+
+# Import saltcloud_buildbot libs
+import saltcloud_buildbot.slave
+from saltcloud_buildbot import (
+    admission, config, history, images, inventory, keys, logsetup,
+    provision, teardown, workers
+)
+from tests import run_inline
+
+
+class FakeDestroyer(object):
+
+    def __init__(self):
+        self.live = {}
+        self.kept = set()
+        self._destroying = {}
+        self.destroyed = []
+
+    def track(self, vm_name, config_loader, slavename=None,
+              keep_on_shutdown=False):
+        self.live[vm_name] = (config_loader, slavename)
+        if keep_on_shutdown:
+            self.kept.add(vm_name)
+        else:
+            self.kept.discard(vm_name)
+
+    def destroy(self, config, names, slavename=None):
+        for vm_name in names:
+            self.live.pop(vm_name, None)
+            self.kept.discard(vm_name)
+        self.destroyed.extend(names)
+        return defer.succeed(list(names))
+
+    def forget(self, vm_name):
+        self.live.pop(vm_name, None)
+        self.kept.discard(vm_name)
+
+
+class FakeClient(object):
+
+    def __init__(self):
+        self.calls = []
+
+    def cmd(self, tgt, fun, arg=(), timeout=None, expr_form='glob'):
+        self.calls.append((fun, list(arg)))
+        return dict((name, True) for name in tgt)
+
+
+class FakeBotMaster(object):
+
+    def maybeStartBuildsForSlave(self, name):
+        pass
+
+
+class SlaveTestCase(unittest.TestCase):
+    '''
+    Run the slaves against fake salt-cloud and salt calls, recording the
+    VMs created and the states run.
+    '''
+
+    def setUp(self):
+        self.destroyer = FakeDestroyer()
+        self.client = FakeClient()
+        self.clock = task.Clock()
+        self.created = []
+        self.states = []
+        self.history_paths = []
+        self.cloud_config = {'profiles': {'linux': {}}}
+        self.patch(saltcloud_buildbot.slave, 'reactor', self.clock)
+        self.patch(workers, 'defer_to_thread', run_inline)
+        self.patch(teardown, 'get_destroyer', lambda **kw: self.destroyer)
+        self.patch(
+            config, 'load_cloud_config', lambda *args: self.cloud_config
+        )
+        self.patch(logsetup, 'setup_logging', lambda *args, **kwargs: None)
+        self.patch(
+            provision, 'build_minion_config',
+            lambda config, profile_name, slavename, password, **kwargs: {
+                'grains': {'buildbot': {'slavename': slavename,
+                                        'password': password}}
+            }
+        )
+        self.patch(
+            provision, 'get_local_client', lambda path: self.client
+        )
+        self.patch(
+            images, 'state_fingerprint', lambda *args, **kwargs: 'fprint'
+        )
+        self.patch(admission, 'create_admitted', self._create)
+        self.patch(provision, 'run_state', self._run_state)
+
+    def _create(self, config, profile_name, vm_name, create, *args,
+                **kwargs):
+        # The minion configuration, and the image if booting one
+        self.created.append((vm_name, args[3:]))
+        return defer.succeed({vm_name: {}})
+
+    def _run_state(self, config, master_config, vm_name, slavename=None,
+                   fun='state.highstate', arg=(), **kwargs):
+        self.states.append((vm_name, fun, list(arg)))
+        self.history_paths.append(kwargs.get('history_path', history.COLD))
+        return defer.succeed({vm_name: {'ret': {}}})
+
+    def slave(self, **kwargs):
+        slave = saltcloud_buildbot.slave.SaltCloudLatentBuildSlave(
+            'slave01', 'secret', 'linux', **kwargs
+        )
+        slave.botmaster = FakeBotMaster()
+        return slave
+
+
+class BakedImageTestCase(SlaveTestCase):
+
+    def setUp(self):
+        SlaveTestCase.setUp(self)
+        self.patch(images, '_BAKERS', {})
+        self.baked = []
+        self.image = 'ami-1'
+
+    def slave(self, **kwargs):
+        slave = SlaveTestCase.slave(
+            self, saltcloud_bake=True, saltcloud_bake_index=self.mktemp(),
+            **kwargs
+        )
+        baker = slave._saltcloud_baker
+        self.patch(
+            baker, 'lookup',
+            lambda *args: defer.succeed(('fprint', self.image))
+        )
+        self.patch(baker, 'bake', lambda *args: self.baked.append(args))
+        return slave
+
+    @defer.inlineCallbacks
+    def test_image_vms_are_highstated_by_default(self):
+        slave = self.slave()
+        yield slave.start_instance(None)
+        vm_name = slave.saltcloud_vm_name
+        self.assertEqual(self.created[0][1][1], 'ami-1')
+        # Rebinding the buildbot grains the image was baked without
+        self.assertEqual(self.states, [(vm_name, 'state.highstate', [])])
+        self.assertEqual(self.history_paths, [history.IMAGE])
+
+    @defer.inlineCallbacks
+    def test_image_vms_run_the_verify_state(self):
+        slave = self.slave(saltcloud_bake_verify_state='buildbot.rebind')
+        yield slave.start_instance(None)
+        self.assertEqual(
+            self.states,
+            [(slave.saltcloud_vm_name, 'state.sls', ['buildbot.rebind'])]
+        )
+
+    @defer.inlineCallbacks
+    def test_no_image_yet(self):
+        self.image = None
+        slave = self.slave()
+        yield slave.start_instance(None)
+        self.assertEqual(len(self.baked), 1)
+        self.assertEqual(len(self.created[0][1]), 1)
+        self.assertEqual(
+            self.states, [(slave.saltcloud_vm_name, 'state.highstate', [])]
+        )
+        self.assertEqual(self.history_paths, [history.COLD])
+
+
+class InventoryTestCase(SlaveTestCase):
+
+    def setUp(self):
+        SlaveTestCase.setUp(self)
+        self.patch(inventory, '_INVENTORIES', {})
+        self.path = self.mktemp()
+        self.inventory = inventory.get_inventory(self.path)
+
+    def slave(self, **kwargs):
+        return SlaveTestCase.slave(self, saltcloud_inventory=self.path,
+                                   **kwargs)
+
+    @defer.inlineCallbacks
+    def test_ready_vms_are_recorded(self):
+        slave = self.slave()
+        yield slave.start_instance(None)
+        record = self.inventory.get(slave.saltcloud_vm_name)
+        self.assertEqual(record['state'], inventory.READY)
+        self.assertEqual(record['slavename'], 'slave01')
+        self.assertEqual(record['fingerprint'], 'fprint')
+        self.assertIn(slave.saltcloud_vm_name, self.destroyer.kept)
+
+    @defer.inlineCallbacks
+    def test_stopped_vms_are_destroyed(self):
+        slave = self.slave()
+        yield slave.start_instance(None)
+        vm_name = slave.saltcloud_vm_name
+        yield slave.stop_instance()
+        self.assertEqual(self.destroyer.destroyed, [vm_name])
+        self.assertIdentical(self.inventory.get(vm_name), None)
+
+    @defer.inlineCallbacks
+    def test_vms_are_kept_when_the_master_stops(self):
+        for stopping, fast in ((True, False), (False, True)):
+            slave = self.slave()
+            yield slave.start_instance(None)
+            vm_name = slave.saltcloud_vm_name
+            slave._saltcloud_stopping = stopping
+            yield slave.stop_instance(fast)
+            self.assertEqual(self.destroyer.destroyed, [])
+            self.assertNotIn(vm_name, self.destroyer.live)
+            self.assertEqual(
+                self.inventory.get(vm_name)['state'], inventory.READY
+            )
+
+    @defer.inlineCallbacks
+    def test_single_build_vms_are_not_kept(self):
+        slave = self.slave(single_build=True)
+        yield slave.start_instance(None)
+        slave._saltcloud_stopping = True
+        yield slave.stop_instance(True)
+        self.assertEqual(
+            self.destroyer.destroyed, [slave.saltcloud_vm_name]
+        )
+
+    @defer.inlineCallbacks
+    def test_reattach(self):
+        first = self.slave()
+        yield first.start_instance(None)
+        vm_name = first.saltcloud_vm_name
+        first._saltcloud_stopping = True
+        yield first.stop_instance()
+
+        second = self.slave()
+        yield second._SaltCloudLatentBuildSlave__load_inventory()
+        yield second.start_instance(None)
+        self.assertEqual(second.saltcloud_vm_name, vm_name)
+        # Not provisioned again
+        self.assertEqual(len(self.created), 1)
+        self.assertIn(
+            ('grains.setval',
+             ['buildbot', {'slavename': 'slave01', 'password': 'secret'}]),
+            self.client.calls
+        )
+
+    @defer.inlineCallbacks
+    def test_changed_state_tree_is_not_reattached(self):
+        first = self.slave()
+        yield first.start_instance(None)
+        vm_name = first.saltcloud_vm_name
+        first._saltcloud_stopping = True
+        yield first.stop_instance()
+
+        self.patch(
+            images, 'state_fingerprint', lambda *args, **kwargs: 'changed'
+        )
+        second = self.slave()
+        yield second._SaltCloudLatentBuildSlave__load_inventory()
+        yield second.start_instance(None)
+        self.assertNotEqual(second.saltcloud_vm_name, vm_name)
+        self.assertEqual(self.destroyer.destroyed, [vm_name])
+
+
+class SubstantiationHistoryTestCase(SlaveTestCase):
+
+    def setUp(self):
+        SlaveTestCase.setUp(self)
+        self.patch(inventory, '_INVENTORIES', {})
+        self.path = self.mktemp()
+        self.patch(history, '_HISTORY', history.History())
+        # Substantiated once the instance is started
+        self.patch(
+            saltcloud_buildbot.slave.AbstractLatentBuildSlave, 'substantiate',
+            lambda slave, sb, build: slave.start_instance(build).addCallback(
+                lambda _: True
+            )
+        )
+
+    def slave(self, **kwargs):
+        return SlaveTestCase.slave(self, saltcloud_inventory=self.path,
+                                   **kwargs)
+
+    def substantiations(self):
+        return history.get_history().samples(
+            'linux', history.SUBSTANTIATION
+        )
+
+    @defer.inlineCallbacks
+    def test_only_cold_creates_are_recorded(self):
+        first = self.slave()
+        yield first.substantiate(None, None)
+        self.assertEqual(self.substantiations(), [0])
+        first._saltcloud_stopping = True
+        yield first.stop_instance()
+
+        second = self.slave()
+        yield second._SaltCloudLatentBuildSlave__load_inventory()
+        yield second.substantiate(None, None)
+        self.assertEqual(second.saltcloud_vm_name, first.saltcloud_vm_name)
+        self.assertEqual(self.substantiations(), [0])
+
+
+class FakeBot(object):
+    '''
+    A buildslave connection from ``host``.
+    '''
+
+    def __init__(self, host):
+        self.host = host
+        self.broker = self
+        self.transport = self
+
+    def getPeer(self):
+        return self
+
+    def __repr__(self):
+        return 'FakeBot({0!r})'.format(self.host)
+
+
+class RetiringTestCase(SlaveTestCase):
+
+    def setUp(self):
+        SlaveTestCase.setUp(self)
+        self.destroying = defer.Deferred()
+        self.patch(
+            self.destroyer, 'destroy',
+            lambda config, names, slavename=None: self.destroying
+        )
+        self.patch(
+            saltcloud_buildbot.slave.AbstractLatentBuildSlave, 'attached',
+            lambda slave, bot: defer.succeed(slave)
+        )
+        self.disconnected = []
+
+    def slave(self, **kwargs):
+        slave = SlaveTestCase.slave(self, **kwargs)
+        self.patch(slave, '_disconnect', self.disconnected.append)
+        return slave
+
+    @defer.inlineCallbacks
+    def test_overlaps_destroy_by_default(self):
+        slave = self.slave()
+        yield slave.start_instance(None)
+        vm_name = slave.saltcloud_vm_name
+        yield slave.stop_instance()
+        self.assertEqual(slave._saltcloud_retiring, set([vm_name]))
+        yield slave.start_instance(None)
+        self.assertNotEqual(slave.saltcloud_vm_name, vm_name)
+        self.destroying.callback([vm_name])
+        self.assertEqual(slave._saltcloud_retiring, set())
+
+    @defer.inlineCallbacks
+    def test_waits_for_destroy(self):
+        slave = self.slave(saltcloud_wait_for_destroy=True)
+        yield slave.start_instance(None)
+        stopping = slave.stop_instance()
+        self.assertNoResult(stopping)
+        self.destroying.callback([slave.saltcloud_vm_name])
+        result = yield stopping
+        self.assertTrue(result)
+
+    @defer.inlineCallbacks
+    def test_retiring_vms_buildslaves_are_refused(self):
+        slave = self.slave()
+        yield slave.start_instance(None)
+        vm_name = slave.saltcloud_vm_name
+        yield slave.attached(FakeBot('10.0.0.1'))
+        yield slave.stop_instance()
+        yield slave.start_instance(None)
+        # The old VM's buildslave reconnecting
+        old = FakeBot('10.0.0.1')
+        yield self.assertFailure(slave.attached(old), RuntimeError)
+        self.assertEqual(self.disconnected, [old])
+        # The new VM's is accepted
+        yield slave.attached(FakeBot('10.0.0.2'))
+        self.assertEqual(self.disconnected, [old])
+        self.assertEqual(
+            slave._saltcloud_vm_hosts,
+            {vm_name: '10.0.0.1', slave.saltcloud_vm_name: '10.0.0.2'}
+        )
+        self.destroying.callback([vm_name])
+        self.assertEqual(
+            slave._saltcloud_vm_hosts,
+            {slave.saltcloud_vm_name: '10.0.0.2'}
+        )
+
+    @defer.inlineCallbacks
+    def test_unknown_hosts_are_refused_while_retiring(self):
+        slave = self.slave()
+        # Its buildslave never connected
+        yield slave.start_instance(None)
+        vm_name = slave.saltcloud_vm_name
+        yield slave.stop_instance()
+        yield slave.start_instance(None)
+        yield self.assertFailure(
+            slave.attached(FakeBot('10.0.0.2')), RuntimeError
+        )
+        self.destroying.callback([vm_name])
+        yield slave.attached(FakeBot('10.0.0.2'))
+        self.assertEqual(len(self.disconnected), 1)
+
+
+class SeededKeysTestCase(SlaveTestCase):
+
+    def setUp(self):
+        SlaveTestCase.setUp(self)
+        self.pki_dir = self.mktemp()
+        self.cloud_config['pki_dir'] = self.pki_dir
+        self.patch(provision, 'deploys', lambda config, profile_name: True)
+        self.failing = False
+
+    def _create(self, config, profile_name, vm_name, create, *args,
+                **kwargs):
+        if self.failing:
+            return defer.fail(RuntimeError('quota exceeded'))
+        return SlaveTestCase._create(
+            self, config, profile_name, vm_name, create, *args, **kwargs
+        )
+
+    def slave(self, **kwargs):
+        slave = SlaveTestCase.slave(self, **kwargs)
+        slave._saltcloud_keys = keys.KeyPool(
+            generator=lambda keysize: ('PRIVATE', 'PUBLIC')
+        )
+        slave._saltcloud_keys.refill()
+        return slave
+
+    def seeded(self):
+        dirname = os.path.join(self.pki_dir, 'minions')
+        return os.path.isdir(dirname) and os.listdir(dirname) or []
+
+    @defer.inlineCallbacks
+    def test_seeded(self):
+        slave = self.slave()
+        yield slave.start_instance(None)
+        self.assertEqual(self.seeded(), [slave.saltcloud_vm_name])
+
+    @defer.inlineCallbacks
+    def test_removed_when_the_create_fails(self):
+        self.failing = True
+        slave = self.slave()
+        yield self.assertFailure(
+            slave.start_instance(None), LatentBuildSlaveFailedToSubstantiate
+        )
+        self.assertEqual(self.seeded(), [])
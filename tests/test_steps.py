@@ -0,0 +1,390 @@
+# -*- coding: utf-8 -*-
+'''
+    tests.test_steps
+    ~~~~~~~~~~~~~~~~
+
+    :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
+    :license: Apache 2.0, see LICENSE for more details.
+'''
+
+# Import python libs
+import os
+import sys
+import json
+import threading
+import subprocess
+from collections import OrderedDict
+
+# Import twisted libs
+from twisted.internet import defer
+from twisted.trial import unittest
+
+# Import buildbot libs
+from buildbot.status.results import SUCCESS, FAILURE
+
+# Import saltcloud_buildbot libs
+from saltcloud_buildbot import events, provision, steps, workers
+from tests import run_inline
+from tests.test_events import wait_until
+
+
+STATES = [
+    ('pkg_|-git_|-git_|-installed', {
+        '__id__': 'git', '__sls__': 'git', '__run_num__': 0,
+        'result': True, 'changes': {'git': {'new': '1.8'}},
+        'comment': 'Installed "git" {ok}', 'duration': 1200.5
+    }),
+    ('file_|-conf_|-/etc/conf_|-managed', {
+        '__id__': 'conf', '__sls__': 'conf', '__run_num__': 1,
+        'result': False, 'changes': {}, 'comment': 'Source file not found',
+        'duration': '30 ms'
+    })
+]
+
+
+def json_output(states):
+    return json.dumps({'local': OrderedDict(states)}, indent=4)
+
+
+class FakeCommand(object):
+
+    def __init__(self, rc=0):
+        self.rc = rc
+
+    def results(self):
+        return self.rc and FAILURE or SUCCESS
+
+
+class StateStreamParserTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.parsed = []
+        self.parser = steps.StateStreamParser(
+            lambda key, ret: self.parsed.append((key, ret))
+        )
+
+    def test_states_parsed_as_they_complete(self):
+        output = json_output(STATES)
+        # The first state's return is complete before the output is
+        first_end = output.rindex('}', 0, output.index(STATES[1][0]))
+        self.parser.feed(output[:first_end])
+        self.assertEqual(self.parsed, [])
+        self.parser.feed(output[first_end:first_end + 1])
+        self.assertEqual(len(self.parsed), 1)
+        self.parser.feed(output[first_end + 1:])
+        self.assertEqual(sorted(self.parsed), sorted(STATES))
+
+    def test_one_character_at_a_time(self):
+        for char in json_output(STATES):
+            self.parser.feed(char)
+        self.assertEqual(sorted(self.parsed), sorted(STATES))
+
+    def test_text_before_the_output_is_ignored(self):
+        self.parser.feed(
+            '[WARNING ] Deprecated "option" {0}\n' + json_output(STATES[:1])
+        )
+        self.assertEqual(self.parsed, STATES[:1])
+
+    def test_non_state_returns_are_ignored(self):
+        self.parser.feed(json.dumps({'local': ['Rendering failed']}))
+        self.parser.feed(json.dumps({'local': {'error': 'failed'}}))
+        self.assertEqual(self.parsed, [])
+
+
+class StateSummaryTestCase(unittest.TestCase):
+
+    def test_state_duration(self):
+        self.assertEqual(steps.state_duration({'duration': 12.5}), 12.5)
+        self.assertEqual(steps.state_duration({'duration': '30 ms'}), 30.0)
+        self.assertIdentical(steps.state_duration({}), None)
+        self.assertIdentical(steps.state_duration({'duration': ''}), None)
+
+    def test_state_summary(self):
+        key, ret = STATES[1]
+        self.assertEqual(steps.state_summary(key, ret), {
+            'key': key,
+            'id': 'conf',
+            'sls': 'conf',
+            'result': False,
+            'comment': 'Source file not found',
+            'changes': False,
+            'duration': 30.0,
+            'run_num': 1
+        })
+
+    def test_format_states(self):
+        states = [steps.state_summary(key, ret) for key, ret in STATES]
+        self.assertEqual(
+            steps.format_states(states, slowest=1).splitlines(),
+            ['OK         1200 ms git (changed): Installed "git" {ok}',
+             'FAILED       30 ms conf: Source file not found',
+             '',
+             'Slowest states:',
+             '      1200 ms git']
+        )
+
+
+class SaltCallCommandTestCase(unittest.TestCase):
+
+    def test_command(self):
+        step = steps.SaltCallCommand(
+            'state.highstate -l debug', sudo_required=True
+        )
+        self.assertEqual(
+            step.command,
+            ['sudo', 'salt-call', 'state.highstate', '-l', 'debug']
+        )
+        step = steps.SaltCallCommand(
+            ['state.highstate'], json_results=True
+        )
+        self.assertEqual(
+            step.command, ['salt-call', '--out=json', 'state.highstate']
+        )
+
+    def test_failed_states_fail_the_step(self):
+        step = steps.SaltCallCommand('state.highstate', json_results=True)
+        for key, ret in STATES:
+            step.addStateResult(key, ret)
+        self.assertEqual(
+            [state['id'] for state in step.failedStates()], ['conf']
+        )
+        self.assertEqual(step.evaluateCommand(FakeCommand(0)), FAILURE)
+
+    def test_success(self):
+        step = steps.SaltCallCommand('state.highstate', json_results=True)
+        step.addStateResult(*STATES[0])
+        self.assertEqual(step.evaluateCommand(FakeCommand(0)), SUCCESS)
+
+
+# A salt-call replacement, where the top SLS only includes the git one
+FAKE_SALT_CALL = r'''
+import sys, json
+git = {
+    'pkg_|-git_|-git_|-installed': {
+        '__id__': 'git', '__sls__': 'git', 'result': True, 'changes': {}
+    }
+}
+# The same, rendered or applied
+print(json.dumps({'local': git}))
+'''
+
+
+class SaltTemplatesCommandTestCase(unittest.TestCase):
+
+    def test_sls_results(self):
+        step = steps.SaltTemplatesCommand('git.sls, conf, top, cached')
+        self.assertEqual(step.state_names, ['git', 'conf', 'top', 'cached'])
+        for key, ret in STATES:
+            step.addStateResult(key, ret)
+        step.skipped.append('cached')
+        step.includes.append('top')
+        results = step.slsResults()
+        self.assertEqual(results['git']['result'], 'success')
+        self.assertEqual(results['git']['changed'], 1)
+        self.assertEqual(results['conf']['result'], 'failure')
+        self.assertEqual(results['top'], {'result': 'include'})
+        self.assertEqual(results['cached'], {'result': 'skipped'})
+        self.assertEqual(step.evaluateCommand(FakeCommand(0)), FAILURE)
+
+    def test_missing_sls_fails(self):
+        step = steps.SaltTemplatesCommand(['git', 'top'])
+        step.addStateResult(*STATES[0])
+        self.assertEqual(step.slsResults()['top']['result'], 'missing')
+        self.assertEqual(step.evaluateCommand(FakeCommand(0)), FAILURE)
+        step.includes.append('top')
+        self.assertEqual(step.evaluateCommand(FakeCommand(0)), SUCCESS)
+
+    def test_sls_lists_observer(self):
+        step = steps.SaltTemplatesCommand(['git', 'top', 'conf'])
+        observer = steps.SlsListsObserver(step)
+        observer.outLineReceived(steps.SKIPPED_PREFIX + 'git, conf')
+        observer.outLineReceived(steps.INCLUDES_PREFIX + 'top')
+        observer.outLineReceived('{"local": {}}')
+        self.assertEqual(step.skipped, ['git', 'conf'])
+        self.assertEqual(step.includes, ['top'])
+
+
+class StatesDriverTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.root = self.mktemp()
+        os.makedirs(self.root)
+        self.salt_call = os.path.join(self.root, 'salt-call.py')
+        with open(self.salt_call, 'w') as wfh:
+            wfh.write(FAKE_SALT_CALL)
+        self.fingerprints = os.path.join(self.root, 'fp', 'sls.json')
+
+    def run_driver(self, names):
+        proc = subprocess.Popen(
+            [sys.executable, '-c', steps.STATES_DRIVER, self.fingerprints,
+             '1', ','.join(names), sys.executable, self.salt_call],
+            stdout=subprocess.PIPE
+        )
+        output = proc.communicate()[0]
+        return proc.returncode, output.decode('utf-8').splitlines()
+
+    def test_include_only_sls(self):
+        retcode, lines = self.run_driver(['top', 'git'])
+        self.assertEqual(retcode, 0)
+        self.assertEqual(lines[-1], steps.INCLUDES_PREFIX + 'top')
+        with open(self.fingerprints) as rfh:
+            self.assertEqual(sorted(json.load(rfh)), ['git', 'top'])
+
+        # Unchanged since, both skipped
+        retcode, lines = self.run_driver(['top', 'git'])
+        self.assertEqual(retcode, 0)
+        self.assertEqual(lines, [steps.SKIPPED_PREFIX + 'top, git'])
+
+
+class FakeLog(object):
+
+    def __init__(self):
+        self.text = []
+
+    def addHeader(self, text):
+        self.text.append(text)
+
+    addStdout = addStderr = addHeader
+
+
+class FakeStepStatus(object):
+
+    def setText(self, text):
+        self.text = text
+
+
+class MasterClient(object):
+
+    def __init__(self, on_publish=None):
+        self.opts = {'sock_dir': '/tmp'}
+        self.on_publish = on_publish
+        self.calls = []
+
+    def cmd(self, tgt, fun, arg=(), timeout=None, expr_form='glob'):
+        self.calls.append((fun, list(arg)))
+        return dict((name, True) for name in tgt)
+
+    def cmd_async(self, tgt, fun, arg=(), expr_form='glob', kwarg=None):
+        self.calls.append((fun, list(arg)))
+        if self.on_publish is not None:
+            self.on_publish('20130101', tgt[0])
+        return '20130101'
+
+
+class SharedLocalClientTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.patch(provision, '_LOCAL_CLIENTS', threading.local())
+        self.patch(
+            provision, 'get_local_client', lambda path: MasterClient()
+        )
+
+    def test_one_client_per_thread(self):
+        client = provision.get_shared_local_client('/etc/salt/master')
+        self.assertIdentical(
+            provision.get_shared_local_client('/etc/salt/master'), client
+        )
+        self.assertNotIdentical(
+            provision.get_shared_local_client('/srv/master'), client
+        )
+        other = []
+        thread = threading.Thread(
+            target=lambda: other.append(
+                provision.get_shared_local_client('/etc/salt/master')
+            )
+        )
+        thread.start()
+        thread.join()
+        self.assertNotIdentical(other[0], client)
+
+
+class SaltMasterCommandTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.bus = events.LocalEventBus()
+        self.reader = events.EventReader(
+            {'sock_dir': '/tmp'}, self.bus.subscribe, linger=0
+        )
+        self.reader.event_wait = 0.05
+        self.addCleanup(self.reader.stop)
+        self.patch(events, 'get_reader', lambda opts: self.reader)
+        self.patch(workers, 'defer_to_thread', run_inline)
+        self.client = MasterClient()
+        self.patch(
+            provision, 'get_shared_local_client', lambda path: self.client
+        )
+        self.step = steps.SaltMasterCommand()
+        self.step.setStepStatus(FakeStepStatus())
+        self.step.properties = {'slavename': 'slave01'}
+        self.step.getProperty = \
+            lambda name, default=None: self.step.properties.get(name, default)
+        self.step.setProperty = \
+            lambda name, value, source: self.step.properties.update(
+                {name: value}
+            )
+        self.logs = {}
+        self.step.addLog = lambda name: self.logs.setdefault(name, FakeLog())
+        self.step.addCompleteLog = \
+            lambda name, text: self.logs.setdefault(name, text)
+        self.results = defer.Deferred()
+        self.step.finished = self.results.callback
+        self.step.failed = self.results.errback
+
+    @defer.inlineCallbacks
+    def test_state_run(self):
+        def publish(jid, minion):
+            self.bus.fire_job_return(jid, minion, dict(STATES[:1]))
+        self.client.on_publish = publish
+        self.step.start()
+        result = yield self.results
+        self.assertEqual(result, SUCCESS)
+        self.assertEqual(self.client.calls[0], ('test.ping', []))
+        self.assertEqual(
+            [state['id'] for state in self.step.properties['salt_states']],
+            ['git']
+        )
+        self.assertEqual(self.step.properties['salt_failed_states'], [])
+
+    @defer.inlineCallbacks
+    def test_failed_states(self):
+        def publish(jid, minion):
+            self.bus.fire_job_return(jid, minion, dict(STATES))
+        self.client.on_publish = publish
+        self.step.start()
+        result = yield self.results
+        self.assertEqual(result, FAILURE)
+        self.assertEqual(
+            self.step.properties['salt_failed_states'], ['conf']
+        )
+
+    @defer.inlineCallbacks
+    def test_interrupt_kills_the_job(self):
+        self.step.start()
+        yield wait_until(lambda: self.step._jid is not None)
+        self.step.interrupt('Build stopped')
+        result = yield self.results
+        self.assertEqual(result, FAILURE)
+        self.assertIn(
+            ('saltutil.kill_job', ['20130101']), self.client.calls
+        )
+        self.assertIn('interrupted', self.step.step_status.text)
+        self.assertEqual(self.reader._watches, {})
+
+    @defer.inlineCallbacks
+    def test_timeout_kills_the_job(self):
+        self.step.timeout = 0.1
+        self.step.start()
+        result = yield self.results
+        self.assertEqual(result, FAILURE)
+        self.assertIn(
+            ('saltutil.kill_job', ['20130101']), self.client.calls
+        )
+        self.assertIn('within 0.1 seconds', ''.join(self.logs['stdio'].text))
+
+    @defer.inlineCallbacks
+    def test_no_minion(self):
+        self.client.cmd = lambda *args, **kwargs: {}
+        self.step.start()
+        result = yield self.results
+        self.assertEqual(result, FAILURE)
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+'''
+    tests.test_teardown
+    ~~~~~~~~~~~~~~~~~~~
+
+    :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
+    :license: Apache 2.0, see LICENSE for more details.
+'''
+
+# Import python libs
+import json
+
+# Import twisted libs
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+# Import saltcloud_buildbot libs
+from saltcloud_buildbot import teardown
+from tests import run_inline
+
+
+class FailedDestroyTestCase(unittest.TestCase):
+
+    def test_failed_destroy(self):
+        self.assertIdentical(
+            teardown.failed_destroy({'ec2': {'vm1': True}}, 'vm1'), None
+        )
+        # Not found, already gone
+        self.assertIdentical(teardown.failed_destroy({}, 'vm1'), None)
+        self.assertEqual(
+            teardown.failed_destroy({'vm1': False}, 'vm1'),
+            'salt-cloud returned False'
+        )
+        self.assertEqual(
+            teardown.failed_destroy({'vm1': {'Error': 'denied'}}, 'vm1'),
+            'denied'
+        )
+
+
+class DestroyerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.report = self.mktemp()
+        self.destroyer = teardown.Destroyer(
+            window=1, max_size=3, max_parallel=1, deadline=30,
+            shutdown_deadline=10, report_path=self.report, clock=self.clock
+        )
+        self.calls = []
+        self.returns = {}
+        self.patch(teardown.workers, 'defer_to_thread', run_inline)
+        self.patch(teardown.provision, 'destroy_vms', self._destroy_vms)
+
+    def _destroy_vms(self, config, names):
+        self.calls.append(list(names))
+        if self.returns.get(names[0], None) is not None:
+            return self.returns[names[0]]
+        return dict((name, True) for name in names)
+
+    def test_coalesced(self):
+        config = {}
+        for vm_name in ('vm1', 'vm2'):
+            self.destroyer.track(vm_name, lambda: config)
+        first = self.destroyer.destroy(config, ['vm1'])
+        second = self.destroyer.destroy(config, ['vm2', 'vm1'])
+        self.assertEqual(self.calls, [])
+        self.clock.advance(1)
+        self.assertEqual(self.calls, [['vm1', 'vm2']])
+        self.assertEqual(self.successResultOf(first), ['vm1'])
+        self.assertEqual(self.successResultOf(second), ['vm2', 'vm1'])
+        self.assertEqual(self.destroyer.live, {})
+
+    def test_max_size(self):
+        config = {}
+        self.destroyer.destroy(config, ['vm1', 'vm2', 'vm3', 'vm4'])
+        self.assertEqual(self.calls, [['vm1', 'vm2', 'vm3']])
+        self.clock.advance(1)
+        self.assertEqual(self.calls[-1], ['vm4'])
+
+    def test_bounded_parallelism(self):
+        self.destroyer.window = 0
+        self.returns['vm1'] = defer.Deferred()
+        first = self.destroyer.destroy({}, ['vm1'])
+        second = self.destroyer.destroy({}, ['vm2'])
+        self.assertEqual(self.calls, [['vm1']])
+        self.returns.pop('vm1').callback({'vm1': True})
+        self.assertEqual(self.calls, [['vm1'], ['vm2']])
+        self.successResultOf(first)
+        self.successResultOf(second)
+
+    def test_failures_are_reported(self):
+        self.destroyer.window = 0
+        self.destroyer.track('vm1', dict, 'slave01')
+        self.returns['vm1'] = {'vm1': {'Error': 'denied'}}
+        d = self.destroyer.destroy({}, ['vm1'])
+        self.failureResultOf(d, teardown.DestroyFailed)
+        # Still live, it didn't die
+        self.assertIn('vm1', self.destroyer.live)
+        with open(self.report) as rfh:
+            report = json.load(rfh)
+        self.assertEqual(report['vm1']['slavename'], 'slave01')
+        self.assertEqual(report['vm1']['reason'], 'denied')
+
+    def test_deadline(self):
+        self.destroyer.window = 0
+        self.returns['vm1'] = defer.Deferred()
+        d = self.destroyer.destroy({}, ['vm1'])
+        self.clock.advance(30)
+        self.failureResultOf(d, teardown.DestroyFailed)
+        self.assertIn('vm1', self.destroyer.failed)
+
+    def test_shutdown(self):
+        config = {}
+        for vm_name in ('vm1', 'vm2'):
+            self.destroyer.track(vm_name, lambda: config, 'slave01')
+        self.destroyer.track('vm3', lambda: config, keep_on_shutdown=True)
+        d = self.destroyer.shutdown()
+        self.successResultOf(d)
+        self.assertEqual(sorted(sum(self.calls, [])), ['vm1', 'vm2'])
+        self.assertEqual(self.destroyer.live.keys(), ['vm3'])
+        self.assertEqual(self.destroyer.failed, {})
+
+    def test_shutdown_deadline(self):
+        self.returns['vm1'] = defer.Deferred()
+        self.destroyer.track('vm1', dict, 'slave01')
+        d = self.destroyer.shutdown()
+        self.assertNoResult(d)
+        self.clock.advance(10)
+        self.successResultOf(d)
+        self.assertIn('vm1', self.destroyer.failed)